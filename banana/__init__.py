@@ -23,17 +23,39 @@ import os
 # Should be set explicitly in all FSL interfaces, but this squashes the warning
 os.environ['FSLOUTPUTTYPE'] = 'NIFTI_GZ'
 
-# Import all objects from Arcana used to design and apply Banana studies
-from arcana import (  # @IgnorePep8
-    SubStudySpec, Parameter, ParamSpec, SwitchSpec, FileFormat, Fileset,
-    FilesetSpec, InputFilesets, InputFilesetSpec, FilesetCollection, Field,
-    FieldSpec, InputFields, InputFieldSpec, FieldCollection, SingleProc,
-    MultiProc, SlurmProc, StaticEnv,
-    ModulesEnv, BasicRepo, XnatRepo)
-
-from .bids_ import BidsRepo  # @IgnorePep8
-
-
-# Import all Study classes into package root
-from .study.base import (  # @IgnorePep8
-    Study, StudyMetaClass, MultiStudy, MultiStudyMetaClass)
+# The objects used to design and apply Banana studies are loaded from the
+# modules that define them on first access (PEP 562), so that importing a
+# light-weight submodule (e.g. for the command-line tool) doesn't pull in
+# Arcana, Nipype and PyBIDS
+_LAZY_ATTRS = {
+    'arcana': (
+        'SubStudySpec', 'Parameter', 'ParamSpec', 'SwitchSpec', 'FileFormat',
+        'Fileset', 'FilesetSpec', 'InputFilesets', 'InputFilesetSpec',
+        'FilesetCollection', 'Field', 'FieldSpec', 'InputFields',
+        'InputFieldSpec', 'FieldCollection', 'SingleProc', 'MultiProc',
+        'StaticEnv', 'ModulesEnv', 'BasicRepo', 'XnatRepo'),
+    'banana.bids_': ('BidsRepo',),
+    'banana.processor': ('SlurmProc',),
+    'banana.study.base': (
+        'Study', 'StudyMetaClass', 'MultiStudy', 'MultiStudyMetaClass')}
+
+_LAZY_MODULES = {name: mod for mod, names in _LAZY_ATTRS.items()
+                 for name in names}
+
+__all__ = ['__version__', '__authors__'] + sorted(_LAZY_MODULES)
+
+
+def __getattr__(name):
+    try:
+        module_name = _LAZY_MODULES[name]
+    except KeyError:
+        raise AttributeError(
+            "module '{}' has no attribute '{}'".format(__name__, name))
+    from importlib import import_module
+    value = getattr(import_module(module_name), name)
+    globals()[name] = value  # Skip __getattr__ on subsequent accesses
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_MODULES))
@@ -1,23 +1,19 @@
 import sys
 import os.path as op
 import os
-from argparse import ArgumentParser
+from argparse import ArgumentParser, _AppendAction
 from importlib import import_module
-from setuptools import find_packages
-from pkgutil import iter_modules
 from multiprocessing import cpu_count
-from arcana.utils import parse_value
-from banana.utils.testing import PipelineTester
-from banana.exceptions import BananaUsageError
-from banana import (
-    InputFilesets, InputFields, MultiProc, SingleProc, SlurmProc, StaticEnv,
-    ModulesEnv, BasicRepo, BidsRepo, XnatRepo, Study)
 import logging
 from banana.__about__ import __version__
+from banana.utils.registry import (
+    DEFAULT_STUDY_CLASS_PATH, study_classes, find_study_class)
 
-logger = logging.getLogger('banana')
+# NB: Arcana, Nipype and the other heavy dependencies are imported within the
+# commands that need them so that the light-weight commands (e.g. 'help' and
+# 'avail') start quickly
 
-DEFAULT_STUDY_CLASS_PATH = 'banana.study'
+logger = logging.getLogger('banana')
 
 
 def set_loggers(loggers):
@@ -35,15 +31,21 @@ def set_loggers(loggers):
 
 
 def resolve_class(class_str, prefixes=(DEFAULT_STUDY_CLASS_PATH,)):
+    from banana.exceptions import BananaUsageError
     parts = class_str.split('.')
     module_name = '.'.join(parts[:-1])
     class_name = parts[-1]
+    if not module_name:
+        # Only import the module that defines the class instead of the whole
+        # package, looking it up in the Study class registry
+        found = find_study_class(class_name, prefixes)
+        if found is not None:
+            module_name, prefixes = found, ()
     cls = None
     for prefix in [''] + list(prefixes):
-        mod_name = prefix + module_name
+        mod_name = '.'.join(p for p in (prefix, module_name) if p)
         if not mod_name:
             continue
-        mod_name = mod_name.strip('.')
         try:
             module = import_module(mod_name)
         except ModuleNotFoundError:
@@ -61,6 +63,50 @@ def resolve_class(class_str, prefixes=(DEFAULT_STUDY_CLASS_PATH,)):
     return cls
 
 
+def args_to_argv(parser, args, **overrides):
+    """
+    Reconstructs the command-line arguments that the parser would parse into
+    the given namespace, with the values of some of them replaced
+
+    Parameters
+    ----------
+    parser : ArgumentParser
+        The parser of the command
+    args : Namespace
+        The parsed arguments
+    **overrides
+        Values to replace in the namespace, keyed by their 'dest'
+    """
+    positional, optional = [], []
+    for action in parser._actions:
+        if action.dest == 'help':
+            continue
+        value = overrides.get(action.dest, getattr(args, action.dest))
+        if not action.option_strings:
+            positional.extend(str(v) for v in (
+                value if isinstance(value, (list, tuple)) else [value]))
+            continue
+        if value is None or value == action.default:
+            continue
+        flag = max(action.option_strings, key=len)
+        if action.nargs == 0:  # 'store_true'
+            optional.append(flag)
+        elif action.nargs == '?' and value == action.const:
+            optional.append(flag)
+        elif isinstance(action, _AppendAction):
+            for item in value:
+                optional.append(flag)
+                optional.extend(str(v) for v in (
+                    item if isinstance(item, (list, tuple)) else [item]))
+        elif isinstance(value, (list, tuple)):
+            if value:
+                optional.append(flag)
+                optional.extend(str(v) for v in value)
+        else:
+            optional.extend((flag, str(value)))
+    return positional + optional
+
+
 class DeriveCmd():
 
     desc = "Generate derivatives from a Banana Study class"
@@ -96,10 +142,11 @@ class DeriveCmd():
                             metavar='ARG',
                             help=("The type of processor to use plus arguments"
                                   "used to initate it. First arg is the type "
-                                  "(one of 'single', 'multi', 'slurm'). "
-                                  "Additional arguments depend on type: "
-                                  "single [], multi [NUM_PROCS], slurm ["
-                                  "ACCOUNT, PARTITION]"))
+                                  "(one of 'single', 'multi', 'slurm', "
+                                  "'slurm_array'). Additional arguments "
+                                  "depend on type: single [], multi "
+                                  "[NUM_PROCS], slurm [ACCOUNT, PARTITION], "
+                                  "slurm_array [ACCOUNT, PARTITION]"))
         parser.add_argument('--environment', type=str, default='static',
                             choices=('modules', 'static'), metavar='TYPE',
                             help="The type of environment to use")
@@ -148,10 +195,77 @@ class DeriveCmd():
                                   "INFO by default)"))
         parser.add_argument('--bids_task', default=None,
                             help=("A task to use to filter the BIDS inputs"))
+        parser.add_argument('--intermediate_format', default=None,
+                            choices=('nifti',),
+                            help=("Store intermediate derivatives (i.e. those "
+                                  "not requested) uncompressed in this format "
+                                  "instead of gzipped NIfTI"))
+        parser.add_argument('--telemetry', nargs='?', default=None,
+                            const='', metavar='DB',
+                            help=("Record the resources used by each node in "
+                                  "a telemetry database (defaults to "
+                                  "'telemetry.db' in the scratch directory)"))
+        parser.add_argument('--learned_resources', action='store_true',
+                            default=False,
+                            help=("Request the wall time and memory for SLURM "
+                                  "jobs from the resources used by previous "
+                                  "runs recorded in the telemetry database "
+                                  "instead of the static hints"))
+        parser.add_argument('--conversion_cache', nargs='?', default=None,
+                            const='', metavar='DIR',
+                            help=("Reuse format conversions (e.g. DICOM to "
+                                  "NIfTI) between pipelines and studies via a "
+                                  "shared cache (defaults to "
+                                  "'conversion-cache' in the scratch "
+                                  "directory)"))
+        parser.add_argument('--conversion_cache_size', type=float,
+                            default=None, metavar='GB',
+                            help=("The size the conversion cache is limited "
+                                  "to, beyond which the least recently used "
+                                  "conversions are evicted (default 50 GB)"))
+        parser.add_argument('--chunk_size', type=int, default=1,
+                            metavar='N',
+                            help=("The number of subjects processed by each "
+                                  "task of the 'slurm_array' processor"))
+        parser.add_argument('--task_procs', type=int, default=4,
+                            metavar='N',
+                            help=("The number of processes used by each task "
+                                  "of the 'slurm_array' processor"))
+        parser.add_argument('--task_wall_time', type=float, default=1440,
+                            metavar='MINUTES',
+                            help=("The wall time requested for each task of "
+                                  "the 'slurm_array' processor"))
+        parser.add_argument('--task_mem_gb', type=float, default=16,
+                            metavar='GB',
+                            help=("The memory requested for each task of "
+                                  "the 'slurm_array' processor"))
+        parser.add_argument('--max_concurrent_tasks', type=int, default=None,
+                            metavar='N',
+                            help=("The maximum number of tasks of the "
+                                  "'slurm_array' processor to run at once"))
+        parser.add_argument('--prefetch', type=int, default=4,
+                            metavar='N',
+                            help=("The number of input filesets to download "
+                                  "at once from an XNAT repository ahead of "
+                                  "the nodes that need them (0 to download "
+                                  "them as they are needed)"))
         return parser
 
     @classmethod
     def run(cls, args):
+        from arcana.utils import parse_value
+        from banana import (
+            InputFilesets, InputFields, MultiProc, SingleProc, SlurmProc,
+            StaticEnv, ModulesEnv, BasicRepo, BidsRepo, XnatRepo)
+        from banana.exceptions import BananaUsageError
+        from banana.file_format import nifti_format
+        from banana.utils.telemetry import TelemetryStore
+        from banana.utils.conversion_cache import (
+            ConversionCache, DEFAULT_MAX_SIZE_GB)
+        from banana.utils import version_cache
+        from banana.utils.prefetch import XnatPrefetcher, input_filesets
+        from banana.processor import SlurmArraySubmitter
+        from banana.requirement import installed_requirements
 
         set_loggers(args.logger)
 
@@ -167,6 +281,29 @@ class DeriveCmd():
 
         work_dir = op.join(scratch_dir, 'work')
 
+        if args.telemetry is not None:
+            telemetry = TelemetryStore(
+                args.telemetry if args.telemetry else
+                op.join(scratch_dir, 'telemetry.db'))
+        elif args.learned_resources:
+            raise BananaUsageError(
+                "'--learned_resources' requires '--telemetry'")
+        else:
+            telemetry = None
+
+        if args.conversion_cache is not None:
+            conversion_cache = ConversionCache(
+                args.conversion_cache if args.conversion_cache else
+                op.join(scratch_dir, 'conversion-cache'),
+                max_size=(args.conversion_cache_size
+                          if args.conversion_cache_size is not None
+                          else DEFAULT_MAX_SIZE_GB))
+            # Enabled via the environment so it is inherited by the
+            # processes/jobs the conversion nodes are run in
+            conversion_cache.enable()
+        else:
+            conversion_cache = None
+
         if args.repository is None:
             if args.input:
                 repository_type = 'basic'
@@ -205,10 +342,10 @@ class DeriveCmd():
                         "Unrecognised arguments passed to '--{}' option "
                         "({}) exactly 1 additional argument is required for "
                         "'basic' type repository (DEPTH)"
-                        .format(option_str, args.respository))
+                        .format(option_str, repo_type))
                 if create_root:
                     os.makedirs(repo_path, exist_ok=True)
-                repo = BasicRepo(repo_path, depth=repo_args[0])
+                repo = BasicRepo(repo_path, depth=int(repo_args[0]))
             elif repo_type == 'xnat':
                 nargs = len(repo_args)
                 if nargs < 1:
@@ -216,13 +353,13 @@ class DeriveCmd():
                         "Not enough arguments passed to '--{}' option "
                         "({}), at least 1 additional argument is required for "
                         "'xnat' type repository (SERVER)"
-                        .format(option_str, args.respository))
+                        .format(option_str, repo_type))
                 elif nargs > 3:
                     raise BananaUsageError(
                         "Unrecognised arguments passed to '--{}' option "
                         "({}), at most 3 additional arguments are accepted for"
                         " 'xnat' type repository (SERVER, USER, PASSWORD)"
-                        .format(option_str, args.respository))
+                        .format(option_str, repo_type))
                 repo = XnatRepo(
                     project_id=repo_path,
                     server=repo_args[0],
@@ -237,7 +374,7 @@ class DeriveCmd():
             return repo
 
         repository = init_repo(args.repository_path, repository_type,
-                               'repository', *args.repository)
+                               'repository', *(args.repository or [])[1:])
 
         if args.output_repository is not None:
             input_repository = repository
@@ -271,12 +408,13 @@ class DeriveCmd():
                 email = None
 
         proc_args = {'reprocess': args.reprocess}
+        array = None
 
         if args.processor[0] == 'single':
             processor = SingleProc(work_dir, **proc_args)
         elif args.processor[0] == 'multi':
             if len(args.processor) > 1:
-                num_processes = args.processor[1]
+                num_processes = int(args.processor[1])
             elif len(args.processor) > 2:
                 raise BananaUsageError(
                     "Unrecognised arguments passed to '--processor' option "
@@ -302,7 +440,28 @@ class DeriveCmd():
                 work_dir, account=(args.processor[1] if nargs >= 2 else None),
                 partition=(args.processor[2] if nargs >= 3 else None),
                 email=email, mail_on=('FAIL',),
+                learned_resources=args.learned_resources,
                 **proc_args)
+        elif args.processor[0] == 'slurm_array':
+            nargs = len(args.processor)
+            if nargs > 3:
+                raise BananaUsageError(
+                    "Unrecognised arguments passed to '--processor' option "
+                    "with 'slurm_array' type ({}), expected at most 2 "
+                    "additional arguments [ACCOUNT, PARTITION]".format(
+                        args.processor))
+            # The study is only used to plan the array, the tasks derive the
+            # data with their own MultiProc processors
+            processor = SingleProc(work_dir, **proc_args)
+            array = SlurmArraySubmitter(
+                op.join(scratch_dir, 'array', args.study_name),
+                chunk_size=args.chunk_size,
+                num_processes=args.task_procs,
+                wall_time=args.task_wall_time,
+                mem_gb=args.task_mem_gb,
+                account=(args.processor[1] if nargs >= 2 else None),
+                partition=(args.processor[2] if nargs >= 3 else None),
+                email=email, max_concurrent=args.max_concurrent_tasks)
         else:
             raise BananaUsageError(
                 "Unrecognised processor type provided as first argument to "
@@ -310,6 +469,9 @@ class DeriveCmd():
 
         if args.environment == 'static':
             environment = StaticEnv()
+            # Detect the versions of the installed requirements in the
+            # background while the study is set up
+            version_cache.prefetch(installed_requirements(), wait=False)
         else:
             environment = ModulesEnv()
 
@@ -332,6 +494,13 @@ class DeriveCmd():
             inputs[name] = inpt_cls(name, pattern=pattern, is_regex=True,
                                     repository=input_repository)
 
+        # Only the requested derivatives are stored in their final format
+        storage_kwargs = {}
+        if args.intermediate_format is not None:
+            storage_kwargs['intermediate_format'] = {
+                'nifti': nifti_format}[args.intermediate_format]
+            storage_kwargs['final_outputs'] = args.derivatives
+
         study = study_class(
             name=args.study_name,
             repository=repository,
@@ -343,7 +512,9 @@ class DeriveCmd():
             visit_ids=visit_ids,
             enforce_inputs=args.enforce_inputs,
             fill_tree=fill_tree,
-            bids_task=args.bids_task)
+            bids_task=args.bids_task,
+            telemetry=telemetry,
+            **storage_kwargs)
 
         for spec_name in args.cache:
             spec = study.bound_spec(spec_name)
@@ -352,8 +523,44 @@ class DeriveCmd():
                     "Cannot cache non-input fileset '{}'".format(spec_name))
             spec.cache()
 
+        if array is not None:
+            parser = cls.parser()
+
+            def task_command(derivatives, subjects_path, task_scratch,
+                             reprocess):
+                return [sys.executable, '-m', 'banana.entrypoint', 'derive'
+                        ] + args_to_argv(
+                    parser, args, derivatives=derivatives,
+                    reprocess=reprocess,
+                    processor=['multi', str(args.task_procs)],
+                    subject_ids=[subjects_path], scratch=task_scratch,
+                    telemetry=(telemetry.path
+                               if telemetry is not None else None),
+                    conversion_cache=(conversion_cache.path
+                                      if conversion_cache is not None
+                                      else None),
+                    cache=())
+
+            array.submit(study, args.derivatives, task_command,
+                         reprocess=args.reprocess)
+            return
+
+        # Download the inputs from XNAT in the background, session by session,
+        # while the first sessions are processed
+        xnat_repo = (input_repository if input_repository is not None
+                     else repository)
+        if args.prefetch and xnat_repo.type == 'xnat':
+            prefetcher = XnatPrefetcher(xnat_repo, num_workers=args.prefetch)
+            prefetcher.start(input_filesets(study))
+        else:
+            prefetcher = None
+
         # Generate data
-        study.data(args.derivatives)
+        try:
+            study.data(args.derivatives)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close(wait=False)
 
         logger.info("Generated derivatives for '{}'".format(args.derivatives))
 
@@ -417,10 +624,16 @@ class TestGenCmd():
         parser.add_argument('--environment', type=str, default='static',
                             choices=('modules', 'static'), metavar='TYPE',
                             help="The type of environment to use")
+        parser.add_argument('--num_processes', type=int, default=1,
+                            metavar='N',
+                            help=("The number of processes to run the "
+                                  "pipelines with, which is also the number "
+                                  "of sessions uploaded at once"))
         return parser
 
     @classmethod
     def run(cls, args):
+        from banana.utils.testing import PipelineTester
 
         # Get Study class
         study_class = resolve_class(args.study_class)
@@ -448,7 +661,8 @@ class TestGenCmd():
             include_bases=include_bases,
             reprocess=args.reprocess, repo_depth=args.repo_depth,
             modules_env=(args.environment == 'modules'),
-            clean_work_dir=(not args.dont_clean_work_dir))
+            clean_work_dir=(not args.dont_clean_work_dir),
+            num_processes=args.num_processes)
 
 
 class HelpCmd():
@@ -505,47 +719,80 @@ class AvailableCmd():
 
     @classmethod
     def run(cls, args):
-        available = {}
-
-        def find_study_classes(pkg_or_module, pkg_or_module_path):
-            for cls_name in dir(pkg_or_module):
-                if cls_name.startswith('_'):
-                    continue
-                cls = getattr(pkg_or_module, cls_name)
-                try:
-                    if (issubclass(cls, Study) and
-                            'desc' in cls.__dict__):
-                        try:
-                            old_path = available[cls]
-                        except KeyError:
-                            available[cls] = pkg_or_module_path
-                        else:
-                            if len(pkg_or_module_path) < len(old_path):
-                                available[cls] = pkg_or_module_path
-                except TypeError:
-                    pass
-
-        search_paths = [cls.default_path] + args.search_paths
-        for search_path in search_paths:
-            base_module = import_module(search_path)
-            for pkg_name in find_packages(op.dirname(base_module.__file__)):
-                pkg_path = search_path + '.' + pkg_name
-                pkg = import_module(pkg_path)
-                find_study_classes(pkg, pkg_path)
-                for module_info in iter_modules([op.dirname(pkg.__file__)]):
-                    module_path = pkg_path + '.' + module_info.name
-                    module = import_module(module_path)
-                    find_study_classes(module, module_path)
+        available = []
+        for search_path in [cls.default_path] + args.search_paths:
+            available.extend(study_classes(search_path))
         msg = ("The following Study classes are available (and have a 'desc' "
                "attr):")
-        for cls, module_path in available.items():
+        for info in available:
+            module_path = info.path
             if module_path.startswith(DEFAULT_STUDY_CLASS_PATH):
                 module_path = module_path[(len(DEFAULT_STUDY_CLASS_PATH) + 1):]
-            msg += '\n\t{}.{}\t\t{}'.format(
-                module_path, cls.__name__, getattr(cls, 'desc', ''))
+            msg += '\n\t{}.{}\t\t{}'.format(module_path, info.name, info.desc)
         print(msg)
 
 
+class TelemetryCmd():
+
+    desc = ("Report the nodes that have used the most resources in the runs "
+            "recorded in a telemetry database")
+
+    @classmethod
+    def parser(cls):
+        from banana.utils.telemetry import (
+            DEFAULT_TELEMETRY_DB, REPORT_SORT_KEYS)
+        parser = ArgumentParser(prog='banana telemetry',
+                                description=cls.desc)
+        parser.add_argument('--db', default=DEFAULT_TELEMETRY_DB,
+                            help=("The telemetry database to report on "
+                                  "(default '{}')".format(
+                                      DEFAULT_TELEMETRY_DB)))
+        parser.add_argument('--study_class', default=None,
+                            help=("Only report nodes of this study class "
+                                  "(e.g. T1Study)"))
+        parser.add_argument('--sort', default='total_wall_time',
+                            choices=REPORT_SORT_KEYS,
+                            help="The resource to rank the nodes by")
+        parser.add_argument('--limit', type=int, default=20,
+                            help="The number of nodes to report")
+        return parser
+
+    @classmethod
+    def run(cls, args):
+        from banana.exceptions import BananaUsageError
+        from banana.utils.telemetry import TelemetryStore
+        if not op.exists(args.db):
+            raise BananaUsageError(
+                "Telemetry database '{}' does not exist".format(args.db))
+        rows = TelemetryStore(args.db).hot_nodes(
+            study_class=args.study_class, sort_by=args.sort,
+            limit=args.limit)
+        print(cls.format_report(rows))
+
+    @classmethod
+    def format_report(cls, rows):
+        header = ('node', 'runs', 'total (min)', 'max wall (min)',
+                  'max cpu (min)', 'peak RSS (GB)', 'read (GB)',
+                  'written (GB)')
+        table = [header]
+        for row in rows:
+            table.append((
+                '{}.{}.{}'.format(row['study_class'], row['pipeline'],
+                                  row['node']),
+                str(row['runs']),
+                '{:.1f}'.format(row['total_wall_time'] / 60),
+                '{:.1f}'.format(row['wall_time'] / 60),
+                '{:.1f}'.format(row['cpu_time'] / 60),
+                '{:.2f}'.format(row['peak_rss'] / 1024 ** 3),
+                '{:.2f}'.format(row['read_bytes'] / 1024 ** 3),
+                '{:.2f}'.format(row['write_bytes'] / 1024 ** 3)))
+        widths = [max(len(r[i]) for r in table) for i in range(len(header))]
+        return '\n'.join(
+            '  '.join(c.ljust(w) if i == 0 else c.rjust(w)
+                      for i, (c, w) in enumerate(zip(r, widths)))
+            for r in table)
+
+
 class MainCmd():
 
     commands = {
@@ -553,6 +800,7 @@ class MainCmd():
         'menu': MenuCmd,
         'derive': DeriveCmd,
         'test-gen': TestGenCmd,
+        'telemetry': TelemetryCmd,
         'help': HelpCmd}
 
     @classmethod
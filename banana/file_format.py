@@ -3,14 +3,19 @@ from abc import ABCMeta, abstractmethod
 import os
 import os.path as op
 import json
+import hashlib
+from itertools import zip_longest
 import pydicom
 import numpy as np
 from arcana.data.file_format import FileFormat, Converter
-from banana.interfaces.mrtrix import MRConvert
+from banana.interfaces.mrtrix import NativeMRConvert
 from banana.requirement import (
     dcm2niix_req, mrtrix_req)
-from banana.interfaces.converters import Dcm2niix  # @UnusedImport
+from banana.interfaces.converters import (  # @UnusedImport
+    Dcm2niix, CachedDcm2niix, GzipConvert)
 from banana.exceptions import BananaUsageError
+from banana.utils import mif, dicom
+from banana.utils.conversion_cache import content_hash
 import nibabel
 # Import base file formats from Arcana for convenience
 from arcana.data.file_format import (
@@ -21,7 +26,7 @@ from arcana.data.file_format import (
 
 class Dcm2niixConverter(Converter):
 
-    interface = Dcm2niix(compression='y')
+    interface = CachedDcm2niix(compression='y')
     input = 'input_dir'
     output = 'converted'
     requirements = [dcm2niix_req.v('1.0.2')]
@@ -35,11 +40,44 @@ class MrtrixConverter(Converter):
 
     @property
     def interface(self):
-        return MRConvert(
+        return NativeMRConvert(
             out_ext=self.output_format.extension,
             quiet=True)
 
 
+class GzipConverter(Converter):
+    """
+    Compresses an uncompressed image in-process, at the given gzip
+    'compresslevel' if provided
+    """
+
+    input = 'in_file'
+    output = 'out_file'
+
+    def __init__(self, *args, compresslevel=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._compresslevel = compresslevel
+
+    @property
+    def interface(self):
+        if self._compresslevel is None:
+            return GzipConvert()
+        return GzipConvert(compresslevel=self._compresslevel)
+
+
+class GunzipConverter(Converter):
+    """
+    Decompresses a gzipped image in-process
+    """
+
+    input = 'in_file'
+    output = 'out_file'
+
+    @property
+    def interface(self):
+        return GzipConvert(decompress=True)
+
+
 # =====================================================================
 # Custom loader functions for different image types
 # =====================================================================
@@ -47,6 +85,13 @@ class MrtrixConverter(Converter):
 
 class ImageFormat(FileFormat, metaclass=ABCMeta):
 
+    # The number of voxels read from each image at a time when comparing them
+    SLAB_VOXELS = 2 ** 22
+
+    # Hidden file (so it is ignored by the repositories) that the digests of
+    # the filesets in a directory are saved in
+    DIGESTS_FNAME = '.digests.json'
+
     @abstractmethod
     def get_header(self, fileset):
         """
@@ -61,10 +106,22 @@ class ImageFormat(FileFormat, metaclass=ABCMeta):
         file format
         """
 
+    def iter_array(self, fileset):
+        """
+        Yields the array data in slabs along its last axis, so that images can
+        be compared without holding them in memory in full
+        """
+        for slab in self._slabs(self.get_array(fileset)):
+            yield slab
+
     def contents_equal(self, fileset, other_fileset, rms_tol=None, **kwargs):
         """
         Test whether the (relevant) contents of two image filesets are equal
-        given specific criteria
+        given specific criteria. If a digest has been saved for either of the
+        filesets (see 'save_digest'), filesets with identical contents are
+        detected by their digests. Otherwise the array data are compared
+        slab-by-slab, once their shapes and data types match, until they are
+        found to differ.
 
         Parameters
         ----------
@@ -78,14 +135,30 @@ class ImageFormat(FileFormat, metaclass=ABCMeta):
         """
         if other_fileset.format != self:
             return False
+        digest = self._saved_digest(fileset)
+        other_digest = self._saved_digest(other_fileset)
+        if digest is not None or other_digest is not None:
+            if digest is None:
+                digest = self.content_digest(fileset)
+            elif other_digest is None:
+                other_digest = self.content_digest(other_fileset)
+            if digest == other_digest:
+                return True
         if self.headers_diff(fileset, other_fileset, **kwargs):
             return False
+        shape, dtype = self._shape_dtype(fileset)
+        other_shape, other_dtype = self._shape_dtype(other_fileset)
+        if shape != other_shape or (not rms_tol and dtype != other_dtype):
+            return False
         if rms_tol:
-            rms_diff = self.rms_diff(fileset, other_fileset)
-            return (rms_diff < rms_tol)
-        else:
-            return np.array_equiv(fileset.get_array(),
-                                  other_fileset.get_array())
+            return (self._sum_sq_diff(fileset, other_fileset,
+                                      limit=rms_tol ** 2) < rms_tol ** 2)
+        for slab, other_slab in zip_longest(
+                self.iter_array(fileset), self.iter_array(other_fileset)):
+            if (slab is None or other_slab is None or
+                    not np.array_equal(slab, other_slab)):
+                return False
+        return True
 
     def headers_diff(self, fileset, other_fileset, include_keys=None,
                      ignore_keys=None, **kwargs):  # @UnusedVariable
@@ -144,8 +217,139 @@ class ImageFormat(FileFormat, metaclass=ABCMeta):
         """
         Return the RMS difference between the image arrays
         """
-        return np.sqrt(np.sum((fileset.get_array() -
-                               other_fileset.get_array()) ** 2))
+        return np.sqrt(self._sum_sq_diff(fileset, other_fileset))
+
+    def content_digest(self, fileset):
+        """
+        Returns a digest of the contents of the files of the fileset, which is
+        read from the digests saved alongside it (see 'save_digest') if they
+        are up to date
+        """
+        digest = self._saved_digest(fileset)
+        if digest is not None:
+            return digest
+        hsh = hashlib.sha256(content_hash(fileset.path).encode())
+        for aux_name in sorted(fileset.aux_files):
+            hsh.update(aux_name.encode() + b'\0')
+            hsh.update(content_hash(fileset.aux_file(aux_name)).encode())
+        return hsh.hexdigest()
+
+    def save_digest(self, fileset, path=None):
+        """
+        Saves the digest of the fileset in a hidden file alongside it, so that
+        it doesn't need to be read again to be compared against (e.g. when it
+        is reference data for a test)
+
+        Parameters
+        ----------
+        fileset : Fileset
+            The fileset to save the digest of
+        path : str | None
+            The path to a copy of the fileset to save the digest for instead
+        """
+        digests_path, name, stamp = self._digest_location(
+            fileset.path if path is None else path,
+            self._aux_paths(fileset, path))
+        try:
+            with open(digests_path) as f:
+                digests = json.load(f)
+        except (OSError, ValueError):
+            digests = {}
+        digests[name] = {'digest': self.content_digest(fileset),
+                         'stamp': stamp}
+        tmp_path = '{}.{}.tmp'.format(digests_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(digests, f, indent=2)
+        os.replace(tmp_path, digests_path)
+
+    def _saved_digest(self, fileset):
+        """
+        Returns the digest saved alongside the fileset if it is up to date,
+        otherwise None
+        """
+        digests_path, name, stamp = self._digest_location(
+            fileset.path, self._aux_paths(fileset))
+        try:
+            with open(digests_path) as f:
+                entry = json.load(f)[name]
+        except (OSError, ValueError, KeyError):
+            return None
+        return entry['digest'] if entry['stamp'] == stamp else None
+
+    def _shape_dtype(self, fileset):
+        "Returns the shape and data type of the image array"
+        array = self.get_array(fileset)
+        return tuple(array.shape), array.dtype
+
+    def _sum_sq_diff(self, fileset, other_fileset, limit=None):
+        """
+        Accumulates the sum of the squared differences between the image
+        arrays slab-by-slab, stopping once it exceeds the limit (if provided)
+        """
+        total = 0.0
+        for slab, other_slab in zip_longest(
+                self.iter_array(fileset), self.iter_array(other_fileset)):
+            if (slab is None or other_slab is None or
+                    slab.shape != other_slab.shape):
+                return np.inf
+            diff = np.subtract(slab, other_slab, dtype=np.float64)
+            total += np.dot(diff.ravel(), diff.ravel())
+            if limit is not None and total >= limit:
+                break
+        return total
+
+    @classmethod
+    def _slabs(cls, array):
+        "Splits an array (or array proxy) into slabs along its last axis"
+        shape = array.shape
+        if len(shape) < 2:
+            yield np.asanyarray(array)
+            return
+        step = max(1, cls.SLAB_VOXELS // int(np.prod(shape[:-1])))
+        for i in range(0, shape[-1], step):
+            yield np.asanyarray(array[..., i:i + step])
+
+    def _aux_paths(self, fileset, path=None):
+        """
+        Returns the paths of the aux files of the fileset, or of those
+        alongside a copy of it at the given path, in the order they are
+        digested
+        """
+        if path is None:
+            return [fileset.aux_file(n) for n in sorted(fileset.aux_files)]
+        stem = path[:-len(self.ext)] if self.ext else path
+        return [stem + self.aux_files[n] for n in sorted(fileset.aux_files)]
+
+    @classmethod
+    def _digest_location(cls, path, aux_paths=()):
+        """
+        Returns the path of the file the digest of a fileset is saved in, the
+        name it is saved under and a stamp of the sizes and modification
+        times of all its files (including its aux files and the files within
+        directories), which is used to detect changes since it was saved
+        """
+        stamp = hashlib.sha256()
+        for file_path in [path] + list(aux_paths):
+            stamp.update(op.basename(file_path).encode() + b'\0')
+            for rel_path, stat in cls._walk_stats(file_path):
+                stamp.update('{}\0{}\0{}\0'.format(
+                    rel_path, stat.st_size, stat.st_mtime_ns).encode())
+        return (op.join(op.dirname(op.abspath(path)), cls.DIGESTS_FNAME),
+                op.basename(path), stamp.hexdigest())
+
+    @classmethod
+    def _walk_stats(cls, path):
+        """
+        Yields the relative paths and stats of a file, or of the files and
+        sub-directories within a directory, in a fixed order
+        """
+        yield '.', os.stat(path)
+        if op.isdir(path):
+            for dpath, dnames, fnames in os.walk(path):
+                dnames.sort()
+                for name in dnames + sorted(fnames):
+                    entry_path = op.join(dpath, name)
+                    yield op.relpath(entry_path, path), os.stat(entry_path)
 
 
 class NiftiFormat(ImageFormat):
@@ -154,7 +358,19 @@ class NiftiFormat(ImageFormat):
         return dict(nibabel.load(fileset.path).header)
 
     def get_array(self, fileset):
-        return nibabel.load(fileset.path).get_data()
+        return np.asanyarray(nibabel.load(fileset.path).dataobj)
+
+    def iter_array(self, fileset):
+        # Only the slabs being compared are read (and decompressed) from the
+        # file, which is kept open between them
+        img = nibabel.load(fileset.path, keep_file_open=True)
+        for slab in self._slabs(img.dataobj):
+            yield slab
+
+    def _shape_dtype(self, fileset):
+        # Read from the header without loading the data
+        hdr = nibabel.load(fileset.path).header
+        return tuple(hdr.get_data_shape()), hdr.get_data_dtype()
 
     def get_vox_sizes(self, fileset):
         # FIXME: This won't work for 4-D files
@@ -181,12 +397,10 @@ class DicomFormat(ImageFormat):
     def dcm_files(self, fileset):
         return [f for f in os.listdir(fileset.path) if f.endswith('.dcm')]
 
-    def get_array(self, fileset):
-        image_stack = []
-        for fname in self.dcm_files(fileset):
-            image_stack.append(
-                pydicom.dcmread(op.join(fileset.path, fname)).pixel_array)
-        return np.asarray(image_stack)
+    def get_array(self, fileset, num_threads=None):
+        return dicom.load_series(
+            [op.join(fileset.path, f) for f in self.dcm_files(fileset)],
+            num_threads=num_threads)
 
     def get_header(self, fileset, index=0):
         dcm_files = [f for f in os.listdir(fileset.path) if f.endswith('.dcm')]
@@ -242,41 +456,27 @@ class DicomFormat(ImageFormat):
 
 class MrtrixImageFormat(ImageFormat):
 
-    def _load_header_and_array(self, fileset):
-        with open(fileset.path, 'rb') as f:
-            contents = f.read()
-        hdr_end = contents.find(b'\nEND\n')
-        hdr_contents = contents[:hdr_end].decode('utf-8')
-        hdr = dict(l.split(': ', maxsplit=1) for l in hdr_contents.split('\n'))
-        for key, value in list(hdr.items()):
-            if ',' in value:
-                try:
-                    hdr[key] = np.array(value.split(','), dtype=int)
-                except ValueError:
-                    try:
-                        hdr[key] = np.array(value.split(','), dtype=float)
-                    except ValueError:
-                        pass
-            else:
-                try:
-                    hdr[key] = int(value)
-                except ValueError:
-                    try:
-                        hdr[key] = float(value)
-                    except ValueError:
-                        pass
-        del hdr['mrtrix image']  # Delete "magic line" at start of header
-        array_start = int(hdr['file'].split()[1])
-        array = np.asarray(contents[array_start:])
-        dim = [hdr['dim'][int(l[1])] for l in hdr['layout']]
-        array = array.reshape(dim)
-        return hdr, array
-
     def get_header(self, fileset):
-        self._load_header_and_array(fileset)[0]
+        hdr = {}
+        for key, values in mif.read_header(fileset.path).items():
+            values = [self._parse_value(v) for v in values]
+            # Keys such as 'transform' and 'dw_scheme' span multiple lines
+            hdr[key] = values[0] if len(values) == 1 else np.array(values)
+        return hdr
 
     def get_array(self, fileset):
-        self._load_header_and_array(fileset)[1]
+        return mif.load(fileset.path)[1]
+
+    @classmethod
+    def _parse_value(cls, value):
+        for dtype in (int, float):
+            try:
+                if ',' in value:
+                    return np.array(value.split(','), dtype=dtype)
+                return dtype(value)
+            except ValueError:
+                pass
+        return value
 
     def get_vox_sizes(self, fileset):
         return self.get_header(fileset)['vox']
@@ -316,11 +516,11 @@ nifti_gz_x_format.set_converter(dicom_format, Dcm2niixConverter)
 
 nifti_format.set_converter(dicom_format, Dcm2niixConverter)
 nifti_format.set_converter(analyze_format, MrtrixConverter)
-nifti_format.set_converter(nifti_gz_format, MrtrixConverter)
+nifti_format.set_converter(nifti_gz_format, GunzipConverter)
 nifti_format.set_converter(mrtrix_image_format, MrtrixConverter)
 
 nifti_gz_format.set_converter(dicom_format, Dcm2niixConverter)
-nifti_gz_format.set_converter(nifti_format, MrtrixConverter)
+nifti_gz_format.set_converter(nifti_format, GzipConverter)
 nifti_gz_format.set_converter(analyze_format, MrtrixConverter)
 nifti_gz_format.set_converter(mrtrix_image_format, MrtrixConverter)
 nifti_gz_format.set_converter(nifti_gz_x_format, IdentityConverter)
@@ -352,6 +552,7 @@ tsv_format = FileFormat(name='tab_separated', extension='.tsv')
 # matlab_format = FileFormat(name='matlab', extension='.mat')
 csv_format = FileFormat(name='comma_separated', extension='.csv')
 text_matrix_format = FileFormat(name='text_matrix', extension='.mat')
+numpy_array_format = FileFormat(name='numpy_array', extension='.npy')
 
 # Diffusion gradient-table data formats
 fsl_bvecs_format = FileFormat(name='fsl_bvecs', extension='.bvec')
@@ -1,5 +1,7 @@
 
 import os.path
+import gzip
+import shutil
 from nipype.interfaces.base import (
     TraitedSpec, BaseInterface, File, Directory, traits, isdefined,
     CommandLineInputSpec, CommandLine)
@@ -10,6 +12,8 @@ import re
 from arcana.exceptions import ArcanaError
 import numpy as np
 from nipype.utils.filemanip import split_filename
+from banana.requirement import dcm2niix_req
+from banana.utils.conversion_cache import ConversionCacheMixin
 
 
 class Dcm2niixInputSpec(CommandLineInputSpec):
@@ -96,6 +100,69 @@ class Dcm2niix(CommandLine):
         return out_name
 
 
+class CachedDcm2niix(ConversionCacheMixin, Dcm2niix):
+    """
+    Dcm2niix that reuses previous conversions of the same DICOM series from
+    the conversion cache (if enabled)
+    """
+
+    source_input = 'input_dir'
+    cache_requirements = [dcm2niix_req]
+
+
+class GzipConvertInputSpec(TraitedSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc="The file to compress or decompress")
+    decompress = traits.Bool(False, usedefault=True,
+                             desc="Decompress the input instead")
+    compresslevel = traits.Range(
+        low=1, high=9, value=9, usedefault=True,
+        desc="Gzip compression level (defaults to that of gzip)")
+
+
+class GzipConvertOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The (de)compressed file")
+
+
+class GzipConvert(BaseInterface):
+    """
+    Compresses or decompresses a file in-process with gzip (e.g. to convert
+    between '.nii' and '.nii.gz') without altering its contents
+    """
+
+    input_spec = GzipConvertInputSpec
+    output_spec = GzipConvertOutputSpec
+
+    def _run_interface(self, runtime):
+        if self.inputs.decompress:
+            in_f = gzip.open(self.inputs.in_file, 'rb')
+            out_f = open(self._gen_outfilename(), 'wb')
+        else:
+            in_f = open(self.inputs.in_file, 'rb')
+            out_f = gzip.open(self._gen_outfilename(), 'wb',
+                              compresslevel=self.inputs.compresslevel)
+        with in_f, out_f:
+            shutil.copyfileobj(in_f, out_f, 1024 ** 2)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_outfilename()
+        return outputs
+
+    def _gen_outfilename(self):
+        fname = os.path.basename(self.inputs.in_file)
+        if self.inputs.decompress:
+            if not fname.endswith('.gz'):
+                raise ArcanaError(
+                    "Cannot decompress '{}' as it doesn't have a '.gz' "
+                    "extension".format(self.inputs.in_file))
+            fname = fname[:-3]
+        else:
+            fname += '.gz'
+        return os.path.join(os.getcwd(), fname)
+
+
 class Nii2DicomInputSpec(TraitedSpec):
     in_file = File(mandatory=True, desc='input nifti file')
     reference_dicom = traits.List(mandatory=True, desc='original umap')
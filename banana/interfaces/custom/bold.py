@@ -1,12 +1,16 @@
 
 from nipype.interfaces.base import (
     BaseInterface, BaseInterfaceInputSpec, TraitedSpec, Directory, File,
-    traits)
+    traits, isdefined)
 import os
-import shutil
 import pydicom
 import numpy as np
+import nibabel as nib
 import glob
+from scipy.ndimage import gaussian_filter
+from banana.utils.staging import stage, STAGING_METHODS
+from banana.utils.nifti import iter_volume_chunks, save_volumes
+from banana.exceptions import BananaUsageError
 
 
 class PrepareFIXInputSpec(BaseInterfaceInputSpec):
@@ -22,6 +26,10 @@ class PrepareFIXInputSpec(BaseInterfaceInputSpec):
     t12MNI_mat = File(exists=True)
     MNI2t1_mat = File(exists=True)
     epi_mean = File(exists=True)
+    staging = traits.Enum(
+        *STAGING_METHODS, usedefault=True,
+        desc=("How the inputs are staged in the FIX directory (see "
+              "banana.utils.staging.stage_file)"))
 
 
 class PrepareFIXOutputSpec(TraitedSpec):
@@ -49,20 +57,27 @@ class PrepareFIX(BaseInterface):
         MNI2t1_mat = self.inputs.MNI2t1_mat
         epi_mean = self.inputs.epi_mean
 
-        shutil.copytree(melodic_dir, 'melodic_ica')
+        method = self.inputs.staging
+        stage(melodic_dir, 'melodic_ica', method=method)
         os.mkdir('melodic_ica/reg')
-        shutil.copy2(t12MNI_mat, 'melodic_ica/reg/highres2std.mat')
-        shutil.copy2(MNI2t1_mat, 'melodic_ica/reg/std2highres.mat')
-        shutil.copy2(epi2t1_mat, 'melodic_ica/reg/example_func2highres.mat')
-        shutil.copy2(t1_brain, 'melodic_ica/reg/highres.nii.gz')
-        shutil.copy2(epi_preproc, 'melodic_ica/reg/example_func.nii.gz')
-        shutil.copy2(t12epi_mat, 'melodic_ica/reg/highres2example_func.mat')
+        stage(t12MNI_mat, 'melodic_ica/reg/highres2std.mat', method=method)
+        stage(MNI2t1_mat, 'melodic_ica/reg/std2highres.mat', method=method)
+        stage(epi2t1_mat, 'melodic_ica/reg/example_func2highres.mat',
+              method=method)
+        stage(t1_brain, 'melodic_ica/reg/highres.nii.gz', method=method)
+        stage(epi_preproc, 'melodic_ica/reg/example_func.nii.gz',
+              method=method)
+        stage(t12epi_mat, 'melodic_ica/reg/highres2example_func.mat',
+              method=method)
         os.mkdir('melodic_ica/mc')
-        shutil.copy2(mc_par, 'melodic_ica/mc/prefiltered_func_data_mcf.par')
-        shutil.copy2(epi_brain_mask, 'melodic_ica/mask.nii.gz')
-        shutil.copy2(epi_mean, 'melodic_ica/mean_func.nii.gz')
-        shutil.copytree(melodic_dir, 'melodic_ica/filtered_func_data.ica')
-        shutil.copy2(filtered_epi, 'melodic_ica/filtered_func_data.nii.gz')
+        stage(mc_par, 'melodic_ica/mc/prefiltered_func_data_mcf.par',
+              method=method)
+        stage(epi_brain_mask, 'melodic_ica/mask.nii.gz', method=method)
+        stage(epi_mean, 'melodic_ica/mean_func.nii.gz', method=method)
+        stage(melodic_dir, 'melodic_ica/filtered_func_data.ica',
+              method=method)
+        stage(filtered_epi, 'melodic_ica/filtered_func_data.nii.gz',
+              method=method)
 
         with open('hand_label_file.txt', 'w') as f:
             f.write('not_provided')
@@ -116,3 +131,338 @@ class FieldMapTimeInfo(BaseInterface):
         outputs["delta_te"] = self.delta_te
 
         return outputs
+
+
+def reduce_eigenspace(data, num_components):
+    """
+    Projects a (rows x voxels) data matrix onto its top temporal
+    eigenvectors, returning at most 'num_components' rows scaled by the
+    square root of their eigenvalues (i.e. the leading rows of S.V^T in the
+    SVD of the data)
+    """
+    cov = data.dot(data.T).astype(float)
+    evals, evecs = np.linalg.eigh(cov)
+    order = np.argsort(evals)[::-1][:num_components]
+    return evecs[:, order].T.astype(data.dtype).dot(data)
+
+
+class MIGPSubjectReductionInputSpec(BaseInterfaceInputSpec):
+
+    in_file = File(exists=True, mandatory=True,
+                   desc="The subject's 4D fMRI time series")
+    mask_file = File(exists=True, mandatory=True,
+                     desc="Mask of voxels to include in the group PCA")
+    num_components = traits.Int(
+        mandatory=True,
+        desc="The number of temporal components to keep for the subject")
+    out_file = File(genfile=True, desc="The reduced data (.npy)")
+
+
+class MIGPSubjectReductionOutputSpec(TraitedSpec):
+
+    out_file = File(exists=True, desc="The reduced data (.npy)")
+
+
+class MIGPSubjectReduction(BaseInterface):
+    """
+    Demeans and variance normalises the in-mask time series of a subject and
+    reduces it to its leading temporal components, ready to be streamed
+    into MIGP. Run per subject so the reductions can be run in parallel.
+    """
+
+    input_spec = MIGPSubjectReductionInputSpec
+    output_spec = MIGPSubjectReductionOutputSpec
+
+    def _run_interface(self, runtime):
+        mask = np.asanyarray(nib.load(self.inputs.mask_file).dataobj) > 0
+        img = nib.load(self.inputs.in_file)
+        data = img.get_fdata(dtype=np.float32)[mask].T
+        del img
+        data -= data.mean(axis=0)
+        std = data.std(axis=0)
+        data /= np.where(std > 0, std, 1.0)
+        np.save(self._gen_outfilename(),
+                reduce_eigenspace(data, self.inputs.num_components))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_outfilename()
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            return self._gen_outfilename()
+        assert False
+
+    def _gen_outfilename(self):
+        if isdefined(self.inputs.out_file):
+            return os.path.abspath(self.inputs.out_file)
+        return os.path.abspath('reduced.npy')
+
+
+class MIGPInputSpec(BaseInterfaceInputSpec):
+
+    in_files = traits.List(
+        File(exists=True), mandatory=True,
+        desc="Reduced subject data produced by MIGPSubjectReduction")
+    mask_file = File(exists=True, mandatory=True,
+                     desc="Mask used in the subject reductions")
+    num_components = traits.Int(
+        mandatory=True,
+        desc="The dimensionality of the running group eigenspace")
+    tr = traits.List(
+        traits.Float(),
+        desc=("Repetition times of the subject time series, which must all "
+              "match"))
+    out_file = File('migp.nii.gz', usedefault=True,
+                    desc="The reduced group data as a 4D image")
+
+
+class MIGPOutputSpec(TraitedSpec):
+
+    out_file = File(exists=True, desc="The reduced group data as a 4D image")
+    tr = traits.Float(desc="The repetition time shared by the subjects")
+
+
+class MIGP(BaseInterface):
+    """
+    MELODIC's Incremental Group-PCA (Smith et al. 2014). Subjects are
+    streamed in one at a time, appended to a running eigenspace that is
+    reduced back to 'num_components' whenever it grows beyond twice that
+    size, so memory use doesn't depend on the number of subjects. The final
+    eigenspace is written as a 4D image (one volume per component) that can
+    be passed to MELODIC in place of the concatenated time series.
+    """
+
+    input_spec = MIGPInputSpec
+    output_spec = MIGPOutputSpec
+
+    def _run_interface(self, runtime):
+        if isdefined(self.inputs.tr) and len(set(self.inputs.tr)) > 1:
+            raise BananaUsageError(
+                "Repetition times of the subjects passed to MIGP differ ({})"
+                .format(sorted(set(self.inputs.tr))))
+        num_comps = self.inputs.num_components
+        eigenspace = None
+        for in_file in self.inputs.in_files:
+            subject = np.load(in_file)
+            if eigenspace is None:
+                eigenspace = subject
+            else:
+                eigenspace = np.concatenate((eigenspace, subject))
+            del subject
+            if len(eigenspace) > 2 * num_comps:
+                eigenspace = reduce_eigenspace(eigenspace, num_comps)
+        eigenspace = reduce_eigenspace(eigenspace, num_comps)
+        mask_img = nib.load(self.inputs.mask_file)
+        mask = np.asanyarray(mask_img.dataobj) > 0
+        out = np.zeros(mask.shape + (len(eigenspace),), dtype=np.float32)
+        out[mask] = eigenspace.T
+        nib.save(nib.Nifti1Image(out, mask_img.affine),
+                 os.path.abspath(self.inputs.out_file))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+        if isdefined(self.inputs.tr) and self.inputs.tr:
+            outputs['tr'] = self.inputs.tr[0]
+        return outputs
+
+
+def tproject_regressors(num_vols, tr, polort=2, stopband=None,
+                        passband=None):
+    """
+    Builds the nuisance regressors projected out by AFNI's 3dTproject:
+    Legendre polynomials up to degree 'polort' and the sines and cosines of
+    the Fourier frequencies within 'stopband' (or outside 'passband')
+
+    Parameters
+    ----------
+    num_vols : int
+        The number of timepoints
+    tr : float
+        The repetition time (s)
+    polort : int
+        The maximum degree of the polynomial trends
+    stopband : tuple(float, float) | None
+        Range of frequencies (Hz) to remove
+    passband : tuple(float, float) | None
+        Range of frequencies (Hz) to keep, all others are removed
+
+    Returns
+    -------
+    regressors : np.array(num_vols, num_regressors)
+    """
+    x = np.linspace(-1.0, 1.0, num_vols)
+    regressors = [np.polynomial.legendre.legval(x, np.eye(polort + 1)[d])
+                  for d in range(polort + 1)]
+    freq_step = 1.0 / (num_vols * tr)
+    freqs = np.arange(1, num_vols // 2 + 1) * freq_step
+    remove = np.zeros(len(freqs), dtype=bool)
+    if stopband is not None:
+        remove |= (freqs >= stopband[0]) & (freqs <= stopband[1])
+    if passband is not None:
+        remove |= (freqs < passband[0]) | (freqs > passband[1])
+    t = np.arange(num_vols)
+    for k in np.arange(1, len(freqs) + 1)[remove]:
+        regressors.append(np.cos(2 * np.pi * k * t / num_vols))
+        if 2 * k != num_vols:  # The sine is zero at the Nyquist frequency
+            regressors.append(np.sin(2 * np.pi * k * t / num_vols))
+    return np.array(regressors).T
+
+
+class TemporalFilterInputSpec(BaseInterfaceInputSpec):
+
+    in_file = File(exists=True, mandatory=True,
+                   desc="The (motion-corrected) 4D series to filter")
+    mask = File(exists=True, mandatory=True,
+                desc="Only voxels within the mask are filtered")
+    delta_t = traits.Float(mandatory=True, desc="The repetition time (s)")
+    polort = traits.Int(2, usedefault=True,
+                        desc="Remove polynomials up to the degree specified")
+    stopband = traits.Tuple(
+        (traits.Float(), traits.Float()), xor=['passband'],
+        desc="Remove all frequencies in the range provided (Hz)")
+    passband = traits.Tuple(
+        (traits.Float(), traits.Float()), xor=['stopband'],
+        desc="Remove all frequencies except those in the range provided (Hz)")
+    blur = traits.Float(
+        desc=("Blur (inside the mask only) with a Gaussian of this FWHM "
+              "(mm) after the temporal filtering"))
+    add_mean = traits.Bool(
+        True, usedefault=True,
+        desc="Add the temporal mean of the input series back to the output")
+    chunk_size = traits.Int(
+        20000, usedefault=True,
+        desc="The number of voxels to project at a time")
+    volume_chunk_size = traits.Int(
+        20, usedefault=True,
+        desc="The number of volumes of the input to read at a time")
+    out_file = File('filtered_func_data.nii.gz', usedefault=True,
+                    desc="The filtered series")
+
+
+class TemporalFilterOutputSpec(TraitedSpec):
+
+    out_file = File(exists=True, desc="The filtered series")
+
+
+class TemporalFilter(BaseInterface):
+    """
+    In-process equivalent of running AFNI's 3dTproject (polynomial
+    detrending, band regression and blurring within the mask) followed by
+    adding back the temporal mean of the input with fslmaths. The input is
+    streamed twice, a chunk of volumes at a time: first to accumulate its
+    mean and the projections of the masked time series onto the nuisance
+    (or, if smaller, the retained) basis, then to subtract the fit a block
+    of voxels at a time and write the result a volume at a time, so the
+    masked time series are never held in memory in full.
+    """
+
+    input_spec = TemporalFilterInputSpec
+    output_spec = TemporalFilterOutputSpec
+
+    def _run_interface(self, runtime):
+        img = nib.load(self.inputs.in_file)
+        shape = img.shape[:3]
+        num_vols = img.shape[3]
+        # Flatten in the same (Fortran) order as iter_volume_chunks
+        mask = np.ravel(np.asanyarray(nib.load(self.inputs.mask).dataobj) > 0,
+                        order='F')
+        regressors = tproject_regressors(
+            num_vols, self.inputs.delta_t, polort=self.inputs.polort,
+            stopband=(self.inputs.stopband
+                      if isdefined(self.inputs.stopband) else None),
+            passband=(self.inputs.passband
+                      if isdefined(self.inputs.passband) else None))
+        # The projection onto the orthogonal complement of the regressors is
+        # either Y - Q.Q^T.Y, with Q an orthonormal basis of the regressors,
+        # or P.P^T.Y, with P an orthonormal basis of their complement, so
+        # only the coefficients for whichever basis is smaller need to be
+        # held in memory
+        full_basis = np.linalg.qr(regressors, mode='complete')[0]
+        num_regressors = regressors.shape[1]
+        residual = num_regressors > num_vols - num_regressors
+        if residual:
+            basis = full_basis[:, num_regressors:]
+        else:
+            basis = full_basis[:, :num_regressors]
+        basis = basis.astype(np.float32)
+        del full_basis
+        # First pass: accumulate the temporal mean and the coefficients of
+        # the masked time series
+        coefs = np.zeros((basis.shape[1], np.count_nonzero(mask)),
+                         dtype=np.float32)
+        total = np.zeros(mask.shape, dtype=np.float64)
+        for start, chunk in self._volume_chunks():
+            total += chunk.sum(axis=0)
+            rows = basis[start:start + len(chunk)].T
+            for block in self._voxel_blocks(coefs.shape[1]):
+                coefs[:, block] += rows.dot(chunk[:, mask][:, block])
+            del chunk
+        if self.inputs.add_mean:
+            mean = (total / num_vols).astype(np.float32).reshape(
+                shape, order='F')
+        else:
+            mean = None
+        save_volumes(os.path.abspath(self.inputs.out_file), img,
+                     self._volumes(self._filtered(basis, coefs, mask,
+                                                  residual),
+                                   mask, mean, shape,
+                                   img.header.get_zooms()[:3]))
+        return runtime
+
+    def _volume_chunks(self):
+        return iter_volume_chunks(self.inputs.in_file,
+                                  self.inputs.volume_chunk_size)
+
+    def _voxel_blocks(self, num_voxels):
+        for i in range(0, num_voxels, self.inputs.chunk_size):
+            yield slice(i, i + self.inputs.chunk_size)
+
+    def _filtered(self, basis, coefs, mask, residual):
+        """
+        Second pass: re-reads the input and yields the filtered masked time
+        series a volume at a time, projecting a block of voxels at a time
+        """
+        for start, chunk in self._volume_chunks():
+            rows = basis[start:start + len(chunk)]
+            masked = chunk[:, mask]
+            del chunk
+            for block in self._voxel_blocks(masked.shape[1]):
+                fitted = rows.dot(coefs[:, block])
+                if residual:
+                    masked[:, block] = fitted
+                else:
+                    masked[:, block] -= fitted
+            for vol in masked:
+                yield vol
+
+    def _volumes(self, data, mask, mean, shape, voxel_sizes):
+        "Yields the filtered volumes, blurred and with the mean added back"
+        blur = isdefined(self.inputs.blur) and self.inputs.blur > 0
+        if blur:
+            # Normalised convolution so that values outside the mask don't
+            # contribute and the edge voxels aren't darkened
+            sigma = [self.inputs.blur / (np.sqrt(8 * np.log(2)) * v)
+                     for v in voxel_sizes]
+            mask_vol = mask.reshape(shape, order='F')
+            weights = gaussian_filter(mask_vol.astype(np.float32), sigma)
+            weights[~mask_vol] = 1.0
+        flat = np.zeros(mask.shape, dtype=np.float32)
+        for masked in data:
+            flat[mask] = masked
+            vol = flat.reshape(shape, order='F')
+            if blur:
+                vol = gaussian_filter(vol, sigma) / weights
+                vol[~mask_vol] = 0.0
+            if mean is not None:
+                vol = vol + mean
+            yield vol
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+        return outputs
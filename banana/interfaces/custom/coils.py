@@ -1,7 +1,8 @@
 import os
 import os.path as op
-from copy import deepcopy
 from collections import defaultdict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import re
 import numpy as np
@@ -10,11 +11,17 @@ from nipype.interfaces.base import (
     TraitedSpec, traits, BaseInterface, BaseInterfaceInputSpec, File,
     Directory, isdefined)
 from banana.exceptions import BananaUsageError
+from banana.utils.archive import NiftiSource
+from banana.utils.nifti import swap_dims, copy_geometry, reorient
 logger = logging.getLogger('banana')
 
 
 class ToPolarCoordsInputSpec(BaseInterfaceInputSpec):
-    in_dir = Directory(exists=True, mandatory=True)
+    in_dir = Directory(exists=True, mandatory=True, xor=['in_archive'],
+                       desc="Directory containing the channel images")
+    in_archive = File(exists=True, mandatory=True, xor=['in_dir'], desc=(
+        "Zip or tar(.gz) archive containing the channel images, which are "
+        "read from it directly instead of being extracted first"))
     in_fname_re = traits.Str(
         r'.*_(?P<channel>\d+)_(?P<echo>\d+)_(?P<axis>[A-Z]+)\.nii\.gz',
         usedefault=True, desc=(
@@ -29,6 +36,17 @@ class ToPolarCoordsInputSpec(BaseInterfaceInputSpec):
         "The label used to specify the real component image"))
     imaginary_label = traits.Str('IMAGINARY', usedefault=True, desc=(
         "The label used to specify the real component image"))
+    flip_dims = traits.List(traits.Str(), minlen=3, maxlen=3, desc=(
+        "Permute/flip the axes of the channel images before they are "
+        "otherwise preprocessed, as for fslswapdim (e.g. ['-x', 'y', 'z'])"))
+    header_image = File(exists=True, desc=(
+        "Image to copy the geometry (voxel sizes, qform and sform) of over "
+        "the channel images, as fslcpgeom does"))
+    reorient_to_std = traits.Bool(False, usedefault=True, desc=(
+        "Reorient the channel images to the orientation of the FSL standard "
+        "templates, as fslreorient2std does"))
+    num_threads = traits.Int(1, usedefault=True, desc=(
+        "The number of channels to load, convert and save concurrently"))
     combined_dir = Directory(genfile=True, desc=(
         "Output directory for coil magnitude and phase images. "
         "Files will be saved with the name "
@@ -63,13 +81,17 @@ class ToPolarCoordsOutputSpec(TraitedSpec):
 
 class ToPolarCoords(BaseInterface):
     """
-    Takes all REAL and IMAGINARY pairs in current directory and prepares
-    them for Phase and QSM processing.
+    Takes all REAL and IMAGINARY pairs in the input directory or archive and
+    prepares them for Phase and QSM processing.
 
     1. Existence of pairs is checked
-    2. Files are load/save cycled for formatting and rename for consistency
+    2. Files are loaded (straight from the archive if provided) and their
+       geometry is corrected in memory
     3. Magnitude and Phase components are produced
     4. Coils are combined for single magnitude images per echo
+
+    The channels of each echo are processed concurrently when 'num_threads'
+    is greater than one.
     """
     input_spec = ToPolarCoordsInputSpec
     output_spec = ToPolarCoordsOutputSpec
@@ -78,7 +100,6 @@ class ToPolarCoords(BaseInterface):
         return runtime
 
     def _list_outputs(self):  # @UnusedVariable
-        print("in-dir: " + self.inputs.in_dir)
         outputs = self._outputs().get()
         # Get names for output directories
         combined_dir = outputs['combined_dir'] = self._gen_filename(
@@ -94,93 +115,123 @@ class ToPolarCoords(BaseInterface):
         outputs['combined_images'] = []
         coil_mags = outputs['coil_magnitudes'] = []
         coil_phases = outputs['coil_phases'] = []
-        # A default dict with three levels of keys to hold the file names
-        # sorted into echo, channel and complex axis
-        paths = defaultdict(lambda: defaultdict(dict))
-        # Compile regular expression for extracting channel, echo and
-        # complex axis indices from input file names
-        fname_re = re.compile(self.inputs.in_fname_re)
-        for fname in os.listdir(self.inputs.in_dir):
-            match = fname_re.match(fname)
-            if match is None:
-                logger.warning("Skipping '{}' file in '{}' as it doesn't "
-                               "match expected filename pattern for raw "
-                               "channel files ('{}')"
-                               .format(fname, self.inputs.in_dir,
-                                       self.inputs.in_fname_re))
-                continue
-            paths[match.group('echo')][match.group('channel')][
-                match.group('axis')] = op.join(self.inputs.in_dir, fname)
-
-        first_echo_index = min(paths.keys())
-        last_echo_index = max(paths.keys())
+        in_path = (self.inputs.in_archive
+                   if isdefined(self.inputs.in_archive)
+                   else self.inputs.in_dir)
+        header_img = (nib.load(self.inputs.header_image)
+                      if isdefined(self.inputs.header_image) else None)
+        with NiftiSource(in_path) as source, ThreadPoolExecutor(
+                max_workers=max(self.inputs.num_threads, 1)) as pool:
+            # A default dict with three levels of keys to hold the file names
+            # sorted into echo, channel and complex axis
+            fnames = defaultdict(lambda: defaultdict(dict))
+            # Compile regular expression for extracting channel, echo and
+            # complex axis indices from input file names
+            fname_re = re.compile(self.inputs.in_fname_re)
+            for fname in source.names():
+                match = fname_re.match(fname)
+                if match is None:
+                    logger.warning("Skipping '{}' file in '{}' as it doesn't "
+                                   "match expected filename pattern for raw "
+                                   "channel files ('{}')"
+                                   .format(fname, in_path,
+                                           self.inputs.in_fname_re))
+                    continue
+                fnames[match.group('echo')][match.group('channel')][
+                    match.group('axis')] = fname
+            if not fnames:
+                raise BananaUsageError(
+                    "No channel files matching '{}' found in '{}'".format(
+                        self.inputs.in_fname_re, in_path))
 
-        for echo_i, channels in paths.items():
-            # Variables to hold combined coil images
-            combined_array = None
-            normaliser_array = None
-            echo_coil_mags = []
-            echo_coil_phases = []
-            for channel_i, axes in channels.items():
-                # Load image real and imaginary data and remove extreme values
-                img_arrays = {}
-                for ax, fname in axes.items():
-                    img = nib.load(fname)
-                    img_array = img.get_fdata()
-                    # Replace extreme values with random value
-                    img_array[img_array == 2048] = 0.02 * np.random.rand()
-                    img_arrays[ax] = img_array
+            echo_indices = sorted(fnames, key=_index)
+            for echo_i in echo_indices:
+                channels = fnames[echo_i]
+                # Variables to hold combined coil images
+                combined_array = None
+                normaliser_array = None
+                echo_coil_mags = []
+                echo_coil_phases = []
+                # Load, convert and save the channels concurrently, adding
+                # them to the combined image as they complete (in order)
+                results = pool.map(
+                    partial(self._channel_to_polar, source, header_img,
+                            echo_i, mags_dir, phases_dir),
+                    sorted(channels.items(), key=lambda c: _index(c[0])))
+                for mag_path, phase_path, mag_array, img in results:
+                    echo_coil_mags.append(mag_path)
+                    echo_coil_phases.append(phase_path)
+                    # Add coil data to combined coil data
+                    if combined_array is None:
+                        combined_array = mag_array ** 2
+                        normaliser_array = mag_array
+                    else:
+                        combined_array += mag_array ** 2
+                        normaliser_array += mag_array
+                coil_mags.append(echo_coil_mags)
+                coil_phases.append(echo_coil_phases)
+                # Normalise combined sum of squares image, save and append
+                # to list of combined echoes
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    combined_array /= normaliser_array
+                combined_array[np.isnan(combined_array)] = 0
+                # Generate filename and append ot list of combined coil images
+                combined_fname = op.join(combined_dir,
+                                         'echo_{}.nii.gz'.format(echo_i))
+                combined_img = nib.Nifti1Image(combined_array, img.affine,
+                                               img.header)
+                nib.save(combined_img, combined_fname)
+                outputs['combined_images'].append(combined_fname)
+                if echo_i == echo_indices[0]:
+                    outputs['first_echo'] = combined_fname
+                if echo_i == echo_indices[-1]:
+                    outputs['last_echo'] = combined_fname
+        return outputs
 
-                # Calculate magnitude and phase from coil data
-                cmplx = (img_arrays[self.inputs.real_label] +
-                         img_arrays[self.inputs.imaginary_label] * 1j)
+    def _channel_to_polar(self, source, header_img, echo_i, mags_dir,
+                          phases_dir, channel):
+        """
+        Loads the real and imaginary images of a channel, corrects their
+        geometry and saves the magnitude and phase images calculated from them
+        """
+        channel_i, axes = channel
+        img_arrays = {}
+        for ax in (self.inputs.real_label, self.inputs.imaginary_label):
+            try:
+                fname = axes[ax]
+            except KeyError:
+                raise BananaUsageError(
+                    "Missing '{}' image for channel {} of echo {} (found {})"
+                    .format(ax, channel_i, echo_i, sorted(axes.values())))
+            img = source.load(fname)
+            if isdefined(self.inputs.flip_dims):
+                img = swap_dims(img, self.inputs.flip_dims)
+            if header_img is not None:
+                img = copy_geometry(img, header_img)
+            if self.inputs.reorient_to_std:
+                img = reorient(img)
+            img_array = img.get_fdata()
+            # Replace extreme values with random value
+            img_array[img_array == 2048] = 0.02 * np.random.rand()
+            img_arrays[ax] = img_array
 
-                # Calculate and save magnitude image
-                mag_array = np.abs(cmplx)
-                mag_img = nib.Nifti1Image(mag_array, img.affine, img.header)
-                mag_path = op.join(
-                    mags_dir,
-                    self.inputs.out_fname_str.format(channel=channel_i,
-                                                     echo=echo_i))
-                echo_coil_mags.append(mag_path)
-                nib.save(mag_img, mag_path)
+        # Calculate magnitude and phase from coil data
+        cmplx = (img_arrays[self.inputs.real_label] +
+                 img_arrays[self.inputs.imaginary_label] * 1j)
+        out_fname = self.inputs.out_fname_str.format(channel=channel_i,
+                                                     echo=echo_i)
 
-                # Save phase image
-                phase_array = np.angle(cmplx)
-                phase_img = nib.Nifti1Image(phase_array, img.affine,
-                                            img.header)
-                phase_path = op.join(
-                    phases_dir,
-                    self.inputs.out_fname_str.format(channel=channel_i,
-                                                     echo=echo_i))
-                echo_coil_phases.append(phase_path)
-                nib.save(phase_img, phase_path)
+        # Calculate and save magnitude image
+        mag_array = np.abs(cmplx)
+        mag_path = op.join(mags_dir, out_fname)
+        nib.save(nib.Nifti1Image(mag_array, img.affine, img.header),
+                 mag_path)
 
-                # Add coil data to combined coil data
-                if combined_array is None:
-                    combined_array = deepcopy(mag_array) ** 2
-                    normaliser_array = deepcopy(mag_array)
-                else:
-                    combined_array += mag_array ** 2
-                    normaliser_array += mag_array
-            coil_mags.append(echo_coil_mags)
-            coil_phases.append(echo_coil_phases)
-            # Normalise combined sum of squares image, save and append
-            # to list of combined echoes
-            combined_array /= normaliser_array
-            combined_array[np.isnan(combined_array)] = 0
-            # Generate filename and append ot list of combined coil images
-            combined_fname = op.join(combined_dir,
-                                     'echo_{}.nii.gz'.format(echo_i))
-            combined_img = nib.Nifti1Image(combined_array, img.affine,
-                                           img.header)
-            nib.save(combined_img, combined_fname)
-            outputs['combined_images'].append(combined_fname)
-            if echo_i == first_echo_index:
-                outputs['first_echo'] = combined_fname
-            if echo_i == last_echo_index:
-                outputs['last_echo'] = combined_fname
-        return outputs
+        # Save phase image
+        phase_path = op.join(phases_dir, out_fname)
+        nib.save(nib.Nifti1Image(np.angle(cmplx), img.affine, img.header),
+                 phase_path)
+        return mag_path, phase_path, mag_array, img
 
     def _gen_filename(self, name):
         if name == 'combined_dir':
@@ -314,3 +365,8 @@ class HIPCombineChannels(BaseInterface):
         else:
             assert False
         return fname
+
+
+def _index(label):
+    "Sorts channel/echo labels numerically where possible"
+    return (0, int(label), label) if label.isdigit() else (1, 0, label)
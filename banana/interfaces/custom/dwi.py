@@ -1,8 +1,13 @@
 from __future__ import absolute_import
 import os.path as op
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
+import nibabel as nib
 from nipype.interfaces.base import (
-    TraitedSpec, BaseInterface, File, isdefined, traits)
+    TraitedSpec, BaseInterface, BaseInterfaceInputSpec, File, isdefined,
+    traits)
+from banana.exceptions import BananaUsageError
 
 
 class TransformGradientsInputSpec(TraitedSpec):
@@ -44,3 +49,241 @@ class TransformGradients(BaseInterface):
         else:
             dpath = op.abspath('transformed')
         return dpath
+
+
+def fsl_to_scanner_bvecs(bvecs, affine):
+    """
+    Rotates gradient directions in FSL format, which are relative to the
+    voxel axes of the image (with the first axis flipped for images that
+    aren't stored in radiological order), into scanner coordinates, as done
+    by MRtrix when it reads FSL gradients
+
+    Parameters
+    ----------
+    bvecs : np.array(3, N)
+        The gradient directions in FSL format
+    affine : np.array(4, 4)
+        The voxel-to-scanner affine of the image the gradients belong to
+
+    Returns
+    -------
+    bvecs : np.array(3, N)
+        The gradient directions in scanner coordinates
+    """
+    bvecs = np.array(bvecs, dtype=float).reshape(3, -1)
+    linear = np.asarray(affine, dtype=float)[:3, :3]
+    if np.linalg.det(linear) > 0:
+        bvecs[0] = -bvecs[0]
+    rotation = linear / np.linalg.norm(linear, axis=0)
+    return rotation.dot(bvecs)
+
+
+def tensor_design_matrix(bvals, bvecs):
+    """
+    Returns the design matrix of the log-linear diffusion tensor model, with
+    columns ordered (Dxx, Dyy, Dzz, Dxy, Dxz, Dyz, log(S0))
+
+    Parameters
+    ----------
+    bvals : np.array(N)
+        The b-values of each volume
+    bvecs : np.array(3, N)
+        The gradient directions of each volume, in the frame the tensor is
+        fitted in
+    """
+    bvals = np.asarray(bvals, dtype=float).ravel()
+    gx, gy, gz = np.asarray(bvecs, dtype=float).reshape(3, -1)
+    return np.column_stack((
+        -bvals * gx * gx, -bvals * gy * gy, -bvals * gz * gz,
+        -2 * bvals * gx * gy, -2 * bvals * gx * gz, -2 * bvals * gy * gz,
+        np.ones_like(bvals)))
+
+
+def fit_tensors(signals, design, method='wls', min_signal=1e-6):
+    """
+    Fits the diffusion tensor to a chunk of voxels at once by (weighted)
+    linear least squares on the log-signal
+
+    Parameters
+    ----------
+    signals : np.array(V, N)
+        The diffusion-weighted signals of V voxels
+    design : np.array(N, 7)
+        The design matrix returned by `tensor_design_matrix`
+    method : str
+        Either 'ols' (ordinary least squares) or 'wls' (weighted least
+        squares, with weights given by the OLS-predicted signal)
+    min_signal : float
+        Signals are clipped to this value before taking their logarithm
+
+    Returns
+    -------
+    params : np.array(V, 7)
+        The fitted tensor elements followed by log(S0) for each voxel
+    """
+    log_signals = np.log(np.maximum(signals, min_signal))
+    params = log_signals.dot(np.linalg.pinv(design).T)
+    if method == 'wls':
+        weights = np.exp(2 * params.dot(design.T))
+        lhs = np.einsum('vn,ni,nj->vij', weights, design, design)
+        rhs = np.einsum('vn,ni,vn->vi', weights, design, log_signals)
+        # Fall back to the OLS estimate for degenerate voxels
+        solvable = np.linalg.cond(lhs) < 1 / np.finfo(float).eps
+        params[solvable] = np.linalg.solve(
+            lhs[solvable], rhs[solvable][:, :, None])[:, :, 0]
+    elif method != 'ols':
+        raise BananaUsageError(
+            "Unrecognised tensor fitting method '{}', can be one of 'wls' or "
+            "'ols'".format(method))
+    return params
+
+
+def tensor_metrics(params):
+    """
+    Calculates scalar and vector metrics from fitted tensor elements
+
+    Parameters
+    ----------
+    params : np.array(V, 6+)
+        The tensor elements ordered (Dxx, Dyy, Dzz, Dxy, Dxz, Dyz)
+
+    Returns
+    -------
+    fa : np.array(V)
+        Fractional anisotropy
+    md : np.array(V)
+        Mean diffusivity (ADC)
+    ad : np.array(V)
+        Axial diffusivity
+    rd : np.array(V)
+        Radial diffusivity
+    evec : np.array(V, 3)
+        The principal eigenvector
+    """
+    dxx, dyy, dzz, dxy, dxz, dyz = params[:, :6].T
+    tensors = np.stack((np.stack((dxx, dxy, dxz), axis=-1),
+                        np.stack((dxy, dyy, dyz), axis=-1),
+                        np.stack((dxz, dyz, dzz), axis=-1)), axis=-2)
+    # Eigenvalues are returned in ascending order
+    evals, evecs = np.linalg.eigh(tensors)
+    md = evals.mean(axis=1)
+    ad = evals[:, 2]
+    rd = evals[:, :2].mean(axis=1)
+    norm = np.sqrt(np.sum(evals ** 2, axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fa = np.sqrt(1.5 * np.sum((evals - md[:, None]) ** 2, axis=1)) / norm
+    fa[norm == 0] = 0.0
+    return fa, md, ad, rd, evecs[:, :, 2]
+
+
+def _fit_tensor_chunk(signals, design, method, min_signal, metrics=True):
+    params = fit_tensors(signals, design, method=method,
+                         min_signal=min_signal)
+    if not metrics:
+        return (params[:, :6],)
+    return (params[:, :6],) + tensor_metrics(params)
+
+
+class DiffusionTensorFitInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc="Preprocessed diffusion-weighted series")
+    grad_fsl = traits.Tuple(
+        File(exists=True), File(exists=True), mandatory=True,
+        desc="The gradient directions and b-values in FSL format")
+    in_mask = File(exists=True, desc="Only fit voxels within this mask")
+    method = traits.Enum('wls', 'ols', usedefault=True,
+                         desc="The least-squares method used for the fit")
+    min_signal = traits.Float(
+        1e-6, usedefault=True,
+        desc="Signals are clipped to this value before fitting")
+    chunk_size = traits.Int(
+        20000, usedefault=True,
+        desc="The number of voxels to fit in each batch")
+    num_processes = traits.Int(
+        1, usedefault=True,
+        desc="The number of processes to distribute the chunks over")
+    out_ext = traits.Str('.nii.gz', usedefault=True,
+                         desc="The extension of the output images")
+    metrics = traits.Bool(
+        True, usedefault=True,
+        desc="Whether to derive the tensor metrics as well as the tensor")
+
+
+class DiffusionTensorFitOutputSpec(TraitedSpec):
+    tensor = File(exists=True,
+                  desc=("The tensor image in scanner coordinates, with "
+                        "volumes ordered D11, D22, D33, D12, D13, D23 (as "
+                        "output by MRtrix's dwi2tensor)"))
+    fa = File(exists=True, desc="Fractional anisotropy")
+    adc = File(exists=True, desc="Mean apparent diffusion coefficient")
+    ad = File(exists=True, desc="Axial diffusivity")
+    rd = File(exists=True, desc="Radial diffusivity")
+    evec = File(exists=True,
+                desc="The principal eigenvector in scanner coordinates")
+
+
+class DiffusionTensorFit(BaseInterface):
+    """
+    Fits the diffusion tensor to each voxel of a DWI series in-process and
+    writes the tensor along with its FA, ADC, AD, RD and principal
+    eigenvector maps in the same pass. The in-mask voxels are fitted in
+    batches, which are distributed over a process pool if 'num_processes' is
+    greater than 1. The gradients are rotated into scanner coordinates before
+    fitting, so the tensor and eigenvector are in the same frame as those
+    derived by MRtrix
+    """
+
+    input_spec = DiffusionTensorFitInputSpec
+    output_spec = DiffusionTensorFitOutputSpec
+
+    metric_names = ('tensor', 'fa', 'adc', 'ad', 'rd', 'evec')
+
+    def _run_interface(self, runtime):
+        bvecs_file, bvals_file = self.inputs.grad_fsl
+        img = nib.load(self.inputs.in_file)
+        design = tensor_design_matrix(
+            np.loadtxt(bvals_file),
+            fsl_to_scanner_bvecs(np.loadtxt(bvecs_file), img.affine))
+        data = np.asanyarray(img.dataobj)
+        if isdefined(self.inputs.in_mask):
+            mask = np.asanyarray(nib.load(self.inputs.in_mask).dataobj) > 0
+        else:
+            mask = np.ones(data.shape[:3], dtype=bool)
+        signals = data[mask]
+        del data
+        chunks = [signals[i:i + self.inputs.chunk_size]
+                  for i in range(0, len(signals), self.inputs.chunk_size)]
+        fit_args = (design, self.inputs.method, self.inputs.min_signal,
+                    self.inputs.metrics)
+        if self.inputs.num_processes > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(self.inputs.num_processes) as executor:
+                results = list(executor.map(
+                    _fit_tensor_chunk, chunks, *(repeat(a) for a in fit_args)))
+        else:
+            results = [_fit_tensor_chunk(c, *fit_args) for c in chunks]
+        for name, values in zip(self._output_names, zip(*results)):
+            values = np.concatenate(values) if values else np.zeros(0)
+            if values.ndim > 1:
+                out = np.zeros(mask.shape + values.shape[1:],
+                               dtype=np.float32)
+            else:
+                out = np.zeros(mask.shape, dtype=np.float32)
+            out[mask] = values
+            out_img = nib.Nifti1Image(out, img.affine)
+            out_img.set_qform(img.affine, int(img.header['qform_code']))
+            out_img.set_sform(img.affine, int(img.header['sform_code']))
+            nib.save(out_img, self._out_path(name))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for name in self._output_names:
+            outputs[name] = self._out_path(name)
+        return outputs
+
+    @property
+    def _output_names(self):
+        return self.metric_names if self.inputs.metrics else ('tensor',)
+
+    def _out_path(self, name):
+        return op.abspath(name + self.inputs.out_ext)
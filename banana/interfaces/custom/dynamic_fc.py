@@ -0,0 +1,535 @@
+import os
+import os.path as op
+from functools import lru_cache
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from scipy.signal import windows, resample, argrelextrema
+from nipype.interfaces.base import (
+    BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, Directory,
+    traits, isdefined)
+
+# Correlations are clipped to this magnitude before the Fisher z-transform
+# so perfectly correlated components map to a large but finite value
+MAX_CORRELATION = 0.9999999
+
+# Methods used to estimate the connectivity within each window. 'corr' is
+# the Pearson correlation, the others are partial correlations from the
+# inverse ('part_corr'), ridge-regularised inverse ('ridge_pc') or graphical
+# lasso estimate ('reg_pc') of the window covariance
+FC_METHODS = ('corr', 'part_corr', 'ridge_pc', 'reg_pc')
+
+GMM_COVARIANCE_TYPES = ('spherical', 'tied', 'diag', 'full')
+
+
+@lru_cache(maxsize=None)
+def lower_triangle_indices(num_nodes):
+    """
+    Returns the (row, col) indices of the strictly lower triangle of a
+    square matrix, in the order used by `mat2vec` and `vec2mat`. Cached
+    as they are requested for every matrix.
+    """
+    return np.tril_indices(num_nodes, -1)
+
+
+def mat2vec(mat):
+    """
+    Returns the strictly lower triangle of a square matrix, or of each matrix
+    in a stack of them (i.e. along the last two axes)
+    """
+    num_nodes = mat.shape[-1]
+    if mat.shape[-2] != num_nodes:
+        raise ValueError(
+            "Matrices must be square (found shape {})".format(mat.shape))
+    rows, cols = lower_triangle_indices(num_nodes)
+    return mat[..., rows, cols]
+
+
+def vec2mat(vec, symmetric=True):
+    """
+    Inverse of `mat2vec`, rebuilds the full matrix (or stack of matrices)
+    from the lower triangle(s) stored along the last axis, leaving the
+    diagonal zero
+    """
+    num_nodes = int(0.5 + np.sqrt(1 + 8 * vec.shape[-1]) / 2)
+    rows, cols = lower_triangle_indices(num_nodes)
+    mat = np.zeros(vec.shape[:-1] + (num_nodes, num_nodes), dtype=vec.dtype)
+    mat[..., rows, cols] = vec
+    if symmetric:
+        mat[..., cols, rows] = vec
+    return mat
+
+
+def num_windows(num_timepoints, window_tp, step=1):
+    return max((num_timepoints - window_tp) // step + 1, 0)
+
+
+def fc_taper(window_tp, sigma=None):
+    """
+    The taper applied to each window, a rectangle convolved with a Gaussian
+    of standard deviation 'sigma' (in timepoints) normalised to a peak of 1.
+    If sigma is None the windows are rectangular.
+    """
+    if sigma is None:
+        return np.ones(window_tp)
+    taper = np.convolve(np.ones(window_tp),
+                        windows.gaussian(window_tp, std=sigma), 'same')
+    return taper / taper.max()
+
+
+def _rectangular_window_moments(tc, window_tp, step):
+    # Window sums of x and of x_i.x_j for each node pair as differences of
+    # cumulative sums, so the cost doesn't depend on the window length. The
+    # cumulants are accumulated in double precision as their differences
+    # would otherwise lose most of their significant figures over long series
+    rows, cols = lower_triangle_indices(tc.shape[1])
+    centred = tc - tc.mean(axis=0)
+    starts = np.arange(num_windows(len(tc), window_tp, step)) * step
+
+    def window_sums(x):
+        cumsum = np.zeros((len(x) + 1, x.shape[1]))
+        np.cumsum(x, axis=0, out=cumsum[1:])
+        return cumsum[starts + window_tp] - cumsum[starts]
+
+    sums = window_sums(centred)
+    var = window_sums(centred ** 2) - sums ** 2 / window_tp
+    cov = window_sums(centred[:, rows] * centred[:, cols])
+    cov -= sums[:, rows] * sums[:, cols] / window_tp
+    return var, cov
+
+
+def window_covariances(tc, window_tp, step=1, sigma=None):
+    """
+    Returns the (unnormalised) covariance matrices of all sliding windows of
+    a time course at once, shape (num_windows, num_nodes, num_nodes). The
+    windows are taken as a strided view of the time course, which is copied
+    once when multiplied by the taper and then centred in place, before one
+    batched matmul.
+    """
+    windowed = np.lib.stride_tricks.sliding_window_view(
+        tc, window_tp, axis=0)[::step] * fc_taper(
+            window_tp, sigma).astype(tc.dtype)
+    windowed -= windowed.mean(axis=-1, keepdims=True)
+    return np.matmul(windowed, windowed.transpose(0, 2, 1))
+
+
+def partial_correlations(precision):
+    """
+    Lower triangles of the partial correlations corresponding to a stack of
+    precision (inverse covariance) matrices
+    """
+    diag = np.sqrt(np.abs(np.diagonal(precision, axis1=-2, axis2=-1)))
+    rows, cols = lower_triangle_indices(precision.shape[-1])
+    return -mat2vec(precision) / (diag[..., rows] * diag[..., cols])
+
+
+def ridge_precisions(cov, ridge=0.1):
+    """
+    Ridge-regularised precision matrices of a stack of covariance matrices,
+    which are first normalised by the RMS of their variances. Inverted in a
+    single batched call
+    """
+    var = np.diagonal(cov, axis1=-2, axis2=-1)
+    scale = np.sqrt(np.mean(var ** 2, axis=-1))[..., None, None]
+    return np.linalg.inv(cov / scale + ridge * np.eye(cov.shape[-1]))
+
+
+def graphical_lasso(emp_cov, alpha, init=None, rho=1.0, max_iter=500,
+                    tol=1e-4):
+    """
+    Sparse inverse covariance estimate by the graphical lasso, solved with
+    ADMM (Boyd et al. 2011, sec. 6.5). Off-diagonal elements are penalised.
+
+    Parameters
+    ----------
+    emp_cov : array (num_nodes, num_nodes)
+        The empirical covariance matrix
+    alpha : float
+        The L1 penalty
+    init : tuple(array, array) | None
+        The ADMM state returned by a previous call, used to warm-start the
+        solver when estimating a series of similar covariances
+    rho : float
+        The initial ADMM penalty parameter, which is adapted to balance the
+        primal and dual residuals
+    max_iter : int
+        The maximum number of iterations
+    tol : float
+        Convergence tolerance on the primal and dual residuals relative to
+        the size of the estimate
+
+    Returns
+    -------
+    precision : array (num_nodes, num_nodes)
+        The estimated precision matrix
+    state : tuple(array, array)
+        The ADMM state, to be passed as 'init' of the next call
+    """
+    num_nodes = emp_cov.shape[0]
+    off_diag = ~np.eye(num_nodes, dtype=bool)
+    if init is None:
+        sparse = np.diag(1.0 / np.diag(emp_cov))
+        dual = np.zeros_like(emp_cov)
+    else:
+        sparse, dual, rho = init
+        sparse, dual = np.array(sparse, dtype=float), np.array(dual)
+    for _ in range(max_iter):
+        evals, evecs = np.linalg.eigh(rho * (sparse - dual) - emp_cov)
+        evals = (evals + np.sqrt(evals ** 2 + 4 * rho)) / (2 * rho)
+        precision = (evecs * evals).dot(evecs.T)
+        prev_sparse = sparse
+        sparse = precision + dual
+        sparse[off_diag] = (np.sign(sparse[off_diag]) * np.maximum(
+            np.abs(sparse[off_diag]) - alpha / rho, 0))
+        dual += precision - sparse
+        primal_res = np.linalg.norm(precision - sparse)
+        dual_res = rho * np.linalg.norm(sparse - prev_sparse)
+        scale = max(np.linalg.norm(sparse), 1.0)
+        if primal_res < tol * scale and dual_res < tol * scale:
+            break
+        # Balance the residuals by adapting the penalty parameter (Boyd et
+        # al. 2011, sec. 3.4.1), rescaling the scaled dual variable to match
+        if primal_res > 10 * dual_res:
+            rho *= 2
+            dual /= 2
+        elif dual_res > 10 * primal_res:
+            rho /= 2
+            dual *= 2
+    return sparse, (sparse, dual, rho)
+
+
+def _graphical_lasso_chain(covs, alpha, max_iter, tol):
+    # Consecutive windows overlap heavily so each solve is warm-started from
+    # the solution of the previous window
+    precisions = np.empty_like(covs)
+    state = None
+    for i, cov in enumerate(covs):
+        precisions[i], state = graphical_lasso(
+            cov, alpha, init=state, max_iter=max_iter, tol=tol)
+    return precisions
+
+
+def graphical_lasso_precisions(cov, alpha=1e-5, max_iter=500, tol=1e-4,
+                               num_processes=1):
+    """
+    Graphical lasso precision matrices of a stack of consecutive window
+    covariances (normalised by their mean variance). The stack is split
+    into contiguous runs, one per process, within which the solves are
+    chained with warm starts.
+    """
+    cov = cov / np.mean(np.diagonal(cov, axis1=-2, axis2=-1),
+                        axis=-1)[..., None, None]
+    num_chains = max(min(num_processes, len(cov)), 1)
+    chains = np.array_split(cov, num_chains)
+    if num_chains > 1:
+        with ProcessPoolExecutor(num_chains) as executor:
+            results = list(executor.map(
+                _graphical_lasso_chain, chains, repeat(alpha),
+                repeat(max_iter), repeat(tol)))
+    else:
+        results = [_graphical_lasso_chain(c, alpha, max_iter, tol)
+                   for c in chains]
+    return np.concatenate(results)
+
+
+def windowed_fc(tc, window_tp=60, step=1, sigma=None, method='corr',
+                ridge=0.1, alpha=1e-5, num_processes=1, dtype=np.float32):
+    """
+    Computes the Fisher z-transformed (partial) correlation between each pair
+    of nodes over all sliding windows of a time course at once
+
+    Parameters
+    ----------
+    tc : array (num_timepoints, num_nodes)
+        The time courses of each node (e.g. dual-regressed ICA components)
+    window_tp : int
+        The length of each window in timepoints
+    step : int
+        The number of timepoints between the starts of consecutive windows
+    sigma : float | None
+        The standard deviation of the Gaussian used to taper the windows
+        (see `fc_taper`). Rectangular windows are used if None.
+    method : str
+        One of FC_METHODS
+    ridge : float
+        The regularisation added to the normalised covariances by 'ridge_pc'
+    alpha : float
+        The L1 penalty of the graphical lasso used by 'reg_pc'
+    num_processes : int
+        The number of processes the graphical lasso fits are distributed over
+    dtype : type
+        The floating point type the windows are computed in and returned as
+
+    Returns
+    -------
+    fc : array (num_windows, num_nodes * (num_nodes - 1) / 2)
+        The lower triangles (see `mat2vec`) of the connectivity matrices
+    """
+    if method not in FC_METHODS:
+        raise ValueError("Unrecognised FC method '{}', can be one of '{}'"
+                         .format(method, "', '".join(FC_METHODS)))
+    tc = np.asarray(tc, dtype=dtype)
+    if tc.ndim != 2:
+        raise ValueError("Time courses must be 2D (timepoints x nodes)")
+    if window_tp > len(tc):
+        raise ValueError(
+            "Window length ({}) is longer than the time course ({})".format(
+                window_tp, len(tc)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'corr':
+            if sigma is None:
+                var, cov = _rectangular_window_moments(tc, window_tp, step)
+            else:
+                cov = window_covariances(tc, window_tp, step, sigma)
+                var = np.diagonal(cov, axis1=1, axis2=2)
+                cov = mat2vec(cov)
+            std = np.sqrt(var)
+            rows, cols = lower_triangle_indices(tc.shape[1])
+            corr = cov / (std[:, rows] * std[:, cols])
+        else:
+            cov = window_covariances(tc, window_tp, step, sigma)
+            if method == 'part_corr':
+                precision = np.linalg.inv(cov)
+            elif method == 'ridge_pc':
+                precision = ridge_precisions(cov, ridge=ridge)
+            else:
+                precision = graphical_lasso_precisions(
+                    cov.astype(float), alpha=alpha,
+                    num_processes=num_processes)
+            corr = partial_correlations(precision)
+    np.clip(corr, -MAX_CORRELATION, MAX_CORRELATION, out=corr)
+    return np.arctanh(corr).astype(dtype, copy=False)
+
+
+def subsample_windows(fc, num_samples=100):
+    """
+    Selects the windows used to fit the FC states from the windows of one
+    session. Long sessions are resampled to 'num_samples' windows and only
+    the windows at local maxima of the variance across node pairs (i.e. the
+    most distinct connectivity patterns) are kept.
+    """
+    if len(fc) <= num_samples:
+        return fc
+    fc = resample(fc, num_samples, axis=0)
+    return fc[argrelextrema(np.var(fc, axis=1), np.greater)[0]]
+
+
+_shared_samples = None
+
+
+def _attach_shared_samples(name, shape, dtype):
+    # Worker initializer, the samples are read from the shared memory block
+    # rather than pickled into every task
+    global _shared_samples
+    block = shared_memory.SharedMemory(name=name)
+    _shared_samples = (block, np.ndarray(shape, dtype=dtype,
+                                         buffer=block.buf))
+
+
+def _fit_gmm(num_components, covariance_type, samples=None, seed=None):
+    from sklearn.mixture import GaussianMixture
+    if samples is None:
+        samples = _shared_samples[1]
+    gmm = GaussianMixture(n_components=num_components,
+                          covariance_type=covariance_type,
+                          random_state=seed)
+    gmm.fit(samples)
+    return gmm.bic(samples), gmm
+
+
+def select_gmm(samples, max_components=13,
+               covariance_types=GMM_COVARIANCE_TYPES, num_processes=1,
+               seed=None):
+    """
+    Fits Gaussian mixture models over a grid of component numbers
+    (1 to max_components - 1) and covariance types and selects the one with
+    the lowest BIC. The grid is fitted in parallel if 'num_processes' is
+    greater than 1, with the samples placed in shared memory once.
+
+    Returns
+    -------
+    bic : array (len(covariance_types), max_components - 1)
+        The BIC of each model in the grid
+    best : GaussianMixture
+        The model with the lowest BIC
+    """
+    grid = [(n, t) for t in covariance_types
+            for n in range(1, max_components)]
+    samples = np.ascontiguousarray(samples)
+    if num_processes > 1 and len(grid) > 1:
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(samples.nbytes, 1))
+        try:
+            np.ndarray(samples.shape, dtype=samples.dtype,
+                       buffer=block.buf)[:] = samples
+            with ProcessPoolExecutor(
+                    num_processes, initializer=_attach_shared_samples,
+                    initargs=(block.name, samples.shape,
+                              samples.dtype)) as executor:
+                results = list(executor.map(
+                    _fit_gmm, *zip(*grid), repeat(None), repeat(seed)))
+        finally:
+            block.close()
+            block.unlink()
+    else:
+        results = [_fit_gmm(n, t, samples, seed) for n, t in grid]
+    bic = np.array([b for b, _ in results]).reshape(
+        len(covariance_types), max_components - 1)
+    return bic, results[int(np.argmin(bic))][1]
+
+
+class SlidingWindowFCInputSpec(BaseInterfaceInputSpec):
+
+    in_file = File(exists=True, mandatory=True,
+                   desc=("Text file containing the node time courses "
+                         "(timepoints x nodes)"))
+    components = traits.List(
+        traits.Int, desc="1-based indices of the nodes to include")
+    window_tp = traits.Int(60, usedefault=True,
+                           desc="Length of the windows in timepoints")
+    step = traits.Int(1, usedefault=True,
+                      desc="Number of timepoints between consecutive windows")
+    sigma = traits.Float(
+        desc=("Standard deviation of the Gaussian taper applied to the "
+              "windows in timepoints. Rectangular windows if not provided"))
+    method = traits.Enum(*FC_METHODS, usedefault=True,
+                         desc="How the connectivity is estimated")
+    ridge = traits.Float(0.1, usedefault=True,
+                         desc="Regularisation used by the 'ridge_pc' method")
+    alpha = traits.Float(1e-5, usedefault=True,
+                         desc="L1 penalty used by the 'reg_pc' method")
+    num_processes = traits.Int(
+        1, usedefault=True,
+        desc="The number of processes the 'reg_pc' fits are distributed over")
+    out_file = File(genfile=True, desc="The windowed FC array (.npy)")
+
+
+class SlidingWindowFCOutputSpec(TraitedSpec):
+
+    out_file = File(exists=True, desc=(
+        "float32 array of the Fisher z-transformed lower triangles of the "
+        "correlation matrix of each window (windows x node pairs)"))
+
+
+class SlidingWindowFC(BaseInterface):
+    """
+    Sliding-window dynamic functional connectivity of a single session
+    """
+
+    input_spec = SlidingWindowFCInputSpec
+    output_spec = SlidingWindowFCOutputSpec
+
+    def _run_interface(self, runtime):
+        tc = np.loadtxt(self.inputs.in_file, ndmin=2)
+        if isdefined(self.inputs.components):
+            tc = tc[:, [c - 1 for c in self.inputs.components]]
+        fc = windowed_fc(
+            tc, window_tp=self.inputs.window_tp, step=self.inputs.step,
+            sigma=(self.inputs.sigma if isdefined(self.inputs.sigma)
+                   else None),
+            method=self.inputs.method, ridge=self.inputs.ridge,
+            alpha=self.inputs.alpha,
+            num_processes=self.inputs.num_processes)
+        np.save(self._gen_outfilename(), fc)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_outfilename()
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            return self._gen_outfilename()
+        assert False
+
+    def _gen_outfilename(self):
+        if isdefined(self.inputs.out_file):
+            return os.path.abspath(self.inputs.out_file)
+        return os.path.abspath('dynamic_fc.npy')
+
+
+class DynamicFCStatesInputSpec(BaseInterfaceInputSpec):
+
+    in_files = traits.List(
+        traits.Either(File(exists=True), traits.List(File(exists=True))),
+        mandatory=True,
+        desc=("The windowed FC arrays of every session (nested lists, e.g. "
+              "from joins over visits then subjects, are flattened)"))
+    max_states = traits.Int(
+        13, usedefault=True,
+        desc=("The GMMs considered have between 1 and max_states - 1 "
+              "components"))
+    num_processes = traits.Int(
+        1, usedefault=True,
+        desc="The number of processes the GMM grid is fitted over")
+    seed = traits.Int(desc="Seed for the GMM initialisation")
+    out_dir = Directory('dynamic_fc_states', usedefault=True,
+                        desc="The output directory")
+
+
+class DynamicFCStatesOutputSpec(TraitedSpec):
+
+    out_dir = Directory(exists=True, desc=(
+        "Directory containing the state of each window of each session "
+        "(FC_states.txt, one row per session in the order of the inputs), "
+        "the state centroids and weights (GMM_means.txt, GMM_weights.txt) "
+        "and the BIC of the model grid (BIC.txt, one row per number of "
+        "states and one column per covariance type)"))
+
+
+class DynamicFCStates(BaseInterface):
+    """
+    Clusters the windowed FC of a group of sessions into recurring FC states
+    with a Gaussian mixture model, whose number of components and covariance
+    type are selected by BIC over a grid of models fitted in parallel
+    """
+
+    input_spec = DynamicFCStatesInputSpec
+    output_spec = DynamicFCStatesOutputSpec
+
+    def _run_interface(self, runtime):
+        from sklearn.mixture import GaussianMixture
+        seed = self.inputs.seed if isdefined(self.inputs.seed) else None
+        fcs = [np.load(f) for f in self._flattened_inputs()]
+        samples = np.concatenate([subsample_windows(f) for f in fcs])
+        bic, best = select_gmm(
+            samples, max_components=self.inputs.max_states,
+            num_processes=self.inputs.num_processes, seed=seed)
+        # Refit to all windows, initialised from the states of the subsample
+        gmm = GaussianMixture(n_components=best.n_components,
+                              covariance_type=best.covariance_type,
+                              means_init=best.means_, random_state=seed)
+        all_windows = np.concatenate(fcs)
+        gmm.fit(all_windows)
+        labels = np.split(gmm.predict(all_windows),
+                          np.cumsum([len(f) for f in fcs])[:-1])
+        out_dir = os.path.abspath(self.inputs.out_dir)
+        os.makedirs(out_dir, exist_ok=True)
+        with open(op.join(out_dir, 'FC_states.txt'), 'w') as f:
+            for session_labels in labels:
+                f.write(' '.join(str(l) for l in session_labels) + '\n')
+        np.savetxt(op.join(out_dir, 'GMM_means.txt'), gmm.means_, fmt='%f')
+        np.savetxt(op.join(out_dir, 'GMM_weights.txt'), gmm.weights_,
+                   fmt='%f')
+        # One row per number of states, one column per covariance type
+        np.savetxt(op.join(out_dir, 'BIC.txt'),
+                   np.column_stack((np.arange(1, len(bic.T) + 1), bic.T)),
+                   fmt=['%d'] + ['%f'] * len(bic),
+                   header=' '.join(('num_states',) + GMM_COVARIANCE_TYPES))
+        return runtime
+
+    def _flattened_inputs(self):
+        in_files = []
+        for in_file in self.inputs.in_files:
+            if isinstance(in_file, (list, tuple)):
+                in_files.extend(in_file)
+            else:
+                in_files.append(in_file)
+        return in_files
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_dir'] = os.path.abspath(self.inputs.out_dir)
+        return outputs
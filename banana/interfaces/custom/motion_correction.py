@@ -20,6 +20,9 @@ from nipype.interfaces import fsl
 import pydicom
 import math
 import subprocess as sp
+from collections import Counter
+from banana.utils.framing import (
+    MotionFramer, parse_time, format_time, volume_at)
 
 
 class MotionMatCalculationInputSpec(BaseInterfaceInputSpec):
@@ -783,112 +786,52 @@ class MotionFraming(BaseInterface):
         else:
             if isdefined(self.inputs.pet_offset):
                 offset = self.inputs.pet_offset
-                pet_st = (dt.datetime.strptime(pet_st, '%H%M%S.%f') +
-                          dt.timedelta(seconds=offset)).strftime('%H%M%S.%f')
+                pet_st = format_time(parse_time(pet_st) + offset)
             if (isdefined(self.inputs.pet_duration) and
                     self.inputs.pet_duration > 0):
                 pet_len = self.inputs.pet_duration
-                pet_endtime = ((dt.datetime.strptime(pet_st, '%H%M%S.%f') +
-                                dt.timedelta(seconds=pet_len))
-                               .strftime('%H%M%S.%f'))
-
-        md_0 = mean_displacement[0]
-        max_md = mean_displacement[0]
-        frame_vol = [0]
-        frame_st4pet = []
-
-        scan_duration = [
-            (dt.datetime.strptime(start_times[i], '%H%M%S.%f') -
-             dt.datetime.strptime(start_times[i - 1], '%H%M%S.%f')
-             ).total_seconds() for i in range(1, len(start_times))]
-
-        for i, md in enumerate(mean_displacement[1:]):
-
-            current_md = md
-            if (np.abs(md_0 - current_md) > th or
-                    np.abs(max_md - current_md) > th):
-                duration = np.sum(scan_duration[frame_vol[-1]:i + 1])
-                if duration > temporal_th:
-                    if i + 1 not in frame_vol:
-                        frame_vol.append(i + 1)
-
-                    md_0 = current_md
-                    max_md = current_md
-                else:
-                    prev_md = mean_displacement[frame_vol[-1]]
-                    if (prev_md - current_md) > th * 2:
-                        frame_vol.remove(frame_vol[-1])
-                    elif (current_md - prev_md) > th:
-                        frame_vol.remove(frame_vol[-1])
-                        frame_vol.append(i)
-            elif mean_displacement_consecutive[i] > th:
-                duration = np.sum(scan_duration[frame_vol[-1]:i + 1])
-                if duration > temporal_th:
-                    if i + 1 not in frame_vol:
-                        frame_vol.append(i + 1)
-                    md_0 = current_md
-                    max_md = current_md
-            elif current_md > max_md:
-                max_md = current_md
-            elif current_md < md_0:
-                md_0 = current_md
-
-        duration = np.sum(scan_duration[frame_vol[-1]:i + 2])
-        if duration > temporal_th:
-            if (i + 2) not in frame_vol:
-                frame_vol.append(i + 2)
-        else:
-            frame_vol.remove(frame_vol[-1])
-            frame_vol.append(i + 2)
-
-        frame_vol = sorted(frame_vol)
+                pet_endtime = format_time(parse_time(pet_st) + pet_len)
+
+        # The timestamps are parsed once and the session replayed through the
+        # same engine used to frame sessions during their acquisition
+        times = [parse_time(t) for t in start_times]
+        frame_vol = MotionFramer(
+            motion_threshold=th, temporal_threshold=temporal_th).replay(
+                times, mean_displacement.tolist(),
+                mean_displacement_consecutive.tolist())
         frame_start_times = [start_times[x] for x in frame_vol]
+        frame_st4pet = []
         if pet_st and pet_endtime:
-            frame_st4pet = [
-                x for x in frame_start_times if
-                (dt.datetime.strptime(x, '%H%M%S.%f') >
-                 dt.datetime.strptime(pet_st, '%H%M%S.%f')
-                 and dt.datetime.strptime(x, '%H%M%S.%f') <
-                 dt.datetime.strptime(pet_endtime, '%H%M%S.%f'))]
-            if frame_start_times[0] in frame_st4pet:
-                frame_st4pet.remove(frame_start_times[0])
-            if frame_start_times[-1] in frame_st4pet:
-                frame_st4pet.remove(frame_start_times[-1])
-            frame_st4pet.append(pet_st)
-            frame_st4pet.append(pet_endtime)
-            frame_st4pet = sorted(frame_st4pet)
-            if ((dt.datetime.strptime(frame_st4pet[1], '%H%M%S.%f') -
-                    dt.datetime.strptime(frame_st4pet[0], '%H%M%S.%f'))
-                    .total_seconds() < 30):
-                frame_st4pet.remove(frame_st4pet[1])
-            if ((dt.datetime.strptime(frame_st4pet[-1], '%H%M%S.%f') -
-                    dt.datetime.strptime(frame_st4pet[-2], '%H%M%S.%f'))
-                    .total_seconds() < 30):
-                frame_st4pet.remove(frame_st4pet[-2])
-            frame_vol = [i for i in range(len(start_times)) for j in
-                         range(len(frame_st4pet)) if start_times[i] ==
-                         frame_st4pet[j]]
-            if (dt.datetime.strptime(start_times[0], '%H%M%S.%f') >
-                    dt.datetime.strptime(pet_st, '%H%M%S.%f')):
+            pet_start, pet_end = parse_time(pet_st), parse_time(pet_endtime)
+            # The frame boundaries within the PET acquisition, with the start
+            # and end of the acquisition in place of the first and last
+            frame_st4pet = sorted(
+                [(times[x], start_times[x]) for x in frame_vol[1:-1]
+                 if pet_start < times[x] < pet_end] +
+                [(pet_start, pet_st), (pet_end, pet_endtime)])
+            if round(frame_st4pet[1][0] - frame_st4pet[0][0], 6) < 30:
+                del frame_st4pet[1]
+            if round(frame_st4pet[-1][0] - frame_st4pet[-2][0], 6) < 30:
+                del frame_st4pet[-2]
+            boundaries = Counter(t for _, t in frame_st4pet)
+            frame_vol = [i for i, t in enumerate(start_times)
+                         for _ in range(boundaries[t])]
+            # A PET start or end that falls on the start of a volume has
+            # already been matched to it above
+            if times[0] > pet_start:
                 frame_vol.append(0)
             else:
-                vol = [i for i in range(len(start_times)) if
-                       (dt.datetime.strptime(start_times[i], '%H%M%S.%f') <
-                        dt.datetime.strptime(frame_st4pet[0], '%H%M%S.%f') and
-                        dt.datetime.strptime(start_times[i + 1], '%H%M%S.%f') >
-                        dt.datetime.strptime(frame_st4pet[0], '%H%M%S.%f'))]
-                frame_vol.append(vol[0])
-            if (dt.datetime.strptime(start_times[-1], '%H%M%S.%f') <
-                    dt.datetime.strptime(pet_endtime, '%H%M%S.%f')):
+                vol = volume_at(times, frame_st4pet[0][0])
+                if vol not in frame_vol:
+                    frame_vol.append(vol)
+            if times[-1] < pet_end:
                 frame_vol.append(len(start_times) - 1)
             else:
-                vol = [i for i in range(len(start_times)) if
-                       (dt.datetime.strptime(start_times[i], '%H%M%S.%f') <
-                        dt.datetime.strptime(frame_st4pet[-1], '%H%M%S.%f') and
-                        dt.datetime.strptime(start_times[i + 1], '%H%M%S.%f') >
-                        dt.datetime.strptime(frame_st4pet[-1], '%H%M%S.%f'))]
-                frame_vol.append(vol[0])
+                vol = volume_at(times, frame_st4pet[-1][0])
+                if vol not in frame_vol:
+                    frame_vol.append(vol)
             frame_vol = sorted(frame_vol)
+            frame_st4pet = [t for _, t in frame_st4pet]
         np.savetxt('frame_start_times.txt', np.asarray(frame_start_times),
                    fmt='%s')
         os.mkdir('timestamps')
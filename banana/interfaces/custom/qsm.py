@@ -0,0 +1,448 @@
+"""
+In-process QSM reconstruction (Laplacian phase unwrapping, V-SHARP background
+field removal and iLSQR dipole inversion) implemented with NumPy/SciPy FFTs,
+as an alternative to running the STI Suite functions in separate MATLAB
+sessions.
+
+All steps operate on batches of images (e.g. the phase of each coil channel)
+stacked along a leading axis, so each FFT is performed once for the whole
+batch. The k-space kernels are cached by image shape and voxel size, so they
+are shared between the channels, echoes and steps that use them, and
+scipy.fft keeps its own cache of FFT plans for the same shapes.
+"""
+import os.path as op
+from functools import lru_cache
+import numpy as np
+import nibabel as nib
+from scipy import fft
+from scipy.ndimage import binary_erosion
+from nipype.interfaces.base import (
+    TraitedSpec, traits, BaseInterface, BaseInterfaceInputSpec, File,
+    InputMultiPath, OutputMultiPath)
+from banana.exceptions import BananaUsageError
+
+# Gyromagnetic ratio of hydrogen (Hz/T)
+GYROMAGNETIC_RATIO = 42.57747892e6
+
+SPATIAL_AXES = (-3, -2, -1)
+
+
+@lru_cache(maxsize=8)
+def _kspace_coords(shape, voxelsize):
+    """
+    The k-space coordinates (cycles/mm) of the samples of a real FFT
+    (i.e. with the last axis halved) of an image with the given shape and
+    voxel size, as broadcastable (sparse) arrays
+    """
+    freqs = [np.fft.fftfreq(n, d=v) for n, v in zip(shape[:2],
+                                                     voxelsize[:2])]
+    freqs.append(np.fft.rfftfreq(shape[2], d=voxelsize[2]))
+    return np.meshgrid(*freqs, indexing='ij', sparse=True)
+
+
+@lru_cache(maxsize=8)
+def laplacian_kernel(shape, voxelsize):
+    """
+    The Laplacian operator and its inverse (zero at the origin) in the
+    (real) Fourier domain
+    """
+    kx, ky, kz = _kspace_coords(shape, voxelsize)
+    kernel = (-4 * np.pi ** 2 * (kx ** 2 + ky ** 2 + kz ** 2)).astype(
+        np.float32)
+    inverse = np.zeros_like(kernel)
+    np.divide(1.0, kernel, out=inverse, where=kernel != 0)
+    return kernel, inverse
+
+
+@lru_cache(maxsize=32)
+def smv_kernel(shape, voxelsize, radius):
+    """
+    The spherical mean value (SMV) kernel of the given radius (mm) in the
+    (real) Fourier domain
+    """
+    coords = [np.minimum(np.arange(n), n - np.arange(n)) * v
+              for n, v in zip(shape, voxelsize)]
+    x, y, z = np.meshgrid(*coords, indexing='ij', sparse=True)
+    sphere = ((x ** 2 + y ** 2 + z ** 2) <= radius ** 2).astype(np.float32)
+    sphere /= sphere.sum()
+    return fft.rfftn(sphere).real.astype(np.float32)
+
+
+@lru_cache(maxsize=8)
+def dipole_kernel(shape, voxelsize, b0_dir):
+    """
+    The unit dipole kernel, D = 1/3 - (k.H)^2 / |k|^2, in the (real) Fourier
+    domain for a main field in the direction 'b0_dir' (in voxel axes)
+    """
+    h = np.asarray(b0_dir, dtype=float)
+    h /= np.linalg.norm(h)
+    kx, ky, kz = _kspace_coords(shape, voxelsize)
+    k2 = kx ** 2 + ky ** 2 + kz ** 2
+    kh = kx * h[0] + ky * h[1] + kz * h[2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kernel = 1.0 / 3.0 - kh ** 2 / k2
+    kernel[0, 0, 0] = 0.0
+    return kernel.astype(np.float32)
+
+
+def laplacian_unwrap(phase, voxelsize, padsize=(12, 12, 12), workers=1):
+    """
+    Unwraps phase images with the Laplacian method (as MRPhaseUnwrap in STI
+    Suite), i.e. by solving the Poisson equation for the Laplacian of the
+    true phase, which can be calculated from the sine and cosine of the
+    wrapped phase, in the Fourier domain
+
+    Parameters
+    ----------
+    phase : np.array(N, X, Y, Z)
+        Batch of wrapped phase images (radians)
+    voxelsize : tuple(float)
+        Voxel size of the images (mm)
+    padsize : tuple(int)
+        Zero-padding applied to each side of each spatial axis
+    workers : int
+        Number of threads to perform the FFTs with
+
+    Returns
+    -------
+    unwrapped : np.array(N, X, Y, Z)
+        The unwrapped phase images
+    """
+    padded = _pad(phase, padsize)
+    kernel, inverse = laplacian_kernel(padded.shape[-3:], tuple(voxelsize))
+    sin, cos = np.sin(padded), np.cos(padded)
+    lap = cos * _apply(sin, kernel, workers)
+    lap -= sin * _apply(cos, kernel, workers)
+    del sin, cos
+    return _crop(_apply(lap, inverse, workers), padsize)
+
+
+def vsharp(phase, mask, voxelsize, smv_size=12.0, threshold=0.05,
+           workers=1):
+    """
+    Removes the background field from unwrapped phase images with the
+    variable-kernel sophisticated harmonic artifact reduction for phase data
+    (V-SHARP) method (as V_SHARP in STI Suite)
+
+    Parameters
+    ----------
+    phase : np.array(N, X, Y, Z)
+        Batch of unwrapped phase images
+    mask : np.array(N | 1, X, Y, Z)
+        The (brain) mask of each image, or a single mask for all of them
+    voxelsize : tuple(float)
+        Voxel size of the images (mm)
+    smv_size : float
+        The radius of the largest SMV kernel (mm). Kernels decreasing in
+        radius by twice the largest voxel dimension are used towards the
+        edge of the mask
+    threshold : float
+        Truncation threshold of the deconvolution of the high-pass filter of
+        the largest kernel
+    workers : int
+        Number of threads to perform the FFTs with
+
+    Returns
+    -------
+    local : np.array(N, X, Y, Z)
+        The local (tissue) phase
+    new_mask : np.array(N, X, Y, Z)
+        The masks eroded by the smallest kernel, i.e. where the local phase
+        is valid
+    """
+    step = 2 * max(voxelsize)
+    radii = np.arange(smv_size, step - 1e-6, -step)
+    if not len(radii):
+        raise BananaUsageError(
+            "SMV size ({} mm) needs to be at least twice the largest voxel "
+            "dimension ({} mm)".format(smv_size, max(voxelsize)))
+    padsize = tuple(int(np.ceil(smv_size / v)) for v in voxelsize)
+    mask = _pad(np.broadcast_to(mask, phase.shape).astype(np.float32),
+                padsize)
+    padded = _pad(phase, padsize) * mask
+    phase_k = fft.rfftn(padded, axes=SPATIAL_AXES, workers=workers)
+    mask_k = fft.rfftn(mask, axes=SPATIAL_AXES, workers=workers)
+    del padded
+    shape = mask.shape[-3:]
+    local = np.zeros_like(mask)
+    filled = np.zeros(mask.shape, dtype=bool)
+    # Fill in the high-passed phase from the largest kernel that fits
+    # within the mask at each voxel
+    for radius in radii:
+        smv = smv_kernel(shape, tuple(voxelsize), float(radius))
+        eroded = _inverse(mask_k * smv, shape, workers) > 0.999
+        eroded &= ~filled
+        local[eroded] = _inverse(phase_k * (1 - smv), shape,
+                                 workers)[eroded]
+        filled |= eroded
+    # Deconvolve the high-pass filter of the largest kernel
+    hpf = 1 - smv_kernel(shape, tuple(voxelsize), float(radii[0]))
+    inverse = np.zeros_like(hpf)
+    np.divide(1.0, hpf, out=inverse, where=np.abs(hpf) > threshold)
+    local = _apply(local, inverse, workers) * filled
+    return _crop(local, padsize), _crop(filled, padsize)
+
+
+def ilsqr(phase, mask, voxelsize, te, b0, b0_dir=(0.0, 0.0, 1.0),
+          padsize=(12, 12, 12), tol=0.01, max_iter=50, threshold=0.1,
+          workers=1):
+    """
+    Inverts the dipole convolution relating the local field to the
+    susceptibility with an iLSQR-style approach: a least-squares (LSQR) fit
+    of the susceptibility to the local field within the mask, with the
+    ill-conditioned region of k-space near the magic angle (|D| < threshold),
+    where the LSQR solution carries the streaking artifacts, replaced by the
+    thresholded (fast QSM) estimate
+
+    Parameters
+    ----------
+    phase : np.array(N, X, Y, Z)
+        Batch of local (background removed) phase images (radians)
+    mask : np.array(N | 1, X, Y, Z)
+        The mask of each image, or a single mask for all of them
+    voxelsize : tuple(float)
+        Voxel size of the images (mm)
+    te : float
+        The echo time (or echo time difference) of the phase (s)
+    b0 : float
+        The main field strength (T)
+    b0_dir : tuple(float)
+        The direction of the main field (in voxel axes)
+    padsize : tuple(int)
+        Zero-padding applied to each side of each spatial axis
+    tol : float
+        Relative tolerance of the LSQR fit
+    max_iter : int
+        Maximum number of LSQR iterations
+    threshold : float
+        Magnitude of the dipole kernel below which k-space is considered
+        ill-conditioned
+    workers : int
+        Number of threads to perform the FFTs with
+
+    Returns
+    -------
+    chi : np.array(N, X, Y, Z)
+        The susceptibility (ppm)
+    """
+    field = phase / np.float32(2 * np.pi * GYROMAGNETIC_RATIO * b0 * te
+                               * 1e-6)
+    mask = _pad(np.broadcast_to(mask, phase.shape).astype(np.float32),
+                padsize)
+    field = _pad(field, padsize) * mask
+    shape = mask.shape[-3:]
+    dipole = dipole_kernel(shape, tuple(voxelsize),
+                           tuple(float(h) for h in b0_dir))
+
+    def forward(x):
+        return _apply(x, dipole, workers) * mask
+
+    def adjoint(y):
+        return _apply(y * mask, dipole, workers)
+
+    # Batched conjugate gradient least-squares (CGLS, equivalent to LSQR in
+    # exact arithmetic) with the convergence of each image tracked
+    # separately
+    chi = np.zeros_like(field)
+    residual = field.copy()
+    s = adjoint(residual)
+    p = s.copy()
+    gamma = _dot(s, s)
+    norm0 = np.sqrt(gamma)
+    active = norm0 > 0
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        q = forward(p)
+        qq = _dot(q, q)
+        alpha = np.where(active & (qq > 0), gamma / np.where(qq > 0, qq, 1),
+                         0).astype(np.float32)
+        chi += alpha * p
+        residual -= alpha * q
+        s = adjoint(residual)
+        gamma_new = _dot(s, s)
+        active &= np.sqrt(gamma_new) > tol * norm0
+        beta = np.where(active, gamma_new / np.where(gamma > 0, gamma, 1),
+                        0).astype(np.float32)
+        p = s + beta * p
+        gamma = gamma_new
+    del residual, s, p
+    # Replace the ill-conditioned region of the LSQR spectrum with the
+    # thresholded inverse of the field
+    ill = np.abs(dipole) < threshold
+    chi_k = fft.rfftn(chi, axes=SPATIAL_AXES, workers=workers)
+    field_k = fft.rfftn(field, axes=SPATIAL_AXES, workers=workers)
+    chi_k[:, ill] = (field_k[:, ill] *
+                     (np.sign(dipole[ill]) / threshold).astype(np.float32))
+    del field_k
+    chi = _inverse(chi_k, shape, workers) * mask
+    return _crop(chi, padsize)
+
+
+def erode(mask, radius):
+    """
+    Erodes a batch of masks by a sphere with the given radius (voxels)
+    """
+    r = int(radius)
+    x, y, z = np.ogrid[-r:r + 1, -r:r + 1, -r:r + 1]
+    ball = (x ** 2 + y ** 2 + z ** 2) <= r ** 2
+    return np.array([binary_erosion(m, structure=ball) for m in mask])
+
+
+def _apply(x, kernel, workers):
+    "Convolves a batch of images with a (real Fourier domain) kernel"
+    return _inverse(fft.rfftn(x, axes=SPATIAL_AXES, workers=workers) *
+                    kernel, x.shape[-3:], workers)
+
+
+def _inverse(x_k, shape, workers):
+    return fft.irfftn(x_k, s=shape, axes=SPATIAL_AXES,
+                      workers=workers).astype(np.float32, copy=False)
+
+
+def _dot(a, b):
+    "The inner product of each pair of images in two batches"
+    return np.einsum('nijk,nijk->n', a, b, dtype=np.float64).reshape(
+        (-1, 1, 1, 1))
+
+
+def _pad(x, padsize):
+    return np.pad(x, [(0, 0)] * (x.ndim - 3) +
+                  [(int(p), int(p)) for p in padsize])
+
+
+def _crop(x, padsize):
+    return x[(Ellipsis,) + tuple(slice(int(p), x.shape[i - 3] - int(p))
+                                 for i, p in enumerate(padsize))]
+
+
+class NativeQSMInputSpec(BaseInterfaceInputSpec):
+
+    in_files = InputMultiPath(File(exists=True), mandatory=True, desc=(
+        "Wrapped phase images (e.g. one for each coil channel), which are "
+        "processed together as a batch"))
+    masks = InputMultiPath(File(exists=True), mandatory=True, desc=(
+        "Mask for each of the phase images, or a single mask for all of "
+        "them"))
+    mask_erosion = traits.Int(0, usedefault=True, desc=(
+        "Radius (voxels) of the sphere to erode the masks by before "
+        "background field removal"))
+    voxelsize = traits.List([traits.Float(), traits.Float(), traits.Float()],
+                            mandatory=True, desc="Voxel size of the images")
+    padsize = traits.List([12, 12, 12],
+                          (traits.Int(), traits.Int(), traits.Int()),
+                          usedefault=True,
+                          desc="Padding size for each dimension")
+    smv_size = traits.Float(12.0, usedefault=True, desc=(
+        "Radius of the largest V-SHARP kernel (mm)"))
+    vsharp_threshold = traits.Float(0.05, usedefault=True, desc=(
+        "Truncation threshold of the V-SHARP deconvolution"))
+    echo_times = traits.List(traits.Float(), mandatory=True,
+                             desc="Echo times of the acquisition (s)")
+    echo_index = traits.Int(0, usedefault=True, desc=(
+        "Index of the echo the phase images were acquired at"))
+    phase_difference = traits.Bool(False, usedefault=True, desc=(
+        "Whether the phase images are the difference between the phases of "
+        "the second and first echoes (e.g. as combined by "
+        "HIPCombineChannels), in which case the echo time difference is "
+        "used instead of 'echo_index'"))
+    B0 = traits.Float(mandatory=True, desc="B0 field strength (T)")
+    H = traits.List((traits.Float(), traits.Float(), traits.Float()),
+                    mandatory=True, desc="Direction of the B0 field")
+    tol = traits.Float(0.01, usedefault=True,
+                       desc="Relative tolerance of the LSQR fit")
+    max_iter = traits.Int(50, usedefault=True,
+                          desc="Maximum number of LSQR iterations")
+    num_threads = traits.Int(1, usedefault=True,
+                             desc="Number of threads to run the FFTs with")
+
+
+class NativeQSMOutputSpec(TraitedSpec):
+
+    out_files = OutputMultiPath(File(exists=True), desc=(
+        "Susceptibility (ppm) for each of the phase images"))
+    new_masks = OutputMultiPath(File(exists=True), desc=(
+        "The masks the susceptibility is valid within"))
+    out_file = File(exists=True, desc="The first susceptibility image")
+    new_mask = File(exists=True, desc="The first of the new masks")
+
+
+class NativeQSM(BaseInterface):
+    """
+    In-process equivalent of running STI Suite's MRPhaseUnwrap, V_SHARP and
+    QSM_iLSQR on each phase image. The phase images are loaded into a
+    single batch so that each step runs over all of them at once without
+    writing intermediate images.
+    """
+
+    input_spec = NativeQSMInputSpec
+    output_spec = NativeQSMOutputSpec
+
+    def _run_interface(self, runtime):
+        in_files = self.inputs.in_files
+        mask_files = self.inputs.masks
+        if len(mask_files) not in (1, len(in_files)):
+            raise BananaUsageError(
+                "Number of masks ({}) needs to be one or match the number "
+                "of phase images ({})".format(len(mask_files), len(in_files)))
+        ref = nib.load(in_files[0])
+        phase = np.array([self._load(f, ref.shape) for f in in_files])
+        mask = np.array([self._load(f, ref.shape) > 0 for f in mask_files])
+        if self.inputs.mask_erosion:
+            mask = erode(mask, self.inputs.mask_erosion)
+        voxelsize = tuple(self.inputs.voxelsize)
+        workers = self.inputs.num_threads
+        echo_times = self.inputs.echo_times
+        if self.inputs.phase_difference:
+            te = echo_times[1] - echo_times[0]
+        else:
+            te = echo_times[self.inputs.echo_index]
+        unwrapped = laplacian_unwrap(phase, voxelsize,
+                                     padsize=self.inputs.padsize,
+                                     workers=workers)
+        del phase
+        local, new_mask = vsharp(unwrapped, mask, voxelsize,
+                                 smv_size=self.inputs.smv_size,
+                                 threshold=self.inputs.vsharp_threshold,
+                                 workers=workers)
+        del unwrapped
+        chi = ilsqr(local, new_mask, voxelsize, te, self.inputs.B0,
+                    b0_dir=self.inputs.H, padsize=self.inputs.padsize,
+                    tol=self.inputs.tol, max_iter=self.inputs.max_iter,
+                    workers=workers)
+        for i, (chi_array, mask_array) in enumerate(zip(chi, new_mask)):
+            self._save(chi_array, ref, self._output_fname('qsm', i))
+            self._save(mask_array.astype(np.uint8), ref,
+                       self._output_fname('mask', i))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        num = len(self.inputs.in_files)
+        outputs['out_files'] = [self._output_fname('qsm', i)
+                                for i in range(num)]
+        outputs['new_masks'] = [self._output_fname('mask', i)
+                                for i in range(num)]
+        outputs['out_file'] = outputs['out_files'][0]
+        outputs['new_mask'] = outputs['new_masks'][0]
+        return outputs
+
+    def _output_fname(self, name, index):
+        return op.abspath('{}{}.nii.gz'.format(name, index))
+
+    @classmethod
+    def _load(cls, fname, shape):
+        img = nib.load(fname)
+        if img.shape[:3] != shape[:3]:
+            raise BananaUsageError(
+                "Shape of '{}' ({}) doesn't match that of the first phase "
+                "image ({})".format(fname, img.shape, shape))
+        return img.get_fdata(dtype=np.float32).reshape(shape[:3])
+
+    @classmethod
+    def _save(cls, array, ref, fname):
+        img = nib.Nifti1Image(array, ref.affine, ref.header)
+        img.set_data_dtype(array.dtype)
+        img.header['scl_slope'] = 1.0
+        img.header['scl_inter'] = 0.0
+        nib.save(img, fname)
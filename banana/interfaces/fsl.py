@@ -13,10 +13,10 @@ from nipype.interfaces.base import isdefined
 import nibabel as nib
 import numpy as np
 import ast
-import subprocess as sp
-import scipy
+import scipy.signal
 from random import shuffle
 import shutil
+from banana.utils.nifti import iter_volume_chunks
 
 
 warn = warnings.warn
@@ -104,6 +104,35 @@ class MelodicL1FSF(BaseInterface):
         return outputs
 
 
+def gaussian_highpass_matrix(num_vols, sigma):
+    """
+    Returns the (num_vols x num_vols) operator that applies the high-pass
+    filter of 'fslmaths -bptf <sigma> -1' to a time series, i.e. subtracts
+    the Gaussian-weighted local straight-line fit at each time point
+
+    Parameters
+    ----------
+    num_vols : int
+        The number of time points
+    sigma : float
+        The high-pass sigma in volumes
+    """
+    half_width = int(sigma * 3)
+    offsets = np.arange(num_vols)[None, :] - np.arange(num_vols)[:, None]
+    weights = np.where(np.abs(offsets) <= half_width,
+                       np.exp(-0.5 * offsets ** 2 / sigma ** 2), 0.0)
+    n = weights.sum(axis=1, keepdims=True)
+    a = (weights * offsets).sum(axis=1, keepdims=True)
+    c = (weights * offsets ** 2).sum(axis=1, keepdims=True)
+    denom = c * n - a ** 2
+    # Weights that give the intercept (at the current time point) of the
+    # local straight-line fit, falling back to the local mean if degenerate
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fit = np.where(denom != 0, weights * (c - a * offsets) / denom,
+                       weights / n)
+    return np.eye(num_vols) - fit
+
+
 class SignalRegressionInputSpec(BaseInterfaceInputSpec):
 
     fix_dir = Directory(exists=True, desc="Prepared FIX directory",
@@ -117,6 +146,10 @@ class SignalRegressionInputSpec(BaseInterfaceInputSpec):
         desc='Whether or not to high pass the motion parameters', default=None)
     customRegressors = File(exists=True, default=None,
                             desc='File containing custom regressors.')
+    chunk_size = traits.Int(
+        50, usedefault=True,
+        desc=("The number of volumes of the input image to read and project "
+              "at a time"))
 
 
 class SignalRegressionOutputSpec(TraitedSpec):
@@ -125,61 +158,84 @@ class SignalRegressionOutputSpec(TraitedSpec):
 
 
 class SignalRegression(BaseInterface):
+    """
+    Regresses the noise components classified by FIX (and optionally the
+    motion confounds and custom regressors) out of the filtered functional
+    data.
+
+    As all the regressions are linear in time, they are combined into a
+    single (time x time) projection operator up front, which is then applied
+    to the input as it is streamed from disk in chunks of volumes and
+    accumulated into the output, so only one chunk is held in memory in
+    addition to the output buffer.
+    """
 
     input_spec = SignalRegressionInputSpec
     output_spec = SignalRegressionOutputSpec
 
     def _run_interface(self, runtime):
 
-        im2filt = self.inputs.fix_dir+'/filtered_func_data.nii.gz'
+        im2filt = self.inputs.fix_dir + '/filtered_func_data.nii.gz'
         ref = nib.load(im2filt)
         components = []
         with open(self.inputs.labelled_components, 'r') as f:
             for line in f:
                 components.append(line)
         bad_components = ast.literal_eval(components[-1].strip())
-        bad_components = [x-1 for x in bad_components]
-        im2filt = nib.load(im2filt)
+        bad_components = [x - 1 for x in bad_components]
         if self.inputs.highpass:
-            hdr = im2filt.header
-            sa = hdr.structarr
-            TR = sa['pixdim'][4]
-            print('Repetition time from the header: {} sec'.format(str(TR)))
+            TR = ref.header.structarr['pixdim'][4]
+            logger.info('Repetition time from the header: {} sec'.format(TR))
         else:
             TR = None
-        im2filt = im2filt.get_data()
-        [x, y, z, t] = im2filt.shape
-        im2filt = np.reshape(im2filt, (x*y*z, t), order='F').T
-        ICA = self.normalise(np.loadtxt(self.inputs.fix_dir+'/melodic_mix'))
+        shape = ref.shape
+        t = shape[3]
+        projection = self.projection_matrix(t, bad_components, TR=TR)
+        # Output is accumulated as (time x voxels), which has the same
+        # memory layout as the (x, y, z, t) image in Fortran order
+        cleaned = np.zeros((t, int(np.prod(shape[:3]))), dtype=np.float32)
+        slab = max(1, cleaned.shape[1] * self.inputs.chunk_size // t)
+        for start, chunk in iter_volume_chunks(im2filt,
+                                               self.inputs.chunk_size):
+            op = projection[:, start:start + len(chunk)].astype(np.float32)
+            for i in range(0, cleaned.shape[1], slab):
+                cleaned[:, i:i + slab] += op.dot(chunk[:, i:i + slab])
+            del chunk
+        im2save = nib.Nifti1Image(cleaned.T.reshape(shape, order='F'),
+                                  affine=ref.affine)
+        nib.save(
+            im2save, self.inputs.fix_dir + '/filtered_func_data_clean.nii.gz')
+
+        return runtime
+
+    def projection_matrix(self, t, bad_components, TR=None):
+        """
+        Returns the (t x t) operator that applies the motion, custom and
+        noise-component regressions in sequence to a time series
+        """
+        projection = np.eye(t)
+        ICA = self.normalise(np.loadtxt(self.inputs.fix_dir + '/melodic_mix'))
         if self.inputs.motion_regression:
-            mp = self.inputs.fix_dir+'/mc/prefiltered_func_data_mcf.par'
+            mp = self.inputs.fix_dir + '/mc/prefiltered_func_data_mcf.par'
             motion_confounds = self.create_motion_confounds(
                 mp, self.inputs.highpass, TR=TR)
-            ICA = ICA - (np.dot(motion_confounds,
-                                np.dot(np.linalg.pinv(motion_confounds), ICA)))
-            im2filt = (im2filt-np.dot(
-                motion_confounds, np.dot(np.linalg.pinv(motion_confounds),
-                                         im2filt)))
+            motion_proj = np.eye(t) - motion_confounds.dot(
+                np.linalg.pinv(motion_confounds))
+            ICA = motion_proj.dot(ICA)
+            projection = motion_proj.dot(projection)
         if self.inputs.customRegressors:
             cr = np.loadtxt(self.inputs.customRegressors)
             if cr.shape[0] != t:
-                print (
+                logger.warning(
                     'custom regressors and input image have a different '
                     'time lenght. They will not be used for the regression.')
             else:
                 cr = self.normalise(cr)
-                im2filt = im2filt - np.dot(cr, np.dot(np.linalg.pinv(cr),
-                                                      im2filt))
-
-        betaICA = np.dot(np.linalg.pinv(ICA), im2filt)
-        im2filt = im2filt - np.dot(ICA[:, bad_components],
-                                   betaICA[bad_components, :])
-        im_filt = np.reshape(im2filt.T, (x, y, z, t), order='F')
-        im2save = nib.Nifti1Image(im_filt, affine=ref.get_affine())
-        nib.save(
-            im2save, self.inputs.fix_dir+'/filtered_func_data_clean.nii.gz')
-
-        return runtime
+                projection = projection - cr.dot(
+                    np.linalg.pinv(cr).dot(projection))
+        unmix = np.linalg.pinv(ICA)
+        return projection - ICA[:, bad_components].dot(
+            unmix[bad_components, :].dot(projection))
 
     def create_motion_confounds(self, mp, hp, TR=None):
 
@@ -189,24 +245,13 @@ class SignalRegression(BaseInterface):
                                              np.diff(confounds, axis=0))))))
         confounds = self.normalise(
             np.hstack((confounds, np.square(confounds))))
-        if hp == 0:
+        if not isdefined(hp) or hp is None:
+            pass
+        elif hp == 0:
             confounds = scipy.signal.detrend(confounds, axis=0, type='linear')
         elif hp > 0:
-            im2save = nib.Nifti1Image(
-                np.reshape(confounds.T, (confounds.shape[1], 1, 1,
-                                         confounds.shape[0]), order='F'),
-                affine=np.eye(4))
-            nib.save(im2save, self.inputs.fix_dir+'/mc/mc_par_conf.nii.gz')
-            cmd = (
-                'fslmaths {0}/mc_par_conf.nii.gz -bptf {1} -1 '
-                '{0}/mc_par_conf_hp'.format(self.inputs.fix_dir+'/mc',
-                                            str(0.5*float(hp)/TR)))
-            sp.check_output(cmd, shell=True)
-            confounds_hp = (nib.load(
-                self.inputs.fix_dir+'/mc/mc_par_conf_hp.nii.gz')).get_data()
-            confounds = self.normalise(
-                np.reshape(confounds_hp, (confounds.shape[1],
-                                          confounds.shape[0]), order='F').T)
+            confounds = self.normalise(gaussian_highpass_matrix(
+                confounds.shape[0], 0.5 * float(hp) / TR).dot(confounds))
 
         return confounds
 
@@ -3,6 +3,6 @@ from .preproc import (
     DWIPreproc, DWI2Mask, DWIBiasCorrect, DWIDenoise,
     DWIIntensityNorm)
 from .utils import (
-    MRConvert, MRCat, MRCrop, MRPad, MRMath, MRCalc, ExtractFSLGradients,
-    ExtractDWIorB0)
+    MRConvert, CachedMRConvert, NativeMRConvert, MRCat, MRCrop, MRPad,
+    MRMath, MRCalc, ExtractFSLGradients, ExtractDWIorB0)
 from .tracking import GlobalTractography
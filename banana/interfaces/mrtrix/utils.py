@@ -5,6 +5,9 @@ from nipype.interfaces.base import (
 from nipype.interfaces.mrtrix3.reconst import (
     MRTrix3Base, MRTrix3BaseInputSpec)
 from arcana.utils import split_extension
+from banana.requirement import mrtrix_req
+from banana.utils.conversion_cache import ConversionCacheMixin
+from banana.utils import mif
 
 
 # =============================================================================
@@ -119,6 +122,44 @@ class MRConvert(MRTrix3Base):
         return out_name
 
 
+class CachedMRConvert(ConversionCacheMixin, MRConvert):
+    """
+    MRConvert that reuses previous conversions of the same input from the
+    conversion cache (if enabled)
+    """
+
+    source_input = 'in_file'
+    cache_requirements = [mrtrix_req]
+
+
+class NativeMRConvert(CachedMRConvert):
+    """
+    Converts between NIfTI and MRtrix image formats in-process with NumPy
+    (copying the voxel data and translating the header) when it is a plain
+    re-containerisation, falling back to mrconvert otherwise (e.g. when
+    extracting coordinates, changing strides or converting DICOMs)
+    """
+
+    # Inputs that can be handled by the native conversion
+    NATIVE_INPUTS = ('in_file', 'out_file', 'out_ext', 'grad_fsl', 'quiet',
+                     'nthreads', 'environ')
+
+    def _run_interface(self, runtime, *args, **kwargs):
+        if not any(isdefined(v) for k, v in self.inputs.get().items()
+                   if k not in self.NATIVE_INPUTS):
+            grad_fsl = (self.inputs.grad_fsl
+                        if isdefined(self.inputs.grad_fsl) else None)
+            try:
+                mif.convert(self.inputs.in_file, self._gen_outfilename(),
+                            grad_fsl=grad_fsl)
+            except mif.MifNotSupportedError:
+                pass
+            else:
+                runtime.returncode = 0
+                return runtime
+        return super()._run_interface(runtime, *args, **kwargs)
+
+
 class MRCatInputSpec(CommandLineInputSpec):
 
     first_scan = traits.File(
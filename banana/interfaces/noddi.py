@@ -1,10 +1,19 @@
+import os
 import os.path
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.io
+from scipy.special import dawsn
+import nibabel as nib
 from nipype.interfaces.base import (
     BaseInterface, File, TraitedSpec, traits, isdefined,
     BaseInterfaceInputSpec)
 from nipype.interfaces.matlab import MatlabCommand
 from arcana.exceptions import ArcanaError
 from arcana.utils import split_extension
+from banana.interfaces.custom.dwi import tensor_design_matrix, fit_tensors
+from banana.exceptions import BananaUsageError
 
 
 class CreateROIInputSpec(BaseInterfaceInputSpec):
@@ -207,3 +216,530 @@ class SaveParamsAsNIfTI(BaseInterface):
                 os.getcwd(), '{}_{}.nii'.format(self.inputs.output_prefix,
                                                 name))
         return outputs
+
+
+# Default NODDI model parameters (diffusivities in mm^2/s)
+NODDI_PARALLEL_DIFFUSIVITY = 1.7e-3
+NODDI_ISOTROPIC_DIFFUSIVITY = 3.0e-3
+NODDI_DICTIONARY_ODS = np.concatenate(([0.03, 0.06],
+                                       np.linspace(0.09, 0.99, 10)))
+NODDI_DICTIONARY_ICVFS = np.linspace(0.1, 0.99, 12)
+
+
+def fibonacci_hemisphere(num_dirs):
+    """
+    Returns approximately evenly distributed unit vectors over the
+    hemisphere z >= 0
+
+    Parameters
+    ----------
+    num_dirs : int
+        The number of directions to generate
+
+    Returns
+    -------
+    dirs : np.array(num_dirs, 3)
+    """
+    i = np.arange(num_dirs) + 0.5
+    z = 1.0 - i / num_dirs
+    r = np.sqrt(1.0 - z ** 2)
+    phi = np.pi * (3.0 - np.sqrt(5.0)) * i
+    return np.column_stack((r * np.cos(phi), r * np.sin(phi), z))
+
+
+def watson_stick_lut(bval, kappa, d_par, cos_grid, num_polar=96,
+                     num_azimuth=72):
+    """
+    Signal attenuation of sticks dispersed about an axis by a Watson
+    distribution, evaluated by numerical quadrature at a grid of cosines of
+    the angle between the gradient and the dispersion axis
+    """
+    t, t_weights = np.polynomial.legendre.leggauss(num_polar)
+    phi = np.linspace(0.0, 2 * np.pi, num_azimuth, endpoint=False)
+    # Scaled so the weight of the mode is 1 to avoid overflow for large kappa
+    watson = t_weights * np.exp(kappa * (t ** 2 - 1.0))
+    watson /= watson.sum() * num_azimuth
+    sin_theta = np.sqrt(1.0 - cos_grid ** 2)
+    dots = (sin_theta[:, None, None] * np.sqrt(1.0 - t ** 2)[None, :, None] *
+            np.cos(phi)[None, None, :] +
+            cos_grid[:, None, None] * t[None, :, None])
+    return np.einsum('ctp,t->c', np.exp(-bval * d_par * dots ** 2), watson)
+
+
+def watson_mean_cos2(kappa):
+    """
+    The expected squared cosine between a Watson distributed vector and
+    its mean axis
+    """
+    root = np.sqrt(kappa)
+    return 1.0 / (2.0 * root * dawsn(root)) - 1.0 / (2.0 * kappa)
+
+
+def noddi_dictionary_path(bvals, bvecs, cache_dir,
+                          d_par=NODDI_PARALLEL_DIFFUSIVITY,
+                          d_iso=NODDI_ISOTROPIC_DIFFUSIVITY, num_dirs=500):
+    """
+    Returns the path the NODDI dictionary is cached at for the given protocol
+    and model parameters
+    """
+    key = hashlib.sha1()
+    for arr in (np.round(np.asarray(bvals, dtype=float).ravel()),
+                np.round(np.asarray(bvecs, dtype=float).reshape(3, -1), 4),
+                np.array([d_par, d_iso, num_dirs], dtype=float),
+                NODDI_DICTIONARY_ODS, NODDI_DICTIONARY_ICVFS):
+        key.update(np.ascontiguousarray(arr).tobytes())
+    return os.path.join(cache_dir,
+                        'noddi_dictionary_{}.npz'.format(key.hexdigest()))
+
+
+def noddi_dictionary(bvals, bvecs, d_par=NODDI_PARALLEL_DIFFUSIVITY,
+                     d_iso=NODDI_ISOTROPIC_DIFFUSIVITY, num_dirs=500,
+                     cache_dir=None):
+    """
+    Generates the dictionary of NODDI compartment responses for an
+    acquisition protocol. Each atom is the combined intra- and extra-cellular
+    response for a given (ODI, ICVF) pair, rotated to each of 'num_dirs'
+    fibre directions, with a final isotropic atom shared by all directions.
+
+    If 'cache_dir' is provided the dictionary is saved there, keyed by a hash
+    of the protocol and model parameters, and reloaded on subsequent calls
+
+    Parameters
+    ----------
+    bvals : np.array(N)
+        The b-values of each volume (s/mm^2)
+    bvecs : np.array(3, N)
+        The gradient directions of each volume in FSL format
+
+    Returns
+    -------
+    dictionary : dict
+        'dirs' (D, 3), 'atoms' (D, N, K + 1), 'ods' (K) and 'icvfs' (K)
+    """
+    bvals = np.asarray(bvals, dtype=float).ravel()
+    bvecs = np.asarray(bvecs, dtype=float).reshape(3, -1)
+    if cache_dir is not None:
+        cache_path = noddi_dictionary_path(bvals, bvecs, cache_dir,
+                                           d_par=d_par, d_iso=d_iso,
+                                           num_dirs=num_dirs)
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                return dict(cached)
+    dirs = fibonacci_hemisphere(num_dirs)
+    norms = np.sqrt(np.sum(bvecs ** 2, axis=0))
+    grads = bvecs / np.where(norms > 0, norms, 1.0)
+    # Absolute cosine between each direction and each gradient
+    cosines = np.clip(np.abs(dirs.dot(grads)), 0.0, 1.0)
+    cos2 = cosines ** 2
+    kappas = 1.0 / np.tan(NODDI_DICTIONARY_ODS * np.pi / 2.0)
+    ods = np.repeat(NODDI_DICTIONARY_ODS, len(NODDI_DICTIONARY_ICVFS))
+    icvfs = np.tile(NODDI_DICTIONARY_ICVFS, len(NODDI_DICTIONARY_ODS))
+    atoms = np.empty((num_dirs, len(bvals), len(ods) + 1))
+    cos_grid = np.linspace(0.0, 1.0, 501)
+    shells = np.round(bvals, -1)
+    for i, kappa in enumerate(kappas):
+        # Intra-cellular sticks, interpolated from a look-up table per shell
+        intra = np.empty_like(cosines)
+        for shell in np.unique(shells):
+            vols = shells == shell
+            lut = watson_stick_lut(shell, kappa, d_par, cos_grid)
+            intra[:, vols] = np.interp(cosines[:, vols], cos_grid, lut)
+        # Extra-cellular tortuous zeppelins, averaged in closed form
+        mean_cos2 = watson_mean_cos2(kappa)
+        for j, icvf in enumerate(NODDI_DICTIONARY_ICVFS):
+            d_perp = d_par * (1.0 - icvf)
+            d_axial = d_perp + (d_par - d_perp) * mean_cos2
+            d_radial = d_perp + (d_par - d_perp) * (1.0 - mean_cos2) / 2.0
+            extra = np.exp(-bvals * (d_axial * cos2 + d_radial * (1 - cos2)))
+            atoms[:, :, i * len(NODDI_DICTIONARY_ICVFS) + j] = (
+                icvf * intra + (1.0 - icvf) * extra)
+    atoms[:, :, -1] = np.exp(-bvals * d_iso)
+    dictionary = {'dirs': dirs, 'atoms': atoms, 'ods': ods, 'icvfs': icvfs}
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temporary file first so concurrent jobs never read a
+        # partially written dictionary
+        tmp_path = cache_path[:-4] + '.{}.tmp.npz'.format(os.getpid())
+        np.savez(tmp_path, **dictionary)
+        os.replace(tmp_path, cache_path)
+    return dictionary
+
+
+def _solve_passive(gram, corr, passive):
+    """
+    Solves the normal equations of each target restricted to its passive set
+    of coefficients, padding the systems of targets with smaller passive sets
+    with the identity so they can be solved as a single batch
+    """
+    sizes = passive.sum(axis=1)
+    size = max(int(sizes.max()), 1)
+    # The indices of the passive coefficients come first in each row
+    idx = np.argsort(~passive, axis=1, kind='stable')[:, :size]
+    valid = np.arange(size) < sizes[:, None]
+    sub = gram[idx[:, :, None], idx[:, None, :]]
+    sub = np.where(valid[:, :, None] & valid[:, None, :], sub, np.eye(size))
+    rhs = np.where(valid, np.take_along_axis(corr, idx, axis=1), 0.0)
+    sol = np.linalg.solve(sub, rhs[:, :, None])[:, :, 0]
+    coefs = np.zeros_like(corr)
+    np.put_along_axis(coefs, idx, np.where(valid, sol, 0.0), axis=1)
+    return coefs
+
+
+def batch_nnls(design, targets, tol=None, max_iter=None):
+    """
+    Solves the non-negative least squares problems of a batch of targets
+    sharing the same design matrix, running the active-set method of Lawson
+    and Hanson (as used by scipy.optimize.nnls) in lockstep over the batch.
+    Each iteration adds a coefficient to the passive sets of the targets that
+    haven't converged and solves the restricted systems of all of them at
+    once.
+
+    Parameters
+    ----------
+    design : np.array(N, K)
+        The design matrix
+    targets : np.array(V, N)
+        The V targets to fit
+    tol : float | None
+        Tolerance on the gradient used to detect convergence. Defaults to
+        that used by scipy.optimize.nnls
+    max_iter : int | None
+        Maximum number of iterations, defaults to 3 * K
+
+    Returns
+    -------
+    coefs : np.array(V, K)
+        The non-negative coefficients that minimise the residuals
+    """
+    gram = design.T.dot(design)
+    corr = np.asarray(targets, dtype=float).dot(design)
+    if tol is None:
+        tol = (10 * max(design.shape) * np.linalg.norm(design, 1) *
+               np.finfo(float).eps)
+    if max_iter is None:
+        max_iter = 3 * design.shape[1]
+    coefs = np.zeros_like(corr)
+    passive = np.zeros(corr.shape, dtype=bool)
+    active = np.arange(len(corr))
+    for _ in range(max_iter):
+        # Add the coefficient with the largest (positive) gradient to the
+        # passive set of each target that hasn't converged
+        grad = np.where(passive[active], -np.inf,
+                        corr[active] - coefs[active].dot(gram))
+        best = np.argmax(grad, axis=1)
+        improvable = grad[np.arange(len(active)), best] > tol
+        active, best = active[improvable], best[improvable]
+        if not len(active):
+            break
+        passive[active, best] = True
+        inner = active
+        while len(inner):
+            sol = _solve_passive(gram, corr[inner], passive[inner])
+            negative = passive[inner] & (sol <= tol)
+            infeasible = negative.any(axis=1)
+            coefs[inner[~infeasible]] = sol[~infeasible]
+            inner = inner[infeasible]
+            if not len(inner):
+                break
+            # Step towards the solutions of infeasible targets until the
+            # first coefficient hits zero and drop it from the passive set
+            sol, negative = sol[infeasible], negative[infeasible]
+            current = coefs[inner]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratios = np.where(negative, current / (current - sol), np.inf)
+            current += ratios.min(axis=1)[:, None] * (sol - current)
+            passive[inner] &= current > tol
+            coefs[inner] = np.where(passive[inner], current, 0.0)
+    return coefs
+
+
+def fit_noddi(signals, bvals, bvecs, dictionary, b0_threshold=10.0):
+    """
+    Fits the NODDI model to a chunk of voxels by non-negative least squares
+    against the dictionary atoms aligned with each voxel's principal
+    diffusion direction. Voxels are grouped by their closest dictionary
+    direction so each group shares the same design matrix and is fitted as
+    a batch (see `batch_nnls`).
+
+    Parameters
+    ----------
+    signals : np.array(V, N)
+        The diffusion-weighted signals of V voxels
+    bvals : np.array(N)
+        The b-values of each volume
+    bvecs : np.array(3, N)
+        The gradient directions of each volume in FSL format
+    dictionary : dict
+        The dictionary returned by `noddi_dictionary`
+
+    Returns
+    -------
+    params : dict
+        'ficvf', 'odi', 'fiso', 'kappa', 'fmin', 'error_code' (V) and
+        'fibredirs' (V, 3)
+    """
+    bvals = np.asarray(bvals, dtype=float).ravel()
+    signals = np.asarray(signals, dtype=float)
+    b0s = bvals <= b0_threshold
+    s0 = signals[:, b0s].mean(axis=1)
+    valid = s0 > 0
+    normed = np.zeros_like(signals)
+    normed[valid] = signals[valid] / s0[valid, None]
+    params = fit_tensors(np.where(valid[:, None], signals, 1.0),
+                         tensor_design_matrix(bvals, bvecs), method='ols')
+    dxx, dyy, dzz, dxy, dxz, dyz = params[:, :6].T
+    tensors = np.stack((np.stack((dxx, dxy, dxz), axis=-1),
+                        np.stack((dxy, dyy, dyz), axis=-1),
+                        np.stack((dxz, dyz, dzz), axis=-1)), axis=-2)
+    fibredirs = np.linalg.eigh(tensors)[1][:, :, 2]
+    closest = np.argmax(np.abs(fibredirs.dot(dictionary['dirs'].T)), axis=1)
+    ods = dictionary['ods']
+    icvfs = dictionary['icvfs']
+    weights = np.zeros((len(signals), len(ods) + 1))
+    fmin = np.zeros(len(signals))
+    for dir_index in np.unique(closest[valid]):
+        voxels = np.flatnonzero((closest == dir_index) & valid)
+        atoms = dictionary['atoms'][dir_index]
+        weights[voxels] = batch_nnls(atoms, normed[voxels])
+        fmin[voxels] = np.sum((weights[voxels].dot(atoms.T) -
+                               normed[voxels]) ** 2, axis=1)
+    total = weights.sum(axis=1)
+    aniso = weights[:, :-1].sum(axis=1)
+    error_code = np.where(valid & (total > 0), 0, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fiso = np.where(total > 0, weights[:, -1] / total, 0.0)
+        ficvf = np.where(aniso > 0, weights[:, :-1].dot(icvfs) / aniso, 0.0)
+        odi = np.where(aniso > 0, weights[:, :-1].dot(ods) / aniso, 0.0)
+        kappa = np.where(odi > 0, 1.0 / np.tan(odi * np.pi / 2.0), 0.0)
+    return {'ficvf': ficvf, 'odi': odi, 'fiso': fiso, 'kappa': kappa,
+            'fmin': fmin, 'error_code': error_code, 'fibredirs': fibredirs}
+
+
+# Loaded once in each worker process of AmicoNODDIFitting
+_worker_dictionary = None
+
+
+def _load_worker_dictionary(dictionary_path):
+    global _worker_dictionary
+    with np.load(dictionary_path) as cached:
+        _worker_dictionary = dict(cached)
+
+
+def _fit_noddi_chunk(signals, bvals, bvecs, b0_threshold):
+    return fit_noddi(signals, bvals, bvecs, _worker_dictionary,
+                     b0_threshold=b0_threshold)
+
+
+class NumpyCreateROIInputSpec(BaseInterfaceInputSpec):
+
+    in_file = File(
+        exists=True, mandatory=True,
+        desc="Input diffusion file to create the ROI for")
+
+    brain_mask = File(exists=True, mandatory=True, desc="Whole brain mask")
+
+    out_file = File(
+        genfile=True, hash_files=False,
+        desc="The name of the ROI file to be generated")
+
+
+class NumpyCreateROIOutputSpec(TraitedSpec):
+
+    out_file = File(exists=True, desc='ROI for NODDI processing')
+
+
+class NumpyCreateROI(CreateROI):
+    """
+    Creates a NODDI ROI file in-process, saving the same 'roi', 'mask' and
+    'idx' variables as the NODDI toolbox's CreateROI (so it can be used with
+    either fitting backend)
+    """
+
+    input_spec = NumpyCreateROIInputSpec
+    output_spec = NumpyCreateROIOutputSpec
+
+    def _run_interface(self, runtime):
+        data = np.asanyarray(nib.load(self.inputs.in_file).dataobj)
+        mask = np.asanyarray(
+            nib.load(self.inputs.brain_mask).dataobj).astype(float)
+        # MATLAB indices are 1-based and column-major
+        idx = np.flatnonzero(mask.ravel(order='F') > 0)
+        roi = data.reshape((-1, data.shape[-1]), order='F')[idx]
+        scipy.io.savemat(
+            self._gen_outfilename(),
+            {'roi': roi.astype(float), 'mask': mask,
+             'idx': (idx + 1).astype(float)[:, None]})
+        return runtime
+
+
+class AmicoNODDIFittingInputSpec(BaseInterfaceInputSpec):
+
+    roi_file = File(
+        exists=True, mandatory=True,
+        desc="Input ROI to fit the parameters for")
+
+    bvecs_file = File(
+        exists=True, mandatory=True,
+        desc=("Gradient encoding directions in FSL format"))
+
+    bvals_file = File(
+        exists=True, mandatory=True,
+        desc="Extracted graident encoding b-values in FSL format")
+
+    parallel_diffusivity = traits.Float(
+        NODDI_PARALLEL_DIFFUSIVITY, usedefault=True,
+        desc="Intrinsic diffusivity of the neurites (mm^2/s)")
+
+    isotropic_diffusivity = traits.Float(
+        NODDI_ISOTROPIC_DIFFUSIVITY, usedefault=True,
+        desc="Diffusivity of the isotropic compartment (mm^2/s)")
+
+    num_dirs = traits.Int(
+        500, usedefault=True,
+        desc="The number of fibre directions in the dictionary")
+
+    b0_threshold = traits.Float(
+        10.0, usedefault=True,
+        desc="Volumes with b-values below this are treated as b=0")
+
+    cache_dir = traits.Str(
+        desc=("Directory to cache the dictionary in between runs. Defaults "
+              "to '~/.banana/noddi'"))
+
+    chunk_size = traits.Int(
+        10000, usedefault=True,
+        desc="The number of voxels to fit in each batch")
+
+    num_processes = traits.Int(
+        1, usedefault=True,
+        desc="The number of processes to distribute the chunks over")
+
+    out_file = File(
+        genfile=True, hash_files=False,
+        desc="The name of the fitted parameters file to be generated")
+
+
+class AmicoNODDIFittingOutputSpec(TraitedSpec):
+
+    out_file = File(exists=True, desc='The fitted NODDI parameters')
+
+
+class AmicoNODDIFitting(BatchNODDIFitting):
+    """
+    Fits the Watson NODDI model in-process with the linearised approach of
+    AMICO (Daducci et al. 2015). A dictionary of compartment responses is
+    precomputed for the acquisition protocol (and cached on disk), and each
+    voxel is then fitted by non-negative least squares against the atoms
+    aligned with its principal diffusion direction. Chunks of voxels are
+    distributed over a process pool if 'num_processes' is greater than 1.
+
+    The output parameters file is read by NumpySaveParamsAsNIfTI
+    """
+
+    input_spec = AmicoNODDIFittingInputSpec
+    output_spec = AmicoNODDIFittingOutputSpec
+
+    def _run_interface(self, runtime):
+        bvals = np.loadtxt(self.inputs.bvals_file).ravel()
+        bvecs = np.loadtxt(self.inputs.bvecs_file).reshape(3, -1)
+        roi = np.asarray(scipy.io.loadmat(self.inputs.roi_file)['roi'],
+                         dtype=float)
+        if roi.shape[1] != len(bvals):
+            raise BananaUsageError(
+                "Number of volumes in ROI ({}) does not match the number of "
+                "b-values ({})".format(roi.shape[1], len(bvals)))
+        if isdefined(self.inputs.cache_dir):
+            cache_dir = self.inputs.cache_dir
+        else:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.banana',
+                                     'noddi')
+        dictionary = noddi_dictionary(
+            bvals, bvecs, d_par=self.inputs.parallel_diffusivity,
+            d_iso=self.inputs.isotropic_diffusivity,
+            num_dirs=self.inputs.num_dirs, cache_dir=cache_dir)
+        chunks = [roi[i:i + self.inputs.chunk_size]
+                  for i in range(0, len(roi), self.inputs.chunk_size)]
+        if self.inputs.num_processes > 1 and len(chunks) > 1:
+            dict_path = noddi_dictionary_path(
+                bvals, bvecs, cache_dir,
+                d_par=self.inputs.parallel_diffusivity,
+                d_iso=self.inputs.isotropic_diffusivity,
+                num_dirs=self.inputs.num_dirs)
+            with ProcessPoolExecutor(
+                    self.inputs.num_processes,
+                    initializer=_load_worker_dictionary,
+                    initargs=(dict_path,)) as executor:
+                results = list(executor.map(
+                    _fit_noddi_chunk, chunks,
+                    *(([a] * len(chunks))
+                      for a in (bvals, bvecs, self.inputs.b0_threshold))))
+        else:
+            results = [fit_noddi(c, bvals, bvecs, dictionary,
+                                 b0_threshold=self.inputs.b0_threshold)
+                       for c in chunks]
+        params = {k: np.concatenate([r[k] for r in results])
+                  for k in results[0]}
+        scipy.io.savemat(self._gen_outfilename(), params)
+        return runtime
+
+
+class NumpySaveParamsAsNIfTIInputSpec(BaseInterfaceInputSpec):
+
+    params_file = File(
+        exists=True, mandatory=True,
+        desc="The parameters fitted by AmicoNODDIFitting")
+
+    roi_file = File(
+        exists=True, mandatory=True, desc="The ROI file created by CreateROI")
+
+    brain_mask_file = File(
+        exists=True, mandatory=True, desc="A whole brain mask")
+
+    output_prefix = traits.Str(
+        "processed_noddi", usedefault=True,
+        desc="Prefix of the generated output files")
+
+
+class NumpySaveParamsAsNIfTI(BaseInterface):
+    """
+    Writes the parameters fitted by AmicoNODDIFitting to NIfTI images, using
+    the same output names as the NODDI toolbox's SaveParamsAsNIfTI
+    """
+
+    input_spec = NumpySaveParamsAsNIfTIInputSpec
+    output_spec = SaveParamsAsNIfTIOutputSpec
+
+    param_names = ('ficvf', 'odi', 'fiso', 'fibredirs_xvec', 'fibredirs_yvec',
+                   'fibredirs_zvec', 'fmin', 'kappa', 'error_code')
+
+    def _run_interface(self, runtime):
+        params = scipy.io.loadmat(self.inputs.params_file)
+        mask_img = nib.load(self.inputs.brain_mask_file)
+        # Convert the 1-based, column-major MATLAB indices of the ROI
+        idx = np.asarray(scipy.io.loadmat(self.inputs.roi_file)['idx'],
+                         dtype=int).ravel() - 1
+        shape = mask_img.shape[:3]
+        fibredirs = params.pop('fibredirs')
+        images = {'fibredirs_{}vec'.format(a): fibredirs[:, i]
+                  for i, a in enumerate('xyz')}
+        images.update((n, params[n].ravel()) for n in (
+            'ficvf', 'odi', 'fiso', 'fmin', 'kappa', 'error_code'))
+        for name, values in images.items():
+            vol = np.zeros(int(np.prod(shape)), dtype=np.float32)
+            vol[idx] = values
+            out_img = nib.Nifti1Image(vol.reshape(shape, order='F'),
+                                      mask_img.affine, mask_img.header)
+            out_img.set_data_dtype(np.float32)
+            nib.save(out_img, self._out_path(name))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for name in self.param_names:
+            outputs[name] = self._out_path(name)
+        return outputs
+
+    def _out_path(self, name):
+        return os.path.join(
+            os.getcwd(), '{}_{}.nii'.format(self.inputs.output_prefix, name))
@@ -7,9 +7,27 @@ Created on 1 Sep. 2017
 
 import os.path
 from nipype.interfaces.base import (
-    TraitedSpec, BaseInterface, File, isdefined)
+    TraitedSpec, BaseInterface, File, isdefined, traits)
 import nibabel as nib
 import numpy as np
+from banana.exceptions import BananaUsageError
+
+
+# Constants of the conversion from R2* to HU in bone and from HU to PET
+# attenuation coefficients (cm^-1), based on
+# Carney J P et al. (2006) Med. Phys. 33 976-83
+R2STAR_SCALE = 1000. / 2.39
+HU_POLY = (0.000001351, -0.003617, 3.841, -19.46)
+HU_BREAKPOINT = 1047.
+HU_LOW_SLOPE = 0.000096
+HU_HIGH_SLOPE = 0.000051
+HU_HIGH_INTERCEPT = 0.0471
+U_BONE_MIN = 0.1134
+U_BONE_FIXED = 0.151
+U_SOFT_FIXED = 0.1
+UMAP_SCALE = 10000.
+
+UMAP_DTYPES = ('float32', 'float64', 'int16', 'uint16')
 
 
 class CoreUmapCalcInputSpec(TraitedSpec):
@@ -23,6 +41,13 @@ class CoreUmapCalcInputSpec(TraitedSpec):
     sute_fix_template = File(
         genfile=True,
         desc='sute fixed map in template space')
+    out_dtype = traits.Enum(
+        *UMAP_DTYPES, usedefault=True,
+        desc=('The data type the umaps are saved with (integer types are '
+              'rounded and clipped to their range)'))
+    slab_size = traits.Int(
+        16, usedefault=True,
+        desc='The number of slices to compute the umaps for at a time')
 
 
 class CoreUmapCalcOutputSpec(TraitedSpec):
@@ -35,66 +60,98 @@ class CoreUmapCalcOutputSpec(TraitedSpec):
 
 
 class CoreUmapCalc(BaseInterface):
-    """Creates two umaps in the template space"""
+    """
+    Creates two umaps in the template space, one with continuous bone
+    attenuation values derived from the R2* of the UTE echoes and one with a
+    fixed bone value.
+
+    Each echo is loaded once as float32 and the umaps are computed a slab of
+    slices at a time, directly into arrays of the output data type.
+    """
 
     input_spec = CoreUmapCalcInputSpec
     output_spec = CoreUmapCalcOutputSpec
 
     def _run_interface(self, runtime):
-        air = nib.load(self.inputs.air__mask)
-        bones = nib.load(self.inputs.bones__mask)
         ute1 = nib.load(self.inputs.ute1_reg)
-        ute2 = nib.load(self.inputs.ute2_reg)
-
-        r2star_map = 1000. * (np.log(np.array(ute1.get_data())) 
-                              - np.log(np.array(ute2.get_data()))) / 2.39
-        nans = np.isnan(r2star_map)
-        r2star_map[nans] = 0
-
-        u_bone = 0.000001351 * (r2star_map**3) - 0.003617 * (r2star_map**2) + 3.841 * r2star_map - 19.46
-        # CONVERSION from HU to PET u values
-        # Conversion based on:
-        # Carney J P et al. (2006) Med. Phys. 33 976-83
-        
-        a = 0.000051
-        b = 0.0471
-        BP = 1047.
-
-        low = u_bone < BP
-        u_bone[low] = 0.000096 * (1000. + u_bone[low])
-        high = u_bone >= BP
-        u_bone[high] = a * (1000. + u_bone[high]) + b
-
-        low_u = u_bone < 0.1134
-        u_bone[low_u] = 0.1134
-        # End of conversion
-        
-        u_soft_fixed = 0.1
-        u_air = 0.
-
-        umap = 10000. * (u_air * np.array(air.get_data()) +
-                         u_bone * np.array(bones.get_data()) +
-                         (1 - np.array(bones.get_data())) *
-                         (1 - np.array(air.get_data())) * u_soft_fixed)
-
-        nans = np.isnan(umap)
-        umap[nans] = 0
-        save_im = nib.Nifti1Image(umap, affine=ute1.affine)
-        nib.save(save_im, self._gen_filename('sute_cont_template'))
-
-        u_bone2 = 0.151
-        umap2 = 10000. * (u_air * np.array(air.get_data()) +
-                         u_bone2 * np.array(bones.get_data()) +
-                         (1 - np.array(bones.get_data())) *
-                         (1 - np.array(air.get_data())) * u_soft_fixed)
-
-        nans = np.isnan(umap2)
-        umap2[nans] = 0
-        save_im = nib.Nifti1Image(umap2, affine=ute1.affine)
-        nib.save(save_im, self._gen_filename('sute_fix_template'))
-
+        echo1 = ute1.get_fdata(dtype=np.float32)
+        echo2 = nib.load(self.inputs.ute2_reg).get_fdata(dtype=np.float32)
+        # The masks are kept in their stored data type
+        air = np.asanyarray(nib.load(self.inputs.air__mask).dataobj)
+        bones = np.asanyarray(nib.load(self.inputs.bones__mask).dataobj)
+        for name, array in (('ute2_reg', echo2), ('air__mask', air),
+                            ('bones__mask', bones)):
+            if array.shape != echo1.shape:
+                raise BananaUsageError(
+                    "Shape of '{}' ({}) doesn't match that of 'ute1_reg' ({})"
+                    .format(name, array.shape, echo1.shape))
+        dtype = np.dtype(self.inputs.out_dtype)
+        cont = np.empty(echo1.shape, dtype=dtype)
+        fixed = np.empty(echo1.shape, dtype=dtype)
+        num_slices = echo1.shape[-1]
+        for start in range(0, num_slices, self.inputs.slab_size):
+            slab = (Ellipsis, slice(start, start + self.inputs.slab_size))
+            self._umap_slab(echo1[slab], echo2[slab], air[slab], bones[slab],
+                            cont[slab], fixed[slab])
+        del echo1, echo2
+        for umap, name in ((cont, 'sute_cont_template'),
+                           (fixed, 'sute_fix_template')):
+            save_im = nib.Nifti1Image(umap, affine=ute1.affine)
+            save_im.set_data_dtype(dtype)
+            nib.save(save_im, self._gen_filename(name))
         return runtime
 
+    @classmethod
+    def _umap_slab(cls, echo1, echo2, air, bones, cont, fixed):
+        """
+        Calculates the continuous and fixed umaps of a slab in float32,
+        writing them into the output slabs 'cont' and 'fixed'
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r2star = np.log(echo1)
+            r2star -= np.log(echo2)
+            r2star *= np.float32(R2STAR_SCALE)
+            r2star[np.isnan(r2star)] = 0
+            # Polynomial fit of HU in bone against R2*
+            u_bone = r2star ** 3
+            u_bone *= np.float32(HU_POLY[0])
+            r2star_sq = r2star ** 2
+            r2star_sq *= np.float32(HU_POLY[1])
+            u_bone += r2star_sq
+            del r2star_sq
+            r2star *= np.float32(HU_POLY[2])
+            u_bone += r2star
+            u_bone += np.float32(HU_POLY[3])
+            del r2star
+            # Conversion from HU to PET u values
+            high = u_bone >= HU_BREAKPOINT
+            u_bone += np.float32(1000.)
+            u_bone *= np.where(high, np.float32(HU_HIGH_SLOPE),
+                               np.float32(HU_LOW_SLOPE))
+            u_bone[high] += np.float32(HU_HIGH_INTERCEPT)
+            u_bone[u_bone < U_BONE_MIN] = U_BONE_MIN
+            # Soft tissue everywhere that isn't bone or air (attenuation of
+            # air is zero)
+            soft = np.subtract(1, bones, dtype=np.float32)
+            soft *= np.subtract(1, air, dtype=np.float32)
+            soft *= np.float32(U_SOFT_FIXED)
+            u_bone *= bones
+            u_bone += soft
+            cls._to_output(u_bone, cont)
+            soft += np.float32(U_BONE_FIXED) * bones
+            cls._to_output(soft, fixed)
+
+    @classmethod
+    def _to_output(cls, u, out):
+        "Scales attenuation values and writes them in the output data type"
+        u *= np.float32(UMAP_SCALE)
+        u[np.isnan(u)] = 0
+        if np.issubdtype(out.dtype, np.integer):
+            info = np.iinfo(out.dtype)
+            np.rint(u, out=u)
+            np.clip(u, info.min, info.max, out=u)
+        np.copyto(out, u, casting='unsafe')
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['sute_cont_template'] = self._gen_sute_cont_template_fname()
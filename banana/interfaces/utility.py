@@ -1,8 +1,16 @@
+import os
 import logging
+import math
 import os.path as op
 from nipype.interfaces.base import (
     TraitedSpec, traits, BaseInterface, BaseInterfaceInputSpec, Directory,
-    File)
+    File, isdefined)
+from arcana.utils import split_extension
+from arcana.utils.interfaces import (
+    CopyToDir as ArcanaCopyToDir, CopyToDirInputSpec as
+    ArcanaCopyToDirInputSpec)
+from banana.exceptions import BananaUsageError
+from banana.utils.staging import stage, STAGING_METHODS
 logger = logging.getLogger('banana')
 
 
@@ -32,3 +40,60 @@ class AppendPath(BaseInterface):
         outputs['out_path'] = op.join(self.inputs.base_path,
                                       *self.inputs.sub_paths)
         return outputs
+
+
+class CopyToDirInputSpec(ArcanaCopyToDirInputSpec):
+    use_symlinks = traits.Bool(
+        False, usedefault=True,
+        desc=("Whether to symlink the inputs into the directory, in which "
+              "case 'staging' is ignored"))
+    staging = traits.Enum(
+        'copy', *(m for m in STAGING_METHODS if m != 'copy'),
+        usedefault=True,
+        desc=("How the inputs are placed in the directory. 'symlink' links "
+              "each input file/directory, otherwise directories are "
+              "recreated and populated using the given staging method (see "
+              "banana.utils.staging.stage_file)"))
+
+
+class CopyToDir(ArcanaCopyToDir):
+    """
+    Places a list of files or directories into a directory, copying them by
+    default as Arcana's CopyToDir does. Inputs can be staged as copy-on-write
+    reflinks (e.g. 'auto'), which only fall back to copying across
+    filesystems, or symlinked instead.
+    """
+
+    input_spec = CopyToDirInputSpec
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        dirname = self.out_dir
+        os.makedirs(dirname)
+        num_files = len(self.inputs.in_files)
+        if isdefined(self.inputs.file_names):
+            if len(self.inputs.file_names) != num_files:
+                raise BananaUsageError(
+                    "Number of provided filenames ({}) does not match number "
+                    "of provided files ({})".format(
+                        len(self.inputs.file_names), num_files))
+            out_files = (op.basename(str(f)) for f in self.inputs.file_names)
+        else:
+            # Create filenames that will sort ascendingly with the order the
+            # file is inputed to the interface
+            ndigits = int(math.ceil(math.log10(max(num_files, 2))))
+            out_files = (str(i).zfill(ndigits) + split_extension(f)[1]
+                         for i, f in enumerate(self.inputs.in_files))
+        method = ('symlink' if self.inputs.use_symlinks
+                  else self.inputs.staging)
+        file_names = []
+        for in_file, out_file in zip(self.inputs.in_files, out_files):
+            out_path = op.join(dirname, out_file)
+            if method == 'symlink':
+                os.symlink(op.abspath(in_file), out_path)
+            else:
+                stage(in_file, out_path, method=method)
+            file_names.append(out_file)
+        outputs['out_dir'] = dirname
+        outputs['file_names'] = file_names
+        return outputs
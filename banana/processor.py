@@ -0,0 +1,382 @@
+"""
+Extensions of the Arcana processors
+"""
+import os
+import os.path as op
+import math
+import shlex
+import logging
+import subprocess as sp
+from arcana.processor import SlurmProc as ArcanaSlurmProc
+from arcana.exceptions import ArcanaNameError
+from banana.exceptions import BananaUsageError, BananaRuntimeError
+from banana.utils.telemetry import input_bytes
+
+logger = logging.getLogger('banana')
+
+
+class SlurmProc(ArcanaSlurmProc):
+    """
+    Extends Arcana's SlurmProc to optionally request the wall time and memory
+    for each job from the resources its node has used in previous runs (as
+    recorded in the telemetry store of the study) instead of the static
+    'wall_time' and 'mem_gb' hints passed to Pipeline.add
+
+    Parameters
+    ----------
+    work_dir : str
+        A directory in which to run the nipype workflows
+    learned_resources : bool
+        Whether to request the resources estimated from the study's
+        telemetry for nodes that have been run enough times
+    **kwargs
+        Passed on to arcana.processor.SlurmProc
+    """
+
+    def __init__(self, work_dir, learned_resources=False, **kwargs):
+        self._learned_resources = learned_resources
+        super().__init__(work_dir, **kwargs)
+
+    @property
+    def learned_resources(self):
+        return self._learned_resources
+
+    def slurm_template(self, node):
+        wall_time, mem_gb = self.resources(node)
+        return super().slurm_template(
+            _ResourceRequest(node, wall_time, mem_gb))
+
+    def resources(self, node):
+        """
+        Returns the wall time (minutes) and memory (GB) to request for a
+        node
+
+        Parameters
+        ----------
+        node : arcana.environment.base.Node
+            The node to request the resources for
+        """
+        wall_time, mem_gb = node._wall_time, node.mem_gb
+        key = getattr(node, 'telemetry_key', None)
+        telemetry = getattr(self.study, 'telemetry', None)
+        if not self._learned_resources or key is None or telemetry is None:
+            return wall_time, mem_gb
+        # Inputs that are connected to upstream nodes won't exist until the
+        # job runs, in which case the estimates aren't scaled by input size
+        est_wall_time, est_mem_gb = telemetry.estimate(
+            key.study_class, key.pipeline, key.node,
+            input_bytes=(input_bytes(node.interface) or None))
+        if est_wall_time is None:
+            return wall_time, mem_gb
+        logger.debug("Requesting %s minutes and %s GB for '%s' node from "
+                     "telemetry (hints were %s minutes and %s GB)",
+                     est_wall_time, est_mem_gb, node.name, wall_time, mem_gb)
+        return est_wall_time, est_mem_gb
+
+
+class _ResourceRequest(object):
+    """
+    Presents a node with the wall time and memory to request for it to the
+    Arcana sbatch template
+    """
+
+    def __init__(self, node, wall_time, mem_gb):
+        self._node = node
+        self.wall_time = wall_time
+        self.mem_gb = mem_gb
+
+    def __getattr__(self, name):
+        return getattr(self._node, name)
+
+
+class SlurmArraySubmitter(object):
+    """
+    Submits the derivation of a study's data to the SLURM scheduler as a job
+    array instead of a job for every node. Each task of the array runs the
+    per-session and per-subject workflows for a chunk of subjects locally
+    (with MultiProc), and the per-visit and per-study pipelines that join
+    over them are run by a job that depends on the array. Subjects whose
+    derivatives already exist are skipped so an interrupted derivation can
+    be resumed by submitting it again.
+
+    Parameters
+    ----------
+    work_dir : str
+        The directory to write the job scripts, subject lists and logs to
+    chunk_size : int
+        The number of subjects processed by each task of the array
+    num_processes : int
+        The number of processes (CPUs) used by each task and the join job
+    wall_time : float
+        The wall time (minutes) requested for each task and the join job
+    mem_gb : float
+        The memory (GB) requested for each task and the join job
+    account : str | None
+        The account to submit the jobs under
+    partition : str | None
+        The partition to submit the jobs to
+    email : str | None
+        The email address to send notifications to
+    mail_on : tuple[str]
+        The events to send notifications on
+    max_concurrent : int | None
+        The maximum number of tasks of the array to run at once
+    """
+
+    # Derivatives of these frequencies are generated by the array tasks
+    ARRAY_FREQUENCIES = ('per_session', 'per_subject')
+
+    def __init__(self, work_dir, chunk_size=1, num_processes=1,
+                 wall_time=1440, mem_gb=16, account=None, partition=None,
+                 email=None, mail_on=('FAIL',), max_concurrent=None):
+        if chunk_size < 1:
+            raise BananaUsageError(
+                "Chunk size needs to be at least 1 ({})".format(chunk_size))
+        self.work_dir = work_dir
+        self.chunk_size = chunk_size
+        self.num_processes = num_processes
+        self.wall_time = wall_time
+        self.mem_gb = mem_gb
+        self.account = account
+        self.partition = partition
+        self.email = email
+        self.mail_on = mail_on
+        self.max_concurrent = max_concurrent
+
+    def split(self, study, derivatives):
+        """
+        Splits the derivatives into those generated by the array tasks and
+        those generated by the join job.
+
+        Per-session and per-subject derivatives that depend on per-visit or
+        per-study derivatives (e.g. a group template) are refused, as each
+        task would derive its own version of the joined derivatives from its
+        chunk of subjects and write it concurrently with the other tasks.
+        """
+        per_chunk, joined = [], []
+        for name in derivatives:
+            if study.data_spec(name).frequency in self.ARRAY_FREQUENCIES:
+                per_chunk.append(name)
+            else:
+                joined.append(name)
+        prerequisites = self.joined_prerequisites(study, per_chunk)
+        if prerequisites:
+            raise BananaUsageError(
+                "Cannot derive per-session or per-subject derivatives that "
+                "depend on per-visit or per-study derivatives with a SLURM "
+                "job array, as each task would derive its own version of "
+                "them from its chunk of subjects ({}). Use the 'slurm' "
+                "processor instead".format('; '.join(
+                    "'{}' depends on '{}'".format(n, "', '".join(sorted(p)))
+                    for n, p in sorted(prerequisites.items()))))
+        return per_chunk, joined
+
+    def joined_prerequisites(self, study, derivatives):
+        """
+        Returns the per-visit and per-study derivatives that each of the
+        (per-session or per-subject) derivatives depends on, either directly
+        or via other per-session or per-subject derivatives
+
+        Returns
+        -------
+        prerequisites : dict[str, set[str]]
+            The names of the joined derivatives each derivative depends on,
+            for those that depend on any
+        """
+        inputs = {}
+
+        def derived_inputs(name):
+            # The derived inputs of the pipeline generating the derivative
+            if name not in inputs:
+                inputs[name] = [i.name for i in study.bound_spec(name)
+                                .pipeline.inputs if i.is_spec and i.derived]
+            return inputs[name]
+
+        prerequisites = {}
+        for name in derivatives:
+            found, visited, to_visit = set(), set(), [name]
+            while to_visit:
+                for input_name in derived_inputs(to_visit.pop()):
+                    if input_name in visited:
+                        continue
+                    visited.add(input_name)
+                    if (study.data_spec(input_name).frequency in
+                            self.ARRAY_FREQUENCIES):
+                        to_visit.append(input_name)
+                    else:
+                        found.add(input_name)
+            if found:
+                prerequisites[name] = found
+        return prerequisites
+
+    def pending_subjects(self, study, derivatives):
+        """
+        Returns the IDs of the subjects that are missing any of the
+        derivatives in any of their sessions (or at the subject level)
+        """
+        tree = study.tree
+        pending = []
+        for subject_id in study.subject_ids:
+            try:
+                subject = tree.subject(subject_id)
+            except ArcanaNameError:
+                pending.append(subject_id)
+                continue
+            nodes = {'per_subject': [subject],
+                     'per_session': [s for s in subject.sessions
+                                     if s.visit_id in study.visit_ids]}
+            if any(not self._exists(study, node, name)
+                   for name in derivatives
+                   for node in nodes[study.data_spec(name).frequency]):
+                pending.append(subject_id)
+        return pending
+
+    def chunks(self, subject_ids):
+        "Partitions the subject IDs into the chunks processed by each task"
+        return [subject_ids[i:i + self.chunk_size]
+                for i in range(0, len(subject_ids), self.chunk_size)]
+
+    def submit(self, study, derivatives, command, reprocess=False):
+        """
+        Submits the array and join jobs to generate the derivatives
+
+        Parameters
+        ----------
+        study : Study
+            The study to derive the data from, used to look up the
+            frequencies of the derivatives and which already exist
+        derivatives : list[str]
+            The names of the derivatives to generate
+        command : callable
+            Returns the command-line (list of str) that derives the data
+            locally given the names of the derivatives, the path of a file
+            listing the subject IDs to process (None for all), the scratch
+            directory to use and whether to reprocess existing derivatives
+        reprocess : bool
+            Whether to regenerate existing derivatives instead of skipping
+            subjects that have them all (and reprocess joined derivatives
+            with mismatching provenance)
+
+        Returns
+        -------
+        array_job_id : str | None
+            The ID of the job array, None if all subjects were complete
+        join_job_id : str | None
+            The ID of the join job, None if no per-visit or per-study
+            derivatives were requested
+        """
+        os.makedirs(self.work_dir, exist_ok=True)
+        per_chunk, joined = self.split(study, derivatives)
+        subject_ids = list(study.subject_ids)
+        if per_chunk and not reprocess:
+            pending = self.pending_subjects(study, per_chunk)
+            logger.info("Skipping %s of %s subjects that already have '%s'",
+                        len(subject_ids) - len(pending), len(subject_ids),
+                        "', '".join(per_chunk))
+        else:
+            pending = subject_ids
+        array_job_id = None
+        if per_chunk and pending:
+            chunks = self.chunks(pending)
+            for i, chunk in enumerate(chunks):
+                self._write_ids(op.join(self.work_dir,
+                                        'subjects-{}.txt'.format(i)), chunk)
+            task_cmd = command(
+                per_chunk,
+                op.join(self.work_dir, 'subjects-${SLURM_ARRAY_TASK_ID}.txt'),
+                op.join(self.work_dir, 'task-${SLURM_ARRAY_TASK_ID}'),
+                reprocess)
+            array_job_id = self.sbatch(self.script(
+                'array', task_cmd, array_size=len(chunks)))
+            logger.info("Submitted job array %s to derive '%s' for %s "
+                        "subjects in %s tasks", array_job_id,
+                        "', '".join(per_chunk), len(pending), len(chunks))
+        join_job_id = None
+        if joined:
+            subjects_path = op.join(self.work_dir, 'subjects-all.txt')
+            self._write_ids(subjects_path, subject_ids)
+            join_cmd = command(joined, subjects_path,
+                               op.join(self.work_dir, 'join'), reprocess)
+            join_job_id = self.sbatch(self.script('join', join_cmd),
+                                      dependency=array_job_id)
+            logger.info("Submitted job %s to derive '%s'%s", join_job_id,
+                        "', '".join(joined),
+                        (" after job array {} completes".format(array_job_id)
+                         if array_job_id is not None else ''))
+        return array_job_id, join_job_id
+
+    def script(self, name, command, array_size=None):
+        """
+        Writes the sbatch script that runs the command and returns its path
+        """
+        log_name = name + ('-%a' if array_size is not None else '') + '.out'
+        lines = ['#!/bin/bash',
+                 '#SBATCH --job-name=banana-{}'.format(name),
+                 '#SBATCH --output={}'.format(op.join(self.work_dir,
+                                                      log_name)),
+                 '#SBATCH --ntasks=1',
+                 '#SBATCH --cpus-per-task={}'.format(self.num_processes),
+                 '#SBATCH --mem={}'.format(int(self.mem_gb * 1000)),
+                 '#SBATCH --time={}'.format(int(math.ceil(self.wall_time))),
+                 '#SBATCH --kill-on-invalid-dep=yes']
+        if array_size is not None:
+            lines.append('#SBATCH --array=0-{}{}'.format(
+                array_size - 1,
+                ('%{}'.format(self.max_concurrent)
+                 if self.max_concurrent is not None else '')))
+        if self.account is not None:
+            lines.append('#SBATCH --account={}'.format(self.account))
+        if self.partition is not None:
+            lines.append('#SBATCH --partition={}'.format(self.partition))
+        if self.email is not None:
+            lines.append('#SBATCH --mail-user={}'.format(self.email))
+            lines.extend('#SBATCH --mail-type={}'.format(m)
+                         for m in self.mail_on)
+        lines.extend(['', ' '.join(self._quote(a) for a in command), ''])
+        path = op.join(self.work_dir, name + '.sh')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines))
+        return path
+
+    def sbatch(self, script_path, dependency=None):
+        "Submits a script to the scheduler and returns the ID of the job"
+        cmd = ['sbatch', '--parsable']
+        if dependency is not None:
+            cmd.append('--dependency=afterok:{}'.format(dependency))
+        cmd.append(script_path)
+        try:
+            out = sp.check_output(cmd, stderr=sp.STDOUT)
+        except OSError as e:
+            raise BananaRuntimeError(
+                "Could not run 'sbatch' to submit '{}' ({})"
+                .format(script_path, e))
+        except sp.CalledProcessError as e:
+            raise BananaRuntimeError(
+                "Submission of '{}' failed: {}".format(
+                    script_path, e.output.decode().strip()))
+        # Strip the cluster name if present (i.e. "<jobid>;<cluster>")
+        return out.decode().strip().split(';')[0]
+
+    @classmethod
+    def _exists(cls, study, node, name):
+        spec = study.data_spec(name)
+        try:
+            if spec.is_fileset:
+                node.fileset(name, from_study=study.name)
+            else:
+                node.field(name, from_study=study.name)
+        except ArcanaNameError:
+            return False
+        return True
+
+    @classmethod
+    def _write_ids(cls, path, ids):
+        with open(path, 'w') as f:
+            f.write('\n'.join(ids) + '\n')
+
+    @classmethod
+    def _quote(cls, arg):
+        # Quote everything but the task ID, which is expanded by the shell
+        return '"${SLURM_ARRAY_TASK_ID}"'.join(
+            shlex.quote(p) if p else '' for p in arg.split(
+                '${SLURM_ARRAY_TASK_ID}'))
@@ -5,18 +5,54 @@ import platform
 import re
 import xml.etree.ElementTree
 from arcana.environment.requirement import (
-    Version, CliRequirement, MatlabPackageRequirement,
-    PythonPackageRequirement,
-    matlab_req)  # @UnusedImport
+    Version, PythonPackageRequirement)
+from arcana.environment.requirement import (
+    CliRequirement as BaseCliRequirement,
+    MatlabPackageRequirement as BaseMatlabPackageRequirement)
+from arcana.environment.requirement.matlab import (
+    MatlabRequirement as BaseMatlabRequirement, MatlabVersion)
 from arcana.utils import run_matlab_cmd
 from arcana.exceptions import (
     ArcanaRequirementNotFoundError, ArcanaVersionNotDetectableError)
+from banana.utils import version_cache
+
+
+class CachedVersionMixin(object):
+    """
+    Looks up the versions of requirements in the persistent version cache
+    (see banana.utils.version_cache) instead of detecting them each time
+    they are required
+
+    Class attributes
+    ----------------
+    version_env : tuple(str)
+        Environment variables (in addition to the loaded modules) that the
+        detected version depends on
+    """
+
+    version_env = ()
+
+    @property
+    def version_executable(self):
+        "The executable whose modification invalidates the cached version"
+        return self.test_cmd
+
+    def detect_version(self, **kwargs):
+        return self.version_cls(
+            self, version_cache.detect_version_str(self), **kwargs)
+
 
 # Command line requirements
 
 
+class CliRequirement(CachedVersionMixin, BaseCliRequirement):
+    pass
+
+
 class FSLRequirement(CliRequirement):
 
+    version_env = ('FSLDIR',)
+
     def detect_version_str(self):
         """
         As FSL doesn't have a simple way of printing the version, we need to
@@ -57,6 +93,8 @@ class C3dRequirement(CliRequirement):
 
 class FreesurferRequirement(CliRequirement):
 
+    version_env = ('FREESURFER_HOME',)
+
     def detect_version_str(self):
         """
         The version that recon-all spits out doesn't match that of Freesurfer
@@ -116,6 +154,17 @@ stir_req = StirRequirement('stir', test_cmd='SSRB')
 # Matlab package requirements
 
 
+class MatlabRequirement(CachedVersionMixin, BaseMatlabRequirement):
+
+    version_executable = 'matlab'
+
+
+class MatlabPackageRequirement(CachedVersionMixin,
+                               BaseMatlabPackageRequirement):
+
+    version_executable = 'matlab'
+
+
 class SpmRequirement(MatlabPackageRequirement):
 
     def parse_help_text(self, help_text):
@@ -173,6 +222,7 @@ class StiRequirement(MatlabPackageRequirement):
         return latest_version
 
 
+matlab_req = MatlabRequirement('matlab', version_cls=MatlabVersion)
 spm_req = SpmRequirement('spm', test_func='spm_authors')
 sti_req = StiRequirement('sti', test_func='V_SHARP')
 # noddi_req = MatlabPackageRequirement('noddi')
@@ -183,3 +233,13 @@ sti_req = StiRequirement('sti', test_func='V_SHARP')
 sklearn_req = PythonPackageRequirement('sklearn')
 pydicom_req = PythonPackageRequirement('pydicom')
 scipy_req = PythonPackageRequirement('scipy')
+
+
+def installed_requirements():
+    """
+    Returns the requirements defined in this module whose executables can be
+    located in the current environment
+    """
+    return [r for r in globals().values()
+            if isinstance(r, CachedVersionMixin) and
+            version_cache.fingerprint(r)[-1] is not None]
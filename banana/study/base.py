@@ -1,6 +1,144 @@
 from copy import copy
 from arcana.study import (
-    Study as ArcanaStudy, MultiStudy, StudyMetaClass, MultiStudyMetaClass)  # @UnusedImport @IgnorePep8
+    Study as ArcanaStudy, MultiStudy as ArcanaMultiStudy, StudyMetaClass,
+    MultiStudyMetaClass)  # @UnusedImport @IgnorePep8
+from arcana.pipeline import Pipeline as ArcanaPipeline
+from arcana.data import FilesetSpec
+from arcana.data.base import BaseData
+from banana.file_format import nifti_format
+from banana.exceptions import BananaUsageError
+from banana.utils.threads import available_cores, runs_concurrently
+from banana.utils.telemetry import TelemetryStore, monitor_node
+
+
+# Formats that intermediate derivatives can be stored in by the storage
+# policy, and the compressed formats they replace
+INTERMEDIATE_FORMATS = (nifti_format,)
+COMPRESSED_FORMAT_NAMES = ('nifti_gz',)
+
+
+class Pipeline(ArcanaPipeline):
+    """
+    Extends the Arcana Pipeline to let nodes read and write the intermediate
+    derivatives stored uncompressed by the study's storage policy directly,
+    to share the available cores between multi-threaded nodes and to record
+    the resources used by each node in the study's telemetry store
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The thread declarations of the nodes that were given them
+        self._node_threads = {}
+        # The inputs of each node that read uncompressed NIfTI as well as
+        # gzipped, and the nodes that write their outputs uncompressed
+        self._uncompressed_inputs = {}
+        self._uncompressed_nodes = set()
+
+    def connect_input(self, spec_name, node, node_input, format=None,  # @ReservedAssignment @IgnorePep8
+                      **kwargs):
+        if (spec_name not in self.study.ITERFIELDS and
+                hasattr(self.study, 'storage_format')):
+            name = self._map_name(spec_name, self._input_map)
+            stored = self.study.storage_format(name)
+            if stored is not None:
+                if format is None:
+                    format = self.study.data_spec(name).format  # @ReservedAssignment @IgnorePep8
+                if format.name in COMPRESSED_FORMAT_NAMES:
+                    # Only inputs that opted in are passed the uncompressed
+                    # derivative, others are passed it converted back at the
+                    # fastest compression level as it is only read once
+                    if node_input in self._uncompressed_inputs.get(node.name,
+                                                                    ()):
+                        format = stored  # @ReservedAssignment
+                    else:
+                        kwargs.setdefault('compresslevel', 1)
+        super().connect_input(spec_name, node, node_input, format=format,
+                              **kwargs)
+
+    def connect_output(self, spec_name, node, node_output, format=None,  # @ReservedAssignment @IgnorePep8
+                       **kwargs):
+        if node.name in self._uncompressed_nodes:
+            # The node writes its NIfTI outputs uncompressed. Those that are
+            # stored compressed (e.g. final outputs) are gzipped afterwards
+            # at the default compression level
+            spec = self.study.data_spec(
+                self._map_name(spec_name, self._output_map))
+            if isinstance(spec, FilesetSpec):
+                if format is None:
+                    format = spec.format  # @ReservedAssignment
+                if format.name in COMPRESSED_FORMAT_NAMES:
+                    format = nifti_format  # @ReservedAssignment
+        super().connect_output(spec_name, node, node_output, format=format,
+                               **kwargs)
+
+    def add(self, name, *args, threads=None, uncompressed_inputs=(),
+            uncompressed_outputs=None, **kwargs):
+        """
+        Extends Arcana's Pipeline.add to take a 'threads' declaration
+        (banana.utils.threads.Threads) from which the number of threads the
+        node is run with is selected, given the cores available to the
+        processor and the number of sessions that can be processed at the
+        same time. The number granted is used to reserve cores for the node
+        (n_procs) and is passed on to the wrapped tool.
+
+        Nodes can also opt in to the storage policy of the study, by listing
+        the 'uncompressed_inputs' that read uncompressed NIfTI as well as
+        gzipped (i.e. that don't rename their input to a '.nii.gz' path) and
+        providing the values of the interface inputs that make it write its
+        NIfTI outputs uncompressed as 'uncompressed_outputs' (e.g.
+        {'output_type': 'NIFTI'} for FSL tools). The intermediate derivatives
+        written by such nodes are stored uncompressed without being
+        converted, and are passed to the inputs that opted in directly.
+        Those written by other nodes are decompressed before being stored.
+        """
+        node_name = '{}_{}'.format(self.name, name)
+        if uncompressed_inputs:
+            self._uncompressed_inputs[node_name] = frozenset(
+                uncompressed_inputs)
+        outputs = kwargs.get('outputs', args[2] if len(args) > 2 else None)
+        if (uncompressed_outputs and outputs and
+                hasattr(self.study, 'storage_format') and any(
+                    self.study.stores_uncompressed(
+                        self._map_name(o, self._output_map))
+                    for o in outputs)):
+            self._uncompressed_nodes.add(node_name)
+        num_threads = None
+        if threads is not None:
+            processor = self.study.processor
+            num_concurrent = 1
+            if runs_concurrently(processor) and 'joinsource' not in kwargs:
+                try:
+                    num_concurrent = self.study.num_sessions
+                except Exception:  # Tree couldn't be determined
+                    pass
+            num_threads = threads.grant(available_cores(processor, threads),
+                                        num_concurrent)
+            kwargs['n_procs'] = num_threads
+        node = super().add(name, *args, **kwargs)
+        if node_name in self._uncompressed_nodes:
+            for input_name, value in uncompressed_outputs.items():
+                setattr(node.inputs, input_name, value)
+        if threads is not None:
+            threads.apply(node.interface, num_threads)
+            self._node_threads[node.name] = threads
+        telemetry = getattr(self.study, 'telemetry', None)
+        if telemetry is not None:
+            monitor_node(node, telemetry.key(
+                type(self.study).__name__, self.name, name))
+        return node
+
+    def _gen_prov(self):
+        # The number of threads a node is run with depends on where it is run
+        # and doesn't change its outputs, so shouldn't trigger reprocessing
+        prov = super()._gen_prov()
+        nodes = prov['workflow']['nodes']
+        for node_name, threads in self._node_threads.items():
+            params = nodes[node_name]['parameters']
+            if threads.input is not None:
+                params.pop(threads.input, None)
+            for var in threads.env:
+                params.get('environ', {}).pop(var, None)
+        return prov
 
 
 # Extend Arcana Study class to support implicit BIDS selectors
@@ -10,7 +148,17 @@ from arcana.study import (
 class Study(ArcanaStudy):
 
     def __init__(self, name, repository, processor, inputs=None,
-                 bids_task=None, **kwargs):
+                 bids_task=None, intermediate_format=None, final_outputs=(),
+                 telemetry=None, **kwargs):
+        if (intermediate_format is not None and
+                intermediate_format not in INTERMEDIATE_FORMATS):
+            raise BananaUsageError(
+                "Intermediate format needs to be one of '{}' (not '{}')"
+                .format("', '".join(f.name for f in INTERMEDIATE_FORMATS),
+                        intermediate_format))
+        self._intermediate_format = intermediate_format
+        self._final_outputs = frozenset(final_outputs)
+        self._telemetry = _telemetry_store(telemetry)
         if inputs is None:
             inputs = {}
         elif not isinstance(inputs, dict):
@@ -44,3 +192,88 @@ class Study(ArcanaStudy):
     @property
     def bids_task(self):
         return self._bids_task
+
+    @property
+    def intermediate_format(self):
+        return self._intermediate_format
+
+    @property
+    def final_outputs(self):
+        return self._final_outputs
+
+    @property
+    def telemetry(self):
+        return self._telemetry
+
+    def new_pipeline(self, *args, **kwargs):
+        return Pipeline(self, *args, **kwargs)
+
+    def stores_uncompressed(self, name):
+        """
+        Whether a derivative is subject to the storage policy of the study,
+        i.e. it is a compressed image that isn't designated as a final output
+        and an 'intermediate_format' was passed to the study
+
+        Parameters
+        ----------
+        name : str
+            Name of the data spec
+        """
+        if (self._intermediate_format is None or
+                name in self._final_outputs or name in self.input_names):
+            return False
+        spec = self.data_spec(name)
+        return (isinstance(spec, FilesetSpec) and
+                spec.format.name in COMPRESSED_FORMAT_NAMES)
+
+    def storage_format(self, name):
+        """
+        Returns the format a derivative is stored in if it differs from the
+        format of its data spec due to the storage policy of the study, i.e.
+        the 'intermediate_format' passed to the study for intermediate
+        derivatives (see 'stores_uncompressed'). Returns None otherwise.
+
+        Parameters
+        ----------
+        name : str
+            Name of the data spec
+        """
+        if self.stores_uncompressed(name):
+            return self._intermediate_format
+        return None
+
+    def bound_spec(self, name):
+        if isinstance(name, BaseData):
+            name = name.name
+        stored = self.storage_format(name)
+        if stored is None:
+            return super().bound_spec(name)
+        try:
+            bound = self._bound_specs[name]
+        except KeyError:
+            spec = self.data_spec(name)
+            kwargs = spec.initkwargs()
+            kwargs['format'] = stored
+            bound = self._bound_specs[name] = type(spec)(**kwargs).bind(self)
+        return bound
+
+
+class MultiStudy(ArcanaMultiStudy):
+
+    def __init__(self, *args, telemetry=None, **kwargs):
+        self._telemetry = _telemetry_store(telemetry)
+        super().__init__(*args, **kwargs)
+
+    @property
+    def telemetry(self):
+        return self._telemetry
+
+    def new_pipeline(self, *args, **kwargs):
+        return Pipeline(self, *args, **kwargs)
+
+
+def _telemetry_store(telemetry):
+    "Accepts either a TelemetryStore or the path to its database"
+    if telemetry is None or isinstance(telemetry, TelemetryStore):
+        return telemetry
+    return TelemetryStore(telemetry)
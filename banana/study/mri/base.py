@@ -3,7 +3,7 @@ from nipype.interfaces.spm.preprocess import Coregister
 from banana.citation import spm_cite
 from banana.file_format import (
     nifti_format, motion_mats_format, nifti_gz_format,
-    multi_nifti_gz_format, zip_format, STD_IMAGE_FORMATS)
+    multi_nifti_gz_format, zip_format, targz_format, STD_IMAGE_FORMATS)
 from arcana.data import FilesetSpec, FieldSpec, InputFilesetSpec
 from banana.study import Study, StudyMetaClass
 from banana.citation import fsl_cite, bet_cite, bet2_cite, ants_cite
@@ -23,8 +23,8 @@ from banana.interfaces.fsl import FSLSlices
 from banana.file_format import text_matrix_format
 import logging
 from banana.interfaces.ants import AntsRegSyn
+from banana.utils.threads import Threads, ITK_ENV
 from banana.interfaces.custom.coils import ToPolarCoords
-from arcana.utils.interfaces import ListDir, CopyToDir
 from nipype.interfaces.ants.resampling import ApplyTransforms
 from nipype.interfaces.fsl.preprocess import ApplyXFM
 from banana.interfaces.c3d import ANTs2FSLMatrixConversion
@@ -57,7 +57,7 @@ class MriStudy(Study, metaclass=StudyMetaClass):
                   "before brain extraction if 'coreg_ref' is provided"),
             optional=True),
         InputFilesetSpec(
-            'channels', (multi_nifti_gz_format, zip_format),
+            'channels', (multi_nifti_gz_format, zip_format, targz_format),
             optional=True, desc=("Reconstructed complex image for each "
                                  "coil without standardisation.")),
         InputFilesetSpec('header_image', dicom_format, desc=(
@@ -147,8 +147,8 @@ class MriStudy(Study, metaclass=StudyMetaClass):
         ParamSpec('force_channel_flip', None, dtype=str, array=True,
                       desc=("Forcibly flip channel inputs during preprocess "
                             "channels to correct issues with channel recon. "
-                            "The inputs are passed directly through to FSL's "
-                            "swapdims (see fsl.SwapDimensions interface)")),
+                            "The inputs are interpreted as for FSL's "
+                            "fslswapdim, e.g. ['-x', 'y', 'z']")),
         SwitchSpec('bet_robust', True),
         ParamSpec('bet_f_threshold', 0.5),
         SwitchSpec('bet_reduce_bias', False,
@@ -241,79 +241,39 @@ class MriStudy(Study, metaclass=StudyMetaClass):
             desc=("Convert channel signals in complex coords to polar coords "
                   "and combine"))
 
-        if (self.provided('header_image') or
-                self.branch('reorient_to_std') or
-                self.parameter('force_channel_flip') is not None):
-            # Read channel files reorient them into standard space and then
-            # write back to directory
-            list_channels = pipeline.add(
-                'list_channels',
-                ListDir(),
-                inputs={
-                    'directory': ('channels', multi_nifti_gz_format)})
-
-            if self.parameter('force_channel_flip') is not None:
-                force_flip = pipeline.add(
-                    'flip_dims',
-                    fsl.SwapDimensions(
-                        new_dims=tuple(self.parameter('force_channel_flip'))),
-                    inputs={
-                        'in_file': (list_channels, 'files')},
-                    iterfield=['in_file'])
-                geom_dest_file = (force_flip, 'out_file')
-            else:
-                geom_dest_file = (list_channels, 'files')
-
-            if self.provided('header_image'):
-                # If header image is provided stomp its geometry over the
-                # acquired channels
-                copy_geom = pipeline.add(
-                    'qsm_copy_geometry',
-                    fsl.CopyGeom(
-                        output_type='NIFTI_GZ'),
-                    inputs={
-                        'in_file': ('header_image', nifti_gz_format),
-                        'dest_file': geom_dest_file},
-                    iterfield=(['dest_file']),
-                    requirements=[fsl_req.v('5.0.8')])
-                reorient_in_file = (copy_geom, 'out_file')
-            else:
-                reorient_in_file = geom_dest_file
-
-            if self.branch('reorient_to_std'):
-                reorient = pipeline.add(
-                    'reorient_channel',
-                    fsl.Reorient2Std(
-                        output_type='NIFTI_GZ'),
-                    inputs={
-                        'in_file': reorient_in_file},
-                    iterfield=['in_file'],
-                    requirements=[fsl_req.v('5.0.8')])
-                copy_to_dir_in_files = (reorient, 'out_file')
-            else:
-                copy_to_dir_in_files = reorient_in_file
-
-            copy_to_dir = pipeline.add(
-                'copy_to_dir',
-                CopyToDir(),
-                inputs={
-                    'in_files': copy_to_dir_in_files,
-                    'file_names': (list_channels, 'files')})
-            to_polar_in_dir = (copy_to_dir, 'out_dir')
+        # The channels are read straight from the archive they are stored
+        # in (if applicable) and their geometry is corrected in memory
+        if (self.provided('channels') and
+                self.input('channels').format in (zip_format, targz_format)):
+            channels_format = self.input('channels').format
+            channels_input = 'in_archive'
         else:
-            to_polar_in_dir = ('channels', multi_nifti_gz_format)
+            channels_format = multi_nifti_gz_format
+            channels_input = 'in_dir'
 
-        pipeline.add(
+        to_polar = pipeline.add(
             'to_polar',
             ToPolarCoords(
                 in_fname_re=self.parameter('channel_fname_regex'),
                 real_label=self.parameter('channel_real_label'),
-                imaginary_label=self.parameter('channel_imag_label')),
+                imaginary_label=self.parameter('channel_imag_label'),
+                reorient_to_std=self.branch('reorient_to_std')),
             inputs={
-                'in_dir': to_polar_in_dir},
+                channels_input: ('channels', channels_format)},
             outputs={
                 'mag_channels': ('magnitudes_dir', multi_nifti_gz_format),
-                'phase_channels': ('phases_dir', multi_nifti_gz_format)})
+                'phase_channels': ('phases_dir', multi_nifti_gz_format)},
+            threads=Threads(max=8, input='num_threads'))
+
+        if self.parameter('force_channel_flip') is not None:
+            to_polar.inputs.flip_dims = list(
+                self.parameter('force_channel_flip'))
+
+        if self.provided('header_image'):
+            # If header image is provided stomp its geometry over the
+            # acquired channels
+            pipeline.connect_input('header_image', to_polar, 'header_image',
+                                   nifti_gz_format)
 
         return pipeline
 
@@ -379,7 +339,9 @@ class MriStudy(Study, metaclass=StudyMetaClass):
                     outputs={
                         'brain_mask_coreg': ('out_file', nifti_gz_format)},
                     requirements=[fsl_req.v('5.0.10')],
-                    wall_time=10)
+                    wall_time=10,
+                    uncompressed_inputs=['in_file', 'reference'],
+                    uncompressed_outputs={'output_type': 'NIFTI'})
 
             elif self.branch('coreg_method', 'ants'):
                 # Convert ANTs transform matrix to FSL format if we have used
@@ -513,7 +475,9 @@ class MriStudy(Study, metaclass=StudyMetaClass):
                 'mag_coreg': ('out_file', nifti_gz_format),
                 'coreg_fsl_mat': ('out_matrix_file', text_matrix_format)},
             requirements=[fsl_req.v('5.0.8')],
-            wall_time=5)
+            wall_time=5,
+            uncompressed_inputs=['in_file', 'reference'],
+            uncompressed_outputs={'output_type': 'NIFTI'})
 
         return pipeline
 
@@ -652,7 +616,9 @@ class MriStudy(Study, metaclass=StudyMetaClass):
                 'qformed': ('out_file', nifti_gz_format),
                 'qform_mat': ('out_matrix_file', text_matrix_format)},
             requirements=[fsl_req.v('5.0.8')],
-            wall_time=5)
+            wall_time=5,
+            uncompressed_inputs=['in_file', 'reference'],
+            uncompressed_outputs={'output_type': 'NIFTI'})
 
         return pipeline
 
@@ -678,7 +644,9 @@ class MriStudy(Study, metaclass=StudyMetaClass):
             outputs={
                 'brain': ('out_file', nifti_gz_format),
                 'brain_mask': ('mask_file', nifti_gz_format)},
-            requirements=[fsl_req.v('5.0.9')])
+            requirements=[fsl_req.v('5.0.9')],
+            uncompressed_inputs=['in_file'],
+            uncompressed_outputs={'output_type': 'NIFTI'})
         # Set either robust or reduce bias
         if self.branch('bet_robust'):
             bet.inputs.robust = True
@@ -701,12 +669,12 @@ class MriStudy(Study, metaclass=StudyMetaClass):
             AntsRegSyn(
                 num_dimensions=3,
                 transformation='s',
-                out_prefix='T12MNI',
-                num_threads=4),
+                out_prefix='T12MNI'),
             inputs={
                 'ref_file': ('template', nifti_gz_format),
                 'input_file': ('mag_preproc', nifti_gz_format)},
             wall_time=25,
+            threads=Threads(max=8, input='num_threads', env=ITK_ENV),
             requirements=[ants_req.v('2.0')])
 
         merge_trans = pipeline.add(
@@ -749,7 +717,8 @@ class MriStudy(Study, metaclass=StudyMetaClass):
             outputs={
                 'brain_mask': ('out_file', nifti_gz_format)},
             wall_time=5,
-            requirements=[fsl_req.v('5.0.8')])
+            requirements=[fsl_req.v('5.0.8')],
+            uncompressed_outputs={'output_type': 'NIFTI'})
 
         maths2 = pipeline.add(
             'mask',
@@ -763,7 +732,9 @@ class MriStudy(Study, metaclass=StudyMetaClass):
             outputs={
                 'brain': ('out_file', nifti_gz_format)},
             wall_time=5,
-            requirements=[fsl_req.v('5.0.8')])
+            requirements=[fsl_req.v('5.0.8')],
+            uncompressed_inputs=['in_file'],
+            uncompressed_outputs={'output_type': 'NIFTI'})
 
         if self.branch('optibet_gen_report'):
             pipeline.add(
@@ -805,7 +776,8 @@ class MriStudy(Study, metaclass=StudyMetaClass):
                 output_type='NIFTI_GZ'),
             inputs={
                 'in_file': ('mag_preproc', nifti_gz_format)},
-            requirements=[fsl_req.v('5.0.8')])
+            requirements=[fsl_req.v('5.0.8')],
+            uncompressed_inputs=['in_file'])
 
         reorient_mask = pipeline.add(
             'reorient_mask',
@@ -813,7 +785,8 @@ class MriStudy(Study, metaclass=StudyMetaClass):
                 output_type='NIFTI_GZ'),
             inputs={
                 'in_file': ('brain_mask', nifti_gz_format)},
-            requirements=[fsl_req.v('5.0.8')])
+            requirements=[fsl_req.v('5.0.8')],
+            uncompressed_inputs=['in_file'])
 
         reorient_brain = pipeline.add(
             'reorient_brain',
@@ -821,7 +794,8 @@ class MriStudy(Study, metaclass=StudyMetaClass):
                 output_type='NIFTI_GZ'),
             inputs={
                 'in_file': ('brain', nifti_gz_format)},
-            requirements=[fsl_req.v('5.0.8')])
+            requirements=[fsl_req.v('5.0.8')],
+            uncompressed_inputs=['in_file'])
 
         # Affine transformation to MNI space
         flirt = pipeline.add(
@@ -868,7 +842,8 @@ class MriStudy(Study, metaclass=StudyMetaClass):
                 'coreg_to_tmpl_fsl_coeff': ('fieldcoeff_file',
                                              nifti_gz_format)},
             requirements=[fsl_req.v('5.0.8')],
-            wall_time=60)
+            wall_time=60,
+            uncompressed_outputs={'output_type': 'NIFTI'})
         # Set registration parameters
         # TODO: Need to work out which parameters to use
         return pipeline
@@ -886,8 +861,7 @@ class MriStudy(Study, metaclass=StudyMetaClass):
             'Struct2MNI_reg',
             AntsRegSyn(
                 num_dimensions=3,
-                transformation='s',
-                num_threads=4),
+                transformation='s'),
             inputs={
                 'input_file': (self.brain_spec_name, nifti_gz_format),
                 'ref_file': ('template_brain', nifti_gz_format)},
@@ -896,7 +870,8 @@ class MriStudy(Study, metaclass=StudyMetaClass):
                 'coreg_to_tmpl_ants_mat': ('regmat', text_matrix_format),
                 'coreg_to_tmpl_ants_warp': ('warp_file', nifti_gz_format)},
             wall_time=25,
-            requirements=[ants_req.v('2.0')])
+            requirements=[ants_req.v('2.0')],
+            threads=Threads(max=8, input='num_threads', env=ITK_ENV))
 
 #         ants_reg = pipeline.add(
 #             'ants_reg',
@@ -10,21 +10,26 @@ from banana.requirement import (
 from banana.citation import fsl_cite
 from banana.file_format import (
     nifti_gz_format, nifti_gz_x_format, rfile_format, directory_format,
-    zip_format, par_format, text_format, dicom_format, text_matrix_format)
+    zip_format, par_format, text_format, dicom_format, text_matrix_format,
+    numpy_array_format)
 from banana.interfaces.afni import Tproject
 from nipype.interfaces.utility import Merge as NiPypeMerge
 import os.path as op
 from nipype.interfaces.utility.base import IdentityInterface
-from arcana.study import ParamSpec
+from arcana.study import ParamSpec, SwitchSpec
 from nipype.interfaces.ants.resampling import ApplyTransforms
 from banana.study.mri.t1 import T1Study
 from arcana.study.multi import (
     MultiStudy, SubStudySpec, MultiStudyMetaClass)
 from arcana.data import InputFilesets
-from arcana.utils.interfaces import CopyToDir
+from banana.interfaces.utility import CopyToDir
 from nipype.interfaces.afni.preprocess import BlurToFWHM
-from banana.interfaces.custom.bold import PrepareFIX
+from banana.interfaces.custom.bold import (
+    PrepareFIX, MIGPSubjectReduction, MIGP, TemporalFilter)
+from banana.interfaces.custom.dynamic_fc import (
+    SlidingWindowFC, DynamicFCStates, FC_METHODS)
 from banana.interfaces.c3d import ANTs2FSLMatrixConversion
+from banana.utils.threads import Threads
 import logging
 from arcana.exceptions import ArcanaNameError
 from banana.bids_ import BidsInputs, BidsAssocInput
@@ -63,14 +68,46 @@ class BoldStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
         FilesetSpec('normalized_ts', nifti_gz_format,
                     'timeseries_normalization_to_atlas_pipeline'),
         FilesetSpec('smoothed_ts', nifti_gz_format,
-                    'smoothing_pipeline')]
+                    'smoothing_pipeline'),
+        InputFilesetSpec('component_timecourses', text_format,
+                         optional=True,
+                         desc=("Time courses of each network/component "
+                               "(timepoints x components), e.g. from dual "
+                               "regression of group ICA maps")),
+        FilesetSpec('dynamic_fc', numpy_array_format,
+                    'dynamic_fc_pipeline'),
+        FilesetSpec('dynamic_fc_states', directory_format,
+                    'dynamic_fc_states_pipeline', frequency='per_study')]
 
     add_param_specs = [
         ParamSpec('component_threshold', 20),
         ParamSpec('motion_reg', True),
         ParamSpec('highpass', 0.01),
         ParamSpec('brain_thresh_percent', 5),
-        ParamSpec('group_ica_components', 15)]
+        ParamSpec('group_ica_components', 15),
+        # 'numpy' filters in a single in-process pass instead of running
+        # 3dTproject and then adding back the mean with fslmaths
+        SwitchSpec('temporal_filter_method', 'afni', ('afni', 'numpy')),
+        ParamSpec('dfc_window_tp', 60,
+                  desc="Length of the dynamic FC windows in timepoints"),
+        ParamSpec('dfc_step', 1,
+                  desc="Number of timepoints between dynamic FC windows"),
+        ParamSpec('dfc_sigma', 20.0,
+                  desc=("Standard deviation (in timepoints) of the Gaussian "
+                        "used to taper the dynamic FC windows")),
+        ParamSpec('dfc_components', None, dtype=int, array=True,
+                  desc=("1-based indices of the components to include in "
+                        "the dynamic FC. All are used if not provided")),
+        ParamSpec('dfc_method', 'corr', choices=FC_METHODS,
+                  desc=("How the connectivity within each window is "
+                        "estimated, see banana.interfaces.custom.dynamic_fc")),
+        ParamSpec('dfc_ridge', 0.1,
+                  desc="Regularisation of the 'ridge_pc' dynamic FC method"),
+        ParamSpec('dfc_lasso_alpha', 1e-5,
+                  desc="L1 penalty of the 'reg_pc' dynamic FC method"),
+        ParamSpec('dfc_max_states', 13,
+                  desc=("Upper bound (exclusive) on the number of dynamic FC "
+                        "states considered in the model selection"))]
 
     primary_bids_selector = BidsInputs(
         spec_name='series', type='bold',
@@ -112,43 +149,59 @@ class BoldStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
             wall_time=5,
             requirements=[afni_req.v('16.2.10')])
 
-        filt = pipeline.add(
-            'Tproject',
-            Tproject(
-                stopband=(0, 0.01),
-                polort=3,
-                blur=3,
-                out_file='filtered_func_data.nii.gz'),
-            inputs={
-                'delta_t': ('tr', float),
-                'mask': (self.brain_mask_spec_name, nifti_gz_format),
-                'in_file': (afni_mc, 'out_file')},
-            wall_time=5,
-            requirements=[afni_req.v('16.2.10')])
-
-        meanfunc = pipeline.add(
-            'meanfunc',
-            ImageMaths(
-                op_string='-Tmean',
-                suffix='_mean',
-                output_type='NIFTI_GZ'),
-            wall_time=5,
-            inputs={
-                'in_file': (afni_mc, 'out_file')},
-            requirements=[fsl_req.v('5.0.10')])
-
-        pipeline.add(
-            'add_mean',
-            ImageMaths(
-                op_string='-add',
-                output_type='NIFTI_GZ'),
-            inputs={
-                'in_file': (filt, 'out_file'),
-                'in_file2': (meanfunc, 'out_file')},
-            outputs={
-                'filtered_data': ('out_file', nifti_gz_format)},
-            wall_time=5,
-            requirements=[fsl_req.v('5.0.10')])
+        if self.branch('temporal_filter_method', 'numpy'):
+            pipeline.add(
+                'temporal_filter',
+                TemporalFilter(
+                    stopband=(0, 0.01),
+                    polort=3,
+                    blur=3,
+                    out_file='filtered_func_data.nii.gz'),
+                inputs={
+                    'delta_t': ('tr', float),
+                    'mask': (self.brain_mask_spec_name, nifti_gz_format),
+                    'in_file': (afni_mc, 'out_file')},
+                outputs={
+                    'filtered_data': ('out_file', nifti_gz_format)},
+                wall_time=5)
+        else:
+            filt = pipeline.add(
+                'Tproject',
+                Tproject(
+                    stopband=(0, 0.01),
+                    polort=3,
+                    blur=3,
+                    out_file='filtered_func_data.nii.gz'),
+                inputs={
+                    'delta_t': ('tr', float),
+                    'mask': (self.brain_mask_spec_name, nifti_gz_format),
+                    'in_file': (afni_mc, 'out_file')},
+                wall_time=5,
+                requirements=[afni_req.v('16.2.10')])
+
+            meanfunc = pipeline.add(
+                'meanfunc',
+                ImageMaths(
+                    op_string='-Tmean',
+                    suffix='_mean',
+                    output_type='NIFTI_GZ'),
+                wall_time=5,
+                inputs={
+                    'in_file': (afni_mc, 'out_file')},
+                requirements=[fsl_req.v('5.0.10')])
+
+            pipeline.add(
+                'add_mean',
+                ImageMaths(
+                    op_string='-add',
+                    output_type='NIFTI_GZ'),
+                inputs={
+                    'in_file': (filt, 'out_file'),
+                    'in_file2': (meanfunc, 'out_file')},
+                outputs={
+                    'filtered_data': ('out_file', nifti_gz_format)},
+                wall_time=5,
+                requirements=[fsl_req.v('5.0.10')])
 
         return pipeline
 
@@ -311,8 +364,7 @@ class BoldStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
                 "labelled_components": ("labelled_components", text_format)},
             outputs={
                 'cleaned_file': ('output', nifti_gz_format)},
-            wall_time=30,
-            requirements=[fsl_req.v('5.0.9'), fix_req.v('1.0')])
+            wall_time=30)
 
         return pipeline
 
@@ -374,6 +426,66 @@ class BoldStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
 
         return pipeline
 
+    def dynamic_fc_pipeline(self, **name_maps):
+
+        pipeline = self.new_pipeline(
+            name='dynamic_fc',
+            desc=("Sliding-window dynamic functional connectivity between "
+                  "component time courses"),
+            name_maps=name_maps)
+
+        dfc = pipeline.add(
+            'sliding_window_fc',
+            SlidingWindowFC(
+                window_tp=self.parameter('dfc_window_tp'),
+                step=self.parameter('dfc_step'),
+                sigma=self.parameter('dfc_sigma'),
+                method=self.parameter('dfc_method'),
+                ridge=self.parameter('dfc_ridge'),
+                alpha=self.parameter('dfc_lasso_alpha')),
+            inputs={
+                'in_file': ('component_timecourses', text_format)},
+            outputs={
+                'dynamic_fc': ('out_file', numpy_array_format)},
+            wall_time=10,
+            threads=Threads(input='num_processes'))
+
+        if self.parameter('dfc_components') is not None:
+            dfc.inputs.components = list(self.parameter('dfc_components'))
+
+        return pipeline
+
+    def dynamic_fc_states_pipeline(self, **name_maps):
+
+        pipeline = self.new_pipeline(
+            name='dynamic_fc_states',
+            desc=("Clusters the dynamic FC of all sessions into recurring FC "
+                  "states"),
+            name_maps=name_maps)
+
+        merge_visits = pipeline.add(
+            'merge_visits',
+            IdentityInterface(['dynamic_fc']),
+            inputs={
+                'dynamic_fc': ('dynamic_fc', numpy_array_format)},
+            joinsource=self.VISIT_ID,
+            joinfield=['dynamic_fc'])
+
+        pipeline.add(
+            'fc_states',
+            DynamicFCStates(
+                max_states=self.parameter('dfc_max_states')),
+            inputs={
+                'in_files': (merge_visits, 'dynamic_fc')},
+            outputs={
+                'dynamic_fc_states': ('out_dir', directory_format)},
+            joinsource=self.SUBJECT_ID,
+            joinfield=['in_files'],
+            wall_time=60,
+            threads=Threads(input='num_processes'))
+
+        return pipeline
+
 
 class MultiBoldMixin(MultiStudy):
     """
@@ -389,6 +501,22 @@ class MultiBoldMixin(MultiStudy):
         FilesetSpec('group_melodic', directory_format,
                     'group_melodic_pipeline')]
 
+    add_param_specs = [
+        # 'migp' reduces the group data with MELODIC's Incremental Group-PCA
+        # before running MELODIC instead of temporally concatenating all
+        # subjects, which keeps memory use constant with the number of
+        # subjects
+        SwitchSpec('group_ica_reduction', 'concat', ('concat', 'migp')),
+        ParamSpec('migp_dim', 500,
+                  desc=("The number of components kept by MIGP, i.e. the "
+                        "dimensionality of the reduced group data passed "
+                        "to MELODIC when 'group_ica_reduction' is 'migp'")),
+        ParamSpec('migp_mem_gb', 8,
+                  desc=("The memory (GB) requested for the per-subject "
+                        "reductions and the MIGP join, which depends on the "
+                        "number of in-mask voxels and volumes and "
+                        "'migp_dim'"))]
+
     @classmethod
     def fmri_substudies(cls):
         # Detect fMRI sub-studies
@@ -489,7 +617,7 @@ class MultiBoldMixin(MultiStudy):
 
         pipeline.add(
             'copy2dir',
-            CopyToDir(),
+            CopyToDir(staging='auto'),
             inputs={
                 'in_files': (merge_inputs, 'out')},
             outputs={
@@ -505,7 +633,8 @@ class MultiBoldMixin(MultiStudy):
             citations=[fsl_cite],
             name_maps=name_maps)
 
-        pipeline.add(
+        melodic = pipeline.add(
+            'gica',
             MELODIC(
                 no_bet=True,
                 bg_threshold=self.parameter('brain_thresh_percent'),
@@ -518,16 +647,47 @@ class MultiBoldMixin(MultiStudy):
                 output_type='NIFTI_GZ'),
             inputs={
                 'bg_image': ('template_brain', nifti_gz_format),
-                'mask': ('template_mask', nifti_gz_format),
-                'in_files': ('smoothed_ts', nifti_gz_format),
-                'tr_sec': ('tr', float)},
+                'mask': ('template_mask', nifti_gz_format)},
             outputs={
                 'group_melodic': ('out_dir', directory_format)},
-            joinsource=self.SUBJECT_ID,
-            joinfield=['in_files'],
-            name='gica',
             requirements=[fsl_req.v('5.0.10')],
-            wall_time=7200)
+            wall_time=7200,
+            **({} if self.branch('group_ica_reduction', 'migp') else
+               {'joinsource': self.SUBJECT_ID, 'joinfield': ['in_files']}))
+
+        if self.branch('group_ica_reduction', 'migp'):
+            # Each subject is reduced in parallel to the dimensionality of
+            # the group eigenspace before being streamed into MIGP
+            subject_pca = pipeline.add(
+                'subject_pca',
+                MIGPSubjectReduction(
+                    num_components=self.parameter('migp_dim')),
+                inputs={
+                    'in_file': ('smoothed_ts', nifti_gz_format),
+                    'mask_file': ('template_mask', nifti_gz_format)},
+                wall_time=30,
+                mem_gb=self.parameter('migp_mem_gb'))
+
+            migp = pipeline.add(
+                'migp',
+                MIGP(
+                    num_components=self.parameter('migp_dim')),
+                inputs={
+                    'in_files': (subject_pca, 'out_file'),
+                    'mask_file': ('template_mask', nifti_gz_format),
+                    'tr': ('tr', float)},
+                joinsource=self.SUBJECT_ID,
+                joinfield=['in_files', 'tr'],
+                wall_time=60,
+                mem_gb=self.parameter('migp_mem_gb'))
+
+            # The joined TR is passed through MIGP so MELODIC only runs once
+            pipeline.connect(migp, 'out_file', melodic, 'in_files')
+            pipeline.connect(migp, 'tr', melodic, 'tr_sec')
+        else:
+            pipeline.connect_input('smoothed_ts', melodic, 'in_files',
+                                   nifti_gz_format)
+            pipeline.connect_input('tr', melodic, 'tr_sec', float)
 
         return pipeline
 
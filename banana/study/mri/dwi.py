@@ -7,30 +7,33 @@ from banana.interfaces.mrtrix import (
     DWIPreproc, MRCat, ExtractDWIorB0, MRMath, DWIBiasCorrect, DWIDenoise,
     MRCalc, DWIIntensityNorm, AverageResponse, DWI2Mask)
 # from nipype.workflows.dwi.fsl.tbss import create_tbss_all
-# from banana.interfaces.noddi import (
-#     CreateROI, BatchNODDIFitting, SaveParamsAsNIfTI)
+from banana.interfaces.noddi import (
+    NumpyCreateROI, AmicoNODDIFitting, NumpySaveParamsAsNIfTI)
 from nipype.interfaces import fsl, mrtrix3, utility
 from arcana.utils.interfaces import MergeTuple, Chain
 from arcana.data import FilesetSpec, InputFilesetSpec
 from arcana.utils.interfaces import SelectSession
 from arcana.study import ParamSpec, SwitchSpec
 from arcana.exceptions import ArcanaMissingDataException, ArcanaNameError
+from banana.utils.threads import Threads, OMP_ENV
 from banana.requirement import (
     fsl_req, mrtrix_req, ants_req)
-from banana.interfaces.mrtrix import MRConvert, ExtractFSLGradients
+from banana.interfaces.mrtrix import (
+    MRConvert, NativeMRConvert, ExtractFSLGradients)
 from banana.study import StudyMetaClass
 from banana.interfaces.custom.motion_correction import (
     PrepareDWI, AffineMatrixGeneration)
-from banana.interfaces.custom.dwi import TransformGradients
+from banana.interfaces.custom.dwi import (
+    TransformGradients, DiffusionTensorFit)
 from banana.interfaces.utility import AppendPath
 from banana.study.base import Study
 from banana.bids_ import BidsInputs, BidsAssocInput
 from banana.exceptions import BananaUsageError
 from banana.citation import (
     mrtrix_cite, fsl_cite, eddy_cite, topup_cite, distort_correct_cite,
-    n4_cite, dwidenoise_cites)
+    n4_cite, dwidenoise_cites, noddi_cite)
 from banana.file_format import (
-    mrtrix_image_format, nifti_gz_format, nifti_gz_x_format, fsl_bvecs_format,
+    mrtrix_image_format, nifti_gz_format, nifti_format, nifti_gz_x_format, fsl_bvecs_format,
     fsl_bvals_format, text_format, dicom_format, eddy_par_format,
     mrtrix_track_format, motion_mats_format, text_matrix_format,
     directory_format, csv_format, zip_format)
@@ -65,6 +68,19 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
         FilesetSpec('tensor', nifti_gz_format, 'tensor_pipeline'),
         FilesetSpec('fa', nifti_gz_format, 'tensor_metrics_pipeline'),
         FilesetSpec('adc', nifti_gz_format, 'tensor_metrics_pipeline'),
+        FilesetSpec('ad', nifti_gz_format, 'tensor_metrics_pipeline',
+                    desc="Axial diffusivity"),
+        FilesetSpec('rd', nifti_gz_format, 'tensor_metrics_pipeline',
+                    desc="Radial diffusivity"),
+        FilesetSpec('tensor_evec', nifti_gz_format, 'tensor_metrics_pipeline',
+                    desc="Principal eigenvector of the tensor"),
+        FilesetSpec('ficvf', nifti_gz_format, 'noddi_fitting_pipeline',
+                    desc=("Neurite density (intra-cellular volume fraction) "
+                          "estimated by NODDI")),
+        FilesetSpec('odi', nifti_gz_format, 'noddi_fitting_pipeline',
+                    desc="Orientation dispersion index estimated by NODDI"),
+        FilesetSpec('fiso', nifti_gz_format, 'noddi_fitting_pipeline',
+                    desc="Free water (CSF) fraction estimated by NODDI"),
         FilesetSpec('wm_response', text_format, 'response_pipeline'),
         FilesetSpec('gm_response', text_format, 'response_pipeline'),
         FilesetSpec('csf_response', text_format, 'response_pipeline'),
@@ -97,7 +113,14 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
         ParamSpec('bet_reduce_bias', False),
         ParamSpec('num_global_tracks', int(1e9)),
         ParamSpec('global_tracks_cutoff', 0.05),
+        ParamSpec('tensor_fit_weighting', 'wls', choices=('wls', 'ols'),
+                  desc=("Least-squares method used to fit the tensor when "
+                        "'tensor_method' is 'numpy'")),
         SwitchSpec('preproc_denoise', False),
+        SwitchSpec('tensor_method', 'mrtrix', ('mrtrix', 'numpy'),
+                   desc=("The tool used to fit the tensor. 'numpy' fits the "
+                         "tensor in-process, deriving the tensor metrics "
+                         "directly from the series in the same pass")),
         SwitchSpec('response_algorithm', 'tax',
                    ('tax', 'dhollander', 'msmt_5tt')),
         SwitchSpec('fod_algorithm', 'csd', ('csd', 'msmt_csd')),
@@ -356,7 +379,9 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
             outputs={
                 'eddy_par': ('eddy_parameters', eddy_par_format)},
             requirements=[mrtrix_req.v('3.0rc3'), fsl_req.v('5.0.10')],
-            wall_time=60)
+            wall_time=60,
+            # eddy is parallelised with OpenMP
+            threads=Threads(input='nthreads', env=OMP_ENV))
 
         if distortion_correction:
             pipeline.connect(prep_dwi, 'pe', preproc, 'pe_dir')
@@ -478,7 +503,7 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
 
         mrconvert = pipeline.add(
             'mrconvert',
-            MRConvert(
+            NativeMRConvert(
                 out_ext='.mif'),
             inputs={
                 'in_file': (self.series_preproc_spec_name, nifti_gz_format),
@@ -553,6 +578,8 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
         """
         Fits the apparrent diffusion tensor (DT) to each voxel of the image
         """
+        if self.branch('tensor_method', 'numpy'):
+            return self._numpy_tensor_pipeline(metrics=False, **name_maps)
 
         pipeline = self.new_pipeline(
             name='tensor',
@@ -572,7 +599,8 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
                 'in_mask': (self.brain_mask_spec_name, nifti_gz_format)},
             outputs={
                 'tensor': ('out_file', nifti_gz_format)},
-            requirements=[mrtrix_req.v('3.0rc3')])
+            requirements=[mrtrix_req.v('3.0rc3')],
+            threads=Threads(input='nthreads'))
 
         return pipeline
 
@@ -580,10 +608,14 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
         """
         Fits the apparrent diffusion tensor (DT) to each voxel of the image
         """
+        if self.branch('tensor_method', 'numpy'):
+            # The metrics are derived in the same pass as the tensor fit
+            return self._numpy_tensor_pipeline(metrics=True, **name_maps)
 
         pipeline = self.new_pipeline(
             name='fa',
-            desc=("Calculates the FA and ADC from a tensor image"),
+            desc=("Calculates the FA, ADC, AD, RD and principal eigenvector "
+                  "from a tensor image"),
             citations=[],
             name_maps=name_maps)
 
@@ -592,17 +624,120 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
             'metrics',
             TensorMetrics(
                 out_fa='fa.nii.gz',
-                out_adc='adc.nii.gz'),
+                out_adc='adc.nii.gz',
+                out_ad='ad.nii.gz',
+                out_rd='rd.nii.gz',
+                out_evec='evec.nii.gz',
+                modulate='none'),
             inputs={
                 'in_file': ('tensor', nifti_gz_format),
                 'in_mask': (self.brain_mask_spec_name, nifti_gz_format)},
             outputs={
                 'fa': ('out_fa', nifti_gz_format),
-                'adc': ('out_adc', nifti_gz_format)},
+                'adc': ('out_adc', nifti_gz_format),
+                'ad': ('out_ad', nifti_gz_format),
+                'rd': ('out_rd', nifti_gz_format),
+                'tensor_evec': ('out_evec', nifti_gz_format)},
             requirements=[mrtrix_req.v('3.0rc3')])
 
         return pipeline
 
+    def _numpy_tensor_pipeline(self, metrics, **name_maps):
+        """
+        Fits the diffusion tensor in-process, deriving either the tensor
+        or its metrics in a single pass over the preprocessed series
+
+        Parameters
+        ----------
+        metrics : bool
+            Whether to derive the tensor metrics instead of the tensor
+        """
+        if metrics:
+            pipeline = self.new_pipeline(
+                name='tensor_metrics',
+                desc=("Estimates the FA, ADC, AD, RD and principal "
+                      "eigenvector of the apparent diffusion tensor in each "
+                      "voxel"),
+                citations=[],
+                name_maps=name_maps)
+            outputs = {
+                'fa': ('fa', nifti_gz_format),
+                'adc': ('adc', nifti_gz_format),
+                'ad': ('ad', nifti_gz_format),
+                'rd': ('rd', nifti_gz_format),
+                'tensor_evec': ('evec', nifti_gz_format)}
+        else:
+            pipeline = self.new_pipeline(
+                name='tensor',
+                desc=("Estimates the apparent diffusion tensor in each "
+                      "voxel"),
+                citations=[],
+                name_maps=name_maps)
+            outputs = {
+                'tensor': ('tensor', nifti_gz_format)}
+
+        pipeline.add(
+            'tensor_fit',
+            DiffusionTensorFit(
+                method=self.parameter('tensor_fit_weighting'),
+                metrics=metrics),
+            inputs={
+                'grad_fsl': self.fsl_grads(pipeline),
+                'in_file': (self.series_preproc_spec_name, nifti_gz_format),
+                'in_mask': (self.brain_mask_spec_name, nifti_gz_format)},
+            outputs=outputs,
+            threads=Threads(input='num_processes'))
+
+        return pipeline
+
+    def noddi_fitting_pipeline(self, **name_maps):  # @UnusedVariable
+        """
+        Fits the Watson NODDI model to each voxel of the image in-process,
+        with the linearised approach of AMICO
+        """
+        pipeline = self.new_pipeline(
+            name='noddi_fitting',
+            desc=("Estimates the neurite density, orientation dispersion and "
+                  "free water fraction in each voxel"),
+            citations=[noddi_cite],
+            name_maps=name_maps)
+
+        if self.is_coregistered:
+            grad_dirs = 'grad_dirs_coreg'
+        else:
+            grad_dirs = 'grad_dirs'
+
+        roi = pipeline.add(
+            'create_roi',
+            NumpyCreateROI(),
+            inputs={
+                'in_file': (self.series_preproc_spec_name, nifti_gz_format),
+                'brain_mask': (self.brain_mask_spec_name, nifti_gz_format)})
+
+        fitting = pipeline.add(
+            'fitting',
+            AmicoNODDIFitting(),
+            inputs={
+                'roi_file': (roi, 'out_file'),
+                'bvecs_file': (grad_dirs, fsl_bvecs_format),
+                'bvals_file': ('bvalues', fsl_bvals_format)},
+            threads=Threads(input='num_processes'))
+
+        pipeline.add(
+            'save_params',
+            NumpySaveParamsAsNIfTI(),
+            inputs={
+                'params_file': (fitting, 'out_file'),
+                'roi_file': (roi, 'out_file'),
+                'brain_mask_file': (self.brain_mask_spec_name,
+                                    nifti_gz_format)},
+            outputs={
+                'ficvf': ('ficvf', nifti_format),
+                'odi': ('odi', nifti_format),
+                'fiso': ('fiso', nifti_format)})
+
+        return pipeline
+
     def response_pipeline(self, **name_maps):  # @UnusedVariable
         """
         Estimates the fibre orientation distribution (FOD) using constrained
@@ -631,7 +766,8 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
                 'in_mask': (self.brain_mask_spec_name, nifti_gz_format)},
             outputs={
                 'wm_response': ('wm_file', text_format)},
-            requirements=[mrtrix_req.v('3.0rc3')])
+            requirements=[mrtrix_req.v('3.0rc3')],
+            threads=Threads(input='nthreads'))
 
         # Connect to outputs
         if self.multi_tissue:
@@ -717,7 +853,8 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
                 'grad_fsl': self.fsl_grads(pipeline)},
             outputs={
                 'wm_odf': ('wm_odf', nifti_gz_format)},
-            requirements=[mrtrix_req.v('3.0rc3')])
+            requirements=[mrtrix_req.v('3.0rc3')],
+            threads=Threads(input='nthreads'))
 
         if self.multi_tissue:
             dwi2fod.inputs.gm_odf = 'gm.mif',
@@ -770,7 +907,7 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
         # Convert to Nifti
         pipeline.add(
             "output_conversion",
-            MRConvert(
+            NativeMRConvert(
                 out_ext='.nii.gz',
                 quiet=True),
             inputs={
@@ -807,7 +944,8 @@ class DwiStudy(EpiSeriesStudy, metaclass=StudyMetaClass):
                 'in_file': ('wm_odf', mrtrix_image_format)},
             outputs={
                 'global_tracks': ('out_file', mrtrix_track_format)},
-            requirements=[mrtrix_req.v('3.0rc3')])
+            requirements=[mrtrix_req.v('3.0rc3')],
+            threads=Threads(input='nthreads'))
 
         if self.provided('anat_5tt'):
             pipeline.connect_input('anat_5tt', tracking, 'act_file',
@@ -8,7 +8,7 @@ from arcana.data import FilesetSpec, InputFilesetSpec
 from arcana.utils.interfaces import JoinPath
 from arcana.study.base import StudyMetaClass
 from arcana.study import ParamSpec, SwitchSpec
-from arcana.utils.interfaces import CopyToDir
+from banana.interfaces.utility import CopyToDir
 from banana.requirement import freesurfer_req, ants_req, fsl_req, mrtrix_req
 from banana.citation import freesurfer_cites, fsl_cite
 from banana.interfaces.freesurfer import AparcStats
@@ -19,6 +19,7 @@ from banana.file_format import (
     nifti_gz_x_format)
 from banana.reference import LocalReferenceData
 from banana.bids_ import BidsInputs
+from banana.utils.threads import Threads, OMP_ENV
 from .t2 import T2Study
 
 
@@ -83,12 +84,14 @@ class T1Study(T2Study, metaclass=StudyMetaClass):
         recon_all = pipeline.add(
             'recon_all',
             interface=ReconAll(
-                directive='all',
-                openmp=self.processor.num_processes),
+                directive='all'),
             inputs={
                 'T1_files': ('mag_preproc', nifti_gz_format)},
             requirements=[freesurfer_req.v('5.3')],
-            wall_time=2000)
+            wall_time=2000,
+            # Only some of the recon-all stages are parallelised
+            threads=Threads(max=8, parallel_fraction=0.5, input='openmp',
+                            env=OMP_ENV))
 
         if self.provided('t2_coreg'):
             pipeline.connect_input('t2_coreg', recon_all, 'T2_file',
@@ -150,7 +153,7 @@ class T1Study(T2Study, metaclass=StudyMetaClass):
 
         copy_to_dir = pipeline.add(
             'copy_to_subjects_dir',
-            CopyToDir(),
+            CopyToDir(staging='auto'),
             inputs={
                 'in_files': ('fs_recon_all', directory_format),
                 'file_names': (self.SUBJECT_ID, int)},
@@ -19,10 +19,12 @@ from banana.interfaces.sti import (
     UnwrapPhase, VSharp, QSMiLSQR, BatchUnwrapPhase, BatchVSharp,
     BatchQSMiLSQR)
 from banana.interfaces.custom.coils import HIPCombineChannels
+from banana.interfaces.custom.qsm import NativeQSM
 from banana.interfaces.custom.mask import (
     DialateMask, MaskCoils, MedianInMasks)
 from arcana.study import ParamSpec, SwitchSpec
 from banana.reference import LocalReferenceData
+from banana.utils.threads import Threads
 from logging import getLogger
 
 logger = getLogger('banana')
@@ -101,6 +103,11 @@ class T2starStudy(MriStudy, metaclass=StudyMetaClass):
 
     add_param_specs = [
         SwitchSpec('qsm_dual_echo', False),
+        SwitchSpec('qsm_method', 'matlab', ('matlab', 'numpy'),
+                   desc=("The implementation of the phase unwrapping, "
+                         "background removal and dipole inversion steps. "
+                         "'numpy' runs them in-process over all channels at "
+                         "once, 'matlab' runs the STI Suite functions")),
         ParamSpec('qsm_echo', 1,
                       desc=("Which echo (by index starting at 1) to use when "
                             "using single echo")),
@@ -155,43 +162,62 @@ class T2starStudy(MriStudy, metaclass=StudyMetaClass):
                     'magnitudes_dir': ('mag_channels', multi_nifti_gz_format),
                     'phases_dir': ('phase_channels', multi_nifti_gz_format)})
 
-            # Unwrap phase using Laplacian unwrapping
-            unwrap = pipeline.add(
-                'unwrap',
-                UnwrapPhase(
-                    padsize=self.parameter('qsm_padding')),
-                inputs={
-                    'voxelsize': ('voxel_sizes', float),
-                    'in_file': (channel_combine, 'phase')},
-                requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)])
-
-            # Remove background noise
-            vsharp = pipeline.add(
-                "vsharp",
-                VSharp(
-                    mask_manip="imerode({}>0, ball(5))"),
-                inputs={
-                    'voxelsize': ('voxel_sizes', float),
-                    'in_file': (unwrap, 'out_file'),
-                    'mask': (erosion, 'out_file')},
-                requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)])
-
-            # Run QSM iLSQR
-            pipeline.add(
-                'qsmrecon',
-                QSMiLSQR(
-                    mask_manip="{}>0",
-                    padsize=self.parameter('qsm_padding')),
-                inputs={
-                    'voxelsize': ('voxel_sizes', float),
-                    'te': ('echo_times', float),
-                    'B0': ('main_field_strength', float),
-                    'H': ('main_field_orient', float),
-                    'in_file': (vsharp, 'out_file'),
-                    'mask': (vsharp, 'new_mask')},
-                outputs={
-                    'qsm': ('qsm', nifti_format)},
-                requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)])
+            if self.branch('qsm_method', 'numpy'):
+                # Unwrap, remove background and invert in a single node
+                pipeline.add(
+                    'qsmrecon',
+                    NativeQSM(
+                        mask_erosion=5,
+                        phase_difference=True,
+                        padsize=self.parameter('qsm_padding')),
+                    inputs={
+                        'voxelsize': ('voxel_sizes', float),
+                        'echo_times': ('echo_times', float),
+                        'B0': ('main_field_strength', float),
+                        'H': ('main_field_orient', float),
+                        'in_files': (channel_combine, 'phase'),
+                        'masks': (erosion, 'out_file')},
+                    outputs={
+                        'qsm': ('out_file', nifti_gz_format)},
+                    threads=Threads(input='num_threads'))
+            else:
+                # Unwrap phase using Laplacian unwrapping
+                unwrap = pipeline.add(
+                    'unwrap',
+                    UnwrapPhase(
+                        padsize=self.parameter('qsm_padding')),
+                    inputs={
+                        'voxelsize': ('voxel_sizes', float),
+                        'in_file': (channel_combine, 'phase')},
+                    requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)])
+
+                # Remove background noise
+                vsharp = pipeline.add(
+                    "vsharp",
+                    VSharp(
+                        mask_manip="imerode({}>0, ball(5))"),
+                    inputs={
+                        'voxelsize': ('voxel_sizes', float),
+                        'in_file': (unwrap, 'out_file'),
+                        'mask': (erosion, 'out_file')},
+                    requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)])
+
+                # Run QSM iLSQR
+                pipeline.add(
+                    'qsmrecon',
+                    QSMiLSQR(
+                        mask_manip="{}>0",
+                        padsize=self.parameter('qsm_padding')),
+                    inputs={
+                        'voxelsize': ('voxel_sizes', float),
+                        'te': ('echo_times', float),
+                        'B0': ('main_field_strength', float),
+                        'H': ('main_field_orient', float),
+                        'in_file': (vsharp, 'out_file'),
+                        'mask': (vsharp, 'new_mask')},
+                    outputs={
+                        'qsm': ('qsm', nifti_format)},
+                    requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)])
 
         else:
             # Dialate eroded mask
@@ -231,57 +257,79 @@ class T2starStudy(MriStudy, metaclass=StudyMetaClass):
                     'whole_brain_mask': (dialate, 'out_file')},
                 requirements=[matlab_req.v('r2017a')])
 
-            # Unwrap phase
-            unwrap = pipeline.add(
-                'unwrap',
-                BatchUnwrapPhase(
-                    padsize=self.parameter('qsm_padding')),
-                inputs={
-                    'voxelsize': ('voxel_sizes', float),
-                    'in_file': (list_phases, 'files')},
-                requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)])
-
-            # Background phase removal
-            vsharp = pipeline.add(
-                "vsharp",
-                BatchVSharp(
-                    mask_manip='{}>0'),
-                inputs={
-                    'voxelsize': ('voxel_sizes', float),
-                    'mask': (mask_coils, 'out_files'),
-                    'in_file': (unwrap, 'out_file')},
-                requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)])
-
-            first_echo_time = pipeline.add(
-                'first_echo',
-                Select(
-                    index=0),
-                inputs={
-                    'inlist': ('echo_times', float)})
-
-            # Perform channel-wise QSM
-            coil_qsm = pipeline.add(
-                'coil_qsmrecon',
-                BatchQSMiLSQR(
-                    mask_manip="{}>0",
-                    padsize=self.parameter('qsm_padding')),
-                inputs={
-                    'voxelsize': ('voxel_sizes', float),
-                    'B0': ('main_field_strength', float),
-                    'H': ('main_field_orient', float),
-                    'in_file': (vsharp, 'out_file'),
-                    'mask': (vsharp, 'new_mask'),
-                    'te': (first_echo_time, 'out')},
-                requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)],
-                wall_time=45)  # FIXME: Should be dependent on number of coils
+            if self.branch('qsm_method', 'numpy'):
+                # Unwrap, remove background and invert all channels as a
+                # single batch
+                coil_qsm = pipeline.add(
+                    'coil_qsmrecon',
+                    NativeQSM(
+                        echo_index=self.parameter('qsm_echo') - 1,
+                        padsize=self.parameter('qsm_padding')),
+                    inputs={
+                        'voxelsize': ('voxel_sizes', float),
+                        'echo_times': ('echo_times', float),
+                        'B0': ('main_field_strength', float),
+                        'H': ('main_field_orient', float),
+                        'in_files': (list_phases, 'files'),
+                        'masks': (mask_coils, 'out_files')},
+                    threads=Threads(input='num_threads'))
+                coil_qsm_files = (coil_qsm, 'out_files')
+                coil_qsm_masks = (coil_qsm, 'new_masks')
+            else:
+                # Unwrap phase
+                unwrap = pipeline.add(
+                    'unwrap',
+                    BatchUnwrapPhase(
+                        padsize=self.parameter('qsm_padding')),
+                    inputs={
+                        'voxelsize': ('voxel_sizes', float),
+                        'in_file': (list_phases, 'files')},
+                    requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)])
+
+                # Background phase removal
+                vsharp = pipeline.add(
+                    "vsharp",
+                    BatchVSharp(
+                        mask_manip='{}>0'),
+                    inputs={
+                        'voxelsize': ('voxel_sizes', float),
+                        'mask': (mask_coils, 'out_files'),
+                        'in_file': (unwrap, 'out_file')},
+                    requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)])
+
+                first_echo_time = pipeline.add(
+                    'first_echo',
+                    Select(
+                        index=0),
+                    inputs={
+                        'inlist': ('echo_times', float)})
+
+                # Perform channel-wise QSM
+                coil_qsm = pipeline.add(
+                    'coil_qsmrecon',
+                    BatchQSMiLSQR(
+                        mask_manip="{}>0",
+                        padsize=self.parameter('qsm_padding')),
+                    inputs={
+                        'voxelsize': ('voxel_sizes', float),
+                        'B0': ('main_field_strength', float),
+                        'H': ('main_field_orient', float),
+                        'in_file': (vsharp, 'out_file'),
+                        'mask': (vsharp, 'new_mask'),
+                        'te': (first_echo_time, 'out')},
+                    # FIXME: Should be dependent on number of coils
+                    requirements=[matlab_req.v('r2017a'), sti_req.v(2.2)],
+                    wall_time=45)
+                coil_qsm_files = (coil_qsm, 'out_file')
+                coil_qsm_masks = (vsharp, 'new_mask')
 
             # Combine channel QSM by taking the median coil value
             pipeline.add(
                 'combine_qsm',
                 MedianInMasks(),
                 inputs={
-                    'channels': (coil_qsm, 'out_file'),
-                    'channel_masks': (vsharp, 'new_mask'),
+                    'channels': coil_qsm_files,
+                    'channel_masks': coil_qsm_masks,
                     'whole_brain_mask': (dialate, 'out_file')},
                 outputs={
                     'qsm': ('out_file', nifti_format)},
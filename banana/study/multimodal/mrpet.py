@@ -7,8 +7,9 @@ from banana.interfaces.custom.motion_correction import (
     AffineMatAveraging, PetCorrectionFactor, CreateMocoSeries, FixedBinning,
     UmapAlign2Reference, ReorientUmap)
 from banana.citation import fsl_cite
-from arcana.study.multi import (
-    MultiStudy, SubStudySpec, MultiStudyMetaClass)
+from arcana.study.multi import SubStudySpec, MultiStudyMetaClass
+from banana.study import MultiStudy
+from banana.utils.threads import Threads, ITK_ENV
 from banana.study.mri.epi import EpiSeriesStudy
 from banana.study.mri.t1 import T1Study
 from banana.study.mri.t2 import T2Study
@@ -626,10 +627,11 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                         num_dimensions=3,
                         transformation='s',
                         out_prefix='reg2MNI',
-                        num_threads=4,
                         ref_file=self.parameter('PET_template_MNI')),
                     wall_time=25,
-                    requirements=[ants_req.v('2')])
+                    requirements=[ants_req.v('2')],
+                    threads=Threads(max=8, input='num_threads',
+                                    env=ITK_ENV))
 
                 if self.branch('dynamic_pet_mc'):
                     pipeline.connect(t_mean, 'out_file', reg_tmean2MNI,
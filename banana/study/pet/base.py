@@ -1,4 +1,4 @@
-from arcana.study.base import Study, StudyMetaClass
+from banana.study import Study, StudyMetaClass
 from arcana.data import (
     FilesetSpec, FieldSpec, InputFilesetSpec, InputFieldSpec)
 from banana.file_format import (
@@ -6,6 +6,7 @@ from banana.file_format import (
     list_mode_format)
 from banana.interfaces.sklearn import FastICA
 from banana.interfaces.ants import AntsRegSyn
+from banana.utils.threads import Threads, ITK_ENV
 import os
 from banana.requirement import fsl_req, mrtrix_req
 from banana.interfaces.custom.pet import PreparePetDir
@@ -105,7 +106,6 @@ class PetStudy(Study, metaclass=StudyMetaClass):
             AntsRegSyn(
                 out_prefix='vol2template',
                 num_dimensions=self.parameter('norm_dim'),
-                num_threads=self.processor.num_processes,
                 transformation=self.parameter('norm_transformation'),
                 ref_file=self.parameter('norm_template')),
             inputs={
@@ -114,7 +114,8 @@ class PetStudy(Study, metaclass=StudyMetaClass):
                 'registered_volume': ('reg_file', nifti_gz_format),
                 'warp_file': ('warp_file', nifti_gz_format),
                 'invwarp_file': ('inv_warp', nifti_gz_format),
-                'affine_mat': ('regmat', text_matrix_format)})
+                'affine_mat': ('regmat', text_matrix_format)},
+            threads=Threads(input='num_threads', env=ITK_ENV))
 
         return pipeline
 
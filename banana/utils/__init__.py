@@ -1 +1,15 @@
-from .base import get_fsl_reference_path, get_template_path, nth
+# Loaded on first access (PEP 562) so the light-weight utils modules can be
+# imported without loading Arcana via banana.exceptions
+_LAZY_ATTRS = ('get_fsl_reference_path', 'get_template_path', 'nth')
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(
+            "module '{}' has no attribute '{}'".format(__name__, name))
+    from . import base
+    return getattr(base, name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
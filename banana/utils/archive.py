@@ -0,0 +1,139 @@
+"""
+In-memory access to the NIfTI images stored in a directory or an archive
+(e.g. coil channels downloaded from XNAT as zip or tar.gz files), so that
+they can be read without first being extracted to disk. Members can be
+loaded from multiple threads at once, so that they are decompressed
+concurrently (zlib releases the GIL).
+"""
+import os
+import os.path as op
+import gzip
+import zipfile
+import tarfile
+import threading
+import nibabel as nib
+from banana.exceptions import BananaUsageError
+
+ZIP_EXTS = ('.zip',)
+TAR_EXTS = ('.tar', '.tar.gz', '.tgz')
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def is_archive(path):
+    "Whether the path is a zip or tar archive (judged by its extension)"
+    return (op.isfile(path) and
+            path.lower().endswith(ZIP_EXTS + TAR_EXTS))
+
+
+def nifti_from_bytes(data):
+    """
+    Loads a NIfTI image from the contents of a .nii or .nii.gz file, with the
+    voxel data held in memory
+    """
+    if data[:2] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+    return nib.Nifti1Image.from_bytes(data)
+
+
+class NiftiSource(object):
+    """
+    The NIfTI images in a directory, zip archive or (optionally compressed)
+    tar archive, which are listed by name and loaded into memory without
+    being extracted to disk. Members of archives are named by their base
+    name, i.e. any directories they are nested in are ignored.
+
+    Parameters
+    ----------
+    path : str
+        Path to the directory or archive
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+        if op.isdir(path):
+            self._kind = 'dir'
+            self._members = {f: op.join(path, f) for f in os.listdir(path)
+                             if op.isfile(op.join(path, f))}
+        elif path.lower().endswith(ZIP_EXTS):
+            self._kind = 'zip'
+            with zipfile.ZipFile(path) as zf:
+                self._members = self._by_basename(
+                    i.filename for i in zf.infolist() if not i.is_dir())
+        elif path.lower().endswith(TAR_EXTS):
+            # Compressed tar archives can only be read sequentially so the
+            # (still gzipped) members are read in a single pass up front
+            self._kind = 'tar'
+            with tarfile.open(path, mode='r|*') as tf:
+                contents = {m.name: tf.extractfile(m).read()
+                            for m in tf if m.isfile()}
+            self._members = {n: contents[p] for n, p in
+                             self._by_basename(contents).items()}
+        else:
+            raise BananaUsageError(
+                "'{}' is neither a directory nor a zip or tar archive"
+                .format(path))
+
+    def __repr__(self):
+        return "{}(path={})".format(type(self).__name__, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        "Closes the handles on the archive opened by the worker threads"
+        with self._lock:
+            for handle in self._handles:
+                handle.close()
+            self._handles = []
+        self._local = threading.local()
+
+    def names(self):
+        "The names of the files in the source"
+        return sorted(self._members)
+
+    def read(self, name):
+        "Returns the contents of the named file"
+        member = self._members[name]
+        if self._kind == 'dir':
+            with open(member, 'rb') as f:
+                return f.read()
+        elif self._kind == 'zip':
+            return self._zipfile().read(member)
+        return member
+
+    def load(self, name):
+        "Loads the named NIfTI image into memory"
+        data = self.read(name)
+        try:
+            return nifti_from_bytes(data)
+        except Exception as e:
+            raise BananaUsageError(
+                "Could not load '{}' from '{}' as a NIfTI image: {}".format(
+                    name, self.path, e))
+
+    def _zipfile(self):
+        # Each thread decompresses members from its own handle on the archive
+        zf = getattr(self._local, 'zipfile', None)
+        if zf is None:
+            zf = self._local.zipfile = zipfile.ZipFile(self.path)
+            with self._lock:
+                self._handles.append(zf)
+        return zf
+
+    def _by_basename(self, paths):
+        members = {}
+        for path in paths:
+            name = op.basename(path)
+            if name in members:
+                raise BananaUsageError(
+                    "Duplicate file name '{}' in '{}' ('{}' and '{}')".format(
+                        name, self.path, members[name], path))
+            members[name] = path
+        return members
@@ -0,0 +1,352 @@
+"""
+A content-addressed cache of format conversions (e.g. DICOM to NIfTI), shared
+between the pipelines and studies run on a host so that the same input isn't
+converted again by each pipeline that requires it in a different format.
+
+The cache is enabled by setting the 'BANANA_CONVERSION_CACHE' environment
+variable to the cache directory (e.g. via the '--conversion_cache' option of
+'banana derive'), which is inherited by the processes (and SLURM jobs) that
+run the conversion nodes. Its size is bounded by
+'BANANA_CONVERSION_CACHE_SIZE' (GB), beyond which the least recently used
+conversions are evicted.
+"""
+import os
+import os.path as op
+import stat
+import json
+import errno
+import shutil
+import hashlib
+import logging
+from contextlib import contextmanager
+from banana.exceptions import BananaUsageError
+from banana.utils import version_cache
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+logger = logging.getLogger('banana')
+
+CACHE_DIR_ENV = 'BANANA_CONVERSION_CACHE'
+CACHE_SIZE_ENV = 'BANANA_CONVERSION_CACHE_SIZE'
+
+DEFAULT_MAX_SIZE_GB = 50.0
+
+MANIFEST = 'manifest.json'
+
+READ_BLOCK = 1024 ** 2
+
+# Version strings of the converter requirements detected in this process
+_detected_versions = {}
+
+
+class ConversionCache(object):
+    """
+    A directory of converted files, keyed by a hash of the contents of the
+    source, the converter class and version and the conversion options, and
+    bounded in size by least-recently-used eviction
+
+    Parameters
+    ----------
+    path : str
+        The directory to store the cached conversions in
+    max_size : float
+        The maximum size of the cache (GB)
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE_GB):
+        if max_size <= 0:
+            raise BananaUsageError(
+                "Maximum size of conversion cache needs to be positive ({})"
+                .format(max_size))
+        self.path = op.abspath(path)
+        self.max_size = max_size
+
+    def __repr__(self):
+        return "{}(path={}, max_size={})".format(type(self).__name__,
+                                                 self.path, self.max_size)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Returns the cache configured by the environment variables, or None if
+        conversion caching is not enabled
+        """
+        path = os.environ.get(CACHE_DIR_ENV)
+        if not path:
+            return None
+        return cls(path, float(os.environ.get(CACHE_SIZE_ENV,
+                                              DEFAULT_MAX_SIZE_GB)))
+
+    def enable(self):
+        "Enables the cache for the conversions run from this process"
+        os.environ[CACHE_DIR_ENV] = self.path
+        os.environ[CACHE_SIZE_ENV] = str(self.max_size)
+
+    @classmethod
+    def key(cls, converter, version, options, source):
+        """
+        Returns the key of a conversion
+
+        Parameters
+        ----------
+        converter : str
+            The qualified name of the converter class
+        version : str
+            The version of the converter
+        options : dict
+            The options the converter is run with
+        source : str
+            The path to the source file or directory
+        """
+        hsh = hashlib.sha256()
+        hsh.update(json.dumps([converter, version,
+                               sorted((k, repr(v))
+                                      for k, v in options.items())]).encode())
+        hsh.update(content_hash(source).encode())
+        return hsh.hexdigest()
+
+    def entry_path(self, key):
+        return op.join(self.path, key[:2], key)
+
+    def fetch(self, key, dest_dir):
+        """
+        Links the cached outputs of a conversion into the destination
+        directory
+
+        Returns
+        -------
+        found : bool
+            Whether the conversion was in the cache
+        """
+        entry = self.entry_path(key)
+        try:
+            with open(op.join(entry, MANIFEST)) as f:
+                fnames = json.load(f)['files']
+            for fname in fnames:
+                dest = op.join(dest_dir, fname)
+                if op.lexists(dest):
+                    os.remove(dest)
+                _link(op.join(entry, fname), dest)
+        except (OSError, ValueError, KeyError):
+            # Not cached or evicted by another process in the meantime
+            return False
+        try:
+            os.utime(entry)  # Mark as recently used
+        except OSError:
+            pass
+        logger.debug("Reused cached conversion %s in %s", key, dest_dir)
+        return True
+
+    def store(self, key, paths):
+        """
+        Stores the outputs of a conversion in the cache and evicts the least
+        recently used conversions if the cache is over its maximum size.
+        Cached files are made read-only as they are hard-linked into the
+        nodes that use them.
+
+        Parameters
+        ----------
+        key : str
+            The key of the conversion
+        paths : list[str]
+            The files produced by the conversion
+        """
+        entry = self.entry_path(key)
+        if op.exists(entry):
+            return
+        tmp = '{}.{}.tmp'.format(entry, os.getpid())
+        os.makedirs(tmp)
+        try:
+            size = 0
+            for path in paths:
+                dest = op.join(tmp, op.basename(path))
+                _link(path, dest)
+                os.chmod(dest, os.stat(dest).st_mode &
+                         ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+                size += os.stat(dest).st_size
+            with open(op.join(tmp, MANIFEST), 'w') as f:
+                json.dump({'files': [op.basename(p) for p in paths],
+                           'size': size}, f)
+            with self._lock():
+                try:
+                    os.rename(tmp, entry)
+                except OSError:
+                    # Stored by another process in the meantime
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    return
+                self._evict()
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def entries(self):
+        """
+        Returns the key, size (bytes) and last-use time of the cached
+        conversions from least to most recently used
+        """
+        entries = []
+        if not op.isdir(self.path):
+            return entries
+        for prefix in os.listdir(self.path):
+            prefix_dir = op.join(self.path, prefix)
+            if len(prefix) != 2 or not op.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                if key.endswith('.tmp'):
+                    continue
+                entry = op.join(prefix_dir, key)
+                try:
+                    with open(op.join(entry, MANIFEST)) as f:
+                        size = json.load(f)['size']
+                    entries.append((key, size, op.getmtime(entry)))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return sorted(entries, key=lambda e: e[2])
+
+    def _evict(self):
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        max_bytes = self.max_size * 1024 ** 3
+        for key, size, _ in entries:
+            if total <= max_bytes:
+                break
+            logger.debug("Evicting conversion %s from cache", key)
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= size
+
+    @contextmanager
+    def _lock(self):
+        "Serialises stores and evictions between processes sharing the cache"
+        if fcntl is None:
+            yield
+            return
+        with open(op.join(self.path, '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ConversionCacheMixin(object):
+    """
+    Mixin for converter interfaces that reuses the outputs of previous
+    conversions of the same source from the conversion cache (if enabled)
+    instead of running the conversion again. Only the outputs written to the
+    working directory of the node are cached.
+
+    Class attributes
+    ----------------
+    source_input : str
+        The name of the input that holds the file/directory to convert
+    cache_requirements : list[arcana.environment.requirement.Requirement]
+        The requirements whose versions are included in the cache key
+    """
+
+    source_input = None
+    cache_requirements = []
+
+    def _run_interface(self, runtime, *args, **kwargs):
+        cache = ConversionCache.from_env()
+        key = self._conversion_key() if cache is not None else None
+        if key is None:
+            return super()._run_interface(runtime, *args, **kwargs)
+        if cache.fetch(key, runtime.cwd):
+            runtime.returncode = 0
+            return runtime
+        existing = set(os.listdir(runtime.cwd))
+        runtime = super()._run_interface(runtime, *args, **kwargs)
+        returncode = getattr(runtime, 'returncode', None)
+        if returncode is not None and returncode not in getattr(
+                runtime, 'success_codes', (0,)):
+            return runtime
+        # Cache the files created by the conversion as long as all the
+        # outputs are among them
+        created = [op.join(runtime.cwd, f)
+                   for f in sorted(set(os.listdir(runtime.cwd)) - existing)
+                   if not f.startswith('_')]
+        outputs = [v for v in self._list_outputs().values()
+                   if isinstance(v, str)]
+        if (created and all(op.isfile(p) for p in created) and
+                all(op.abspath(p) in created for p in outputs)):
+            try:
+                cache.store(key, created)
+            except OSError as e:
+                logger.warning("Could not store conversion in cache %s: %s",
+                               cache.path, e)
+        return runtime
+
+    def _conversion_key(self):
+        version = _converter_version(self.cache_requirements)
+        if version is None:
+            return None
+        source = getattr(self.inputs, self.source_input)
+        # The names of the outputs are typically derived from the name of
+        # the source so it is included in the options
+        options = {k: v for k, v in self.inputs.get().items()
+                   if k not in (self.source_input, 'environ')}
+        options['source_name'] = op.basename(source.rstrip(os.sep))
+        cls = type(self)
+        return ConversionCache.key(
+            '{}.{}'.format(cls.__module__, cls.__name__), version, options,
+            source)
+
+
+def content_hash(path):
+    "Returns a hash of the contents of a file or directory (recursively)"
+    hsh = hashlib.sha256()
+    if op.isdir(path):
+        for dpath, dnames, fnames in os.walk(path):
+            dnames.sort()
+            for fname in sorted(fnames):
+                fpath = op.join(dpath, fname)
+                hsh.update(op.relpath(fpath, path).encode() + b'\0')
+                _update_hash(hsh, fpath)
+    else:
+        _update_hash(hsh, path)
+    return hsh.hexdigest()
+
+
+def _update_hash(hsh, path):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_BLOCK), b''):
+            hsh.update(block)
+
+
+def _converter_version(requirements):
+    """
+    Returns the versions of the requirements installed in the current
+    environment, falling back to the path and modification time of the
+    executable if the version can't be detected, or None if neither can be
+    determined
+    """
+    versions = []
+    for req in requirements:
+        try:
+            version = _detected_versions[req.name]
+        except KeyError:
+            try:
+                version = version_cache.detect_version_str(req)
+            except Exception:
+                cmd = shutil.which(getattr(req, 'test_cmd', req.name))
+                version = ('{}@{}'.format(cmd, op.getmtime(cmd))
+                           if cmd is not None else None)
+            _detected_versions[req.name] = version
+        if version is None:
+            return None
+        versions.append('{}=={}'.format(req.name, version))
+    return ','.join(versions)
+
+
+def _link(src, dest):
+    "Hard-links the file, or copies it if that isn't possible"
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dest)
+
@@ -0,0 +1,101 @@
+"""
+Loading of the voxel data of DICOM series, with the slices ordered by their
+position and their pixel data decoded concurrently into a single
+preallocated array
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pydicom
+from banana.exceptions import BananaUsageError
+
+# The header fields used to order the slices of a series
+SORT_TAGS = ['ImagePositionPatient', 'ImageOrientationPatient',
+             'InstanceNumber']
+
+
+def slice_order(headers):
+    """
+    Returns the order of the slices of a series, by their position along the
+    slice normal if each slice has a distinct position, otherwise (e.g. for
+    multiple volumes stored in the same series) by their instance number
+
+    Parameters
+    ----------
+    headers : list[pydicom.Dataset]
+        The headers of the slices (only the SORT_TAGS need to be read)
+
+    Returns
+    -------
+    order : list[int]
+        The indices of the slices in sorted order
+    """
+    try:
+        orient = np.array(headers[0].ImageOrientationPatient, dtype=float)
+        normal = np.cross(orient[:3], orient[3:])
+        positions = [float(np.dot(normal, np.array(
+            h.ImagePositionPatient, dtype=float))) for h in headers]
+    except (AttributeError, TypeError, ValueError):
+        positions = None
+    else:
+        if len(set(positions)) == len(positions):
+            return sorted(range(len(headers)), key=positions.__getitem__)
+    instances = [getattr(h, 'InstanceNumber', None) for h in headers]
+    if None in instances:
+        return list(range(len(headers)))
+    return sorted(range(len(headers)), key=lambda i: int(instances[i]))
+
+
+def load_series(paths, num_threads=None):
+    """
+    Loads the voxel data of a DICOM series into a single array, with the
+    slices stacked along the first axis in the order of their position. A
+    series consisting of a single multi-frame (enhanced) file is returned
+    as stored.
+
+    Parameters
+    ----------
+    paths : list[str]
+        The paths to the files of the series
+    num_threads : int | None
+        The number of files to read and decode at once, the number of cores
+        if None
+
+    Returns
+    -------
+    array : np.ndarray
+        The voxel data of the series
+    """
+    if not paths:
+        raise BananaUsageError("No DICOM files provided to load")
+    if len(paths) == 1:
+        dcm = pydicom.dcmread(paths[0])
+        if int(getattr(dcm, 'NumberOfFrames', 1) or 1) > 1:
+            return dcm.pixel_array
+        return dcm.pixel_array[None]
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=min(num_threads,
+                                            len(paths))) as executor:
+        headers = list(executor.map(_read_sort_header, paths))
+        paths = [paths[i] for i in slice_order(headers)]
+        first = pydicom.dcmread(paths[0]).pixel_array
+        array = np.empty((len(paths),) + first.shape, dtype=first.dtype)
+        array[0] = first
+
+        def decode(index):
+            pixels = pydicom.dcmread(paths[index]).pixel_array
+            if pixels.shape != first.shape:
+                raise BananaUsageError(
+                    "Shape of '{}' {} doesn't match the rest of the series "
+                    "{}".format(paths[index], pixels.shape, first.shape))
+            array[index] = pixels
+
+        # Consume the results to propagate any exceptions
+        list(executor.map(decode, range(1, len(paths))))
+    return array
+
+
+def _read_sort_header(path):
+    return pydicom.dcmread(path, stop_before_pixels=True,
+                           specific_tags=SORT_TAGS)
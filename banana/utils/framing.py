@@ -0,0 +1,239 @@
+"""
+Incremental detection of the frames of a PET-MR session within which the
+subject was still, from the motion estimated for each MR volume. Volumes can
+be added as they are acquired so frame boundaries are available during the
+acquisition, or a completed session replayed through the same engine.
+"""
+import datetime as dt
+from bisect import bisect_right
+from banana.exceptions import BananaUsageError
+
+# Format of the time-of-day timestamps output by MeanDisplacementCalculation
+TIME_FORMAT = '%H%M%S.%f'
+
+_MIDNIGHT = dt.datetime.strptime('000000.000000', TIME_FORMAT)
+
+
+def parse_time(timestamp):
+    """
+    Converts a timestamp in TIME_FORMAT into seconds since midnight
+    """
+    return (dt.datetime.strptime(timestamp, TIME_FORMAT) -
+            _MIDNIGHT).total_seconds()
+
+
+def format_time(seconds):
+    """
+    Converts seconds since midnight into a timestamp in TIME_FORMAT
+    """
+    return (_MIDNIGHT + dt.timedelta(seconds=seconds)).strftime(TIME_FORMAT)
+
+
+def volume_at(start_times, time):
+    """
+    Returns the index of the volume acquired at the given time
+
+    Parameters
+    ----------
+    start_times : list[float]
+        The (ascending) start times of the volumes
+    time : float
+        The time to find the volume of
+    """
+    return bisect_right(start_times, time) - 1
+
+
+class MotionFramer(object):
+    """
+    Splits a session into frames at the volumes where the mean displacement
+    of the subject changes by more than the motion threshold, merging frames
+    shorter than the temporal threshold.
+
+    A frame boundary can be moved or dropped until the temporal threshold has
+    passed after it, after which it is "confirmed" and returned by
+    `add_volume`, i.e. boundaries are reported with a latency of the
+    temporal threshold.
+
+    Parameters
+    ----------
+    motion_threshold : float
+        The change in mean displacement (mm) that starts a new frame
+    temporal_threshold : float
+        The minimum duration of a frame (s)
+    """
+
+    def __init__(self, motion_threshold=2.0, temporal_threshold=30.0):
+        self.motion_threshold = motion_threshold
+        self.temporal_threshold = temporal_threshold
+        self.num_vols = 0
+        self.finished = False
+        # The volume indices, start times and mean displacements of the
+        # frame boundaries detected so far
+        self._frame_vols = []
+        self._frame_times = []
+        self._frame_mds = []
+        self._num_confirmed = 0
+        self._prev = None
+        self._md_0 = self._max_md = None
+
+    @property
+    def frame_vols(self):
+        "The volumes the frames detected so far start at"
+        return list(self._frame_vols)
+
+    @property
+    def frame_times(self):
+        "The start times of the frames detected so far"
+        return list(self._frame_times)
+
+    @property
+    def confirmed(self):
+        "The volumes the frames start at that won't change"
+        return self._frame_vols[:self._num_confirmed]
+
+    def add_volume(self, start_time, mean_displacement,
+                   consecutive_displacement=None):
+        """
+        Adds the motion estimate of the next volume of the session
+
+        Parameters
+        ----------
+        start_time : float
+            The start time of the volume (s), e.g. since the epoch
+        mean_displacement : float
+            The mean displacement of the volume from the reference (mm)
+        consecutive_displacement : float
+            The mean displacement of the volume from the previous one (mm),
+            not required for the first volume
+
+        Returns
+        -------
+        confirmed : list[int]
+            The volumes of the frame boundaries confirmed by the volume
+        """
+        if self.finished:
+            raise BananaUsageError(
+                "Cannot add volumes to {} after it has finished".format(self))
+        vol = self.num_vols
+        if not vol:
+            self._append(vol, start_time, mean_displacement)
+            self._md_0 = self._max_md = mean_displacement
+        else:
+            if consecutive_displacement is None:
+                raise BananaUsageError(
+                    "The consecutive displacement is required for all but "
+                    "the first volume ({})".format(vol))
+            th = self.motion_threshold
+            md = mean_displacement
+            if abs(self._md_0 - md) > th or abs(self._max_md - md) > th:
+                if self._duration(start_time) > self.temporal_threshold:
+                    self._append(vol, start_time, md)
+                    self._md_0 = self._max_md = md
+                else:
+                    # Too soon after the last boundary, move it instead
+                    prev_md = self._frame_mds[-1]
+                    if prev_md - md > th * 2:
+                        # The first boundary is always kept
+                        if len(self._frame_vols) > 1:
+                            self._pop()
+                    elif md - prev_md > th:
+                        self._pop()
+                        self._append(vol - 1, *self._prev)
+            elif consecutive_displacement > th:
+                if self._duration(start_time) > self.temporal_threshold:
+                    self._append(vol, start_time, md)
+                    self._md_0 = self._max_md = md
+            elif md > self._max_md:
+                self._max_md = md
+            elif md < self._md_0:
+                self._md_0 = md
+        self._prev = (start_time, mean_displacement)
+        self.num_vols += 1
+        return self._confirm(start_time)
+
+    def finish(self, end_time):
+        """
+        Ends the session, adding the end of the last volume as the final
+        boundary
+
+        Parameters
+        ----------
+        end_time : float
+            The time the last volume ended
+
+        Returns
+        -------
+        confirmed : list[int]
+            The remaining boundaries, all of which are now confirmed
+        """
+        if not self.num_vols:
+            raise BananaUsageError(
+                "No volumes were added to {}".format(self))
+        if self._duration(end_time) <= self.temporal_threshold:
+            # Merge the last frame into the one before it
+            self._pop()
+        self._append(self.num_vols, end_time, None)
+        self.finished = True
+        confirmed = self._frame_vols[self._num_confirmed:]
+        self._num_confirmed = len(self._frame_vols)
+        return confirmed
+
+    def replay(self, start_times, mean_displacement,
+               consecutive_displacement):
+        """
+        Frames a completed session
+
+        Parameters
+        ----------
+        start_times : list[float]
+            The start times of the volumes followed by the end time of the
+            last one
+        mean_displacement : list[float]
+            The mean displacement of each volume from the reference
+        consecutive_displacement : list[float]
+            The mean displacement of each volume (after the first) from the
+            previous one
+
+        Returns
+        -------
+        frame_vols : list[int]
+            The volumes the frames start at, followed by the number of
+            volumes
+        """
+        if len(start_times) != len(mean_displacement) + 1:
+            raise BananaUsageError(
+                "Expected one more start time than mean displacements ({} "
+                "and {})".format(len(start_times), len(mean_displacement)))
+        self.add_volume(start_times[0], mean_displacement[0])
+        for start_time, md, consec in zip(start_times[1:-1],
+                                          mean_displacement[1:],
+                                          consecutive_displacement):
+            self.add_volume(start_time, md, consec)
+        self.finish(start_times[-1])
+        return self.frame_vols
+
+    def _duration(self, time):
+        # Rounded to the resolution of the timestamps so that frames of
+        # exactly the threshold aren't split by rounding errors
+        return round(time - self._frame_times[-1], 6)
+
+    def _append(self, vol, time, md):
+        self._frame_vols.append(vol)
+        self._frame_times.append(time)
+        self._frame_mds.append(md)
+
+    def _pop(self):
+        # Only unconfirmed boundaries are removed, as they are less than the
+        # temporal threshold from the current volume
+        assert len(self._frame_vols) > self._num_confirmed
+        self._frame_vols.pop()
+        self._frame_times.pop()
+        self._frame_mds.pop()
+
+    def _confirm(self, time):
+        start = self._num_confirmed
+        while (self._num_confirmed < len(self._frame_vols) and
+               round(time - self._frame_times[self._num_confirmed], 6) >
+               self.temporal_threshold):
+            self._num_confirmed += 1
+        return self._frame_vols[start:self._num_confirmed]
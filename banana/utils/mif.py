@@ -0,0 +1,316 @@
+"""
+Reading and writing of MRtrix image (.mif) files with NumPy, so that images
+can be re-containerised between NIfTI and MRtrix formats without spawning
+mrconvert. The voxel data is copied (or memory-mapped) as is, with the
+header translated between the two formats.
+"""
+import os.path as op
+import gzip
+import sys
+import numpy as np
+import nibabel as nib
+from banana.exceptions import BananaUsageError
+
+MAGIC = 'mrtrix image'
+
+# Data types of MRtrix images and their NumPy equivalents (without byte
+# order, which is given by the 'LE'/'BE' suffix for multi-byte types)
+MIF_DTYPES = {
+    'Int8': 'i1', 'UInt8': 'u1', 'Int16': 'i2', 'UInt16': 'u2',
+    'Int32': 'i4', 'UInt32': 'u4', 'Int64': 'i8', 'UInt64': 'u8',
+    'Float32': 'f4', 'Float64': 'f8', 'CFloat32': 'c8', 'CFloat64': 'c16'}
+
+COPY_BLOCK = 16 * 1024 ** 2
+
+
+class MifNotSupportedError(BananaUsageError):
+    "Raised for images that can't be converted natively (i.e. need mrconvert)"
+
+
+def read_header(path):
+    """
+    Reads the header of an MRtrix image
+
+    Returns
+    -------
+    header : dict[str, list[str]]
+        The values of each key in the header, in the order they appear (keys
+        such as 'transform' and 'dw_scheme' span multiple lines)
+    """
+    header = {}
+    with _open(path, 'rb') as f:
+        magic = f.readline().decode().strip()
+        if magic != MAGIC:
+            raise BananaUsageError(
+                "'{}' is not an MRtrix image (starts with '{}')".format(
+                    path, magic))
+        for line in f:
+            line = line.decode().strip()
+            if line == 'END':
+                break
+            key, value = line.split(':', maxsplit=1)
+            header.setdefault(key.strip(), []).append(value.strip())
+        else:
+            raise BananaUsageError(
+                "Header of '{}' is missing the 'END' line".format(path))
+    return header
+
+
+def load(path, mmap=True):
+    """
+    Loads an MRtrix image
+
+    Parameters
+    ----------
+    path : str
+        The path to the image (.mif, .mif.gz or .mih)
+    mmap : bool
+        Whether to memory-map the voxel data of uncompressed images
+
+    Returns
+    -------
+    header : dict[str, list[str]]
+        The header of the image
+    array : np.ndarray
+        The voxel data, with the axes in the order of the image axes and
+        with the intensity scaling applied
+    affine : np.ndarray
+        The 4x4 voxel-to-scanner transform of the image
+    """
+    header = read_header(path)
+    dims = _ints(header['dim'][0])
+    vox = _floats(header['vox'][0])
+    dtype = _dtype(header['datatype'][0])
+    layout = _layout(header['layout'][0])
+    data_path, offset = header['file'][0].split()
+    offset = int(offset)
+    if data_path == '.':
+        data_path = path
+    else:
+        data_path = op.join(op.dirname(path), data_path)
+    # The axes from slowest to fastest varying in memory
+    mem_axes = sorted(range(len(dims)), key=lambda a: -layout[a][1])
+    count = int(np.prod(dims))
+    if mmap and not data_path.endswith('.gz'):
+        flat = np.memmap(data_path, dtype=dtype, mode='r', offset=offset,
+                         shape=(count,))
+    else:
+        with _open(data_path, 'rb') as f:
+            f.seek(offset)
+            flat = np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype)
+    array = flat.reshape([dims[a] for a in mem_axes])
+    array = array.transpose([mem_axes.index(a) for a in range(len(dims))])
+    for axis, (sign, _) in enumerate(layout):
+        if sign < 0:
+            array = np.flip(array, axis)
+    if 'scaling' in header:
+        offset, scale = _floats(header['scaling'][0])
+        if (offset, scale) != (0.0, 1.0):
+            array = array * scale + offset
+    transform = np.array([_floats(t) for t in header['transform']])
+    affine = np.eye(4)
+    affine[:3, :3] = transform[:, :3] * vox[:3]
+    affine[:3, 3] = transform[:, 3]
+    return header, array, affine
+
+
+def nifti_to_mif(in_file, out_file, grad_fsl=None):
+    """
+    Converts a NIfTI image to MRtrix format, copying the voxel data as is
+    (in NIfTI's storage order, i.e. with a '+0,+1,+2,...' layout)
+
+    Parameters
+    ----------
+    in_file : str
+        The NIfTI image (.nii or .nii.gz)
+    out_file : str
+        The MRtrix image to write (.mif or .mif.gz)
+    grad_fsl : tuple(str, str) | None
+        Paths to FSL-style bvecs and bvals files to embed in the header as
+        the diffusion gradient scheme
+    """
+    img = nib.load(in_file)
+    hdr = img.header
+    dims = list(hdr.get_data_shape())
+    if len(dims) < 3:
+        raise MifNotSupportedError(
+            "Native conversion of {}D images is not supported".format(
+                len(dims)))
+    if not nib.is_proxy(img.dataobj) or img.dataobj.order != 'F':
+        raise MifNotSupportedError(
+            "Voxel data of '{}' can't be copied directly".format(in_file))
+    dtype = hdr.get_data_dtype()
+    datatype = _mif_datatype(dtype)
+    vox = [float(v) for v in hdr.get_zooms()]
+    rotation, translation = _rotation(img.affine, vox)
+    layout = ['+{}'.format(i) for i in range(len(dims))]
+    if np.linalg.det(rotation) < 0:
+        # MRtrix transforms are rigid so the reflection is encoded in the
+        # layout instead, by flipping the first axis (as mrconvert does)
+        translation = translation + rotation[:, 0] * vox[0] * (dims[0] - 1)
+        rotation[:, 0] = -rotation[:, 0]
+        layout[0] = '-0'
+    lines = [MAGIC,
+             'dim: ' + ','.join(str(d) for d in dims),
+             'vox: ' + ','.join(_fmt(v) for v in vox),
+             'layout: ' + ','.join(layout),
+             'datatype: ' + datatype]
+    lines.extend('transform: ' + ','.join(_fmt(v) for v in row)
+                 for row in np.hstack((rotation, translation[:, None])))
+    # The scaling and offset of the data as read by nibabel (the header
+    # values can be unset or zero, meaning defaults)
+    proxy = img.dataobj
+    slope, inter = float(proxy.slope), float(proxy.inter)
+    if (slope, inter) != (1.0, 0.0):
+        lines.append('scaling: {},{}'.format(_fmt(inter), _fmt(slope)))
+    if grad_fsl is not None:
+        lines.extend('dw_scheme: ' + ','.join(_fmt(v) for v in row)
+                     for row in _fsl_to_scheme(grad_fsl, img.affine, vox))
+    header = _with_offset('\n'.join(lines) + '\n')
+    nbytes = int(np.prod(dims)) * dtype.itemsize
+    with _open(in_file, 'rb') as fin, _open(out_file, 'wb') as fout:
+        fout.write(header.encode())
+        fin.seek(proxy.offset)
+        _copy(fin, fout, nbytes)
+
+
+def mif_to_nifti(in_file, out_file):
+    """
+    Converts an MRtrix image to NIfTI format (.nii or .nii.gz)
+    """
+    header, array, affine = load(in_file)
+    img = nib.Nifti1Image(array, affine)
+    vox = [v if np.isfinite(v) else 1.0
+           for v in _floats(header['vox'][0])]
+    img.header.set_zooms(vox[:array.ndim])
+    img.header.set_qform(affine, code='scanner')
+    img.header.set_sform(affine, code='scanner')
+    nib.save(img, out_file)
+
+
+def convert(in_file, out_file, grad_fsl=None):
+    """
+    Converts between NIfTI and MRtrix image formats in-process, raising
+    MifNotSupportedError for conversions that need mrconvert
+    """
+    in_fmt, out_fmt = _format(in_file), _format(out_file)
+    if in_fmt == 'nifti' and out_fmt == 'mif':
+        nifti_to_mif(in_file, out_file, grad_fsl=grad_fsl)
+    elif in_fmt == 'mif' and out_fmt == 'nifti' and grad_fsl is None:
+        mif_to_nifti(in_file, out_file)
+    else:
+        raise MifNotSupportedError(
+            "Native conversion from '{}' to '{}'{} is not supported".format(
+                in_file, out_file,
+                ' with gradients' if grad_fsl is not None else ''))
+
+
+def _format(path):
+    if path.endswith(('.nii', '.nii.gz')):
+        return 'nifti'
+    if path.endswith(('.mif', '.mif.gz')):
+        return 'mif'
+    return None
+
+
+def _open(path, mode):
+    return gzip.open(path, mode) if path.endswith('.gz') else open(path, mode)
+
+
+def _copy(fin, fout, nbytes):
+    while nbytes:
+        block = fin.read(min(COPY_BLOCK, nbytes))
+        if not block:
+            raise BananaUsageError(
+                "Voxel data ends {} bytes short of the size given by the "
+                "header".format(nbytes))
+        fout.write(block)
+        nbytes -= len(block)
+
+
+def _with_offset(text):
+    "Appends the 'file' and 'END' lines with the offset of the data"
+    offset = 0
+    while True:
+        header = '{}file: . {}\nEND\n'.format(text, offset)
+        if len(header) <= offset:
+            return header + '\0' * (offset - len(header))
+        offset = (len(header) + 15) // 16 * 16  # Align to 16 bytes
+
+
+def _rotation(affine, vox):
+    "Splits the affine into the rotation (with unit columns) and translation"
+    rotation = affine[:3, :3] / np.array(vox[:3])
+    return rotation, affine[:3, 3].copy()
+
+
+def _fsl_to_scheme(grad_fsl, affine, vox):
+    """
+    Converts FSL bvecs (in image space, with the x-axis flipped for images
+    with a neurological voxel order) and bvals into an MRtrix gradient
+    scheme in scanner space
+    """
+    bvecs = np.loadtxt(grad_fsl[0], ndmin=2)
+    bvals = np.loadtxt(grad_fsl[1], ndmin=1)
+    if bvecs.shape[0] != 3:
+        bvecs = bvecs.T
+    if bvecs.shape != (3, len(bvals)):
+        raise BananaUsageError(
+            "Shape of bvecs {} doesn't match the number of bvals ({})".format(
+                bvecs.shape, len(bvals)))
+    rotation = _rotation(affine, vox)[0]
+    bvecs = bvecs.copy()
+    if np.linalg.det(rotation) > 0:
+        bvecs[0] = -bvecs[0]
+    grads = rotation.dot(bvecs)
+    norms = np.linalg.norm(grads, axis=0)
+    grads[:, norms > 0] /= norms[norms > 0]
+    return np.vstack((grads, bvals)).T
+
+
+def _mif_datatype(dtype):
+    code = dtype.str[1:]
+    for name, mif_code in MIF_DTYPES.items():
+        if mif_code == code:
+            break
+    else:
+        raise MifNotSupportedError(
+            "Data type {} isn't supported by native conversion".format(dtype))
+    if dtype.itemsize == 1:
+        return name
+    byteorder = dtype.byteorder
+    if byteorder == '=':
+        byteorder = '<' if sys.byteorder == 'little' else '>'
+    return name + ('LE' if byteorder == '<' else 'BE')
+
+
+def _dtype(datatype):
+    name, byteorder = datatype, '<'
+    if datatype.endswith(('LE', 'BE')):
+        name = datatype[:-2]
+        byteorder = '<' if datatype.endswith('LE') else '>'
+    try:
+        return np.dtype(byteorder + MIF_DTYPES[name])
+    except KeyError:
+        raise MifNotSupportedError(
+            "MRtrix data type '{}' isn't supported by native conversion"
+            .format(datatype))
+
+
+def _layout(layout):
+    "Returns the sign and rank (in memory order) of each axis"
+    return [(-1 if s.startswith('-') else 1, int(s.lstrip('+-')))
+            for s in layout.split(',')]
+
+
+def _ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+def _floats(value):
+    return [float(v) for v in value.split(',')]
+
+
+def _fmt(value):
+    return repr(float(value))
+
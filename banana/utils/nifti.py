@@ -0,0 +1,169 @@
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import seek_tell
+from banana.exceptions import BananaUsageError
+
+
+def iter_volume_chunks(path, chunk_size, dtype=np.float32):
+    """
+    Reads a 4D NIfTI image sequentially, a chunk of volumes at a time, so
+    that only one chunk needs to be held in memory (works equally well for
+    gzipped images as the file is only read forward)
+
+    Parameters
+    ----------
+    path : str
+        Path to the 4D NIfTI image
+    chunk_size : int
+        The number of volumes to read at a time
+    dtype : numpy.dtype
+        The dtype to return the (scaled) data in
+
+    Yields
+    ------
+    start : int
+        The index of the first volume in the chunk
+    chunk : np.array(K, V)
+        The volumes of the chunk, flattened in voxel (i.e. Fortran) order
+    """
+    img = nib.load(path)
+    if len(img.shape) != 4:
+        raise BananaUsageError(
+            "Expected 4D image, '{}' has shape {}".format(path, img.shape))
+    num_voxels = int(np.prod(img.shape[:3]))
+    num_vols = img.shape[3]
+    disk_dtype = img.get_data_dtype()
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    vol_bytes = num_voxels * disk_dtype.itemsize
+    with ImageOpener(path) as f:
+        f.seek(img.dataobj.offset)
+        for start in range(0, num_vols, chunk_size):
+            size = min(chunk_size, num_vols - start)
+            buff = f.read(size * vol_bytes)
+            chunk = np.frombuffer(buff, dtype=disk_dtype).reshape(
+                size, num_voxels).astype(dtype)
+            if slope != 1.0:
+                chunk *= slope
+            if inter != 0.0:
+                chunk += inter
+            yield start, chunk
+
+
+def save_volumes(path, ref, volumes, dtype=np.float32):
+    """
+    Writes a 4D NIfTI image sequentially, a volume at a time, so that the
+    whole series doesn't need to be held in memory (the counterpart of
+    iter_volume_chunks)
+
+    Parameters
+    ----------
+    path : str
+        Path to save the image to
+    ref : nib.Nifti1Image
+        The image to take the header (i.e. shape and geometry) from
+    volumes : iterable[np.array]
+        The 3D volumes of the image, one for each volume of the reference
+    dtype : numpy.dtype
+        The dtype to save the data in (unscaled)
+    """
+    hdr = ref.header.copy()
+    hdr.set_data_dtype(dtype)
+    hdr.set_slope_inter(1.0, 0.0)
+    num_vols = 0
+    with ImageOpener(path, 'wb') as f:
+        hdr.write_to(f)
+        seek_tell(f, hdr.get_data_offset(), write0=True)
+        for vol in volumes:
+            if vol.shape != ref.shape[:3]:
+                raise BananaUsageError(
+                    "Volume {} has shape {}, expected {}".format(
+                        num_vols, vol.shape, ref.shape[:3]))
+            f.write(np.asarray(vol, dtype=dtype).tobytes(order='F'))
+            num_vols += 1
+    if num_vols != ref.shape[3]:
+        raise BananaUsageError(
+            "Expected {} volumes to save to '{}', found {}".format(
+                ref.shape[3], path, num_vols))
+
+
+# fslswapdim labels for each voxel axis and the anatomical labels in the
+# direction the axis increases (nibabel axis codes)
+SWAP_DIM_AXES = {'x': 0, 'y': 1, 'z': 2}
+SWAP_DIM_ANAT = {'LR': 'R', 'RL': 'L', 'PA': 'A', 'AP': 'P', 'IS': 'S',
+                 'SI': 'I'}
+
+# The orientation of FSL's standard templates (i.e. that fslreorient2std
+# reorients images to)
+STD_AXCODES = ('L', 'A', 'S')
+
+
+def swap_dims(img, new_dims):
+    """
+    Permutes and/or flips the voxel axes of an image in memory, keeping the
+    world coordinates of the voxels the same (as fslswapdim does)
+
+    Parameters
+    ----------
+    img : nib.Nifti1Image
+        The image to reorder
+    new_dims : tuple(str)
+        The new voxel axes in terms of the old ones, either 'x', 'y', 'z'
+        (optionally negated, e.g. ('-x', 'y', 'z')) or anatomical labels
+        (e.g. ('RL', 'PA', 'IS'))
+    """
+    new_dims = tuple(new_dims)
+    if len(new_dims) != 3:
+        raise BananaUsageError(
+            "Expected 3 new dims, found {}".format(new_dims))
+    if all(d in SWAP_DIM_ANAT for d in new_dims):
+        return reorient(img, tuple(SWAP_DIM_ANAT[d] for d in new_dims))
+    ornt = np.zeros((3, 2))
+    for new_axis, dim in enumerate(new_dims):
+        try:
+            old_axis = SWAP_DIM_AXES[dim.lstrip('-')]
+        except KeyError:
+            raise BananaUsageError(
+                "Unrecognised dim '{}' in {}, can be 'x', 'y', 'z' "
+                "(optionally negated) or anatomical labels ({})".format(
+                    dim, new_dims, ', '.join(SWAP_DIM_ANAT)))
+        ornt[old_axis] = (new_axis, -1 if dim.startswith('-') else 1)
+    if sorted(ornt[:, 0]) != [0, 1, 2]:
+        raise BananaUsageError(
+            "Each of 'x', 'y' and 'z' needs to be used exactly once ({})"
+            .format(new_dims))
+    return img.as_reoriented(ornt)
+
+
+def reorient(img, axcodes=STD_AXCODES):
+    """
+    Reorients the voxel axes of an image in memory to the closest match to
+    the given orientation, by default that of FSL's standard templates (as
+    fslreorient2std does)
+    """
+    ornt = nib.orientations.ornt_transform(
+        nib.orientations.io_orientation(img.affine),
+        nib.orientations.axcodes2ornt(axcodes))
+    return img.as_reoriented(ornt)
+
+
+def copy_geometry(img, ref):
+    """
+    Replaces the geometry (voxel sizes, qform and sform) of an image in
+    memory with that of a reference image of the same dimensions (as
+    fslcpgeom does)
+    """
+    if img.shape[:3] != ref.shape[:3]:
+        raise BananaUsageError(
+            "Can't copy geometry from image with shape {} to image with shape "
+            "{}".format(ref.shape, img.shape))
+    hdr = img.header.copy()
+    zooms = list(hdr.get_zooms())
+    zooms[:3] = ref.header.get_zooms()[:3]
+    hdr.set_zooms(zooms)
+    sform, sform_code = ref.header.get_sform(coded=True)
+    qform, qform_code = ref.header.get_qform(coded=True)
+    hdr.set_sform(sform, int(sform_code))
+    hdr.set_qform(qform, int(qform_code))
+    return nib.Nifti1Image(np.asanyarray(img.dataobj), hdr.get_best_affine(),
+                           hdr)
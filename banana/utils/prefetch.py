@@ -0,0 +1,294 @@
+"""
+Concurrent download of the input filesets of a study from XNAT into the cache
+directory of the repository, ahead of the nodes that use them, so that
+processing doesn't stall on each download in turn.
+
+Files are downloaded individually via the XNAT REST API (rather than as a
+zip of the whole resource as by the XnatRepo) so that interrupted downloads
+can be resumed with HTTP range requests. The downloads are staged in the
+same '<cache-path>.download' directory the XnatRepo uses, so nodes that need
+a fileset while it is being prefetched wait for it to finish instead of
+downloading it again.
+"""
+import os
+import os.path as op
+import json
+import errno
+import shutil
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from banana.exceptions import BananaRuntimeError
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+logger = logging.getLogger('banana')
+
+DEFAULT_NUM_WORKERS = 4
+
+# Number of times a file is requested before giving up, each time resuming
+# from where the last attempt was interrupted
+MAX_ATTEMPTS = 3
+
+CHUNK_SIZE = 1024 ** 2
+
+# Marks a download directory as belonging to a prefetch, which can be resumed
+# if interrupted (unlike those of the XnatRepo)
+PREFETCH_MARKER = '.prefetch'
+
+
+class XnatPrefetcher(object):
+    """
+    Downloads filesets from an XNAT repository into its cache directory in a
+    pool of worker threads
+
+    Parameters
+    ----------
+    repository : arcana.XnatRepo
+        The repository to download the filesets from
+    num_workers : int
+        The number of filesets to download at once
+    timeout : float
+        Timeout (s) for the connection to the server and between the chunks
+        of a download
+    """
+
+    def __init__(self, repository, num_workers=DEFAULT_NUM_WORKERS,
+                 timeout=60.0):
+        self.repository = repository
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self._local = threading.local()
+        self._executor = None
+        self._futures = []
+
+    def __repr__(self):
+        return "{}(repository={}, num_workers={})".format(
+            type(self).__name__, self.repository, self.num_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self, filesets):
+        """
+        Starts downloading the filesets in the background, session by session
+        in order so that the inputs of the first sessions are available first
+
+        Parameters
+        ----------
+        filesets : list[Fileset]
+            The filesets to download
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        for fileset in sorted(filesets, key=session_order):
+            self._futures.append(
+                (fileset, self._executor.submit(self._prefetch, fileset)))
+
+    def wait(self):
+        """
+        Waits for the downloads started so far to finish
+
+        Returns
+        -------
+        failed : list[Fileset]
+            The filesets that couldn't be prefetched (and will be downloaded
+            by the nodes that need them instead)
+        """
+        failed = [f for f, future in self._futures if not future.result()]
+        self._futures = []
+        return failed
+
+    def close(self, wait=True):
+        """
+        Shuts down the worker pool, cancelling the downloads that haven't
+        started yet unless waiting for them
+        """
+        if self._executor is not None:
+            if not wait:
+                for _, future in self._futures:
+                    future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._futures = []
+
+    def download(self, fileset):
+        """
+        Downloads a fileset into the cache of the repository, resuming a
+        previous prefetch of it that was interrupted
+
+        Parameters
+        ----------
+        fileset : Fileset
+            The fileset to download. Its URI and resource name need to be set
+            (i.e. it was found in the repository tree)
+
+        Returns
+        -------
+        downloaded : bool
+            Whether the fileset was downloaded, False if it was already
+            cached or is being downloaded by another process
+        """
+        if fileset.uri is None or fileset._resource_name is None:
+            raise BananaRuntimeError(
+                "Cannot prefetch {} as it wasn't found in the tree of {}"
+                .format(fileset, self.repository))
+        cache_path = self.repository._cache_path(fileset)
+        md5_path = cache_path + self.repository.MD5_SUFFIX
+        if op.exists(cache_path) and op.exists(md5_path):
+            return False
+        tmp_dir = cache_path + '.download'
+        try:
+            os.mkdir(tmp_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if not op.exists(op.join(tmp_dir, PREFETCH_MARKER)):
+                return False  # Being downloaded by the XnatRepo
+        with open(op.join(tmp_dir, PREFETCH_MARKER), 'a') as marker:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(marker, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return False  # Being prefetched by another process
+            if not op.isdir(tmp_dir) or op.exists(md5_path):
+                return False  # Finished by another process in the meantime
+            files_dir = op.join(tmp_dir, 'files')
+            os.makedirs(files_dir, exist_ok=True)
+            resource_uri = '{}/resources/{}'.format(fileset.uri,
+                                                    fileset._resource_name)
+            for entry in self._list_files(resource_uri):
+                self._download_file(entry, op.join(files_dir, entry['Name']),
+                                    tmp_dir)
+            checksums = {e['Name']: e['digest']
+                         for e in self._list_files(fileset.uri)}
+            if not fileset.format.directory:
+                # Key the primary file by '.' as in the checksums calculated
+                # by Arcana
+                primary = fileset.format.assort_files(checksums.keys())[0]
+                checksums['.'] = checksums.pop(primary)
+            # The checksums are written before the files are moved into place
+            # so the cache is never seen without them
+            with open(md5_path, 'w') as f:
+                json.dump(checksums, f, indent=2)
+            if op.exists(cache_path):
+                shutil.rmtree(cache_path)
+            os.rename(files_dir, cache_path)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.debug("Prefetched %s into %s", fileset, cache_path)
+        return True
+
+    def _prefetch(self, fileset):
+        try:
+            self.download(fileset)
+        except Exception as e:
+            logger.warning("Could not prefetch %s, it will be downloaded when "
+                           "it is required instead: %s", fileset, e)
+            return False
+        return True
+
+    def _list_files(self, uri):
+        response = self._session().get(
+            self._url(uri + '/files'), params={'format': 'json'},
+            timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['ResultSet']['Result']
+
+    def _download_file(self, entry, path, tmp_dir):
+        """
+        Downloads a file of a resource, resuming from the end of a partial
+        download and checking its MD5 digest (if provided by the server)
+        """
+        size = int(entry['Size']) if entry.get('Size') else None
+        digest = entry.get('digest') or None
+        if op.exists(path) and op.getsize(path) == size and (
+                digest is None or _md5(path) == digest):
+            return
+        for attempt in range(MAX_ATTEMPTS):
+            offset = op.getsize(path) if op.exists(path) else 0
+            if size is not None and offset > size:
+                offset = 0
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+            try:
+                with self._session().get(
+                        self._url(entry['URI']), headers=headers,
+                        stream=True, timeout=self.timeout) as response:
+                    if response.status_code == 416:  # Nothing left to read
+                        pass
+                    else:
+                        response.raise_for_status()
+                        # Servers that don't support ranges send it all again
+                        mode = 'ab' if response.status_code == 206 else 'wb'
+                        with open(path, mode) as f:
+                            for chunk in response.iter_content(CHUNK_SIZE):
+                                f.write(chunk)
+                                # Show processes waiting on the download
+                                # directory that it is still progressing
+                                os.utime(tmp_dir)
+            except requests.RequestException as e:
+                logger.debug("Download of %s interrupted (attempt %d): %s",
+                             entry['URI'], attempt + 1, e)
+                continue
+            if digest is None or _md5(path) == digest:
+                return
+            logger.debug("Checksum of %s doesn't match, downloading it "
+                         "again", entry['URI'])
+            os.remove(path)
+        raise BananaRuntimeError(
+            "Could not download '{}' from {} in {} attempts".format(
+                entry['URI'], self.repository.server, MAX_ATTEMPTS))
+
+    def _session(self):
+        # Each worker thread has its own connection to the server
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            if self.repository._user is not None:
+                session.auth = (self.repository._user,
+                                self.repository._password)
+        return session
+
+    def _url(self, uri):
+        return self.repository.server.rstrip('/') + uri
+
+
+def session_order(item):
+    "Sort key that orders items by session"
+    return (str(item.subject_id), str(item.visit_id), item.name)
+
+
+def input_filesets(study):
+    """
+    Returns the filesets matched by the inputs of a study that are stored in
+    an XNAT repository (i.e. that can be prefetched)
+    """
+    filesets = []
+    for inpt in study.inputs:
+        if not inpt.is_fileset:
+            continue
+        try:
+            collection = inpt.collection
+        except Exception:
+            continue
+        for fileset in collection:
+            if (fileset.repository is not None and
+                    fileset.repository.type == 'xnat' and
+                    fileset.uri is not None):
+                filesets.append(fileset)
+    return filesets
+
+
+def _md5(path):
+    hsh = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hsh.update(block)
+    return hsh.hexdigest()
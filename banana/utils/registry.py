@@ -0,0 +1,260 @@
+"""
+A registry of the Study classes defined in a package, which is built by
+statically scanning the source of its modules (so they don't need to be
+imported, along with all their dependencies, to find the classes) and cached
+against the modification times of the source files
+"""
+import os
+import os.path as op
+import ast
+import json
+import logging
+from collections import namedtuple
+from importlib.util import find_spec
+
+logger = logging.getLogger('banana')
+
+DEFAULT_STUDY_CLASS_PATH = 'banana.study'
+
+CACHE_PATH = op.join(
+    os.environ.get('XDG_CACHE_HOME', op.join(op.expanduser('~'), '.cache')),
+    'banana', 'study_registry.json')
+
+# Names of the base classes that make a class a Study class
+STUDY_BASES = frozenset(('Study', 'MultiStudy'))
+
+# Bump when the format of the cached entries changes
+REGISTRY_VERSION = 2
+
+StudyClassInfo = namedtuple('StudyClassInfo', (
+    'name',  # Name of the class
+    'module',  # The module the class is defined in
+    'path',  # The shortest path the class can be imported from
+    'desc'))  # The 'desc' attribute of the class
+
+
+def study_classes(package=DEFAULT_STUDY_CLASS_PATH, cache_path=CACHE_PATH):
+    """
+    Returns the Study classes defined in a package that have a 'desc'
+    attribute (i.e. that are intended to be used directly)
+
+    Parameters
+    ----------
+    package : str
+        The import path of the package to search
+    cache_path : str | None
+        The path to the registry cache, None to disable caching
+
+    Returns
+    -------
+    classes : list[StudyClassInfo]
+        The Study classes found in the package
+    """
+    return [c for c in _all_study_classes(package, cache_path)
+            if c.desc is not None]
+
+
+def find_study_class(name, packages=(DEFAULT_STUDY_CLASS_PATH,),
+                     cache_path=CACHE_PATH):
+    """
+    Returns the module that defines the Study class with the given name in
+    the given packages (including classes without a 'desc', e.g. base
+    classes), or None if it isn't found
+    """
+    for package in packages:
+        for info in _all_study_classes(package, cache_path):
+            if info.name == name:
+                return info.module
+    return None
+
+
+def scan(package, package_dir, files, bases=STUDY_BASES):
+    """
+    Finds the Study classes in the given source files of a package by parsing
+    them. Classes are identified as Study classes if they derive (by name)
+    from one of the given base classes or from another Study class defined
+    in the package.
+
+    Parameters
+    ----------
+    package : str
+        The import path of the package
+    package_dir : str
+        The directory of the package
+    files : iterable[str]
+        Paths of the source files relative to the package directory
+    bases : iterable[str]
+        Names of the classes that make a class a Study class
+
+    Returns
+    -------
+    classes : list[StudyClassInfo]
+        The Study classes found, with a desc of None if they don't have one
+    """
+    classes = {}  # (module, name) -> (base names, desc or None)
+    aliases = {}  # imported-as name -> original name
+    exports = {}  # (module, name) -> modules that import it from there
+    for relpath in sorted(files):
+        module = _module_path(package, relpath)
+        try:
+            with open(op.join(package_dir, relpath), 'rb') as f:
+                tree = ast.parse(f.read(), filename=relpath)
+        except (SyntaxError, ValueError) as e:
+            logger.warning("Could not parse '%s' when scanning for Study "
+                           "classes: %s", relpath, e)
+            continue
+        is_pkg = op.basename(relpath) == '__init__.py'
+        for node in tree.body:
+            if isinstance(node, ast.ClassDef):
+                classes[(module, node.name)] = (
+                    [_base_name(b) for b in node.bases], _desc(node))
+            elif isinstance(node, ast.ImportFrom):
+                src = _resolve_import(module, is_pkg, node)
+                for alias in node.names:
+                    if alias.asname is not None:
+                        aliases[alias.asname] = alias.name
+                    if src is not None:
+                        exports.setdefault((src, alias.name), set()).add(
+                            module)
+    # Find the classes that derive from Study classes
+    study_names = set(bases)
+    changed = True
+    while changed:
+        changed = False
+        for (_, name), (bases, _) in classes.items():
+            if name not in study_names and any(
+                    aliases.get(b, b) in study_names for b in bases):
+                study_names.add(name)
+                changed = True
+    found = []
+    for (module, name), (_, desc) in sorted(classes.items()):
+        if name not in study_names:
+            continue
+        # Follow re-exports in the package to find the shortest import path
+        paths = {module}
+        stack = [module]
+        while stack:
+            for mod in exports.get((stack.pop(), name), ()):
+                if mod not in paths:
+                    paths.add(mod)
+                    stack.append(mod)
+        found.append(StudyClassInfo(name, module,
+                                    min(paths, key=lambda p: (len(p), p)),
+                                    desc))
+    return found
+
+
+def _all_study_classes(package, cache_path):
+    "Returns all the Study classes in a package, including abstract ones"
+    bases = set(STUDY_BASES)
+    if package != DEFAULT_STUDY_CLASS_PATH:
+        # Classes in other packages can derive from those in Banana (e.g.
+        # MriStudy), which can't be recognised by their bases alone
+        bases.update(c.name for c in _all_study_classes(
+            DEFAULT_STUDY_CLASS_PATH, cache_path))
+    bases = sorted(bases)
+    package_dir = _package_dir(package)
+    files = _source_files(package_dir)
+    cache = _load_cache(cache_path)
+    entry = cache.get(package)
+    if (entry is None or entry['dir'] != package_dir or
+            entry['files'] != files or entry['bases'] != bases):
+        logger.debug("Scanning '%s' for Study classes", package)
+        entry = cache[package] = {
+            'dir': package_dir, 'files': files, 'bases': bases,
+            'classes': [list(c) for c in scan(package, package_dir, files,
+                                              bases=bases)]}
+        _save_cache(cache, cache_path)
+    return [StudyClassInfo(*c) for c in entry['classes']]
+
+
+def _package_dir(package):
+    spec = find_spec(package)
+    if spec is None or not spec.submodule_search_locations:
+        raise ImportError("Could not find package '{}'".format(package))
+    return op.abspath(list(spec.submodule_search_locations)[0])
+
+
+def _source_files(package_dir):
+    "Maps the source files of the package and sub-packages to their mtimes"
+    files = {}
+    for dpath, dnames, fnames in os.walk(package_dir):
+        if '__init__.py' not in fnames:
+            dnames[:] = []
+            continue
+        dnames[:] = [d for d in dnames if not d.startswith(('.', '__'))]
+        for fname in fnames:
+            if fname.endswith('.py'):
+                path = op.join(dpath, fname)
+                files[op.relpath(path, package_dir)] = op.getmtime(path)
+    return files
+
+
+def _module_path(package, relpath):
+    parts = relpath[:-len('.py')].split(os.sep)
+    if parts[-1] == '__init__':
+        parts = parts[:-1]
+    return '.'.join([package] + parts)
+
+
+def _resolve_import(module, is_pkg, node):
+    "Returns the absolute path of the module imported from"
+    if not node.level:
+        return node.module
+    parts = module.split('.')
+    if not is_pkg:
+        parts = parts[:-1]
+    if node.level > 1:
+        parts = parts[:-(node.level - 1)]
+    if node.module:
+        parts.append(node.module)
+    return '.'.join(parts)
+
+
+def _base_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return None
+
+
+def _desc(class_node):
+    "Returns the 'desc' class attribute if it is set (and literal)"
+    for node in class_node.body:
+        if (isinstance(node, ast.Assign) and
+                any(isinstance(t, ast.Name) and t.id == 'desc'
+                    for t in node.targets)):
+            try:
+                return str(ast.literal_eval(node.value))
+            except ValueError:
+                return ''
+    return None
+
+
+def _load_cache(cache_path):
+    if cache_path is None:
+        return {}
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.pop('version', None) != REGISTRY_VERSION:
+        return {}
+    return cache
+
+
+def _save_cache(cache, cache_path):
+    if cache_path is None:
+        return
+    cache = dict(cache, version=REGISTRY_VERSION)
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        os.makedirs(op.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.debug("Could not save Study class registry to '%s': %s",
+                     cache_path, e)
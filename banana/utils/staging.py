@@ -0,0 +1,118 @@
+"""
+Helpers to lay out existing files in the directory structures expected by
+external tools without copying their contents where possible
+"""
+import os
+import os.path as op
+import errno
+import shutil
+import logging
+from banana.exceptions import BananaUsageError
+
+logger = logging.getLogger('banana')
+
+STAGING_METHODS = ('auto', 'reflink', 'hardlink', 'symlink', 'copy')
+
+# The Linux ioctl request number to clone a file (copy-on-write)
+FICLONE = 0x40049409
+
+# Errors that mean a link/clone isn't possible (rather than that something is
+# wrong with the paths) and so the next method should be tried
+_UNSUPPORTED_ERRNOS = frozenset(
+    getattr(errno, n) for n in ('EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'EINVAL',
+                                'ENOTTY', 'EPERM', 'EMLINK', 'ENOSYS')
+    if hasattr(errno, n))
+
+
+def reflink(src, dst):
+    """
+    Creates a copy-on-write clone of 'src' at 'dst', which shares the data
+    blocks of 'src' until either is modified. Raises OSError if the
+    filesystem (or platform) doesn't support it.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.ENOTSUP, "Reflinks are not supported on this "
+                      "platform", src)
+    with open(src, 'rb') as src_f:
+        try:
+            with open(dst, 'wb') as dst_f:
+                fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+        except OSError:
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def stage_file(src, dst, method='auto'):
+    """
+    Stages a single file at a new path
+
+    Parameters
+    ----------
+    src : str
+        Path to the existing file
+    dst : str
+        The path to stage it at
+    method : str
+        One of 'reflink', 'hardlink', 'symlink', 'copy' or 'auto'. 'auto'
+        tries a copy-on-write reflink and copies if it isn't supported (e.g.
+        across filesystems), so the staged file can always be written to
+        without modifying the source. Hardlinks share the data of the source
+        so are only used if requested explicitly. Explicit 'reflink' and
+        'hardlink' methods also fall back to copying.
+
+    Returns
+    -------
+    method : str
+        The method that was actually used to stage the file
+    """
+    if method not in STAGING_METHODS:
+        raise BananaUsageError(
+            "Unrecognised staging method '{}', can be one of '{}'".format(
+                method, "', '".join(STAGING_METHODS)))
+    if method == 'symlink':
+        os.symlink(op.abspath(src), dst)
+        return method
+    if method in ('auto', 'reflink'):
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+    if method == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+    if method != 'copy':
+        logger.debug("Falling back to copying '%s' to '%s'", src, dst)
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def stage(src, dst, method='auto'):
+    """
+    Stages a file or directory at a new path. Directories are recreated
+    with real directories (so tools can write new files into them without
+    touching the source) that are populated with staged files.
+
+    Parameters
+    ----------
+    src : str
+        Path to the existing file or directory
+    dst : str
+        The path to stage it at
+    method : str
+        See `stage_file`
+    """
+    if not op.isdir(src):
+        stage_file(src, dst, method=method)
+    else:
+        shutil.copytree(
+            src, dst, symlinks=True,
+            copy_function=lambda s, d: stage_file(s, d, method=method))
@@ -0,0 +1,499 @@
+"""
+Per-node runtime telemetry (wall time, CPU time, peak memory and disk I/O),
+which is recorded in a local SQLite database and used to estimate the
+resources to request for each node in place of the static hints passed to
+Pipeline.add
+"""
+import os
+import os.path as op
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+from nipype.interfaces.base import isdefined, Directory
+from arcana.environment.base import Node, JoinNode, MapNode
+from arcana.environment.modules import (
+    ModulesNode, ModulesJoinNode, ModulesMapNode)
+from banana.exceptions import BananaUsageError
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+logger = logging.getLogger('banana')
+
+DEFAULT_TELEMETRY_DB = op.join(op.expanduser('~'), 'banana-scratch',
+                               'telemetry.db')
+
+# The columns that nodes can be ranked by in the hot-nodes report
+REPORT_SORT_KEYS = ('total_wall_time', 'wall_time', 'cpu_time', 'peak_rss',
+                    'read_bytes', 'write_bytes')
+
+# How often the memory of the node's process tree is sampled (seconds)
+SAMPLE_INTERVAL = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS node_runs (
+    study_class TEXT NOT NULL,
+    pipeline TEXT NOT NULL,
+    node TEXT NOT NULL,
+    input_bytes INTEGER NOT NULL,
+    wall_time REAL NOT NULL,
+    cpu_time REAL NOT NULL,
+    peak_rss INTEGER NOT NULL,
+    read_bytes INTEGER NOT NULL,
+    write_bytes INTEGER NOT NULL,
+    n_procs INTEGER NOT NULL,
+    succeeded INTEGER NOT NULL,
+    host TEXT,
+    timestamp REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS node_runs_key
+    ON node_runs (study_class, pipeline, node);
+"""
+
+# Measurements of a single execution of a node. Times are in seconds and
+# sizes in bytes
+NodeRun = namedtuple('NodeRun', (
+    'input_bytes', 'wall_time', 'cpu_time', 'peak_rss', 'read_bytes',
+    'write_bytes', 'n_procs', 'succeeded'))
+
+# Identifies the node runs are recorded against, which is stored on the
+# nodes so it is available in the processes they are executed in
+TelemetryKey = namedtuple('TelemetryKey', ('db_path', 'study_class',
+                                           'pipeline', 'node'))
+
+
+class TelemetryStore(object):
+    """
+    A SQLite database of node runs, keyed by study class, pipeline and node.
+    Each run is inserted in its own short transaction so the database can be
+    shared by concurrent processes (and jobs on a cluster, providing the
+    filesystem supports locking)
+
+    Parameters
+    ----------
+    path : str
+        Path to the database file, which is created if it doesn't exist
+    min_runs : int
+        The number of successful runs of a node required before its resource
+        requirements are estimated from them
+    margin : float
+        The factor the estimates are scaled by to leave headroom over the
+        upper end of the resources used previously
+    """
+
+    def __init__(self, path=DEFAULT_TELEMETRY_DB, min_runs=3, margin=1.5):
+        if margin < 1.0:
+            raise BananaUsageError(
+                "Telemetry margin needs to be >= 1 (not {})".format(margin))
+        self.path = op.abspath(path)
+        self.min_runs = min_runs
+        self.margin = margin
+        self._initialised = False
+
+    def __repr__(self):
+        return "{}(path={})".format(type(self).__name__, self.path)
+
+    def __getstate__(self):
+        dct = dict(self.__dict__)
+        dct['_initialised'] = False
+        return dct
+
+    def connect(self):
+        if not self._initialised:
+            os.makedirs(op.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60)
+        if not self._initialised:
+            conn.executescript(_SCHEMA)
+            self._initialised = True
+        return conn
+
+    def key(self, study_class, pipeline, node):
+        return TelemetryKey(self.path, study_class, pipeline, node)
+
+    def record(self, study_class, pipeline, node, run, host=None):
+        """
+        Records a run of a node
+
+        Parameters
+        ----------
+        study_class : str
+            Name of the study class the pipeline belongs to
+        pipeline : str
+            Name of the pipeline
+        node : str
+            Name of the node within the pipeline
+        run : NodeRun
+            The measurements of the run
+        """
+        if host is None:
+            host = socket.gethostname()
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO node_runs VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (study_class, pipeline, node, int(run.input_bytes),
+                     run.wall_time, run.cpu_time, int(run.peak_rss),
+                     int(run.read_bytes), int(run.write_bytes),
+                     int(run.n_procs), int(bool(run.succeeded)), host,
+                     time.time()))
+        finally:
+            conn.close()
+
+    def runs(self, study_class, pipeline, node, succeeded=True):
+        "Returns the recorded runs of a node"
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                "SELECT " + ', '.join(NodeRun._fields) + " FROM node_runs "
+                "WHERE study_class=? AND pipeline=? AND node=? "
+                "AND succeeded=?",
+                (study_class, pipeline, node, int(succeeded))).fetchall()
+        finally:
+            conn.close()
+        return [NodeRun(*r) for r in rows]
+
+    def estimate(self, study_class, pipeline, node, input_bytes=None):
+        """
+        Estimates the wall time and memory required by a node from its
+        previous runs. If the size of the node's inputs is given, the
+        estimates are scaled by it (relative to the sizes of the inputs of
+        the previous runs), otherwise the most resources used by a previous
+        run is used. The estimates are never less than the resources used by
+        runs that failed
+
+        Parameters
+        ----------
+        study_class : str
+            Name of the study class the pipeline belongs to
+        pipeline : str
+            Name of the pipeline
+        node : str
+            Name of the node within the pipeline
+        input_bytes : int | None
+            The total size of the node's inputs if known
+
+        Returns
+        -------
+        wall_time : float | None
+            Estimated wall time in minutes, None if there aren't enough runs
+        mem_gb : float | None
+            Estimated memory in GB, None if there aren't enough runs
+        """
+        runs = self.runs(study_class, pipeline, node)
+        if len(runs) < self.min_runs:
+            return None, None
+        wall_time = self._scale([r.wall_time for r in runs], runs,
+                                input_bytes)
+        peak_rss = self._scale([r.peak_rss for r in runs], runs, input_bytes)
+        # Runs that failed (e.g. were killed for exceeding their memory or
+        # wall time) needed at least what they used before failing
+        failed = self.runs(study_class, pipeline, node, succeeded=False)
+        if failed:
+            wall_time = max(wall_time, max(r.wall_time for r in failed))
+            peak_rss = max(peak_rss, max(r.peak_rss for r in failed))
+        return (max(wall_time * self.margin / 60.0, 1.0),
+                max(peak_rss * self.margin / 1024 ** 3, 0.25))
+
+    @classmethod
+    def _scale(cls, values, runs, input_bytes):
+        """
+        Scales the largest value per byte of input to the given input size,
+        without going below the smallest value recorded (i.e. the overhead
+        that doesn't depend on the size of the inputs)
+        """
+        if input_bytes and all(r.input_bytes for r in runs):
+            per_byte = max(v / r.input_bytes for v, r in zip(values, runs))
+            return max(per_byte * input_bytes, min(values))
+        return max(values)
+
+    def hot_nodes(self, study_class=None, sort_by='total_wall_time',
+                  limit=20):
+        """
+        Summarises the recorded runs of each node, ranked by the resources
+        they have used
+
+        Parameters
+        ----------
+        study_class : str | None
+            Only include nodes from the given study class
+        sort_by : str
+            The summary column to rank the nodes by, one of REPORT_SORT_KEYS
+        limit : int
+            The number of nodes to return
+
+        Returns
+        -------
+        rows : list[dict]
+            Summaries of the hottest nodes
+        """
+        if sort_by not in REPORT_SORT_KEYS:
+            raise BananaUsageError(
+                "Unrecognised sort key '{}', can be one of '{}'".format(
+                    sort_by, "', '".join(REPORT_SORT_KEYS)))
+        query = (
+            "SELECT study_class, pipeline, node, COUNT(*) AS runs, "
+            "SUM(wall_time) AS total_wall_time, MAX(wall_time) AS wall_time, "
+            "MAX(cpu_time) AS cpu_time, MAX(peak_rss) AS peak_rss, "
+            "MAX(read_bytes) AS read_bytes, MAX(write_bytes) AS write_bytes "
+            "FROM node_runs WHERE succeeded=1")
+        params = []
+        if study_class is not None:
+            query += " AND study_class=?"
+            params.append(study_class)
+        query += (" GROUP BY study_class, pipeline, node "
+                  "ORDER BY {} DESC LIMIT ?".format(sort_by))
+        params.append(limit)
+        conn = self.connect()
+        try:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+        return [dict(r) for r in rows]
+
+
+class ResourceMonitor(object):
+    """
+    Context manager that measures the wall time, CPU time, peak resident
+    memory and bytes read/written from disk by the current process and the
+    processes it spawns while it is active.
+
+    CPU time and I/O of spawned processes are only counted once they have
+    exited and been waited on (as is the case for command-line interfaces).
+    Memory is sampled from /proc in a background thread where available.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.wall_time = self.cpu_time = 0.0
+        self.peak_rss = self.read_bytes = self.write_bytes = 0
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def __enter__(self):
+        self._start_io = _proc_io()
+        self._start_usage = _rusage()
+        self._start_time = time.time()
+        if op.exists('/proc/self/status'):
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall_time = time.time() - self._start_time
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+        end_usage = _rusage()
+        self.cpu_time = end_usage[0] - self._start_usage[0]
+        # The peak memory of spawned processes is a high-water mark across
+        # all of those the process has waited on, so it only applies to
+        # this node if it has risen while the node was running
+        if end_usage[1] > self._start_usage[1]:
+            self.peak_rss = max(self.peak_rss, end_usage[1])
+        end_io = _proc_io()
+        if self._start_io is not None and end_io is not None:
+            self.read_bytes = end_io[0] - self._start_io[0]
+            self.write_bytes = end_io[1] - self._start_io[1]
+        else:
+            self.read_bytes = (end_usage[2] - self._start_usage[2]) * 512
+            self.write_bytes = (end_usage[3] - self._start_usage[3]) * 512
+        return False
+
+    def _sample(self):
+        pid = os.getpid()
+        while True:
+            self.peak_rss = max(self.peak_rss, _tree_rss(pid))
+            if self._stop.wait(self.interval):
+                break
+
+
+def _rusage():
+    """
+    Returns the CPU time (s), peak RSS of waited on children (bytes) and
+    blocks read/written by the current process and its waited on children
+    """
+    if resource is None:
+        return (time.process_time(), 0, 0, 0)
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime + children.ru_utime +
+            children.ru_stime,
+            children.ru_maxrss * 1024,
+            own.ru_inblock + children.ru_inblock,
+            own.ru_oublock + children.ru_oublock)
+
+
+def _proc_io():
+    """
+    Returns the bytes read from and written to disk by the current process
+    (including the children it has waited on), or None if not available
+    """
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(l.split(':') for l in f if ':' in l)
+        return (int(fields['read_bytes']), int(fields['write_bytes']))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _tree_rss(pid):
+    "Total resident memory (bytes) of a process and its descendants"
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                # Process names can contain spaces so split after the ')'
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total = 0
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        stack.extend(children.get(p, ()))
+        try:
+            with open('/proc/{}/status'.format(p)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+def input_bytes(interface):
+    """
+    Total size of the existing files (and directories passed to Directory
+    inputs) that are passed to the inputs of an interface
+    """
+    total = 0
+    for name, value in interface.inputs.get().items():
+        if not isdefined(value):
+            continue
+        trait = interface.inputs.trait(name)
+        dirs = isinstance(trait.trait_type, Directory) or any(
+            isinstance(t.trait_type, Directory)
+            for t in (trait.inner_traits or ()))
+        stack = [value]
+        while stack:
+            val = stack.pop()
+            if isinstance(val, (list, tuple)):
+                stack.extend(val)
+            elif isinstance(val, str):
+                if op.isfile(val):
+                    total += op.getsize(val)
+                elif dirs and op.isdir(val):
+                    for dpath, _, fnames in os.walk(val):
+                        total += sum(
+                            op.getsize(op.join(dpath, f)) for f in fnames
+                            if op.isfile(op.join(dpath, f)))
+    return total
+
+
+class TelemetryMixin(object):
+    """
+    Records the resources used each time the node is executed (rather than
+    its results loaded from the work directory) in the telemetry store
+    referenced by the node's 'telemetry_key' attribute
+    """
+
+    telemetry_key = None
+
+    def _run_command(self, execute, copyfiles=True):
+        if not execute or self.telemetry_key is None:
+            return super()._run_command(execute, copyfiles=copyfiles)
+        in_bytes = input_bytes(self.interface)
+        succeeded = False
+        monitor = ResourceMonitor()
+        try:
+            with monitor:
+                result = super()._run_command(execute, copyfiles=copyfiles)
+            succeeded = True
+        finally:
+            # Failed runs are recorded too (with the resources they used
+            # before failing) and the exception re-raised
+            self._record_run(monitor, in_bytes, succeeded)
+        return result
+
+    def _record_run(self, monitor, in_bytes, succeeded):
+        key = self.telemetry_key
+        run = NodeRun(
+            input_bytes=in_bytes, wall_time=monitor.wall_time,
+            cpu_time=monitor.cpu_time, peak_rss=monitor.peak_rss,
+            read_bytes=monitor.read_bytes, write_bytes=monitor.write_bytes,
+            n_procs=self.n_procs, succeeded=succeeded)
+        try:
+            TelemetryStore(key.db_path).record(key.study_class, key.pipeline,
+                                               key.node, run)
+        except sqlite3.Error as e:
+            # Telemetry shouldn't cause the workflow to fail
+            logger.warning("Could not record telemetry for '%s' node in %s: "
+                           "%s", self.name, key.db_path, e)
+
+
+class TelemetryNode(TelemetryMixin, Node):
+    pass
+
+
+class TelemetryJoinNode(TelemetryMixin, JoinNode):
+    pass
+
+
+class TelemetryMapNode(TelemetryMixin, MapNode):
+    pass
+
+
+class TelemetryModulesNode(TelemetryMixin, ModulesNode):
+    pass
+
+
+class TelemetryModulesJoinNode(TelemetryMixin, ModulesJoinNode):
+    pass
+
+
+class TelemetryModulesMapNode(TelemetryMixin, ModulesMapNode):
+    pass
+
+
+TELEMETRY_NODE_TYPES = {
+    Node: TelemetryNode,
+    JoinNode: TelemetryJoinNode,
+    MapNode: TelemetryMapNode,
+    ModulesNode: TelemetryModulesNode,
+    ModulesJoinNode: TelemetryModulesJoinNode,
+    ModulesMapNode: TelemetryModulesMapNode}
+
+
+def monitor_node(node, key):
+    """
+    "Casts" an Arcana node to the equivalent node type that records its runs
+    in the telemetry store (in the same way Arcana casts the nodes generated
+    by MapNodes)
+
+    Parameters
+    ----------
+    node : arcana.environment.base.Node
+        The node to monitor
+    key : TelemetryKey
+        Identifies the store and the study class, pipeline and node to record
+        the runs against
+    """
+    try:
+        node.__class__ = TELEMETRY_NODE_TYPES[type(node)]
+    except KeyError:
+        if not isinstance(node, TelemetryMixin):
+            logger.warning("Cannot record telemetry for '%s' node of unknown"
+                           " type %s", node.name, type(node))
+            return
+    node.telemetry_key = key
@@ -3,13 +3,16 @@ import os.path as op
 import logging
 import tempfile
 import shutil
+import threading
 from copy import copy
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 from itertools import chain
 from unittest import TestCase
 from arcana.exceptions import ArcanaNameError
 from arcana import (InputFilesets, InputFields, BasicRepo, XnatRepo, SingleProc,
-                    Field, Fileset, ModulesEnv, StaticEnv)
+                    MultiProc, Field, Fileset, ModulesEnv, StaticEnv)
 from arcana.data.spec import BaseInputSpec
 from arcana.exceptions import (
     ArcanaInputMissingMatchError, ArcanaMissingDataException)
@@ -212,7 +215,8 @@ class PipelineTester(TestCase):
                            parameters=(), include=None, skip=(),
                            include_bases=(), reprocess=False, repo_depth=0,
                            modules_env=False, clean_work_dir=True,
-                           loggers=('nipype.workflow', 'arcana', 'banana')):
+                           loggers=('nipype.workflow', 'arcana', 'banana'),
+                           num_processes=1):
         """
         Generates reference data for a pipeline tester unittests given a study
         class and set of parameters
@@ -253,6 +257,10 @@ class PipelineTester(TestCase):
             Whether to use modules environment or not
         clean_work_dir : bool
             Whether to clean the Nipype work directory or not
+        num_processes : int
+            The number of processes to run the pipelines with (using a
+            MultiProc processor if greater than one), which is also the number
+            of sessions uploaded to the output repository at once
         """
 
         for logger_name in loggers:
@@ -317,16 +325,23 @@ class PipelineTester(TestCase):
         else:
             env = StaticEnv()
 
+        proc_kwargs = dict(
+            reprocess=reprocess,
+            clean_work_dir_between_runs=clean_work_dir,
+            prov_ignore=(
+                SingleProc.DEFAULT_PROV_IGNORE +
+                ['.*/pkg_version',
+                 'workflow/nodes/.*/requirements/.*']))
+        if num_processes > 1:
+            processor = MultiProc(work_dir, num_processes=num_processes,
+                                  **proc_kwargs)
+        else:
+            processor = SingleProc(work_dir, **proc_kwargs)
+
         study = study_class(
             study_name,
             repository=temp_repo,
-            processor=SingleProc(
-                work_dir, reprocess=reprocess,
-                clean_work_dir_between_runs=clean_work_dir,
-                prov_ignore=(
-                    SingleProc.DEFAULT_PROV_IGNORE +
-                    ['.*/pkg_version',
-                     'workflow/nodes/.*/requirements/.*'])),
+            processor=processor,
             environment=env,
             inputs=inputs,
             parameters=parameters,
@@ -334,7 +349,7 @@ class PipelineTester(TestCase):
             visit_ids=in_repo.tree().visit_ids,
             fill_tree=True)
 
-        if include is None:
+        if not include:
             # Get set of methods that could override pipeline getters in
             # base classes that are not included
             potentially_overridden = set()
@@ -352,18 +367,21 @@ class PipelineTester(TestCase):
                             spec.pipeline_getter in potentially_overridden):
                         include.add(spec.name)
 
-        # Generate all derived data
-        for spec_name in sorted(include):
-            study.data(spec_name)
+        # Generate all derived data in a single workflow, so that the
+        # pipelines they share are only built and run once
+        study.data(sorted(include))
 
         # Get output repository to write the data to
-        if out_server is not None:
-            out_repo = XnatRepo(project_id=out_repo, server=out_server,
+        def out_repository():
+            if out_server is not None:
+                return XnatRepo(project_id=out_repo, server=out_server,
                                 cache_dir=op.join(work_dir, 'xnat-cache'))
-        else:
-            out_repo = BasicRepo(out_repo, depth=repo_depth)
+            else:
+                return BasicRepo(out_repo, depth=repo_depth)
 
-        # Upload data to repository
+        # Group the items to upload by the session (or subject/visit/study)
+        # they belong to
+        to_upload = defaultdict(list)
         for spec in study.data_specs():
             try:
                 data = study.data(spec.name, generate=False)
@@ -377,22 +395,49 @@ class PipelineTester(TestCase):
                 if skip is not None and item.name in skip:
                     logger.info("Forced skip of {}".format(item.name))
                     continue
+                to_upload[(item.subject_id, item.visit_id)].append(item)
+
+        local = threading.local()
+
+        def upload(items):
+            # Each thread uploads via its own connection to the repository,
+            # and the items of a session are uploaded by the same thread so
+            # that it is only created once
+            try:
+                repo = local.repo
+            except AttributeError:
+                repo = local.repo = out_repository()
+            for item in items:
                 if item.is_fileset:
                     item_cpy = Fileset(
                         name=item.name, format=item.format,
                         frequency=item.frequency, path=item.path,
                         aux_files=copy(item.aux_files),
                         subject_id=item.subject_id, visit_id=item.visit_id,
-                        repository=out_repo, exists=True)
+                        repository=repo, exists=True)
                 else:
                     item_cpy = Field(
                         name=item.name, value=item.value, dtype=item.dtype,
                         frequency=item.frequency, array=item.array,
                         subject_id=item.subject_id, visit_id=item.visit_id,
-                        repository=out_repo, exists=True)
+                        repository=repo, exists=True)
+                if item.is_fileset and isinstance(repo, BasicRepo):
+                    os.makedirs(op.dirname(repo.fileset_path(item_cpy)),
+                                exist_ok=True)
                 logger.info("Uploading {}".format(item_cpy))
                 item_cpy.put()
+                if (item.is_fileset and isinstance(repo, BasicRepo) and
+                        hasattr(item.format, 'save_digest')):
+                    # Saved with the reference data so that it doesn't need
+                    # to be read again by the tests it matches
+                    item.format.save_digest(
+                        item, path=repo.fileset_path(item_cpy))
                 logger.info("Uploaded {}".format(item_cpy))
+
+        # Upload data to repository
+        with ThreadPoolExecutor(max_workers=num_processes) as executor:
+            # Consume the results to propagate any exceptions
+            list(executor.map(upload, to_upload.values()))
         logger.info("Finished generating and uploading test data for {}"
                     .format(study_class))
 
@@ -0,0 +1,147 @@
+"""
+Per-node thread declarations, which are used to share the cores available to
+the processor between the nodes that run concurrently and to pass the number
+of threads granted to each node on to the tool it wraps
+"""
+import os
+import math
+from banana.exceptions import BananaUsageError
+
+# Environment variables read by the common multi-threaded toolkits
+OMP_ENV = ('OMP_NUM_THREADS',)
+ITK_ENV = ('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',)
+MRTRIX_ENV = ('MRTRIX_NTHREADS',)
+
+
+def runs_concurrently(processor):
+    "Whether the processor runs multiple nodes at once on the same host"
+    return type(processor).__name__ == 'MultiProc'
+
+
+def submits_jobs(processor):
+    "Whether the processor submits each node as a job to a scheduler"
+    return any(c.__name__ == 'SlurmProc' for c in type(processor).__mro__)
+
+
+def available_cores(processor, threads=None):
+    """
+    The number of cores available to the nodes run by the given processor.
+    Processors that run their nodes one at a time make all of the host's
+    cores available to each node, and Slurm jobs the CPUs requested per task
+    (if set). Otherwise Slurm jobs are given the maximum number of threads
+    declared for the node, or a single core if it isn't capped, as the cores
+    of the submit host say nothing about those of the compute nodes (and
+    each core requested adds a task and its memory to the job).
+
+    Parameters
+    ----------
+    processor : arcana.processor.base.Processor
+        The processor the nodes are run by
+    threads : Threads | None
+        The thread declaration of the node
+    """
+    if runs_concurrently(processor) and processor.num_processes:
+        return processor.num_processes
+    if submits_jobs(processor):
+        cpus_per_task = getattr(processor, '_cpus_per_task', None)
+        if cpus_per_task:
+            return cpus_per_task
+        if threads is not None and threads.max is not None:
+            return threads.max
+        return 1
+    return os.cpu_count() or 1
+
+
+class Threads(object):
+    """
+    Declares how many threads a node can make use of
+
+    Parameters
+    ----------
+    min : int
+        The minimum number of threads the node needs to run effectively
+    max : int | None
+        The maximum number of threads the node can make use of. If None the
+        node can use all available cores
+    parallel_fraction : float
+        Scaling hint, the fraction of the node's run time that parallelises
+        across threads (as in Amdahl's law). Nodes that scale poorly are
+        given fewer threads when there are other sessions to process
+        concurrently
+    input : str | None
+        The name of the input of the interface that sets the number of threads
+        (e.g. 'num_threads' for ANTs, 'nthreads' for MRtrix, 'openmp' for
+        FreeSurfer)
+    env : tuple(str)
+        Environment variables to set to the number of threads granted when
+        the interface is a command (e.g. OMP_ENV, ITK_ENV, MRTRIX_ENV)
+    """
+
+    def __init__(self, min=1, max=None, parallel_fraction=0.9, input=None,  # @ReservedAssignment @IgnorePep8
+                 env=()):
+        if min < 1 or (max is not None and max < min):
+            raise BananaUsageError(
+                "Invalid thread range ({}, {})".format(min, max))
+        if not 0.0 <= parallel_fraction <= 1.0:
+            raise BananaUsageError(
+                "Parallel fraction must be between 0 and 1 (not {})"
+                .format(parallel_fraction))
+        self.min = min
+        self.max = max
+        self.parallel_fraction = parallel_fraction
+        self.input = input
+        self.env = tuple(env)
+
+    def __repr__(self):
+        return ("{}(min={}, max={}, parallel_fraction={}, input={}, env={})"
+                .format(type(self).__name__, self.min, self.max,
+                        self.parallel_fraction, self.input, self.env))
+
+    def speedup(self, num_threads):
+        return 1.0 / ((1.0 - self.parallel_fraction) +
+                      self.parallel_fraction / num_threads)
+
+    def grant(self, num_cores, num_concurrent=1):
+        """
+        Selects the number of threads to run each instance of the node with
+        so that 'num_concurrent' instances (e.g. one per session) complete
+        the soonest when packed onto 'num_cores' cores
+
+        Parameters
+        ----------
+        num_cores : int
+            The number of cores available to the processor
+        num_concurrent : int
+            The number of instances of the node that can run concurrently
+
+        Returns
+        -------
+        num_threads : int
+            The number of threads to run each instance with
+        """
+        upper = num_cores if self.max is None else min(self.max, num_cores)
+        if upper <= self.min:
+            # Nodes that need more threads than there are cores can still
+            # be run on all of them (just slower)
+            return min(self.min, num_cores)
+        best, best_time = self.min, None
+        for num_threads in range(self.min, upper + 1):
+            batches = math.ceil(
+                max(num_concurrent, 1) / max(num_cores // num_threads, 1))
+            run_time = batches / self.speedup(num_threads)
+            # Extra threads also cost memory and contention, so are only
+            # taken when they give a worthwhile gain
+            if best_time is None or run_time < best_time * 0.95:
+                best, best_time = num_threads, run_time
+        return best
+
+    def apply(self, interface, num_threads):
+        """
+        Passes the number of threads granted on to the interface via its
+        thread input and/or environment variables
+        """
+        if self.input is not None:
+            setattr(interface.inputs, self.input, num_threads)
+        if self.env and hasattr(interface.inputs, 'environ'):
+            interface.inputs.environ.update(
+                (v, str(num_threads)) for v in self.env)
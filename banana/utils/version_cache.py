@@ -0,0 +1,256 @@
+"""
+A persistent cache of the versions of the software requirements detected in
+the current environment, which is shared between processes so that tools
+(and MATLAB in particular) don't need to be launched to interrogate their
+versions each time a pipeline is constructed.
+
+Versions are cached against the path, modification time and size of the
+executable the requirement is located by, the environment modules that are
+loaded and any environment variables the detection depends on, so that an
+entry is invalidated as soon as the installation changes. The cache is
+stored in '~/.cache/banana/requirement_versions.json' by default, which can
+be overridden by the 'BANANA_VERSION_CACHE' environment variable (set it to
+an empty string to disable caching).
+"""
+import os
+import os.path as op
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from arcana.exceptions import ArcanaVersionNotDetectableError
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+logger = logging.getLogger('banana')
+
+CACHE_PATH_ENV = 'BANANA_VERSION_CACHE'
+
+CACHE_PATH = op.join(
+    os.environ.get('XDG_CACHE_HOME', op.join(op.expanduser('~'), '.cache')),
+    'banana', 'requirement_versions.json')
+
+# Environment variables that hold the state of the loaded environment
+# modules (Lmod and Tcl modules) and the MATLAB search path
+MODULE_ENV_VARS = ('LOADEDMODULES', '_LMFILES_', 'MATLABPATH')
+
+# Bump when the format of the cached entries changes
+CACHE_VERSION = 1
+
+DEFAULT_PREFETCH_THREADS = 8
+
+_memo = {}
+_memo_lock = threading.Lock()
+# Serialises the detection of each requirement within the process so that
+# a requirement being prefetched isn't detected again in the meantime
+_detect_locks = {}
+
+
+class VersionCache(object):
+    """
+    A JSON file of detected version strings, keyed by a fingerprint of the
+    installation each version was detected from
+
+    Parameters
+    ----------
+    path : str
+        Path to the cache file
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = op.abspath(path)
+
+    def __repr__(self):
+        return "{}(path={})".format(type(self).__name__, self.path)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Returns the cache at the path configured by the environment, or None
+        if version caching is disabled
+        """
+        path = os.environ.get(CACHE_PATH_ENV, CACHE_PATH)
+        return cls(path) if path else None
+
+    def lookup(self, key):
+        """
+        Returns the cached entry for the key, a dict containing either the
+        'version' string or the 'error' raised when it couldn't be detected,
+        or None if it isn't cached
+        """
+        with self._lock(exclusive=False):
+            return self._load().get(key)
+
+    def store(self, key, requirement_id, executable, stamp, **entry):
+        """
+        Stores an entry in the cache, dropping any entries for versions of
+        the requirement detected from the same executable before it was
+        modified (i.e. with a different modification time and size stamp)
+        """
+        entry.update(requirement=requirement_id, executable=executable,
+                     stamp=list(stamp))
+        try:
+            os.makedirs(op.dirname(self.path), exist_ok=True)
+            with self._lock(exclusive=True):
+                entries = {
+                    k: e for k, e in self._load().items()
+                    if not (e.get('requirement') == requirement_id and
+                            e.get('executable') == executable and
+                            e.get('stamp') != entry['stamp'])}
+                entries[key] = entry
+                tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump({'version': CACHE_VERSION,
+                               'entries': entries}, f)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.debug("Could not save requirement version to '%s': %s",
+                         self.path, e)
+
+    def clear(self):
+        "Removes all entries from the cache"
+        try:
+            with self._lock(exclusive=True):
+                os.remove(self.path)
+        except OSError:
+            pass
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                contents = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if contents.get('version') != CACHE_VERSION:
+            return {}
+        return contents.get('entries', {})
+
+    @contextmanager
+    def _lock(self, exclusive):
+        "Serialises access to the cache file between processes"
+        if fcntl is None or not op.isdir(op.dirname(self.path)):
+            yield
+            return
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def fingerprint(requirement):
+    """
+    Returns the path to the executable the version of the requirement is
+    detected from, its modification time and size, and a key that changes
+    whenever the executable or the environment it is detected in change, or
+    (None, None, None) if the requirement doesn't have a (locatable)
+    executable
+    """
+    cmd = getattr(requirement, 'version_executable', None)
+    path = shutil.which(cmd) if cmd is not None else None
+    if path is None:
+        return None, None, None
+    try:
+        stat = os.stat(op.realpath(path))
+    except OSError:
+        return None, None, None
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    env_vars = MODULE_ENV_VARS + tuple(getattr(requirement, 'version_env',
+                                               ()))
+    hsh = hashlib.sha256(json.dumps([
+        _requirement_id(requirement), path, stamp,
+        [os.environ.get(v) for v in env_vars]]).encode())
+    return path, stamp, hsh.hexdigest()
+
+
+def detect_version_str(requirement, cache=None):
+    """
+    Returns the version string of the requirement in the current
+    environment, from the cache if it has been detected before with the same
+    executable and environment
+
+    Parameters
+    ----------
+    requirement : arcana.environment.requirement.BaseRequirement
+        The requirement to detect the version of
+    cache : VersionCache | None
+        The cache to use, the one configured by the environment if None
+    """
+    executable, stamp, key = fingerprint(requirement)
+    if key is None:
+        return requirement.detect_version_str()
+    if cache is None:
+        cache = VersionCache.from_env()
+    memo_key = (cache.path if cache is not None else None, key)
+    with _memo_lock:
+        lock = _detect_locks.setdefault(memo_key, threading.Lock())
+    with lock:
+        entry = _memo.get(memo_key)
+        if entry is None and cache is not None:
+            entry = cache.lookup(key)
+        if entry is None:
+            try:
+                entry = {'version': requirement.detect_version_str()}
+            except ArcanaVersionNotDetectableError as e:
+                entry = {'error': str(e)}
+            if cache is not None:
+                cache.store(key, _requirement_id(requirement), executable,
+                            stamp, **entry)
+        _memo[memo_key] = entry
+    if 'error' in entry:
+        raise ArcanaVersionNotDetectableError(entry['error'])
+    return entry['version']
+
+
+def prefetch(requirements, num_threads=DEFAULT_PREFETCH_THREADS, wait=True):
+    """
+    Detects the versions of the requirements concurrently so that they are
+    cached by the time they are required. Requirements that are not found or
+    whose versions can't be detected are skipped.
+
+    Parameters
+    ----------
+    requirements : list[arcana.environment.requirement.BaseRequirement]
+        The requirements to detect the versions of
+    num_threads : int
+        The number of requirements to detect at once
+    wait : bool
+        Whether to wait for the detection to finish before returning
+
+    Returns
+    -------
+    versions : dict[str, str | None] | None
+        The detected versions by requirement name if waited for
+    """
+    requirements = [r for r in requirements
+                    if fingerprint(r)[-1] is not None]
+
+    def detect(requirement):
+        try:
+            return detect_version_str(requirement)
+        except Exception as e:
+            logger.debug("Could not prefetch version of %s: %s",
+                         requirement, e)
+            return None
+
+    if not requirements:
+        return {} if wait else None
+    executor = ThreadPoolExecutor(max_workers=min(num_threads,
+                                                  len(requirements)))
+    futures = [executor.submit(detect, r) for r in requirements]
+    executor.shutdown(wait=wait)
+    if not wait:
+        return None
+    return {r.name: f.result() for r, f in zip(requirements, futures)}
+
+
+def _requirement_id(requirement):
+    cls = type(requirement)
+    return '{}.{}:{}'.format(cls.__module__, cls.__name__, requirement.name)
@@ -0,0 +1,19 @@
+"""
+Benchmarks of the interfaces that run in-process (i.e. don't wrap external
+tools), run on synthetic inputs generated by the 'synthetic' module.
+
+The benchmarks follow the conventions of airspeed velocity (asv), i.e.
+classes with 'setup'/'teardown' methods, 'params' and 'time_*' and
+'peakmem_*' benchmark methods, so they can be run with 'asv run' (see
+asv.conf.json in the root of the repository), or without any extra
+dependencies with
+
+    python -m benchmarks.run --save
+
+which stores the results as a baseline (named after the current commit by
+default) in 'benchmarks/baselines', and
+
+    python -m benchmarks.run --compare <baseline>
+
+to compare the current tree against it.
+"""
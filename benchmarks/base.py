@@ -0,0 +1,56 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+from itertools import product
+
+# Generated inputs are shared between the samples of a benchmark (and between
+# runs if this is set to a persistent directory)
+DATA_DIR = os.environ.get('BANANA_BENCHMARK_DATA',
+                          op.join(tempfile.gettempdir(), 'banana-benchmarks'))
+
+
+class InterfaceBenchmark(object):
+    """
+    Base class for benchmarks of interfaces. The synthetic inputs for each
+    set of parameters are generated by 'generate' the first time they are
+    required and each sample is run in a fresh working directory.
+    """
+
+    timeout = 600
+    params = []
+    param_names = []
+
+    def generate(self, inputs_dir, *params):
+        raise NotImplementedError
+
+    def setup(self, *params):
+        self.inputs_dir = op.join(
+            DATA_DIR, type(self).__name__,
+            '_'.join(str(p).replace(' ', '') for p in params) or 'default')
+        if not op.exists(op.join(self.inputs_dir, '.complete')):
+            shutil.rmtree(self.inputs_dir, ignore_errors=True)
+            os.makedirs(self.inputs_dir)
+            self.generate(self.inputs_dir, *params)
+            open(op.join(self.inputs_dir, '.complete'), 'w').close()
+        self._cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+
+    def teardown(self, *params):
+        os.chdir(self._cwd)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def input(self, *path):
+        return op.join(self.inputs_dir, *path)
+
+    def run(self, interface):
+        return interface.run(cwd=self.work_dir)
+
+    @classmethod
+    def param_sets(cls):
+        params = cls.params
+        # asv allows a single list of parameters in place of a list of lists
+        if params and not isinstance(params[0], (list, tuple)):
+            params = [params]
+        return list(product(*params))
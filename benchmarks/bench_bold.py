@@ -0,0 +1,47 @@
+from banana.interfaces.fsl import SignalRegression
+from banana.interfaces.custom.bold import TemporalFilter
+from .base import InterfaceBenchmark
+from . import synthetic
+
+
+class SignalRegressionBenchmark(InterfaceBenchmark):
+
+    params = [[(64, 64, 32, 200)], [False, True]]
+    param_names = ['shape', 'motion_regression']
+
+    def generate(self, inputs_dir, shape, motion_regression):
+        synthetic.fix_dir(self.input('fix'), shape)
+
+    def _run(self, motion_regression):
+        self.run(SignalRegression(
+            fix_dir=self.input('fix'),
+            labelled_components=self.input('labelled_components.txt'),
+            motion_regression=motion_regression, highpass=100.0))
+
+    def time_signal_regression(self, shape, motion_regression):
+        self._run(motion_regression)
+
+    def peakmem_signal_regression(self, shape, motion_regression):
+        self._run(motion_regression)
+
+
+class TemporalFilterBenchmark(InterfaceBenchmark):
+
+    params = [[(64, 64, 32, 200)], [0.0, 6.0]]
+    param_names = ['shape', 'blur']
+
+    def generate(self, inputs_dir, shape, blur):
+        synthetic.nifti_4d(self.input('func.nii.gz'), shape, tr=2.0)
+        synthetic.mask(self.input('mask.nii.gz'), shape[:3], fraction=0.8)
+
+    def _run(self, blur):
+        self.run(TemporalFilter(
+            in_file=self.input('func.nii.gz'),
+            mask=self.input('mask.nii.gz'), delta_t=2.0, polort=2,
+            passband=(0.01, 0.1), blur=blur))
+
+    def time_temporal_filter(self, shape, blur):
+        self._run(blur)
+
+    def peakmem_temporal_filter(self, shape, blur):
+        self._run(blur)
@@ -0,0 +1,38 @@
+import os
+import os.path as op
+import zipfile
+from banana.interfaces.custom.coils import ToPolarCoords
+from .base import InterfaceBenchmark
+from . import synthetic
+
+
+class ToPolarCoordsBenchmark(InterfaceBenchmark):
+
+    params = [[4, 32], [(128, 128, 64)], ['dir', 'zip'], [1, 4]]
+    param_names = ['num_channels', 'shape', 'source', 'num_threads']
+
+    def generate(self, inputs_dir, num_channels, shape, source, num_threads):
+        synthetic.coil_dir(self.input('coils'), shape=shape,
+                           num_channels=num_channels, num_echoes=2)
+        if source == 'zip':
+            with zipfile.ZipFile(self.input('coils.zip'), 'w') as zf:
+                for fname in os.listdir(self.input('coils')):
+                    zf.write(self.input('coils', fname), op.join('coils',
+                                                                 fname))
+
+    def _run(self, source, num_threads):
+        if source == 'zip':
+            inputs = {'in_archive': self.input('coils.zip')}
+        else:
+            inputs = {'in_dir': self.input('coils')}
+        self.run(ToPolarCoords(in_fname_re=(r'coil_(?P<channel>\d+)_'
+                                            r'(?P<echo>\d+)_(?P<axis>[A-Z]+)'
+                                            r'\.nii\.gz'),
+                               num_threads=num_threads, **inputs))
+
+    def time_to_polar_coords(self, num_channels, shape, source, num_threads):
+        self._run(source, num_threads)
+
+    def peakmem_to_polar_coords(self, num_channels, shape, source,
+                                num_threads):
+        self._run(source, num_threads)
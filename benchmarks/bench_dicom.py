@@ -0,0 +1,38 @@
+from banana.interfaces.custom.dicom import (
+    DicomHeaderInfoExtraction, PetTimeInfo)
+from .base import InterfaceBenchmark
+from . import synthetic
+
+
+class DicomHeaderInfoExtractionBenchmark(InterfaceBenchmark):
+
+    params = [[1, 20], [(128, 128, 64)]]
+    param_names = ['num_volumes', 'shape']
+
+    def generate(self, inputs_dir, num_volumes, shape):
+        synthetic.dicom_series(self.input('dicoms'), shape=shape,
+                               num_volumes=num_volumes,
+                               echo_times=(5.0, 10.0, 15.0))
+
+    def _run(self, num_volumes):
+        self.run(DicomHeaderInfoExtraction(dicom_folder=self.input('dicoms'),
+                                           multivol=num_volumes > 1))
+
+    def time_header_info(self, num_volumes, shape):
+        self._run(num_volumes)
+
+    def peakmem_header_info(self, num_volumes, shape):
+        self._run(num_volumes)
+
+
+class PetTimeInfoBenchmark(InterfaceBenchmark):
+
+    params = [[60, 600]]
+    param_names = ['duration']
+
+    def generate(self, inputs_dir, duration):
+        synthetic.list_mode(self.input('pet'), duration=duration,
+                            events_per_ms=50)
+
+    def time_pet_time_info(self, duration):
+        self.run(PetTimeInfo(pet_data_dir=self.input('pet')))
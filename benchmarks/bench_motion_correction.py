@@ -0,0 +1,117 @@
+import os
+import numpy as np
+from banana.interfaces.custom.motion_correction import (
+    MotionMatCalculation, MeanDisplacementCalculation, MotionFraming,
+    AffineMatAveraging)
+from .base import InterfaceBenchmark
+from . import synthetic
+
+
+class MotionMatCalculationBenchmark(InterfaceBenchmark):
+
+    params = [[100, 1000]]
+    param_names = ['num_mats']
+
+    def generate(self, inputs_dir, num_mats):
+        synthetic.motion_mats_dir(self.input('align_mats'), num_mats)
+        np.savetxt(self.input('reg.mat'),
+                   synthetic.rigid_walk(2, 0.1, 5.0, seed=1)[-1])
+        np.savetxt(self.input('qform.mat'), synthetic.DEFAULT_AFFINE)
+
+    def setup(self, *params):
+        super().setup(*params)
+        # The motion matrices are written alongside the alignment matrices
+        self.align_mats = os.path.join(self.work_dir, 'align_mats')
+        os.symlink(self.input('align_mats'), self.align_mats)
+
+    def _run(self):
+        self.run(MotionMatCalculation(
+            reg_mat=self.input('reg.mat'), qform_mat=self.input('qform.mat'),
+            align_mats=self.align_mats))
+
+    def teardown(self, *params):
+        # Clean up the motion matrices written to the input directory
+        for fname in os.listdir(self.input('align_mats')):
+            if 'motion_mat' in fname:
+                os.remove(self.input('align_mats', fname))
+        super().teardown(*params)
+
+    def time_motion_mats(self, num_mats):
+        self._run()
+
+
+class MeanDisplacementCalculationBenchmark(InterfaceBenchmark):
+
+    params = [[10, 100], [100]]
+    param_names = ['num_scans', 'vols_per_scan']
+
+    def generate(self, inputs_dir, num_scans, vols_per_scan):
+        synthetic.nifti_4d(self.input('reference.nii.gz'), (64, 64, 32))
+        for i in range(num_scans):
+            mats = synthetic.rigid_walk(vols_per_scan, seed=i)
+            scan_dir = self.input('scan{}'.format(i))
+            os.makedirs(scan_dir)
+            for j, mat in enumerate(mats):
+                np.savetxt(os.path.join(
+                    scan_dir, 'vol{:04}_motion_mat_inv.mat'.format(j)), mat)
+                np.savetxt(os.path.join(
+                    scan_dir, 'vol{:04}_motion_mat.mat'.format(j)),
+                    np.linalg.inv(mat))
+
+    def _run(self, num_scans, vols_per_scan):
+        tr = 2.0
+        start_times = []
+        for i in range(num_scans):
+            secs = int(12 * 3600 + i * (vols_per_scan * tr + 30))
+            start_times.append('{:02d}{:02d}{:02d}.000000'.format(
+                secs // 3600, secs % 3600 // 60, secs % 60))
+        self.run(MeanDisplacementCalculation(
+            motion_mats=[self.input('scan{}'.format(i))
+                         for i in range(num_scans)],
+            trs=[tr] * num_scans, start_times=start_times,
+            real_durations=[vols_per_scan * tr] * num_scans,
+            reference=self.input('reference.nii.gz'),
+            input_names=['scan{}'.format(i) for i in range(num_scans)]))
+
+    def time_mean_displacement(self, num_scans, vols_per_scan):
+        self._run(num_scans, vols_per_scan)
+
+    def peakmem_mean_displacement(self, num_scans, vols_per_scan):
+        self._run(num_scans, vols_per_scan)
+
+
+class MotionFramingBenchmark(InterfaceBenchmark):
+
+    params = [[1000, 10000]]
+    param_names = ['num_vols']
+
+    def generate(self, inputs_dir, num_vols):
+        synthetic.motion_timecourse(inputs_dir, num_vols=num_vols,
+                                    jumps=num_vols // 100)
+
+    def time_motion_framing(self, num_vols):
+        self.run(MotionFraming(
+            mean_displacement=self.input('mean_displacement.txt'),
+            mean_displacement_consec=self.input(
+                'mean_displacement_consecutive.txt'),
+            start_times=self.input('start_times.txt'),
+            motion_threshold=2.0, temporal_threshold=30.0))
+
+
+class AffineMatAveragingBenchmark(InterfaceBenchmark):
+
+    params = [[1000]]
+    param_names = ['num_mats']
+
+    def generate(self, inputs_dir, num_mats):
+        synthetic.motion_mats_dir(self.input('mats'), num_mats)
+        with open(self.input('mats4average.txt'), 'w') as f:
+            f.write('\n'.join(self.input('mats', 'MAT_{:04}'.format(i))
+                              for i in range(num_mats)) + '\n')
+        np.savetxt(self.input('frame_vol_numbers.txt'),
+                   np.arange(0, num_mats + 1, 50), fmt='%d')
+
+    def time_affine_mat_averaging(self, num_mats):
+        self.run(AffineMatAveraging(
+            frame_vol_numbers=self.input('frame_vol_numbers.txt'),
+            all_mats4average=self.input('mats4average.txt')))
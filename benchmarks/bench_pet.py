@@ -0,0 +1,57 @@
+from banana.interfaces.custom.pet import (
+    PETdr, GlobalTrendRemoval, SUVRCalculation)
+from .base import InterfaceBenchmark
+from . import synthetic
+
+
+class PETdrBenchmark(InterfaceBenchmark):
+
+    params = [[(128, 128, 64, 60)]]
+    param_names = ['shape']
+
+    def generate(self, inputs_dir, shape):
+        synthetic.nifti_4d(self.input('pet.nii.gz'), shape)
+        synthetic.nifti_4d(self.input('map.nii.gz'), shape[:3], seed=1)
+
+    def _run(self):
+        self.run(PETdr(volume=self.input('pet.nii.gz'),
+                       regression_map=self.input('map.nii.gz'),
+                       threshold=500.0))
+
+    def time_dual_regression(self, shape):
+        self._run()
+
+    def peakmem_dual_regression(self, shape):
+        self._run()
+
+
+class GlobalTrendRemovalBenchmark(InterfaceBenchmark):
+
+    params = [[(96, 96, 48, 60)]]
+    param_names = ['shape']
+
+    def generate(self, inputs_dir, shape):
+        synthetic.nifti_4d(self.input('pet.nii.gz'), shape)
+
+    def _run(self):
+        self.run(GlobalTrendRemoval(volume=self.input('pet.nii.gz')))
+
+    def time_global_trend_removal(self, shape):
+        self._run()
+
+    def peakmem_global_trend_removal(self, shape):
+        self._run()
+
+
+class SUVRCalculationBenchmark(InterfaceBenchmark):
+
+    params = [[(256, 256, 128)]]
+    param_names = ['shape']
+
+    def generate(self, inputs_dir, shape):
+        synthetic.nifti_4d(self.input('pet.nii.gz'), shape)
+        synthetic.mask(self.input('mask.nii.gz'), shape)
+
+    def time_suvr(self, shape):
+        self.run(SUVRCalculation(volume=self.input('pet.nii.gz'),
+                                 base_mask=self.input('mask.nii.gz')))
@@ -0,0 +1,39 @@
+import numpy as np
+import nibabel as nib
+from banana.interfaces.custom.qsm import NativeQSM
+from .base import InterfaceBenchmark
+from . import synthetic
+
+
+class NativeQSMBenchmark(InterfaceBenchmark):
+
+    params = [[1, 8, 32], [(128, 128, 64)]]
+    param_names = ['num_channels', 'shape']
+
+    def generate(self, inputs_dir, num_channels, shape):
+        state = synthetic.rng(0)
+        grid = np.meshgrid(*(np.linspace(-np.pi, np.pi, n) for n in shape),
+                           indexing='ij')
+        for i in range(num_channels):
+            # Smooth phase that wraps a few times plus noise
+            phase = (3 * np.sin(grid[0] + i) * np.cos(grid[1]) +
+                     2 * grid[2] + state.standard_normal(shape) * 0.1)
+            nib.save(nib.Nifti1Image(
+                np.angle(np.exp(1j * phase)).astype(np.float32),
+                synthetic.DEFAULT_AFFINE),
+                self.input('phase{}.nii.gz'.format(i)))
+        synthetic.mask(self.input('mask.nii.gz'), shape, fraction=0.6)
+
+    def _run(self, num_channels):
+        self.run(NativeQSM(
+            in_files=[self.input('phase{}.nii.gz'.format(i))
+                      for i in range(num_channels)],
+            masks=[self.input('mask.nii.gz')],
+            voxelsize=[2.0, 2.0, 2.0], echo_times=[0.02], B0=3.0,
+            H=[0.0, 0.0, 1.0]))
+
+    def time_native_qsm(self, num_channels, shape):
+        self._run(num_channels)
+
+    def peakmem_native_qsm(self, num_channels, shape):
+        self._run(num_channels)
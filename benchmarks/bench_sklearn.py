@@ -0,0 +1,22 @@
+from banana.interfaces.sklearn import FastICA
+from .base import InterfaceBenchmark
+from . import synthetic
+
+
+class FastICABenchmark(InterfaceBenchmark):
+
+    params = [[(64, 64, 32, 100)], [20]]
+    param_names = ['shape', 'n_components']
+
+    def generate(self, inputs_dir, shape, n_components):
+        synthetic.nifti_4d(self.input('func.nii.gz'), shape)
+
+    def _run(self, n_components):
+        self.run(FastICA(volume=self.input('func.nii.gz'),
+                         n_components=n_components, ica_type='spatial'))
+
+    def time_fast_ica(self, shape, n_components):
+        self._run(n_components)
+
+    def peakmem_fast_ica(self, shape, n_components):
+        self._run(n_components)
@@ -0,0 +1,27 @@
+from banana.interfaces.umap_calc import CoreUmapCalc
+from .base import InterfaceBenchmark
+from . import synthetic
+
+
+class CoreUmapCalcBenchmark(InterfaceBenchmark):
+
+    params = [[(192, 192, 128)]]
+    param_names = ['shape']
+
+    def generate(self, inputs_dir, shape):
+        synthetic.nifti_4d(self.input('ute1.nii.gz'), shape, seed=0)
+        synthetic.nifti_4d(self.input('ute2.nii.gz'), shape, seed=1)
+        synthetic.mask(self.input('air.nii.gz'), shape, fraction=0.9)
+        synthetic.mask(self.input('bones.nii.gz'), shape, fraction=0.3)
+
+    def _run(self):
+        self.run(CoreUmapCalc(air__mask=self.input('air.nii.gz'),
+                              bones__mask=self.input('bones.nii.gz'),
+                              ute1_reg=self.input('ute1.nii.gz'),
+                              ute2_reg=self.input('ute2.nii.gz')))
+
+    def time_umap(self, shape):
+        self._run()
+
+    def peakmem_umap(self, shape):
+        self._run()
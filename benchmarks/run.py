@@ -0,0 +1,222 @@
+"""
+Runs the benchmarks without asv, saving the results as baselines and/or
+comparing them against a previously saved baseline
+"""
+import os
+import os.path as op
+import re
+import sys
+import gc
+import json
+import time
+import socket
+import platform
+import tracemalloc
+import subprocess as sp
+from datetime import datetime
+from argparse import ArgumentParser
+from importlib import import_module
+from pkgutil import iter_modules
+import numpy as np
+from .base import InterfaceBenchmark
+
+BASELINES_DIR = op.join(op.dirname(__file__), 'baselines')
+
+PREFIXES = ('time_', 'peakmem_')
+
+
+def discover(pattern=None):
+    """
+    Returns the benchmarks in the 'bench_*' modules of the package as a list
+    of (name, class, method name) tuples, filtered by a regex pattern matched
+    against the name, and the modules that couldn't be imported (e.g. due to
+    missing optional dependencies) mapped to the error
+    """
+    benchmarks = []
+    failed = {}
+    for module_info in iter_modules([op.dirname(__file__)]):
+        if not module_info.name.startswith('bench_'):
+            continue
+        try:
+            module = import_module('.' + module_info.name, __package__)
+        except ImportError as e:
+            if pattern is None or re.search(pattern, module_info.name):
+                failed[module_info.name] = '{}: {}'.format(
+                    type(e).__name__, e)
+            continue
+        for cls_name, cls in sorted(vars(module).items()):
+            if not (isinstance(cls, type) and
+                    issubclass(cls, InterfaceBenchmark) and
+                    cls.__module__ == module.__name__):
+                continue
+            for attr in sorted(dir(cls)):
+                if not attr.startswith(PREFIXES):
+                    continue
+                name = '{}.{}.{}'.format(module_info.name, cls_name, attr)
+                if pattern is None or re.search(pattern, name):
+                    benchmarks.append((name, cls, attr))
+    return benchmarks, failed
+
+
+def run_benchmark(cls, method_name, params, repeat=3):
+    """
+    Runs a benchmark for a set of parameters
+
+    Returns
+    -------
+    result : float
+        The minimum run time (s) over the repeats for 'time_' benchmarks,
+        or the peak memory (bytes) allocated by Python and NumPy during the
+        run (as traced by tracemalloc) for 'peakmem_' benchmarks
+    """
+    bench = cls()
+    samples = []
+    for _ in range(repeat if method_name.startswith('time_') else 1):
+        bench.setup(*params)
+        try:
+            method = getattr(bench, method_name)
+            gc.collect()
+            if method_name.startswith('time_'):
+                start = time.perf_counter()
+                method(*params)
+                samples.append(time.perf_counter() - start)
+            else:
+                tracemalloc.start()
+                try:
+                    method(*params)
+                    samples.append(tracemalloc.get_traced_memory()[1])
+                finally:
+                    tracemalloc.stop()
+        finally:
+            bench.teardown(*params)
+    return min(samples)
+
+
+def run_all(pattern=None, quick=False, repeat=3, log=print):
+    "Runs all benchmarks and returns the results keyed by name and params"
+    results = {}
+    benchmarks, failed = discover(pattern)
+    for module_name, error in failed.items():
+        results[module_name] = {'error': error}
+        log('{}: not run ({})'.format(module_name, error))
+    for name, cls, method_name in benchmarks:
+        param_sets = cls.param_sets()
+        if quick:
+            param_sets = param_sets[:1]
+        for params in param_sets:
+            key = '{}({})'.format(name, ', '.join(repr(p) for p in params))
+            try:
+                value = run_benchmark(cls, method_name, params,
+                                      repeat=(1 if quick else repeat))
+            except Exception as e:
+                results[key] = {'error': '{}: {}'.format(type(e).__name__,
+                                                        e)}
+                log('{}: failed ({})'.format(key, results[key]['error']))
+            else:
+                results[key] = {'value': value}
+                log('{}: {}'.format(key, format_value(key, value)))
+    return results
+
+
+def format_value(key, value):
+    if '.time_' in key:
+        return '{:.3f} s'.format(value)
+    return '{:.1f} MB'.format(value / 1024 ** 2)
+
+
+def git_commit():
+    try:
+        return sp.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=sp.DEVNULL,
+            cwd=op.dirname(__file__)).decode().strip()
+    except (sp.CalledProcessError, OSError):
+        return None
+
+
+def save(results, label):
+    os.makedirs(BASELINES_DIR, exist_ok=True)
+    path = op.join(BASELINES_DIR, label + '.json')
+    with open(path, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'date': datetime.now().isoformat(),
+            'machine': {'host': socket.gethostname(),
+                        'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__},
+            'results': results}, f, indent=2, sort_keys=True)
+    return path
+
+
+def compare(results, baseline, threshold=1.2):
+    """
+    Compares the results against a baseline
+
+    Returns
+    -------
+    rows : list[(str, float | None, float | None, float | None)]
+        The key, baseline value, current value and ratio of each benchmark
+    regressions : list[str]
+        The benchmarks that are slower (or use more memory) than the baseline
+        by more than the threshold factor
+    """
+    rows = []
+    regressions = []
+    for key in sorted(set(results) | set(baseline)):
+        base = baseline.get(key, {}).get('value')
+        current = results.get(key, {}).get('value')
+        ratio = current / base if base and current is not None else None
+        if ratio is not None and ratio > threshold:
+            regressions.append(key)
+        rows.append((key, base, current, ratio))
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog='python -m benchmarks.run',
+                            description=__doc__)
+    parser.add_argument('--bench', '-b', default=None, metavar='REGEX',
+                        help="Only run benchmarks whose names match")
+    parser.add_argument('--quick', action='store_true', default=False,
+                        help=("Only run the first set of parameters of each "
+                              "benchmark once"))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="The number of times to repeat each timing")
+    parser.add_argument('--save', nargs='?', const='', default=None,
+                        metavar='LABEL',
+                        help=("Save the results as a baseline (named after "
+                              "the current commit by default)"))
+    parser.add_argument('--compare', default=None, metavar='LABEL',
+                        help="Compare the results against a saved baseline")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help=("The ratio to the baseline above which a "
+                              "result is reported as a regression"))
+    args = parser.parse_args(argv)
+    if args.compare is not None:
+        with open(op.join(BASELINES_DIR, args.compare + '.json')) as f:
+            baseline = json.load(f)['results']
+    results = run_all(args.bench, quick=args.quick, repeat=args.repeat)
+    if args.save is not None:
+        label = args.save or git_commit() or datetime.now().strftime(
+            '%Y%m%d%H%M%S')
+        print("Saved baseline to {}".format(save(results, label)))
+    if args.compare is not None:
+        rows, regressions = compare(results, baseline,
+                                    threshold=args.threshold)
+        print("\n{:>10}  {:>10}  {:>6}  benchmark".format(
+            args.compare, 'current', 'ratio'))
+        for key, base, current, ratio in rows:
+            print("{:>10}  {:>10}  {:>6}  {}".format(
+                format_value(key, base) if base is not None else '-',
+                format_value(key, current) if current is not None else '-',
+                '{:.2f}'.format(ratio) if ratio is not None else '-', key))
+        if regressions:
+            print("\n{} benchmark(s) regressed by more than {}x".format(
+                len(regressions), args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
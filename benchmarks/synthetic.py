@@ -0,0 +1,406 @@
+"""
+Generators of synthetic inputs for the benchmarks, which mimic the layout (but
+not the content) of the data the interfaces are run on so that no reference
+repositories or external neuroimaging tools are required
+"""
+import os
+import os.path as op
+import struct
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+# Siemens' "MR Image Storage" SOP class
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+
+DEFAULT_AFFINE = np.diag([2.0, 2.0, 2.0, 1.0])
+
+ASCCONV_DEFAULTS = {
+    'alTR[0]': 2500000,
+    'alTE[0]': 30000,
+    'lTotalScanTimeSec': 600,
+    'sSliceArray.asSlice[0].dInPlaneRot': 0.0,
+    'sDiffusion.lDiffDirections': 0}
+
+
+def rng(seed=0):
+    return np.random.RandomState(seed)
+
+
+def _save_dicom(ds, path):
+    try:
+        ds.save_as(path, enforce_file_format=True)
+    except TypeError:  # pydicom < 3.0
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        ds.save_as(path, write_like_original=False)
+
+
+def nifti_4d(path, shape=(64, 64, 32, 100), dtype=np.float32, seed=0,
+             affine=DEFAULT_AFFINE, tr=None):
+    """
+    Saves a NIfTI image of smooth random signal plus noise
+
+    Parameters
+    ----------
+    path : str
+        Path to save the image at
+    shape : tuple(int)
+        The shape of the image (3D or 4D)
+    dtype : numpy.dtype
+        The data type to store the image with
+    tr : float | None
+        The repetition time to set in the header (for 4D images)
+    """
+    state = rng(seed)
+    spatial = shape[:3]
+    # A smooth positive baseline (so logs and ratios are well defined) with
+    # independent noise in each volume
+    grid = np.meshgrid(*(np.linspace(-1, 1, n) for n in spatial),
+                       indexing='ij')
+    baseline = 1000.0 * np.exp(-sum(g ** 2 for g in grid)) + 100.0
+    if len(shape) == 3:
+        data = baseline + state.standard_normal(spatial) * 10.0
+    else:
+        data = np.empty(shape, dtype=np.float32)
+        for t in range(shape[3]):
+            data[..., t] = (baseline +
+                            state.standard_normal(spatial) * 10.0)
+    img = nib.Nifti1Image(data.astype(dtype), affine)
+    if tr is not None:
+        img.header.set_xyzt_units('mm', 'sec')
+        img.header['pixdim'][4] = tr
+    nib.save(img, path)
+    return path
+
+
+def mask(path, shape=(64, 64, 32), fraction=0.5, affine=DEFAULT_AFFINE):
+    "Saves a binary ellipsoid mask filling 'fraction' of each axis"
+    grid = np.meshgrid(*(np.linspace(-1, 1, n) for n in shape),
+                       indexing='ij')
+    data = (sum(g ** 2 for g in grid) <= fraction ** 2).astype(np.uint8)
+    nib.save(nib.Nifti1Image(data, affine), path)
+    return path
+
+
+def coil_dir(path, shape=(64, 64, 32), num_channels=8, num_echoes=2,
+             seed=0, fname='coil_{channel}_{echo}_{axis}.nii.gz'):
+    """
+    Creates a directory of real and imaginary channel images for each echo
+    of a multi-channel (complex) coil acquisition, named so they match the
+    default regex of ToPolarCoords
+
+    Parameters
+    ----------
+    path : str
+        Directory to create
+    shape : tuple(int)
+        The shape of each channel image
+    num_channels : int
+        The number of coil channels
+    num_echoes : int
+        The number of echoes
+    """
+    state = rng(seed)
+    os.makedirs(path, exist_ok=True)
+    grid = np.meshgrid(*(np.linspace(-1, 1, n) for n in shape),
+                       indexing='ij')
+    magnitude = 1000.0 * np.exp(-sum(g ** 2 for g in grid))
+    for echo in range(num_echoes):
+        phase = (echo + 1) * np.pi * grid[0]
+        for channel in range(num_channels):
+            # Each coil has a smooth sensitivity profile centred on a
+            # different point around the FOV
+            angle = 2 * np.pi * channel / num_channels
+            sensitivity = np.exp(-((grid[0] - np.cos(angle)) ** 2 +
+                                   (grid[1] - np.sin(angle)) ** 2))
+            cmplx = (magnitude * sensitivity * np.exp(1j * (phase + angle)) +
+                     state.standard_normal(shape) * 5.0)
+            for axis, data in (('REAL', cmplx.real), ('IMAGINARY',
+                                                      cmplx.imag)):
+                nib.save(
+                    nib.Nifti1Image(data.astype(np.float32), DEFAULT_AFFINE),
+                    op.join(path, fname.format(channel=channel, echo=echo,
+                                               axis=axis)))
+    return path
+
+
+def ascconv(**fields):
+    """
+    Returns a Siemens ASCCONV protocol block, as embedded in the private CSA
+    series header of Siemens DICOMs, with the given fields added to (or
+    overriding) ASCCONV_DEFAULTS
+    """
+    values = dict(ASCCONV_DEFAULTS)
+    values.update(fields)
+    lines = ['### ASCCONV BEGIN ###']
+    lines.extend('{} = {}'.format(k, v) for k, v in values.items())
+    lines.append('### ASCCONV END ###')
+    return '\n'.join(lines) + '\n'
+
+
+def csa_header(tags):
+    """
+    Encodes a Siemens CSA header (the 'SV10' variant read by
+    nibabel.nicom.csareader) containing the given tags
+
+    Parameters
+    ----------
+    tags : dict[str, (str, list)]
+        Maps the tag names to their VR and list of values
+    """
+    out = b'SV10\x04\x03\x02\x01' + struct.pack('<2I', len(tags), 77)
+    for name, (vr, values) in tags.items():
+        out += struct.pack('<64si4s3i', name.encode(), len(values),
+                           vr.encode(), 0, len(values), 77)
+        for value in values:
+            item = str(value).encode() + b'\x00'
+            out += struct.pack('<4i', len(item), len(item), 77, len(item))
+            out += item + b'\x00' * ((4 - len(item) % 4) % 4)
+    return out
+
+
+def dicom_series(path, shape=(64, 64, 32), num_volumes=1, seed=0,
+                 echo_times=(30.0,), acquisition_time='120000.000000',
+                 **ascconv_fields):
+    """
+    Creates a directory containing a Siemens-style DICOM series, one file per
+    slice (per echo and per volume), with an ASCCONV protocol block in the
+    CSA series header and the phase encoding direction in the CSA image
+    header
+
+    Parameters
+    ----------
+    path : str
+        Directory to create
+    shape : tuple(int)
+        The shape of each volume
+    num_volumes : int
+        The number of volumes in the series
+    echo_times : tuple(float)
+        The echo times (ms) of the series
+    acquisition_time : str
+        The acquisition time of the series (HHMMSS.ffffff)
+    **ascconv_fields
+        Fields to add to the ASCCONV block (see `ascconv`)
+    """
+    state = rng(seed)
+    os.makedirs(path, exist_ok=True)
+    series_uid = generate_uid()
+    protocol = ascconv(**ascconv_fields).encode()
+    image_csa = csa_header({'PhaseEncodingDirectionPositive': ('IS', [1])})
+    index = 0
+    for vol in range(num_volumes):
+        for echo_i, echo_time in enumerate(echo_times):
+            for slice_i in range(shape[2]):
+                index += 1
+                meta = FileMetaDataset()
+                meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+                meta.MediaStorageSOPInstanceUID = generate_uid()
+                meta.TransferSyntaxUID = ExplicitVRLittleEndian
+                ds = Dataset()
+                ds.file_meta = meta
+                ds.SOPClassUID = MR_IMAGE_STORAGE
+                ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+                ds.SeriesInstanceUID = series_uid
+                ds.Modality = 'MR'
+                ds.Manufacturer = 'SIEMENS'
+                ds.AcquisitionTime = acquisition_time
+                ds.EchoTime = echo_time
+                ds.EchoNumbers = echo_i + 1
+                ds.AcquisitionNumber = vol + 1
+                ds.InstanceNumber = index
+                ds.MagneticFieldStrength = 3.0
+                ds.PixelSpacing = [2.0, 2.0]
+                ds.SliceThickness = 2.0
+                ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+                ds.ImagePositionPatient = [0.0, 0.0, 2.0 * slice_i]
+                ds.InPlanePhaseEncodingDirection = 'COL'
+                ds.Rows, ds.Columns = shape[:2]
+                ds.SamplesPerPixel = 1
+                ds.PhotometricInterpretation = 'MONOCHROME2'
+                ds.BitsAllocated = ds.BitsStored = 16
+                ds.HighBit = 15
+                ds.PixelRepresentation = 0
+                ds.PixelData = state.randint(
+                    0, 4096, size=shape[:2], dtype=np.uint16).tobytes()
+                ds.add_new(0x00290010, 'LO', 'SIEMENS CSA HEADER')
+                ds.add_new(0x00291010, 'OB', image_csa)
+                ds.add_new(0x00291020, 'OB', protocol)
+                _save_dicom(ds, op.join(path, '{:06}.dcm'.format(index)))
+    return path
+
+
+def motion_mats_dir(path, num_mats=100, max_rotation=0.02,
+                    max_translation=2.0, seed=0, fname='MAT_{:04}'):
+    """
+    Creates a directory of rigid-body affine matrices (as written by MCFLIRT)
+    following a random walk
+
+    Parameters
+    ----------
+    path : str
+        Directory to create
+    num_mats : int
+        The number of matrices (i.e. volumes)
+    max_rotation : float
+        The standard deviation of the rotation (radians) at the last matrix
+    max_translation : float
+        The standard deviation of the translation (mm) at the last matrix
+    """
+    os.makedirs(path, exist_ok=True)
+    for i, mat in enumerate(rigid_walk(num_mats, max_rotation,
+                                       max_translation, seed=seed)):
+        np.savetxt(op.join(path, fname.format(i)), mat)
+    return path
+
+
+def rigid_walk(num_mats, max_rotation=0.02, max_translation=2.0, seed=0):
+    "Returns a random walk of rigid-body affine matrices"
+    state = rng(seed)
+    scale = 1.0 / np.sqrt(max(num_mats, 1))
+    rots = np.cumsum(state.standard_normal((num_mats, 3)) *
+                     max_rotation * scale, axis=0)
+    trans = np.cumsum(state.standard_normal((num_mats, 3)) *
+                      max_translation * scale, axis=0)
+    mats = []
+    for (rx, ry, rz), t in zip(rots, trans):
+        cx, sx, cy, sy, cz, sz = (np.cos(rx), np.sin(rx), np.cos(ry),
+                                  np.sin(ry), np.cos(rz), np.sin(rz))
+        mat = np.eye(4)
+        mat[:3, :3] = (np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]).dot(
+            np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])).dot(
+                np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])))
+        mat[:3, 3] = t
+        mats.append(mat)
+    return mats
+
+
+def list_mode(path, duration=60, events_per_ms=200, seed=0,
+              acquisition_time='120000.000000'):
+    """
+    Creates a list-mode-like PET data directory containing a binary '.bf'
+    file of 32-bit event words, with a time mark word after each millisecond
+    of events (the layout of Siemens' PETLINK 32-bit format), along with the
+    '.dcm' header that accompanies it, which holds the acquisition time and
+    an interfile header with the image duration
+
+    Parameters
+    ----------
+    path : str
+        Directory to create
+    duration : int
+        The duration of the acquisition in seconds
+    events_per_ms : int
+        The number of prompt/delayed events between time marks
+    """
+    state = rng(seed)
+    os.makedirs(path, exist_ok=True)
+    bf_path = op.join(path, 'listmode.bf')
+    # Events have the top bit clear and time marks the '100' tag bits
+    time_mark = np.uint32(0x80000000)
+    with open(bf_path, 'wb') as f:
+        for s in range(duration):
+            events = state.randint(
+                0, 0x7FFFFFFF, size=(1000, events_per_ms + 1),
+                dtype=np.uint32)
+            events[:, -1] = time_mark | (s * 1000 + np.arange(1000,
+                                                              dtype=np.uint32))
+            events.tofile(f)
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = '1.3.12.2.1107.5.9.1'
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.Modality = 'PT'
+    ds.AcquisitionTime = acquisition_time
+    ds.add_new(0x00290010, 'LO', 'SIEMENS CSA HEADER')
+    ds.add_new(0x00291010, 'OB', (
+        '!INTERFILE:=\n%image duration (sec):={}\n!END OF INTERFILE:=\n'
+        .format(duration)).encode())
+    _save_dicom(ds, op.join(path, 'listmode.dcm'))
+    return path
+
+
+def motion_timecourse(path, num_vols=1000, tr=2.5, jumps=10, seed=0,
+                      start_time='120000.000000'):
+    """
+    Saves the mean displacement (to the reference and between consecutive
+    volumes) and start-time text files produced by
+    MeanDisplacementCalculation, for a subject that moves 'jumps' times
+
+    Parameters
+    ----------
+    path : str
+        Directory to save 'mean_displacement.txt',
+        'mean_displacement_consecutive.txt' and 'start_times.txt' in
+    num_vols : int
+        The number of volumes
+    tr : float
+        The time between volumes (s)
+    jumps : int
+        The number of abrupt movements
+    """
+    state = rng(seed)
+    os.makedirs(path, exist_ok=True)
+    steps = np.zeros(num_vols)
+    steps[state.choice(np.arange(1, num_vols), jumps, replace=False)] = (
+        state.uniform(2.0, 6.0, jumps) * state.choice((-1, 1), jumps))
+    md = np.abs(np.cumsum(steps) + state.standard_normal(num_vols) * 0.1)
+    np.savetxt(op.join(path, 'mean_displacement.txt'), md)
+    np.savetxt(op.join(path, 'mean_displacement_consecutive.txt'),
+               np.abs(np.diff(md)))
+    hh, mm, ss = (int(start_time[:2]), int(start_time[2:4]),
+                  float(start_time[4:]))
+    start = hh * 3600 + mm * 60 + ss
+    times = []
+    for t in start + tr * np.arange(num_vols + 1):
+        times.append('{:02d}{:02d}{:09.6f}'.format(
+            int(t // 3600), int(t % 3600 // 60), t % 60))
+    with open(op.join(path, 'start_times.txt'), 'w') as f:
+        f.write('\n'.join(times) + '\n')
+    return path
+
+
+def fix_dir(path, shape=(64, 64, 32, 200), num_components=40,
+            num_bad=20, tr=2.0, seed=0):
+    """
+    Creates a FIX directory as prepared for SignalRegression, i.e. containing
+    'filtered_func_data.nii.gz', 'melodic_mix' and the motion parameters from
+    MCFLIRT in 'mc/prefiltered_func_data_mcf.par', along with the FIX
+    labelled components file (returned)
+
+    Parameters
+    ----------
+    path : str
+        Directory to create
+    shape : tuple(int)
+        The shape of the functional data
+    num_components : int
+        The number of ICA components in the mixing matrix
+    num_bad : int
+        The number of components labelled as noise
+    """
+    state = rng(seed)
+    os.makedirs(op.join(path, 'mc'), exist_ok=True)
+    nifti_4d(op.join(path, 'filtered_func_data.nii.gz'), shape, seed=seed,
+             tr=tr)
+    np.savetxt(op.join(path, 'melodic_mix'),
+               state.standard_normal((shape[3], num_components)))
+    np.savetxt(op.join(path, 'mc', 'prefiltered_func_data_mcf.par'),
+               np.cumsum(state.standard_normal((shape[3], 6)) * 0.01,
+                         axis=0))
+    labels = op.join(op.dirname(path), 'labelled_components.txt')
+    bad = sorted(state.choice(np.arange(1, num_components + 1), num_bad,
+                              replace=False).tolist())
+    with open(labels, 'w') as f:
+        f.write('filtered_func_data.ica\n')
+        for i in range(1, num_components + 1):
+            f.write('{}, {}, {}\n'.format(
+                i, 'Unclassified noise' if i in bad else 'Signal',
+                i in bad))
+        f.write('{}\n'.format(bad))
+    return labels
+
@@ -3,7 +3,6 @@ Created on 18Nov.,2016
 
 @author: sforaz
 '''
-from scipy import signal
 import matplotlib.pyplot as plot
 import glob
 import os
@@ -11,9 +10,9 @@ import scipy.io
 from scipy.signal import argrelextrema, resample
 import numpy as np
 from sklearn import mixture
-import sys
-from sklearn.covariance import graph_lasso  # , GraphLassoCV
 from scipy.spatial.distance import pdist, squareform
+from banana.interfaces.custom.dynamic_fc import (
+    windowed_fc, select_gmm, mat2vec, vec2mat)
 # from numbapro import jit, float32
 
 
@@ -58,49 +57,8 @@ class DynamicFC:
         self.ica = ica
         self.resampled_mat = []
 
-    @staticmethod
-    def mat2vec(mat):
-        """
-        vec = mat2vec(mat)
-        returns the lower triangle of mat
-        mat should be square
-        """
-        [n, m] = mat.shape
-
-        if n != m:
-            print('Error: mat must be square!')
-            return False
-
-        temp = np.ones((n, n))
-        #  find the indices of the lower triangle of the matrix
-        IND = np.where((temp-np.triu(temp)) > 0)
-
-        vec = mat[IND]
-
-        return vec
-
-    @staticmethod
-    def vec2mat(vec, symmetric):
-        """
-        mat = vec2mat(vec,1)
-        returns full matrix starting from a vector
-        """
-        N = len(vec)
-        n_comp = int(0.5+np.sqrt(1+8*N)/2)
-        mat = np.zeros((n_comp, n_comp))
-
-        temp = np.ones((n_comp, n_comp))
-
-        IND = np.where((temp-np.triu(temp)) > 0)
-
-        mat[IND] = vec
-
-        if symmetric:
-            tempmat = np.flipud(np.rot90(mat))
-            tempmat[IND] = vec
-            mat = np.flipud(np.rot90(tempmat))
-
-        return mat
+    mat2vec = staticmethod(mat2vec)
+    vec2mat = staticmethod(vec2mat)
 
     def load_subjects(self):
 
@@ -138,7 +96,8 @@ class DynamicFC:
         self.tp = n_timepoints
         self.list_subs = list_sub
 
-    def windowed_fc(self, window_tp=60, step=1, sigma=20, method='corr'):
+    def windowed_fc(self, window_tp=60, step=1, sigma=20, method='corr',
+                    num_processes=1):
 
         subs = self.all_subs
         overlap = window_tp-step
@@ -147,77 +106,13 @@ class DynamicFC:
         n_window = int((self.tp-overlap)/(window_tp-overlap))
         cov_mat = (np.zeros((n_sub, n_window-1, (n_ic_components *
                                                  (n_ic_components-1))//2)))
-        # netmat = np.zeros((n_sub, n_ic_components*n_ic_components))
-        gaus_win = signal.gaussian((window_tp), std=sigma)
-        rect = np.ones(window_tp)
-        conv_gaus = signal.convolve(rect, gaus_win, 'same')
-        conv_gaus = conv_gaus/conv_gaus.max()
-
+        # All windows of each subject are computed at once by the
+        # vectorised kernel
         for j in range(n_sub):
-            sub = subs[j*self.tp:(j+1)*self.tp, :]
-            for i in range(n_window-1):
-                sub_window = sub[i*(window_tp-overlap):(i+1) *
-                                 (window_tp-overlap)+overlap, :]
-                sub_window = np.multiply(
-                    sub_window, np.tile(conv_gaus, (np.size(sub_window, 1),
-                                                    1)).T)
-                if method == 'corr':
-                    cov_1 = np.corrcoef(sub_window.T)
-                    cov_1[np.eye(n_ic_components) > 0] = 0
-                    cov_1 = self.mat2vec(cov_1)
-                    cov_1 = np.arctanh(cov_1)
-                    # cov_1=cov_1-np.mean(cov_1)
-                    # cov_1=cov_1/np.std(cov_1)
-                    cov_mat[j, i, :] = cov_1
-                if method == 'part_corr':
-                    cov_1 = np.cov(sub_window.T)
-                    cov_1 = - np.linalg.inv(cov_1)
-                    cov_1 = (
-                        cov_1 / np.tile(np.sqrt(np.abs(np.diag(cov_1))),
-                                        (n_ic_components, 1)).T)/np.tile(
-                                            np.sqrt(np.abs(np.diag(cov_1))),
-                                            (n_ic_components, 1))
-                    cov_1[np.eye(n_ic_components) > 0] = 0
-                    cov_1 = self.mat2vec(cov_1)
-                    cov_1 = np.arctanh(cov_1)
-                    # cov_1=cov_1-np.mean(cov_1)
-                    # cov_1=cov_1/np.std(cov_1)
-                    cov_mat[j, i, :] = cov_1
-                elif method == 'reg_pc':
-                    cov_true = np.cov(sub_window.T)
-                    cov_true = cov_true/np.mean(np.diag(cov_true))
-                    # GL = GraphLassoCV()
-                    # gl_fit = GL.fit(cov_true)
-                    # cov_1 = gl_fit.get_precision()
-                    cov, cov_1 = graph_lasso(cov_true, 0.00001, max_iter=500,
-                                             tol=0.005)
-                    cov_1 = -(
-                        (cov_1 / np.tile(np.sqrt(np.abs(np.diag(cov_1))),
-                                         (n_ic_components, 1)).T) /
-                        np.tile(np.sqrt(np.abs(np.diag(cov_1))),
-                                (n_ic_components, 1)))
-                    cov_1[np.eye(n_ic_components) > 0] = 0
-                    cov_1 = self.mat2vec(cov_1)
-                    cov_1 = np.arctanh(cov_1)
-                    cov_mat[j, i, :] = cov_1
-                elif method == 'ridge_pc':
-                    cov_true = np.cov(sub_window.T)
-                    cov_true = cov_true/np.sqrt(np.mean(np.diag(
-                        np.square(cov_true))))
-                    cov_1 = - np.linalg.inv(cov_true+0.1*np.eye(
-                        n_ic_components))
-                    cov_1 = (
-                        cov_1 / np.tile(np.sqrt(np.abs(np.diag(cov_1))),
-                                        (n_ic_components, 1)).T)/np.tile(
-                                           np.sqrt(np.abs(np.diag(cov_1))),
-                                           (n_ic_components, 1))
-                    cov_1[np.eye(n_ic_components) > 0] = 0
-                    cov_1 = self.mat2vec(cov_1)
-                    cov_1 = np.arctanh(cov_1)
-                    # cov_1=cov_1-np.mean(cov_1)
-                    # cov_1=cov_1/np.std(cov_1)
-                    cov_mat[j, i, :] = cov_1
-
+            cov_mat[j] = windowed_fc(
+                subs[j * self.tp:(j + 1) * self.tp, :], window_tp,
+                step=step, sigma=sigma, method=method,
+                num_processes=num_processes)[:n_window - 1]
         self.covariance_mat = cov_mat
 
     def subsampling(self):
@@ -243,13 +138,15 @@ class DynamicFC:
 
         # self.resampled_mat = resampled_mat
 
-    def find_num_clusters_gmm(self, components=13):
+    def find_num_clusters_gmm(self, components=13, num_processes=1):
             """Function to find the best parameters for your GMM.
            Input:
                components: number of components with which you want to test
                your model. For example, if you choose 10,
                the function will fit up to 10 components into your data and
                returns the best choice of parameters.
+               num_processes: number of processes to fit the grid of models
+               over.
            Usage:
 
            bic,best_parameters,best_gmm=dynamic.find_num_clusters_gmm(10)
@@ -259,33 +156,12 @@ class DynamicFC:
             else:
                 mat = self.covariance_mat
 
-            lowest_bic = np.infty
-            bic = []
-            n_components_range = range(1, int(components))
-            cv_types = ['spherical', 'tied', 'diag', 'full']
-            # cv_types = ['full']
-
-            for cv_type in cv_types:
-                for n_components in n_components_range:
-                    # Fit a mixture of Gaussians with EM
-                    sys.stdout.write(
-                        "\r" + cv_type+', components: '+str(n_components))
-                    # sys.stdout.flush()
-                    gmm = mixture.GaussianMixture(n_components=n_components,
-                                                  covariance_type=cv_type)
-                    gmm.fit(mat)
-                    bic.append(gmm.bic(mat))
-                    if bic[-1] < lowest_bic:
-                        lowest_bic = bic[-1]
-                        best_gmm = gmm
-                        best_parameters = [n_components, cv_type]
-                    sys.stdout.flush()
-                # sys.stdout.flush()
-
-            bic = np.array(bic)
-            best_parameters = np.array(best_parameters)
-
-            self.bic = np.array(bic)
+            bic, best_gmm = select_gmm(mat, max_components=int(components),
+                                       num_processes=num_processes)
+            best_parameters = [best_gmm.n_components,
+                               best_gmm.covariance_type]
+
+            self.bic = bic.ravel()
             self.best_parameters = np.array(best_parameters)
             self.best_gmm = best_gmm
             self.best_gmm_weights = best_gmm.weights_
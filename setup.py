@@ -15,7 +15,7 @@ setup(
     version=__version__,
     author='Tom G. Close',
     author_email='tom.g.close@gmail.com',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     url='https://github.com/MonashBI/{}'.format(PACKAGE_NAME),
     license='The Apache Software Licence 2.0',
     description=(
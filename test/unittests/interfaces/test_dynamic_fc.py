@@ -0,0 +1,130 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+import numpy as np
+from banana.interfaces.custom.dynamic_fc import (
+    windowed_fc, fc_taper, mat2vec, vec2mat, window_covariances,
+    graphical_lasso, select_gmm, DynamicFCStates, GMM_COVARIANCE_TYPES)
+try:
+    import sklearn
+except ImportError:
+    sklearn = None
+
+
+def reference_windowed_fc(tc, window_tp, step, sigma, method='corr'):
+    taper = fc_taper(window_tp, sigma)
+    fc = []
+    for start in range(0, len(tc) - window_tp + 1, step):
+        window = tc[start:start + window_tp] * taper[:, None]
+        if method == 'corr':
+            mat = np.corrcoef(window.T)
+        else:
+            cov = np.cov(window.T)
+            if method == 'ridge_pc':
+                cov = (cov / np.sqrt(np.mean(np.diag(cov) ** 2)) +
+                       0.1 * np.eye(len(cov)))
+            precision = -np.linalg.inv(cov)
+            diag = np.sqrt(np.abs(np.diag(precision)))
+            mat = precision / np.outer(diag, diag)
+        fc.append(np.arctanh(mat2vec(mat)))
+    return np.array(fc)
+
+
+class TestWindowedFC(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.tc = rng.randn(200, 8).dot(rng.randn(8, 8)) + 10.0
+
+    def test_rectangular(self):
+        for step in (1, 3):
+            fc = windowed_fc(self.tc, 45, step=step)
+            self.assertEqual(fc.dtype, np.float32)
+            ref = reference_windowed_fc(self.tc, 45, step, None)
+            self.assertEqual(fc.shape, ref.shape)
+            self.assertTrue(np.allclose(fc, ref, atol=1e-5))
+
+    def test_tapered(self):
+        for step in (1, 4):
+            fc = windowed_fc(self.tc, 45, step=step, sigma=14)
+            ref = reference_windowed_fc(self.tc, 45, step, 14)
+            self.assertEqual(fc.shape, ref.shape)
+            self.assertTrue(np.allclose(fc, ref, atol=1e-5))
+
+    def test_partial_correlation(self):
+        for method in ('part_corr', 'ridge_pc'):
+            fc = windowed_fc(self.tc, 45, step=2, sigma=14, method=method)
+            ref = reference_windowed_fc(self.tc, 45, 2, 14, method=method)
+            self.assertTrue(np.allclose(fc, ref, atol=1e-3))
+
+    def test_graphical_lasso(self):
+        alpha = 0.05
+        covs = window_covariances(self.tc, 45, step=5, sigma=14)
+        state = None
+        off_diag = ~np.eye(self.tc.shape[1], dtype=bool)
+        for cov in covs:
+            cov = cov / np.mean(np.diag(cov))
+            # Warm-started from the previous window
+            precision, state = graphical_lasso(cov, alpha, init=state,
+                                               tol=1e-7, max_iter=5000)
+            # Check the optimality conditions of the lasso problem
+            grad = (cov - np.linalg.inv(precision))[off_diag]
+            nonzero = precision[off_diag] != 0
+            self.assertTrue(np.allclose(
+                grad[nonzero], -alpha * np.sign(precision[off_diag][nonzero]),
+                atol=1e-4))
+            self.assertTrue(np.all(np.abs(grad[~nonzero]) <= alpha + 1e-4))
+
+    def test_graphical_lasso_chains(self):
+        single = windowed_fc(self.tc, 45, step=5, sigma=14, method='reg_pc',
+                             alpha=0.05)
+        multi = windowed_fc(self.tc, 45, step=5, sigma=14, method='reg_pc',
+                            alpha=0.05, num_processes=2)
+        self.assertEqual(single.shape, multi.shape)
+        self.assertTrue(np.allclose(single, multi, atol=0.05))
+
+    @skipIf(sklearn is None, "scikit-learn is not installed")
+    def test_select_gmm(self):
+        rng = np.random.RandomState(2)
+        samples = np.concatenate([rng.randn(100, 3) + c
+                                  for c in ((0, 0, 0), (8, 8, 8))])
+        bic, best = select_gmm(samples, max_components=4,
+                               covariance_types=('diag', 'full'),
+                               num_processes=2, seed=0)
+        self.assertEqual(bic.shape, (2, 3))
+        self.assertEqual(best.n_components, 2)
+
+    @skipIf(sklearn is None, "scikit-learn is not installed")
+    def test_states(self):
+        tmp_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(tmp_dir)
+            rng = np.random.RandomState(3)
+            in_files = []
+            for i in range(2):
+                path = op.join(tmp_dir, 'fc{}.npy'.format(i))
+                np.save(path, np.concatenate([rng.randn(30, 3) + c
+                                              for c in (0, 8)]))
+                in_files.append(path)
+            out_dir = DynamicFCStates(in_files=in_files, max_states=4,
+                                      seed=0).run().outputs.out_dir
+            with open(op.join(out_dir, 'BIC.txt')) as f:
+                header = f.readline()
+            self.assertEqual(header.split()[1:],
+                             ['num_states'] + list(GMM_COVARIANCE_TYPES))
+            bic = np.loadtxt(op.join(out_dir, 'BIC.txt'))
+            # One row per number of states
+            self.assertEqual(bic.shape, (3, len(GMM_COVARIANCE_TYPES) + 1))
+            self.assertTrue(np.array_equal(bic[:, 0], [1, 2, 3]))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp_dir)
+
+    def test_vec2mat(self):
+        vecs = np.random.RandomState(1).randn(5, 28)
+        mats = vec2mat(vecs)
+        self.assertTrue(np.array_equal(mats, mats.transpose(0, 2, 1)))
+        self.assertTrue(np.array_equal(mat2vec(mats), vecs))
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from scipy.signal import detrend
+from banana.interfaces.fsl import SignalRegression, gaussian_highpass_matrix
+from banana.utils.nifti import iter_volume_chunks
+
+
+def normalise(params):
+    return (params - params.mean(axis=0)) / params.std(axis=0, ddof=1)
+
+
+class TestSignalRegression(TestCase):
+
+    NUM_VOLS = 60
+    SHAPE = (6, 5, 4, NUM_VOLS)
+    BAD_COMPONENTS = [1, 3, 4]
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Tests change into the temporary directory
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fix_dir = os.path.join(self.tmp_dir, 'fix')
+        os.makedirs(os.path.join(self.fix_dir, 'mc'))
+        self.data = (rng.rand(*self.SHAPE) * 100).astype(np.float32)
+        nib.save(nib.Nifti1Image(self.data, np.eye(4)),
+                 os.path.join(self.fix_dir, 'filtered_func_data.nii.gz'))
+        self.mix = rng.randn(self.NUM_VOLS, 10)
+        np.savetxt(os.path.join(self.fix_dir, 'melodic_mix'), self.mix)
+        self.motion = rng.randn(self.NUM_VOLS, 6)
+        np.savetxt(os.path.join(self.fix_dir, 'mc',
+                                'prefiltered_func_data_mcf.par'),
+                   self.motion)
+        self.labels = os.path.join(self.tmp_dir, 'labels.txt')
+        with open(self.labels, 'w') as f:
+            f.write('filtered_func_data.ica\n{}\n'.format(
+                self.BAD_COMPONENTS))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_regression(self):
+        os.chdir(self.tmp_dir)
+        SignalRegression(fix_dir=self.fix_dir,
+                         labelled_components=self.labels,
+                         motion_regression=True, highpass=0.0,
+                         chunk_size=7).run()
+        cleaned = np.asanyarray(nib.load(os.path.join(
+            self.fix_dir, 'filtered_func_data_clean.nii.gz')).dataobj)
+        # Reference regression applied to the whole data matrix at once
+        data = self.data.reshape(-1, self.NUM_VOLS, order='F').T
+        confounds = normalise(np.hstack((
+            self.motion, np.vstack((np.zeros(6),
+                                    np.diff(self.motion, axis=0))))))
+        confounds = normalise(np.hstack((confounds, confounds ** 2)))
+        confounds = detrend(confounds, axis=0, type='linear')
+        mix = normalise(self.mix)
+        mix -= confounds.dot(np.linalg.pinv(confounds).dot(mix))
+        data = data - confounds.dot(np.linalg.pinv(confounds).dot(data))
+        betas = np.linalg.pinv(mix).dot(data)
+        bad = [c - 1 for c in self.BAD_COMPONENTS]
+        data -= mix[:, bad].dot(betas[bad])
+        ref = data.T.reshape(self.SHAPE, order='F')
+        self.assertTrue(np.allclose(cleaned, ref, atol=1e-3))
+
+    def test_highpass(self):
+        num_vols = 100
+        highpass = gaussian_highpass_matrix(num_vols, 10.0)
+        # Straight lines are removed entirely
+        line = np.linspace(-5, 20, num_vols)
+        self.assertTrue(np.allclose(highpass.dot(line), 0.0))
+        # Fast oscillations are mostly preserved
+        wave = np.sin(np.arange(num_vols) * np.pi / 2)
+        self.assertTrue(np.allclose(highpass.dot(wave)[30:70],
+                                    wave[30:70], atol=0.05))
+
+    def test_volume_chunks(self):
+        path = os.path.join(self.fix_dir, 'filtered_func_data.nii.gz')
+        chunks = list(iter_volume_chunks(path, 7))
+        self.assertEqual([s for s, _ in chunks],
+                         list(range(0, self.NUM_VOLS, 7)))
+        self.assertTrue(np.array_equal(
+            np.concatenate([c for _, c in chunks]),
+            self.data.reshape(-1, self.NUM_VOLS, order='F').T))
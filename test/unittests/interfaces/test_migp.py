@@ -0,0 +1,87 @@
+import os
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from banana.interfaces.custom.bold import MIGPSubjectReduction, MIGP
+from banana.exceptions import BananaUsageError
+
+
+class TestMIGP(TestCase):
+
+    SHAPE = (8, 8, 6)
+    NUM_VOLS = 100
+    NUM_SUBJECTS = 12
+    NUM_SOURCES = 5
+    MIGP_DIM = 20
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mask = np.ones(self.SHAPE, dtype=np.uint8)
+        self.mask[0] = 0
+        self.mask_file = os.path.join(self.tmp_dir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(self.mask, np.eye(4)), self.mask_file)
+        maps = rng.randn(self.NUM_SOURCES, int(self.mask.sum()))
+        self.in_files = []
+        self.normalised = []
+        for i in range(self.NUM_SUBJECTS):
+            ts = (rng.randn(self.NUM_VOLS, self.NUM_SOURCES).dot(maps) +
+                  0.5 * rng.randn(self.NUM_VOLS, maps.shape[1]))
+            img = np.zeros(self.SHAPE + (self.NUM_VOLS,), dtype=np.float32)
+            img[self.mask > 0] = ts.T
+            path = os.path.join(self.tmp_dir, 'sub{}.nii.gz'.format(i))
+            nib.save(nib.Nifti1Image(img, np.eye(4)), path)
+            self.in_files.append(path)
+            ts = ts - ts.mean(axis=0)
+            self.normalised.append(ts / ts.std(axis=0))
+
+    def test_migp(self):
+        cwd = os.getcwd()
+        reduced = []
+        try:
+            for i, in_file in enumerate(self.in_files):
+                work_dir = os.path.join(self.tmp_dir, 'work{}'.format(i))
+                os.makedirs(work_dir)
+                os.chdir(work_dir)
+                reduced.append(MIGPSubjectReduction(
+                    in_file=in_file, mask_file=self.mask_file,
+                    num_components=self.MIGP_DIM).run().outputs.out_file)
+            os.chdir(self.tmp_dir)
+            out_file = MIGP(
+                in_files=reduced, mask_file=self.mask_file,
+                num_components=self.MIGP_DIM).run().outputs.out_file
+        finally:
+            os.chdir(cwd)
+        out = np.asanyarray(nib.load(out_file).dataobj)
+        self.assertEqual(out.shape, self.SHAPE + (self.MIGP_DIM,))
+        self.assertTrue(np.all(out[self.mask == 0] == 0))
+        # The leading spatial subspace should match that of the PCA of the
+        # full temporally concatenated group data
+        migp = out[self.mask > 0].T
+        _, _, full_vt = np.linalg.svd(np.concatenate(self.normalised),
+                                      full_matrices=False)
+        _, _, migp_vt = np.linalg.svd(migp, full_matrices=False)
+        cosines = np.linalg.svd(full_vt[:self.NUM_SOURCES].dot(
+            migp_vt[:self.NUM_SOURCES].T), compute_uv=False)
+        self.assertGreater(cosines.min(), 0.999)
+
+    def test_tr(self):
+        cwd = os.getcwd()
+        try:
+            os.chdir(self.tmp_dir)
+            reduced = MIGPSubjectReduction(
+                in_file=self.in_files[0], mask_file=self.mask_file,
+                num_components=self.MIGP_DIM).run().outputs.out_file
+            # The joined TRs are passed through so the group ICA runs once
+            outputs = MIGP(in_files=[reduced, reduced],
+                           mask_file=self.mask_file,
+                           num_components=self.MIGP_DIM,
+                           tr=[2.5, 2.5]).run().outputs
+            self.assertEqual(outputs.tr, 2.5)
+            self.assertRaises(
+                BananaUsageError,
+                MIGP(in_files=[reduced, reduced], mask_file=self.mask_file,
+                     num_components=self.MIGP_DIM, tr=[2.5, 3.0]).run)
+        finally:
+            os.chdir(cwd)
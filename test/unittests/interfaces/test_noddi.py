@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from scipy.optimize import nnls
+from banana.interfaces.noddi import (
+    fibonacci_hemisphere, noddi_dictionary, noddi_dictionary_path, fit_noddi,
+    batch_nnls, NumpyCreateROI, AmicoNODDIFitting, NumpySaveParamsAsNIfTI)
+
+
+class TestAmicoNODDI(TestCase):
+
+    def setUp(self):
+        # Tests change into the temporary directory
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.bvals = np.r_[np.zeros(3), np.full(20, 700.0),
+                           np.full(30, 2000.0)]
+        self.bvecs = np.column_stack((
+            np.zeros((3, 3)), fibonacci_hemisphere(20).T,
+            fibonacci_hemisphere(30).T))
+        self.dictionary = noddi_dictionary(self.bvals, self.bvecs,
+                                           num_dirs=100,
+                                           cache_dir=self.cache_dir)
+        # Synthesise voxels from random dictionary atoms with free water,
+        # excluding the near-isotropic atoms (ODI > 0.9), which are
+        # degenerate with the isotropic compartment
+        rng = np.random.RandomState(0)
+        num_voxels = 60
+        self.dir_indices = rng.randint(100, size=num_voxels)
+        self.atom_indices = rng.randint(120, size=num_voxels)
+        self.fiso = rng.uniform(0.0, 0.3, size=num_voxels)
+        atoms = self.dictionary['atoms']
+        self.signals = 500.0 * (
+            (1.0 - self.fiso[:, None]) *
+            atoms[self.dir_indices, :, self.atom_indices] +
+            self.fiso[:, None] * atoms[0, :, -1])
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dictionary_cache(self):
+        path = noddi_dictionary_path(self.bvals, self.bvecs, self.cache_dir,
+                                     num_dirs=100)
+        self.assertTrue(os.path.exists(path))
+        cached = noddi_dictionary(self.bvals, self.bvecs, num_dirs=100,
+                                  cache_dir=self.cache_dir)
+        self.assertTrue(np.array_equal(cached['atoms'],
+                                       self.dictionary['atoms']))
+        # b=0 volumes are unattenuated
+        self.assertTrue(np.allclose(self.dictionary['atoms'][:, :3], 1.0))
+
+    def test_batch_nnls(self):
+        rng = np.random.RandomState(1)
+        atoms = self.dictionary['atoms'][0]
+        targets = (self.signals / 500.0 +
+                   0.02 * rng.randn(*self.signals.shape))
+        coefs = batch_nnls(atoms, targets)
+        self.assertTrue(np.all(coefs >= 0))
+        # Reaches the same minimum as fitting each target separately
+        residual = np.sum((coefs.dot(atoms.T) - targets) ** 2, axis=1)
+        expected = np.array([nnls(atoms, t)[1] ** 2 for t in targets])
+        self.assertTrue(np.allclose(residual, expected, rtol=1e-6,
+                                    atol=1e-12))
+
+    def test_fit(self):
+        params = fit_noddi(self.signals, self.bvals, self.bvecs,
+                           self.dictionary)
+        self.assertFalse(params['error_code'].any())
+        self.assertTrue(np.allclose(
+            params['ficvf'], self.dictionary['icvfs'][self.atom_indices],
+            atol=0.05))
+        self.assertTrue(np.allclose(
+            params['odi'], self.dictionary['ods'][self.atom_indices],
+            atol=0.05))
+        self.assertTrue(np.allclose(params['fiso'], self.fiso, atol=0.05))
+
+    def test_interfaces(self):
+        affine = np.diag([2.0, 2.0, 2.0, 1.0])
+        mask = np.zeros((5, 4, 4), dtype=np.uint8)
+        mask.ravel()[:len(self.signals)] = 1
+        data = np.zeros(mask.shape + (len(self.bvals),), dtype=np.float32)
+        data[mask > 0] = self.signals
+        dwi_path = os.path.join(self.tmp_dir, 'dwi.nii.gz')
+        mask_path = os.path.join(self.tmp_dir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(data, affine), dwi_path)
+        nib.save(nib.Nifti1Image(mask, affine), mask_path)
+        bvals_path = os.path.join(self.tmp_dir, 'bvals')
+        bvecs_path = os.path.join(self.tmp_dir, 'bvecs')
+        np.savetxt(bvals_path, self.bvals[None, :])
+        np.savetxt(bvecs_path, self.bvecs)
+        os.chdir(self.tmp_dir)
+        roi = NumpyCreateROI(in_file=dwi_path, brain_mask=mask_path).run()
+        fit = AmicoNODDIFitting(
+            roi_file=roi.outputs.out_file, bvals_file=bvals_path,
+            bvecs_file=bvecs_path, num_dirs=100, cache_dir=self.cache_dir,
+            chunk_size=20, num_processes=2).run()
+        save = NumpySaveParamsAsNIfTI(
+            params_file=fit.outputs.out_file,
+            roi_file=roi.outputs.out_file, brain_mask_file=mask_path).run()
+        fiso = np.asanyarray(nib.load(save.outputs.fiso).dataobj)
+        self.assertEqual(fiso.shape, mask.shape)
+        self.assertTrue(np.allclose(fiso[mask > 0], self.fiso, atol=0.05))
+        self.assertTrue(np.all(fiso[mask == 0] == 0))
@@ -0,0 +1,80 @@
+import os.path as op
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from nipype.pipeline.engine import Node
+from banana.interfaces.custom import qsm
+
+
+class TestNativeQSM(TestCase):
+
+    shape = (48, 48, 40)
+    voxelsize = (1.0, 1.0, 1.0)
+    te = 0.02
+    b0 = 3.0
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        x, y, z = np.meshgrid(*(np.arange(n) - n / 2 for n in self.shape),
+                              indexing='ij')
+        self.grid = (x, y, z)
+        self.brain = (x ** 2 + y ** 2) / 20.0 ** 2 + z ** 2 / 16.0 ** 2 < 1
+        self.chi = np.zeros(self.shape, dtype=np.float32)
+        self.chi[(x - 4) ** 2 + y ** 2 + z ** 2 < 25] = 0.1
+        self.chi[(x + 6) ** 2 + (y - 5) ** 2 + z ** 2 < 9] = -0.05
+        dipole = qsm.dipole_kernel(self.shape, self.voxelsize,
+                                   (0.0, 0.0, 1.0))
+        field = np.fft.irfftn(np.fft.rfftn(self.chi) * dipole,
+                              s=self.shape, axes=(0, 1, 2))
+        self.local_phase = field * (2 * np.pi * qsm.GYROMAGNETIC_RATIO *
+                                    self.b0 * self.te * 1e-6)
+        # Add a harmonic (linear) background field
+        self.phase = (self.local_phase + 0.4 * x + 0.1 * y) * self.brain
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save(self, array, name):
+        path = op.join(self.tmp_dir, name)
+        nib.save(nib.Nifti1Image(np.asarray(array, dtype=np.float32),
+                                 np.eye(4)), path)
+        return path
+
+    def test_unwrap(self):
+        x, y, z = self.grid
+        true = 8 * np.exp(-(x ** 2 + y ** 2 + z ** 2) / (2 * 8.0 ** 2))
+        # Each image in the batch is unwrapped independently
+        unwrapped = qsm.laplacian_unwrap(
+            np.angle(np.exp(1j * np.array([true, -0.5 * true]))).astype(
+                np.float32), self.voxelsize)
+        for array, scale in zip(unwrapped, (1.0, -0.5)):
+            diff = (array - scale * true)[self.brain]
+            self.assertLess(np.abs(diff - diff.mean()).max(), 0.05)
+
+    def test_vsharp(self):
+        local, new_mask = qsm.vsharp(self.phase[None].astype(np.float32),
+                                     self.brain[None], self.voxelsize)
+        self.assertTrue(new_mask[0].sum() < self.brain.sum())
+        self.assertFalse((new_mask[0] & ~self.brain).any())
+        self.assertGreater(np.corrcoef(local[0][new_mask[0]],
+                                       self.local_phase[new_mask[0]])[0, 1],
+                           0.9)
+
+    def test_interface(self):
+        wrapped = np.angle(np.exp(1j * self.phase))
+        in_files = [self.save(wrapped, 'phase{}.nii.gz'.format(i))
+                    for i in range(2)]
+        node = Node(qsm.NativeQSM(
+            in_files=in_files, masks=[self.save(self.brain, 'mask.nii.gz')],
+            voxelsize=list(self.voxelsize), echo_times=[self.te],
+            B0=self.b0, H=[0.0, 0.0, 1.0], num_threads=2),
+            name='qsm', base_dir=self.tmp_dir)
+        outputs = node.run().outputs
+        self.assertEqual(len(outputs.out_files), 2)
+        mask = nib.load(outputs.new_mask).get_fdata() > 0
+        chis = [nib.load(f).get_fdata() for f in outputs.out_files]
+        self.assertTrue(np.allclose(chis[0], chis[1], atol=1e-5))
+        self.assertGreater(np.corrcoef(chis[0][mask], self.chi[mask])[0, 1],
+                           0.85)
@@ -0,0 +1,99 @@
+import os
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from banana.interfaces.custom.bold import TemporalFilter, tproject_regressors
+
+
+class TestTemporalFilter(TestCase):
+
+    SHAPE = (7, 6, 5, 80)
+    TR = 2.0
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.tmp_dir = tempfile.mkdtemp()
+        t = np.arange(self.SHAPE[3]) * self.TR
+        self.data = (
+            rng.randn(*self.SHAPE) +
+            100.0 * rng.rand(*self.SHAPE[:3])[..., None] +
+            np.sin(2 * np.pi * 0.005 * t) * 5.0 +
+            0.01 * t).astype(np.float32)
+        self.mask = np.zeros(self.SHAPE[:3], dtype=np.uint8)
+        self.mask[1:-1, 1:-1, 1:-1] = 1
+        self.in_file = os.path.join(self.tmp_dir, 'mc.nii.gz')
+        self.mask_file = os.path.join(self.tmp_dir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(self.data, np.diag([2., 2., 3., 1.])),
+                 self.in_file)
+        nib.save(nib.Nifti1Image(self.mask, np.diag([2., 2., 3., 1.])),
+                 self.mask_file)
+
+    def _run(self, out_fname='filtered.nii.gz', **kwargs):
+        out_file = os.path.join(self.tmp_dir, out_fname)
+        kwargs.setdefault('chunk_size', 7)
+        TemporalFilter(in_file=self.in_file, mask=self.mask_file,
+                       delta_t=self.TR, polort=3, stopband=(0, 0.01),
+                       out_file=out_file, **kwargs).run()
+        return np.asanyarray(nib.load(out_file).dataobj)
+
+    def test_filter(self):
+        out = self._run()
+        regressors = tproject_regressors(self.SHAPE[3], self.TR, polort=3,
+                                         stopband=(0, 0.01))
+        mask = self.mask > 0
+        ts = self.data[mask].T.astype(float)
+        resid = ts - regressors.dot(np.linalg.lstsq(regressors, ts,
+                                                    rcond=None)[0])
+        mean = self.data.mean(axis=3)
+        self.assertTrue(np.allclose(out[mask], resid.T + mean[mask][:, None],
+                                    atol=1e-3))
+        self.assertTrue(np.allclose(out[~mask], mean[~mask][:, None],
+                                    atol=1e-3))
+        # The slow drift and the 0.005 Hz oscillation are removed
+        self.assertLess(np.abs(resid.mean(axis=1)).max(), 0.5)
+
+    def test_blur(self):
+        out = self._run(blur=4.0, add_mean=False)
+        mask = self.mask > 0
+        self.assertTrue(np.all(out[~mask] == 0))
+        unblurred = self._run(add_mean=False)
+        # Blurring averages out the independent noise between voxels
+        self.assertLess(out[mask].std(), unblurred[mask].std())
+
+    def test_output_image(self):
+        # The output is written a volume at a time with the geometry of the
+        # input, either gzipped or not
+        out = self._run()
+        self.assertTrue(np.array_equal(self._run('filtered.nii'), out))
+        img = nib.load(os.path.join(self.tmp_dir, 'filtered.nii'))
+        self.assertEqual(img.shape, self.SHAPE)
+        self.assertEqual(img.get_data_dtype(), np.float32)
+        self.assertTrue(np.allclose(img.affine, np.diag([2., 2., 3., 1.])))
+
+    def test_chunk_sizes(self):
+        # The input is streamed in chunks of volumes and projected in blocks
+        # of voxels, neither of which should change the result
+        out = self._run()
+        for volume_chunk_size in (1, 13, 80):
+            self.assertTrue(np.allclose(
+                self._run(volume_chunk_size=volume_chunk_size,
+                          chunk_size=100), out, atol=1e-3))
+
+    def test_passband(self):
+        # With a narrow passband there are more nuisance regressors than
+        # retained components, so the complement basis is used instead
+        out_file = os.path.join(self.tmp_dir, 'passband.nii.gz')
+        TemporalFilter(in_file=self.in_file, mask=self.mask_file,
+                       delta_t=self.TR, polort=2, passband=(0.01, 0.05),
+                       add_mean=False, volume_chunk_size=9,
+                       out_file=out_file).run()
+        out = np.asanyarray(nib.load(out_file).dataobj)
+        regressors = tproject_regressors(self.SHAPE[3], self.TR, polort=2,
+                                         passband=(0.01, 0.05))
+        self.assertGreater(regressors.shape[1], self.SHAPE[3] // 2)
+        mask = self.mask > 0
+        ts = self.data[mask].T.astype(float)
+        resid = ts - regressors.dot(np.linalg.lstsq(regressors, ts,
+                                                    rcond=None)[0])
+        self.assertTrue(np.allclose(out[mask], resid.T, atol=1e-3))
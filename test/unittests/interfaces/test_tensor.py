@@ -0,0 +1,108 @@
+import os
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from nipype.interfaces.base import isdefined
+from banana.interfaces.custom.dwi import (
+    tensor_design_matrix, fit_tensors, tensor_metrics, DiffusionTensorFit,
+    fsl_to_scanner_bvecs)
+
+
+def tensor_params(tensor):
+    return np.array([tensor[0, 0], tensor[1, 1], tensor[2, 2], tensor[0, 1],
+                     tensor[0, 2], tensor[1, 2]])
+
+
+class TestDiffusionTensorFit(TestCase):
+
+    EVALS = np.array([1.7e-3, 0.3e-3, 0.3e-3])
+    S0 = 1000.0
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        num_dirs = 30
+        bvecs = rng.normal(size=(3, num_dirs))
+        bvecs /= np.linalg.norm(bvecs, axis=0)
+        bvecs[:, :3] = 0.0
+        self.bvecs = bvecs
+        self.bvals = np.r_[np.zeros(3), np.full(num_dirs - 3, 1000.0)]
+        self.design = tensor_design_matrix(self.bvals, self.bvecs)
+        # Rotate the tensor so the principal axis lies along (1, 1, 0)
+        rot = np.array([[1, -1, 0], [1, 1, 0], [0, 0, np.sqrt(2)]])
+        rot /= np.sqrt(2)
+        self.tensor = rot.dot(np.diag(self.EVALS)).dot(rot.T)
+        self.params = np.r_[tensor_params(self.tensor), np.log(self.S0)]
+        self.signal = np.exp(self.design.dot(self.params))
+
+    def test_fit(self):
+        signals = np.tile(self.signal, (10, 1))
+        for method in ('ols', 'wls'):
+            params = fit_tensors(signals, self.design, method=method)
+            self.assertTrue(np.allclose(params, self.params))
+
+    def test_metrics(self):
+        fa, md, ad, rd, evec = tensor_metrics(self.params[None, :])
+        self.assertAlmostEqual(md[0], self.EVALS.mean())
+        self.assertAlmostEqual(ad[0], self.EVALS[0])
+        self.assertAlmostEqual(rd[0], self.EVALS[1])
+        self.assertAlmostEqual(
+            fa[0], np.sqrt(1.5 * np.sum((self.EVALS - self.EVALS.mean()) ** 2)
+                           / np.sum(self.EVALS ** 2)))
+        self.assertAlmostEqual(abs(evec[0].dot([1, 1, 0])), np.sqrt(2))
+
+    def test_scanner_bvecs(self):
+        # FSL gradients are the same for an image stored in radiological
+        # (LAS) and neurological (RAS) order, and so are the scanner ones
+        bvecs = self.bvecs[:, 3:]
+        scanner = fsl_to_scanner_bvecs(bvecs, np.diag([-2.0, 2.0, 2.0, 1.0]))
+        self.assertTrue(np.allclose(scanner, bvecs * [[-1], [1], [1]]))
+        self.assertTrue(np.allclose(
+            fsl_to_scanner_bvecs(bvecs, np.diag([2.0, 2.0, 2.0, 1.0])),
+            scanner))
+
+    def test_interface(self):
+        tmp_dir = tempfile.mkdtemp()
+        orig_dir = os.getcwd()
+        try:
+            os.chdir(tmp_dir)
+            # An oblique image stored in radiological order
+            angle = np.pi / 6
+            rotation = np.array([[np.cos(angle), -np.sin(angle), 0],
+                                 [np.sin(angle), np.cos(angle), 0],
+                                 [0, 0, 1]]).dot(np.diag([-1.0, 1.0, 1.0]))
+            affine = np.eye(4)
+            affine[:3, :3] = rotation * 2.0
+            data = np.tile(self.signal, (4, 5, 3, 1)).astype(np.float32)
+            nib.save(nib.Nifti1Image(data, affine), 'dwi.nii.gz')
+            mask = np.zeros(data.shape[:3], dtype=np.uint8)
+            mask[1:3, 1:4, :] = 1
+            nib.save(nib.Nifti1Image(mask, affine), 'mask.nii.gz')
+            np.savetxt('grads.bvec', self.bvecs)
+            np.savetxt('grads.bval', self.bvals[None, :])
+            result = DiffusionTensorFit(
+                in_file='dwi.nii.gz', in_mask='mask.nii.gz',
+                grad_fsl=('grads.bvec', 'grads.bval'), chunk_size=7,
+                num_processes=2).run()
+            tensor = nib.load(result.outputs.tensor).get_fdata()
+            self.assertEqual(tensor.shape, data.shape[:3] + (6,))
+            # The tensor is output in scanner coordinates
+            expected = tensor_params(
+                rotation.dot(self.tensor).dot(rotation.T))
+            self.assertTrue(np.allclose(tensor[mask > 0], expected))
+            self.assertTrue(np.all(tensor[mask == 0] == 0))
+            adc = nib.load(result.outputs.adc).get_fdata()
+            self.assertTrue(np.allclose(adc[mask > 0], self.EVALS.mean()))
+            # Only the tensor is written if the metrics aren't required
+            os.mkdir('tensor_only')
+            os.chdir('tensor_only')
+            result = DiffusionTensorFit(
+                in_file='../dwi.nii.gz', in_mask='../mask.nii.gz',
+                grad_fsl=('../grads.bvec', '../grads.bval'),
+                metrics=False).run()
+            self.assertTrue(np.allclose(
+                nib.load(result.outputs.tensor).get_fdata(), tensor))
+            self.assertFalse(isdefined(result.outputs.fa))
+            self.assertEqual(os.listdir('.'), ['tensor.nii.gz'])
+        finally:
+            os.chdir(orig_dir)
@@ -0,0 +1,120 @@
+import os
+import os.path as op
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from nipype.pipeline.engine import Node
+from banana.interfaces.custom.coils import ToPolarCoords
+from banana.utils.archive import NiftiSource
+
+
+class TestToPolarCoords(TestCase):
+
+    shape = (6, 7, 5)
+    num_channels = 3
+    num_echoes = 2
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.channels_dir = op.join(self.tmp_dir, 'channels')
+        os.makedirs(self.channels_dir)
+        state = np.random.RandomState(0)
+        self.affine = np.diag([2.0, 2.0, 3.0, 1.0])
+        self.cmplx = {}
+        for echo in range(self.num_echoes):
+            for channel in range(self.num_channels):
+                cmplx = (state.standard_normal(self.shape) +
+                         state.standard_normal(self.shape) * 1j) * 100.0
+                self.cmplx[(channel, echo)] = cmplx
+                for axis, data in (('REAL', cmplx.real),
+                                   ('IMAGINARY', cmplx.imag)):
+                    nib.save(nib.Nifti1Image(data.astype(np.float32),
+                                             self.affine),
+                             op.join(self.channels_dir,
+                                     'coil_{}_{}_{}.nii.gz'.format(
+                                         channel, echo, axis)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def archive(self, ext):
+        path = op.join(self.tmp_dir, 'channels' + ext)
+        fnames = sorted(os.listdir(self.channels_dir))
+        if ext == '.zip':
+            with zipfile.ZipFile(path, 'w') as zf:
+                for fname in fnames:
+                    zf.write(op.join(self.channels_dir, fname),
+                             op.join('channels', fname))
+        else:
+            with tarfile.open(path, 'w:gz') as tf:
+                for fname in fnames:
+                    tf.add(op.join(self.channels_dir, fname),
+                           op.join('channels', fname))
+        return path
+
+    def run_node(self, name, **inputs):
+        node = Node(ToPolarCoords(
+            in_fname_re=(r'coil_(?P<channel>\d+)_(?P<echo>\d+)_'
+                         r'(?P<axis>[A-Z]+)\.nii\.gz'), **inputs),
+            name=name, base_dir=self.tmp_dir)
+        return node.run().outputs
+
+    def test_archives(self):
+        ref = self.run_node('dir', in_dir=self.channels_dir)
+        self.assertEqual(len(ref.coil_magnitudes), self.num_echoes)
+        mag = nib.load(ref.coil_magnitudes[1][2])
+        self.assertTrue(np.allclose(mag.get_fdata(),
+                                    np.abs(self.cmplx[(2, 1)]), atol=1e-3))
+        for ext in ('.zip', '.tar.gz'):
+            outputs = self.run_node(
+                ext.replace('.', '_'), in_archive=self.archive(ext),
+                num_threads=4)
+            for ref_paths, paths in zip(
+                    ref.coil_phases + [ref.combined_images],
+                    outputs.coil_phases + [outputs.combined_images]):
+                self.assertEqual([op.basename(p) for p in ref_paths],
+                                 [op.basename(p) for p in paths])
+                for ref_path, path in zip(ref_paths, paths):
+                    self.assertTrue(np.array_equal(
+                        nib.load(ref_path).get_fdata(),
+                        nib.load(path).get_fdata()))
+
+    def test_geometry(self):
+        header_affine = np.array([[0.0, 0.0, 3.0, -10.0],
+                                  [-2.0, 0.0, 0.0, 20.0],
+                                  [0.0, 2.0, 0.0, -30.0],
+                                  [0.0, 0.0, 0.0, 1.0]])
+        header_image = op.join(self.tmp_dir, 'header.nii.gz')
+        nib.save(nib.Nifti1Image(np.zeros(self.shape), header_affine),
+                 header_image)
+        outputs = self.run_node(
+            'geom', in_archive=self.archive('.zip'),
+            flip_dims=['-x', 'y', 'z'], header_image=header_image,
+            reorient_to_std=True, num_threads=2)
+        mag = nib.load(outputs.coil_magnitudes[0][1])
+        self.assertEqual(nib.aff2axcodes(mag.affine), ('L', 'A', 'S'))
+        # The flipped voxel data ends up in the world coordinates of the
+        # header image
+        expected = nib.Nifti1Image(
+            np.abs(self.cmplx[(1, 0)])[::-1], header_affine)
+        expected = nib.as_closest_canonical(expected)
+        self.assertTrue(np.allclose(
+            nib.as_closest_canonical(mag).get_fdata(),
+            expected.get_fdata(), atol=1e-3))
+        self.assertTrue(np.allclose(nib.as_closest_canonical(mag).affine,
+                                    expected.affine))
+
+    def test_source(self):
+        for path in (self.channels_dir, self.archive('.zip'),
+                     self.archive('.tar.gz')):
+            with NiftiSource(path) as source:
+                self.assertEqual(source.names(),
+                                 sorted(os.listdir(self.channels_dir)))
+                img = source.load('coil_0_1_REAL.nii.gz')
+                self.assertTrue(np.allclose(img.affine, self.affine))
+                self.assertTrue(np.allclose(
+                    img.get_fdata(), self.cmplx[(0, 1)].real, atol=1e-3))
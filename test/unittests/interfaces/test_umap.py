@@ -0,0 +1,83 @@
+import os.path as op
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from nipype.pipeline.engine import Node
+from banana.interfaces.umap_calc import CoreUmapCalc
+
+
+def reference_umaps(ute1, ute2, air, bones):
+    "Straightforward float64 implementation of the umap calculation"
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2star = 1000. * (np.log(ute1) - np.log(ute2)) / 2.39
+        r2star[np.isnan(r2star)] = 0
+        u_bone = (0.000001351 * (r2star ** 3) - 0.003617 * (r2star ** 2) +
+                  3.841 * r2star - 19.46)
+        low = u_bone < 1047.
+        u_bone[low] = 0.000096 * (1000. + u_bone[low])
+        high = u_bone >= 1047.
+        u_bone[high] = 0.000051 * (1000. + u_bone[high]) + 0.0471
+        u_bone[u_bone < 0.1134] = 0.1134
+        soft = (1 - bones) * (1 - air) * 0.1
+        cont = 10000. * (u_bone * bones + soft)
+        fixed = 10000. * (0.151 * bones + soft)
+    cont[np.isnan(cont)] = 0
+    fixed[np.isnan(fixed)] = 0
+    return cont, fixed
+
+
+class TestCoreUmapCalc(TestCase):
+
+    shape = (20, 18, 13)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        state = np.random.RandomState(0)
+        self.ute1 = state.uniform(50, 1000, self.shape)
+        self.ute2 = self.ute1 * state.uniform(0.2, 1.0, self.shape)
+        # Include voxels with zero signal and an R2* above the breakpoint
+        self.ute1[0, 0, :] = 0
+        self.ute2[1, 0, :] = 0
+        self.ute2[2, 0, :] = self.ute1[2, 0, :] * 0.01
+        self.air = (state.uniform(size=self.shape) < 0.3).astype(np.uint8)
+        self.bones = ((state.uniform(size=self.shape) < 0.4) &
+                      ~self.air.astype(bool)).astype(np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save(self, array, name):
+        path = op.join(self.tmp_dir, name)
+        nib.save(nib.Nifti1Image(array, np.eye(4)), path)
+        return path
+
+    def run_umap(self, name, **inputs):
+        node = Node(CoreUmapCalc(
+            ute1_reg=self.save(self.ute1.astype(np.float32), 'ute1.nii.gz'),
+            ute2_reg=self.save(self.ute2.astype(np.float32), 'ute2.nii.gz'),
+            air__mask=self.save(self.air, 'air.nii.gz'),
+            bones__mask=self.save(self.bones, 'bones.nii.gz'), **inputs),
+            name=name, base_dir=self.tmp_dir)
+        outputs = node.run().outputs
+        return (nib.load(outputs.sute_cont_template),
+                nib.load(outputs.sute_fix_template))
+
+    def test_umaps(self):
+        ref_cont, ref_fixed = reference_umaps(
+            self.ute1.astype(np.float32).astype(float),
+            self.ute2.astype(np.float32).astype(float),
+            self.air.astype(float), self.bones.astype(float))
+        cont, fixed = self.run_umap('float', slab_size=4)
+        self.assertEqual(cont.get_data_dtype(), np.float32)
+        self.assertTrue(np.allclose(cont.get_fdata(), ref_cont, rtol=1e-4,
+                                    atol=0.5))
+        self.assertTrue(np.allclose(fixed.get_fdata(), ref_fixed, rtol=1e-4,
+                                    atol=0.5))
+        cont, fixed = self.run_umap('int', out_dtype='int16')
+        self.assertEqual(cont.get_data_dtype(), np.int16)
+        self.assertTrue(np.allclose(np.asanyarray(cont.dataobj), ref_cont,
+                                    atol=1))
+        self.assertTrue(np.array_equal(np.asanyarray(fixed.dataobj),
+                                       np.rint(ref_fixed)))
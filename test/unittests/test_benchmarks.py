@@ -0,0 +1,27 @@
+import os
+import tempfile
+from unittest import TestCase
+from benchmarks import base, run
+
+
+class TestBenchmarks(TestCase):
+
+    def setUp(self):
+        self._data_dir = base.DATA_DIR
+        base.DATA_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        base.DATA_DIR = self._data_dir
+
+    def test_run(self):
+        cwd = os.getcwd()
+        results = run.run_all('MotionFraming', quick=True, log=lambda m: None)
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(len(results), 1)
+        (key, result), = results.items()
+        self.assertIn('time_motion_framing(1000)', key)
+        self.assertGreater(result['value'], 0.0)
+        rows, regressions = run.compare(
+            results, {key: {'value': result['value'] / 2}}, threshold=1.5)
+        self.assertEqual(regressions, [key])
+        self.assertAlmostEqual(rows[0][3], 2.0)
@@ -0,0 +1,130 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+import numpy as np
+import nibabel as nib
+from arcana.data import Fileset
+from banana.file_format import (
+    nifti_gz_format, nifti_gz_x_format, dicom_format, NiftiFormat)
+
+
+class TestImageCompare(TestCase):
+
+    shape = (10, 12, 8, 6)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        state = np.random.RandomState(0)
+        self.data = state.standard_normal(self.shape).astype(np.float32)
+        self.ref = self.fileset('ref', self.data)
+        # Slabs of a single volume so the comparison is streamed
+        self.slab_voxels = NiftiFormat.SLAB_VOXELS
+        NiftiFormat.SLAB_VOXELS = int(np.prod(self.shape[:3]))
+
+    def tearDown(self):
+        NiftiFormat.SLAB_VOXELS = self.slab_voxels
+        shutil.rmtree(self.tmp_dir)
+
+    def fileset(self, name, data):
+        path = op.join(self.tmp_dir, name + '.nii.gz')
+        nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+        return Fileset(name, nifti_gz_format, path=path)
+
+    def test_identical(self):
+        copy_path = op.join(self.tmp_dir, 'copy.nii.gz')
+        shutil.copy(self.ref.path, copy_path)
+        test = Fileset('copy', nifti_gz_format, path=copy_path)
+        self.assertEqual(nifti_gz_format.content_digest(test),
+                         nifti_gz_format.content_digest(self.ref))
+        self.assertTrue(test.contents_equal(self.ref))
+
+    def test_digest_only_if_saved(self):
+        copy_path = op.join(self.tmp_dir, 'copy.nii.gz')
+        shutil.copy(self.ref.path, copy_path)
+        test = Fileset('copy', nifti_gz_format, path=copy_path)
+        # Without saved digests the arrays are compared directly, without
+        # hashing the files first
+        with patch.object(NiftiFormat, 'content_digest') as content_digest:
+            self.assertTrue(test.contents_equal(self.ref))
+            self.assertFalse(self.fileset('shape', self.data[..., :-1])
+                             .contents_equal(self.ref))
+            self.assertFalse(content_digest.called)
+        self.assertEqual(nifti_gz_format._shape_dtype(self.ref),
+                         (self.shape, np.dtype(np.float32)))
+        # Only the fileset without a saved digest is hashed
+        nifti_gz_format.save_digest(self.ref)
+        with patch.object(NiftiFormat, 'content_digest',
+                          return_value=nifti_gz_format.content_digest(
+                              self.ref)) as content_digest:
+            self.assertTrue(test.contents_equal(self.ref))
+            content_digest.assert_called_once_with(test)
+
+    def test_rms_diff(self):
+        perturbed = self.data.copy()
+        perturbed[..., -1] += 0.01
+        test = self.fileset('test', perturbed)
+        expected = np.sqrt(np.sum((perturbed.astype(np.float64) -
+                                   self.data) ** 2))
+        self.assertAlmostEqual(test.rms_diff(self.ref), expected, places=4)
+        self.assertFalse(test.contents_equal(self.ref))
+        self.assertTrue(test.contents_equal(self.ref, rms_tol=expected * 1.01))
+        self.assertFalse(test.contents_equal(self.ref,
+                                             rms_tol=expected * 0.99))
+        # Stops accumulating once the tolerance is exceeded in the first slab
+        different = self.fileset('different', self.data + 1.0)
+        self.assertLess(nifti_gz_format._sum_sq_diff(different, self.ref,
+                                                     limit=1.0),
+                        np.prod(self.shape[:3]) + 1)
+        self.assertFalse(self.fileset('shape', self.data[..., :-1])
+                         .contents_equal(self.ref, rms_tol=1.0))
+
+    def test_saved_digest(self):
+        digest = nifti_gz_format.content_digest(self.ref)
+        nifti_gz_format.save_digest(self.ref)
+        self.assertTrue(op.exists(op.join(self.tmp_dir,
+                                          NiftiFormat.DIGESTS_FNAME)))
+        # The saved digest is used instead of reading the file again as long
+        # as its size and modification time are unchanged
+        mtime_ns = os.stat(self.ref.path).st_mtime_ns
+        with open(self.ref.path, 'r+b') as f:
+            f.seek(-4, 2)
+            f.write(b'\0\0\0\0')
+        os.utime(self.ref.path, ns=(mtime_ns, mtime_ns))
+        self.assertEqual(nifti_gz_format.content_digest(self.ref), digest)
+        os.utime(self.ref.path)
+        self.assertNotEqual(nifti_gz_format.content_digest(self.ref), digest)
+
+    def test_saved_digest_aux(self):
+        json_path = op.join(self.tmp_dir, 'ref.json')
+        with open(json_path, 'w') as f:
+            f.write('{"EchoTime": 0.01}')
+        ref = Fileset('ref', nifti_gz_x_format, path=self.ref.path,
+                      aux_files={'json': json_path})
+        digest = nifti_gz_x_format.content_digest(ref)
+        nifti_gz_x_format.save_digest(ref)
+        self.assertEqual(nifti_gz_x_format.content_digest(ref), digest)
+        # Changes to the aux files are detected too
+        with open(json_path, 'w') as f:
+            f.write('{"EchoTime": 0.02}')
+        self.assertNotEqual(nifti_gz_x_format.content_digest(ref), digest)
+
+    def test_saved_digest_directory(self):
+        dcm_dir = op.join(self.tmp_dir, 'dicoms')
+        os.mkdir(dcm_dir)
+        for i in range(3):
+            with open(op.join(dcm_dir, '{}.dcm'.format(i)), 'wb') as f:
+                f.write(os.urandom(100))
+        ref = Fileset('dicoms', dicom_format, path=dcm_dir)
+        digest = dicom_format.content_digest(ref)
+        dicom_format.save_digest(ref)
+        self.assertEqual(dicom_format.content_digest(ref), digest)
+        # Rewriting a file within the directory doesn't change the
+        # modification time of the directory itself
+        dir_mtime_ns = os.stat(dcm_dir).st_mtime_ns
+        with open(op.join(dcm_dir, '1.dcm'), 'wb') as f:
+            f.write(os.urandom(100))
+        os.utime(dcm_dir, ns=(dir_mtime_ns, dir_mtime_ns))
+        self.assertNotEqual(dicom_format.content_digest(ref), digest)
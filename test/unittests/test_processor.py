@@ -0,0 +1,280 @@
+import os
+import os.path as op
+import stat
+import shlex
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from nipype.interfaces.utility import IdentityInterface
+from arcana import InputFilesetSpec, FilesetSpec
+from arcana.exceptions import ArcanaNameError
+from banana.study.base import Study as BananaStudy
+from banana.study import StudyMetaClass
+from banana.file_format import nifti_gz_format
+from banana.exceptions import BananaUsageError
+from banana.processor import SlurmArraySubmitter
+from banana.entrypoint import DeriveCmd, args_to_argv
+
+
+class Spec(object):
+
+    is_spec = True
+
+    def __init__(self, name, frequency, is_fileset=True, inputs=None):
+        self.name = name
+        self.frequency = frequency
+        self.is_fileset = is_fileset
+        self.inputs = inputs
+        self.derived = inputs is not None
+        self.study = None
+
+    @property
+    def pipeline(self):
+        "Stands in for the pipeline, which only needs its inputs"
+        return Pipeline([self.study.data_spec(n) for n in self.inputs])
+
+
+class Pipeline(object):
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+
+
+class Node(object):
+    "Stands in for a subject or session of a repository tree"
+
+    def __init__(self, derivatives, visit_id=None, sessions=()):
+        self.derivatives = derivatives
+        self.visit_id = visit_id
+        self.sessions = sessions
+
+    def fileset(self, name, from_study=None):
+        if name not in self.derivatives:
+            raise ArcanaNameError(name, name)
+
+    field = fileset
+
+
+class Tree(object):
+
+    def __init__(self, subjects):
+        self.subjects = subjects
+
+    def subject(self, id):  # @ReservedAssignment
+        try:
+            return self.subjects[id]
+        except KeyError:
+            raise ArcanaNameError(id, id)
+
+
+class Study(object):
+
+    name = 'test'
+
+    def __init__(self, tree, subject_ids, visit_ids):
+        self.tree = tree
+        self.subject_ids = subject_ids
+        self.visit_ids = visit_ids
+        self.specs = {}
+        for spec in (
+                Spec('t1', 'per_session'),
+                Spec('brain', 'per_session', inputs=['t1']),
+                Spec('template', 'per_subject', inputs=['brain']),
+                Spec('group_mean', 'per_study', is_fileset=False,
+                     inputs=['template']),
+                Spec('group_template', 'per_study', inputs=['brain']),
+                Spec('registered', 'per_session',
+                     inputs=['brain', 'group_template']),
+                Spec('normalised', 'per_subject', inputs=['registered'])):
+            spec.study = self
+            self.specs[spec.name] = spec
+
+    def data_spec(self, name):
+        return self.specs[name]
+
+    bound_spec = data_spec
+
+
+class ArrayStudy(BananaStudy, metaclass=StudyMetaClass):
+
+    add_data_specs = [
+        InputFilesetSpec('image', nifti_gz_format),
+        FilesetSpec('brain', nifti_gz_format, 'brain_pipeline')]
+
+    def brain_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            'brain', desc="", citations=[], name_maps=name_maps)
+        pipeline.add(
+            'identity',
+            IdentityInterface(fields=['image']),
+            inputs={
+                'image': ('image', nifti_gz_format)},
+            outputs={
+                'brain': ('image', nifti_gz_format)})
+        return pipeline
+
+
+class TestSlurmArraySubmitter(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # Stand-in for sbatch that records its arguments
+        bin_dir = op.join(self.tmp_dir, 'bin')
+        os.makedirs(bin_dir)
+        self.sbatch_log = op.join(self.tmp_dir, 'sbatch.log')
+        sbatch_path = op.join(bin_dir, 'sbatch')
+        with open(sbatch_path, 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> {}\n'
+                    'echo "$(wc -l < {});cluster"\n'.format(
+                        self.sbatch_log, self.sbatch_log))
+        os.chmod(sbatch_path, os.stat(sbatch_path).st_mode | stat.S_IEXEC)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self.path
+        done = ('brain', 'template')
+        self.study = Study(
+            Tree({
+                's1': Node(done, sessions=[Node(done, 'v1'),
+                                           Node(done, 'v2')]),
+                's2': Node(done, sessions=[Node(done, 'v1'),
+                                           Node(('template',), 'v2')]),
+                's3': Node((), sessions=[Node(done, 'v1')]),
+                's4': Node(done, sessions=[Node(done, 'v1')])}),
+            ['s1', 's2', 's3', 's4', 's5'], ['v1', 'v2'])
+        self.submitter = SlurmArraySubmitter(
+            op.join(self.tmp_dir, 'array'), chunk_size=2, num_processes=4,
+            wall_time=90, mem_gb=8, partition='short')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pending(self):
+        self.assertEqual(
+            self.submitter.pending_subjects(self.study,
+                                            ['brain', 'template']),
+            ['s2', 's3', 's5'])
+        self.assertEqual(
+            self.submitter.pending_subjects(self.study, ['brain']),
+            ['s2', 's5'])
+        self.assertEqual(self.submitter.chunks(['s2', 's3', 's5']),
+                         [['s2', 's3'], ['s5']])
+
+    def test_submit(self):
+        commands = []
+
+        def command(derivatives, subjects_path, scratch, reprocess):
+            commands.append((derivatives, subjects_path, scratch, reprocess))
+            return ['banana', 'derive', subjects_path]
+
+        array_id, join_id = self.submitter.submit(
+            self.study, ['brain', 'template', 'group_mean'], command)
+        self.assertEqual((array_id, join_id), ('1', '2'))
+        with open(self.sbatch_log) as f:
+            calls = f.read().split('\n')
+        self.assertTrue(
+            calls[1].startswith('--parsable --dependency=afterok:1 '))
+        array_dir = op.join(self.tmp_dir, 'array')
+        self.assertEqual(commands[0][0], ['brain', 'template'])
+        # The join job only derives the joined derivatives
+        self.assertEqual(commands[1][0], ['group_mean'])
+        with open(op.join(array_dir, 'subjects-1.txt')) as f:
+            self.assertEqual(f.read().split(), ['s5'])
+        with open(op.join(array_dir, 'array.sh')) as f:
+            script = f.read()
+        self.assertIn('#SBATCH --array=0-1\n', script)
+        self.assertIn('#SBATCH --time=90\n', script)
+        self.assertIn('#SBATCH --partition=short\n', script)
+        self.assertIn('{}"${{SLURM_ARRAY_TASK_ID}}".txt'.format(
+            shlex.quote(op.join(array_dir, 'subjects-'))), script)
+        # Everything but the task ID is quoted
+        self.assertEqual(
+            SlurmArraySubmitter._quote("a'b ${SLURM_ARRAY_TASK_ID}"),
+            shlex.quote("a'b ") + '"${SLURM_ARRAY_TASK_ID}"')
+
+    def test_reprocess(self):
+        commands = []
+
+        def command(derivatives, subjects_path, scratch, reprocess):
+            commands.append((derivatives, reprocess))
+            return ['banana', 'derive', subjects_path]
+
+        self.submitter.submit(self.study, ['brain', 'group_mean'], command,
+                              reprocess=True)
+        self.assertEqual(commands, [(['brain'], True),
+                                    (['group_mean'], True)])
+        with open(op.join(self.tmp_dir, 'array', 'subjects-1.txt')) as f:
+            self.assertEqual(f.read().split(), ['s3', 's4'])
+
+    def test_split(self):
+        self.assertEqual(
+            self.submitter.split(self.study, ['brain', 'template',
+                                              'group_mean']),
+            (['brain', 'template'], ['group_mean']))
+        self.assertEqual(
+            self.submitter.joined_prerequisites(
+                self.study, ['brain', 'normalised']),
+            {'normalised': {'group_template'}})
+        # Derivatives that depend on a group template can't be derived by
+        # each task separately
+        self.assertRaises(BananaUsageError, self.submitter.split, self.study,
+                          ['brain', 'normalised'])
+        self.assertRaises(BananaUsageError, self.submitter.split, self.study,
+                          ['registered', 'group_template'])
+
+    def test_derive(self):
+        repo_dir = op.join(self.tmp_dir, 'repo')
+        for subject_id in ('s1', 's2', 's3'):
+            session_dir = op.join(repo_dir, subject_id, 'v1')
+            os.makedirs(session_dir)
+            nib.save(nib.Nifti1Image(np.ones((3, 3, 3), dtype=np.float32),
+                                     np.eye(4)),
+                     op.join(session_dir, 'image.nii.gz'))
+        scratch = op.join(self.tmp_dir, 'scratch')
+        parser = DeriveCmd.parser()
+        DeriveCmd.run(parser.parse_args([
+            repo_dir, '{}.ArrayStudy'.format(__name__), 'array', 'brain',
+            '--repository', 'basic', '2', '--input', 'image', 'image',
+            '--processor', 'slurm_array', 'myacc', '--chunk_size', '2',
+            '--scratch', scratch]))
+        with open(self.sbatch_log) as f:
+            calls = f.read().split('\n')[:-1]
+        # Only the array is submitted as there are no joined derivatives
+        self.assertEqual(len(calls), 1)
+        array_dir = op.join(scratch, 'array', 'array')
+        with open(op.join(array_dir, 'array.sh')) as f:
+            script = f.read()
+        self.assertIn('#SBATCH --array=0-1\n', script)
+        self.assertIn('#SBATCH --account=myacc\n', script)
+        # The tasks derive the data locally for their chunk of subjects
+        argv = shlex.split(script.split('\n')[-2].replace(
+            '${SLURM_ARRAY_TASK_ID}', '0'))
+        self.assertEqual(argv[1:4], ['-m', 'banana.entrypoint', 'derive'])
+        task_args = parser.parse_args(argv[4:])
+        self.assertEqual(task_args.processor, ['multi', '4'])
+        self.assertEqual(task_args.derivatives, ['brain'])
+        with open(task_args.subject_ids[0]) as f:
+            self.assertEqual(f.read().split(), ['s1', 's2'])
+
+    def test_task_argv(self):
+        parser = DeriveCmd.parser()
+        args = parser.parse_args([
+            '/data/repo', 'T1Study', 'test', 'brain', 'template',
+            '--processor', 'slurm_array', 'myacc', '--parameter', 'a', '1',
+            '--enforce_inputs', '--telemetry', '--chunk_size', '5',
+            '--reprocess'])
+        argv = args_to_argv(parser, args, derivatives=['brain'],
+                            processor=['multi', '4'])
+        self.assertTrue(parser.parse_args(argv).reprocess)
+        argv = args_to_argv(parser, args, derivatives=['brain'],
+                            processor=['multi', '4'], reprocess=False)
+        self.assertNotIn('--reprocess', argv)
+        reparsed = parser.parse_args(argv)
+        self.assertEqual(reparsed.derivatives, ['brain'])
+        self.assertEqual(reparsed.processor, ['multi', '4'])
+        for name in ('repository_path', 'study_class', 'study_name',
+                     'parameter', 'enforce_inputs', 'telemetry',
+                     'chunk_size', 'logger'):
+            self.assertEqual(getattr(reparsed, name), getattr(args, name),
+                             name)
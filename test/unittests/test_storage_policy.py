@@ -0,0 +1,199 @@
+import os
+import gzip
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from arcana import (
+    BasicRepo, SingleProc, InputFilesetSpec, FilesetSpec, InputFilesets)
+from nipype.interfaces.base import isdefined
+from nipype.interfaces.utility import IdentityInterface
+from banana.study.base import Study
+from banana.study import StudyMetaClass
+from banana.file_format import (
+    nifti_gz_format, nifti_format, mrtrix_image_format, text_format)
+from banana.interfaces.converters import GzipConvert
+from banana.exceptions import BananaUsageError
+
+
+class StoragePolicyStudy(Study, metaclass=StudyMetaClass):
+
+    add_data_specs = [
+        InputFilesetSpec('image', nifti_gz_format),
+        FilesetSpec('intermediate', nifti_gz_format, 'first_pipeline'),
+        FilesetSpec('report', text_format, 'first_pipeline'),
+        FilesetSpec('summary', nifti_gz_format, 'first_pipeline'),
+        FilesetSpec('gzipped', nifti_gz_format, 'gzipped_pipeline'),
+        FilesetSpec('final', nifti_gz_format, 'second_pipeline')]
+
+    def first_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            'first', desc="", citations=[], name_maps=name_maps)
+        # Writes its image uncompressed if requested
+        pipeline.add(
+            'identity',
+            IdentityInterface(fields=['image', 'report', 'output_type']),
+            inputs={
+                'image': ('image', nifti_gz_format)},
+            outputs={
+                'intermediate': ('image', nifti_gz_format),
+                'report': ('report', text_format),
+                'summary': ('image', nifti_gz_format)},
+            uncompressed_outputs={'output_type': 'NIFTI'})
+        return pipeline
+
+    def gzipped_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            'gzipped', desc="", citations=[], name_maps=name_maps)
+        # Only writes gzipped images
+        pipeline.add(
+            'identity',
+            IdentityInterface(fields=['image']),
+            inputs={
+                'image': ('image', nifti_gz_format)},
+            outputs={
+                'gzipped': ('image', nifti_gz_format)})
+        return pipeline
+
+    def second_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            'second', desc="", citations=[], name_maps=name_maps)
+        pipeline.add(
+            'identity',
+            IdentityInterface(fields=['image', 'gzipped', 'output_type']),
+            inputs={
+                'image': ('intermediate', nifti_gz_format),
+                'gzipped': ('gzipped', nifti_gz_format)},
+            outputs={
+                'final': ('image', nifti_gz_format)},
+            uncompressed_inputs=['image'],
+            uncompressed_outputs={'output_type': 'NIFTI'})
+        # Renames its input to a '.nii.gz' path so doesn't opt in
+        pipeline.add(
+            'renames',
+            IdentityInterface(fields=['image']),
+            inputs={
+                'image': ('intermediate', nifti_gz_format)})
+        return pipeline
+
+
+class TestStoragePolicy(TestCase):
+
+    def setUp(self):
+        # Tests change into the temporary directory
+        self.cwd = os.getcwd()
+        self.repo_dir = tempfile.mkdtemp()
+        self.work_dir = tempfile.mkdtemp()
+        session_dir = os.path.join(self.repo_dir, 'SUBJECT', 'VISIT')
+        os.makedirs(session_dir)
+        nib.save(nib.Nifti1Image(np.ones((3, 3, 3), dtype=np.float32),
+                                 np.eye(4)),
+                 os.path.join(session_dir, 'image.nii.gz'))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.repo_dir)
+        shutil.rmtree(self.work_dir)
+
+    def create_study(self, **kwargs):
+        return StoragePolicyStudy(
+            'policy', BasicRepo(self.repo_dir), SingleProc(self.work_dir),
+            [InputFilesets('image', 'image', nifti_gz_format)], **kwargs)
+
+    def test_default(self):
+        study = self.create_study()
+        self.assertIsNone(study.storage_format('intermediate'))
+        self.assertEqual(study.bound_spec('intermediate').format,
+                         nifti_gz_format)
+
+    def test_intermediate_format(self):
+        study = self.create_study(intermediate_format=nifti_format,
+                                  final_outputs=['final'])
+        # Intermediate derivatives are stored uncompressed whichever node
+        # produces them
+        self.assertEqual(study.bound_spec('intermediate').format,
+                         nifti_format)
+        self.assertEqual(study.bound_spec('gzipped').format, nifti_format)
+        # Inputs, final outputs and non-image derivatives are untouched
+        self.assertEqual(study.bound_spec('image').format, nifti_gz_format)
+        self.assertEqual(study.bound_spec('final').format, nifti_gz_format)
+        self.assertEqual(study.bound_spec('report').format, text_format)
+
+    def test_uncompressed_outputs(self):
+        study = self.create_study(intermediate_format=nifti_format,
+                                  final_outputs=['final'])
+        # The node is told to write its output uncompressed, so it doesn't
+        # need to be converted
+        pipeline = study.first_pipeline()
+        node, _, format, _ = pipeline._output_conns['intermediate']
+        self.assertEqual(format, nifti_format)
+        self.assertEqual(node.inputs.output_type, 'NIFTI')
+        # Nodes that only write final outputs are left as they are
+        pipeline = study.second_pipeline()
+        node, _, format, _ = pipeline._output_conns['final']
+        self.assertEqual(format, nifti_gz_format)
+        self.assertFalse(isdefined(node.inputs.output_type))
+        # Nodes that haven't opted in write gzipped images, which are
+        # decompressed before being stored
+        pipeline = study.gzipped_pipeline()
+        node, _, format, _ = pipeline._output_conns['gzipped']
+        self.assertEqual(format, nifti_gz_format)
+        self.assertIsInstance(
+            nifti_format.converter_from(format).interface, GzipConvert)
+
+    def test_uncompressed_inputs(self):
+        study = self.create_study(intermediate_format=nifti_format,
+                                  final_outputs=['final'])
+        pipeline = study.second_pipeline()
+        formats = {n.name: (f, k) for n, _, f, k in
+                   pipeline._input_conns['intermediate']}
+        # Only the inputs that opted in read the '.nii' intermediate
+        # directly, it is converted back for the others at the fastest
+        # compression level
+        self.assertEqual(formats, {
+            'second_identity': (nifti_format, {}),
+            'second_renames': (nifti_gz_format, {'compresslevel': 1})})
+        self.assertEqual(
+            nifti_gz_format.converter_from(
+                nifti_format, compresslevel=1).interface.inputs.compresslevel,
+            1)
+        (_, _, format, _), = pipeline._input_conns['gzipped']
+        self.assertEqual(format, nifti_gz_format)
+
+    def test_final_output_compression(self):
+        study = self.create_study(intermediate_format=nifti_format,
+                                  final_outputs=['final', 'summary'])
+        # Final outputs written uncompressed by a node that opted in are
+        # gzipped at the default compression level
+        pipeline = study.first_pipeline()
+        node, _, format, kwargs = pipeline._output_conns['summary']
+        self.assertEqual(format, nifti_format)
+        self.assertEqual(kwargs, {})
+        self.assertEqual(study.bound_spec('summary').format, nifti_gz_format)
+        self.assertEqual(
+            nifti_gz_format.converter_from(
+                format).interface.inputs.compresslevel, 9)
+
+    def test_invalid_intermediate_format(self):
+        self.assertRaises(BananaUsageError, self.create_study,
+                          intermediate_format=text_format)
+        # MRtrix images would need to be converted on every read
+        self.assertRaises(BananaUsageError, self.create_study,
+                          intermediate_format=mrtrix_image_format)
+
+    def test_gzip_convert(self):
+        os.chdir(self.work_dir)
+        in_file = os.path.join(self.repo_dir, 'SUBJECT', 'VISIT',
+                               'image.nii.gz')
+        unzipped = GzipConvert(in_file=in_file,
+                               decompress=True).run().outputs.out_file
+        self.assertTrue(unzipped.endswith('image.nii'))
+        rezipped = GzipConvert(in_file=unzipped).run().outputs.out_file
+        self.assertTrue(rezipped.endswith('image.nii.gz'))
+        with gzip.open(in_file) as f:
+            orig = f.read()
+        with open(unzipped, 'rb') as f:
+            self.assertEqual(f.read(), orig)
+        with gzip.open(rezipped) as f:
+            self.assertEqual(f.read(), orig)
@@ -0,0 +1,75 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+from unittest import TestCase
+from nipype.pipeline.engine import Node
+from banana.interfaces.converters import GzipConvert
+from banana.utils.conversion_cache import (
+    ConversionCache, ConversionCacheMixin, CACHE_DIR_ENV, CACHE_SIZE_ENV)
+
+
+class CachedGzipConvert(ConversionCacheMixin, GzipConvert):
+
+    source_input = 'in_file'
+
+
+class TestConversionCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = ConversionCache(op.join(self.tmp_dir, 'cache'),
+                                     max_size=2.5 / 1024)  # 2.5 MB
+        self.env = {k: os.environ.get(k)
+                    for k in (CACHE_DIR_ENV, CACHE_SIZE_ENV)}
+
+    def tearDown(self):
+        for k, v in self.env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, size, fill=b'\0'):
+        path = op.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(fill * size)
+        return path
+
+    def test_store_fetch_evict(self):
+        keys = []
+        for i in range(3):
+            src = self.write('src{}.bin'.format(i), 1024 ** 2,
+                             fill=bytes([i]))
+            key = self.cache.key('Converter', '1.0', {'opt': i}, src)
+            self.assertNotIn(key, keys)
+            keys.append(key)
+            out = self.write('out{}.bin'.format(i), 1024 ** 2)
+            self.cache.store(key, [out])
+            # Mark the first conversion as used more recently than the second
+            if i == 1:
+                os.utime(self.cache.entry_path(keys[0]))
+        # The least recently used conversion has been evicted
+        self.assertEqual(sorted(e[0] for e in self.cache.entries()),
+                         sorted([keys[0], keys[2]]))
+        dest = op.join(self.tmp_dir, 'dest')
+        os.makedirs(dest)
+        self.assertFalse(self.cache.fetch(keys[1], dest))
+        self.assertTrue(self.cache.fetch(keys[0], dest))
+        self.assertEqual(os.listdir(dest), ['out0.bin'])
+        self.assertEqual(os.stat(op.join(dest, 'out0.bin')).st_size,
+                         1024 ** 2)
+
+    def test_interface(self):
+        src = self.write('image.nii', 4096, fill=b'\1')
+        self.cache.enable()
+        results = []
+        for i in range(2):
+            node = Node(CachedGzipConvert(in_file=src), name='gzip',
+                        base_dir=op.join(self.tmp_dir, 'work{}'.format(i)))
+            results.append(node.run().outputs.out_file)
+        self.assertEqual(len(self.cache.entries()), 1)
+        # The second conversion is hard-linked from the cache
+        self.assertTrue(op.samefile(*results))
+        self.assertNotEqual(op.dirname(results[0]), op.dirname(results[1]))
@@ -0,0 +1,91 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from banana.file_format import dicom_format
+from banana.utils import dicom
+
+
+class MockFileset(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+class TestLoadSeries(TestCase):
+
+    shape = (6, 8, 10)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data = np.arange(np.prod(self.shape), dtype=np.uint16).reshape(
+            self.shape)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def dataset(self, pixels, **fields):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = pydicom.uid.MRImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.Rows, ds.Columns = pixels.shape[-2:]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = pixels.tobytes()
+        for name, value in fields.items():
+            setattr(ds, name, value)
+        return ds
+
+    def write_series(self, name, positions, instances):
+        series_dir = op.join(self.tmp_dir, name)
+        os.makedirs(series_dir)
+        for i, (pos, inst) in enumerate(zip(positions, instances)):
+            ds = self.dataset(
+                self.data[i], InstanceNumber=inst,
+                ImageOrientationPatient=[0, 1, 0, 0, 0, -1],
+                ImagePositionPatient=[pos, 0.0, 0.0])
+            # File names that don't sort in slice order
+            ds.save_as(op.join(series_dir, '{}.dcm'.format(
+                generate_uid())), enforce_file_format=True)
+        return series_dir
+
+    def test_sorted_by_position(self):
+        # Slices are ordered along the normal of the orientation (-x), not by
+        # their instance numbers
+        positions = [10.0, 4.0, -2.0, 7.0, 1.0, -5.0]
+        series_dir = self.write_series(
+            'series', positions, instances=[6, 5, 4, 3, 2, 1])
+        array = dicom_format.get_array(MockFileset(series_dir),
+                                       num_threads=3)
+        order = np.argsort(positions)[::-1]
+        self.assertEqual(array.dtype, np.uint16)
+        self.assertTrue(np.array_equal(array, self.data[order]))
+
+    def test_sorted_by_instance(self):
+        # Repeated positions (e.g. multiple volumes) fall back to the
+        # instance numbers
+        instances = [3, 1, 6, 2, 5, 4]
+        series_dir = self.write_series('series', [0.0, 1.0] * 3, instances)
+        array = dicom_format.get_array(MockFileset(series_dir))
+        self.assertTrue(np.array_equal(array,
+                                       self.data[np.argsort(instances)]))
+
+    def test_multiframe(self):
+        path = op.join(self.tmp_dir, 'enhanced.dcm')
+        self.dataset(self.data, NumberOfFrames=self.shape[0]).save_as(
+            path, enforce_file_format=True)
+        array = dicom.load_series([path])
+        self.assertTrue(np.array_equal(array, self.data))
@@ -0,0 +1,105 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+from banana.exceptions import BananaUsageError
+from banana.interfaces.custom.motion_correction import MotionFraming
+from banana.utils.framing import (
+    MotionFramer, parse_time, format_time, volume_at)
+
+
+class TestMotionFramer(TestCase):
+
+    tr = 2.0
+    num_vols = 60
+    start = parse_time('120000.000000')
+
+    def session(self, jumps):
+        "Mean displacements that change to the given values at each volume"
+        md = np.zeros(self.num_vols)
+        for vol, value in sorted(jumps.items()):
+            md[vol:] = value
+        times = self.start + self.tr * np.arange(self.num_vols + 1)
+        return times.tolist(), md.tolist(), np.abs(np.diff(md)).tolist()
+
+    def stream(self, times, md, consec):
+        framer = MotionFramer(motion_threshold=2.0, temporal_threshold=30.0)
+        confirmed = {}
+        for vol, (time, disp) in enumerate(zip(times, md)):
+            for frame_vol in framer.add_volume(
+                    time, disp, consec[vol - 1] if vol else None):
+                confirmed[frame_vol] = vol
+        for frame_vol in framer.finish(times[-1]):
+            confirmed[frame_vol] = self.num_vols
+        return framer, confirmed
+
+    def test_streaming(self):
+        times, md, consec = self.session({20: 5.0})
+        framer, confirmed = self.stream(times, md, consec)
+        self.assertEqual(framer.frame_vols, [0, 20, 60])
+        # Boundaries are confirmed as soon as the temporal threshold has
+        # passed after them
+        self.assertEqual(confirmed, {0: 16, 20: 36, 60: 60})
+        self.assertEqual(MotionFramer().replay(times, md, consec),
+                         framer.frame_vols)
+        self.assertRaises(BananaUsageError, framer.add_volume, times[-1], 0.0)
+
+    def test_short_frame(self):
+        # Moving back within the temporal threshold drops the boundary
+        # before it is confirmed, starting the frame after the move instead
+        times, md, consec = self.session({20: 5.0, 25: 0.0})
+        framer, confirmed = self.stream(times, md, consec)
+        self.assertEqual(framer.frame_vols, [0, 26, 60])
+        self.assertNotIn(20, confirmed)
+        # A short frame at the end is merged into the previous one
+        times, md, consec = self.session({50: 5.0})
+        self.assertEqual(MotionFramer().replay(times, md, consec), [0, 60])
+
+    def test_times(self):
+        self.assertEqual(parse_time('013005.250000'), 5405.25)
+        self.assertEqual(format_time(5405.25), '013005.250000')
+        self.assertEqual(volume_at([0.0, 2.0, 4.0], 3.0), 1)
+
+    def frame_pet(self, pet_start_time, pet_end_time):
+        times, md, consec = self.session({20: 5.0, 40: 10.0})
+        tmp_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            np.savetxt(op.join(tmp_dir, 'md.txt'), md)
+            np.savetxt(op.join(tmp_dir, 'consec.txt'), consec)
+            np.savetxt(op.join(tmp_dir, 'times.txt'),
+                       [format_time(t) for t in times], fmt='%s')
+            os.chdir(tmp_dir)
+            MotionFraming(
+                mean_displacement=op.join(tmp_dir, 'md.txt'),
+                mean_displacement_consec=op.join(tmp_dir, 'consec.txt'),
+                start_times=op.join(tmp_dir, 'times.txt'),
+                motion_threshold=2.0, temporal_threshold=30.0,
+                pet_start_time=pet_start_time,
+                pet_end_time=pet_end_time).run()
+            frame_vols = np.loadtxt('frame_vol_numbers.txt', dtype=int)
+            with open('timestamps/frame_start_times_4PET.txt') as f:
+                pet_times = f.read().split()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp_dir)
+        return frame_vols.tolist(), pet_times
+
+    def test_interface(self):
+        # The frames are cropped to the PET acquisition
+        frame_vols, pet_times = self.frame_pet('120009.000000',
+                                               '120151.000000')
+        self.assertEqual(frame_vols, [4, 20, 40, 55])
+        self.assertEqual(pet_times, ['120009.000000', '120040.000000',
+                                     '120120.000000', '120151.000000'])
+
+    def test_interface_aligned(self):
+        # PET start and end times that fall on the start of a volume
+        frame_vols, pet_times = self.frame_pet('120010.000000',
+                                               '120150.000000')
+        self.assertEqual(frame_vols, [5, 20, 40, 55])
+        self.assertEqual(pet_times, ['120010.000000', '120040.000000',
+                                     '120120.000000', '120150.000000'])
+        self.assertEqual(len(frame_vols), len(pet_times))
@@ -0,0 +1,98 @@
+import os.path as op
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from nipype.pipeline.engine import Node
+from banana.utils import mif
+from banana.interfaces.mrtrix import NativeMRConvert
+
+
+class TestMif(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data = np.arange(5 * 6 * 7 * 3, dtype=np.int16).reshape(
+            (5, 6, 7, 3))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def nifti(self, affine, name='in.nii.gz', data=None):
+        img = nib.Nifti1Image(self.data if data is None else data, affine)
+        # Stored as int16, with scaling if the data is floating point
+        img.set_data_dtype(np.int16)
+        img.header.set_zooms(list(np.linalg.norm(affine[:3, :3], axis=0)) +
+                             [2.5])
+        path = op.join(self.tmp_dir, name)
+        nib.save(img, path)
+        return path
+
+    def assert_equivalent(self, path, other_path):
+        img = nib.as_closest_canonical(nib.load(path))
+        other = nib.as_closest_canonical(nib.load(other_path))
+        self.assertTrue(np.allclose(img.affine, other.affine))
+        self.assertTrue(np.array_equal(np.asarray(img.dataobj),
+                                       np.asarray(other.dataobj)))
+
+    def test_roundtrip(self):
+        las = np.diag([-2.0, 2.0, 3.0, 1.0])
+        las[:3, 3] = [50.0, -60.0, -20.0]
+        oblique = np.array([[0.0, 0.0, 2.0, -30.0],
+                            [1.5, 0.0, 0.0, 12.0],
+                            [0.0, 1.5, 0.0, 7.0],
+                            [0.0, 0.0, 0.0, 1.0]])
+        for i, affine in enumerate((las, oblique)):
+            nii = self.nifti(affine, name='in{}.nii.gz'.format(i))
+            mif_path = op.join(self.tmp_dir, 'out{}.mif'.format(i))
+            mif.convert(nii, mif_path)
+            hdr, array, mif_affine = mif.load(mif_path)
+            self.assertEqual(hdr['dim'], ['5,6,7,3'])
+            self.assertEqual(hdr['datatype'], ['Int16LE'])
+            self.assertEqual(array.shape, self.data.shape)
+            # MRtrix transforms are rigid (reflections go in the layout)
+            rotation = mif_affine[:3, :3] / np.linalg.norm(
+                mif_affine[:3, :3], axis=0)
+            self.assertAlmostEqual(np.linalg.det(rotation), 1.0)
+            out_nii = op.join(self.tmp_dir, 'out{}.nii'.format(i))
+            mif.convert(mif_path, out_nii)
+            self.assert_equivalent(nii, out_nii)
+
+    def test_scaling(self):
+        data = self.data * 0.01 + 10.0
+        nii = self.nifti(np.diag([2.0, 2.0, 2.0, 1.0]), data=data)
+        mif_path = op.join(self.tmp_dir, 'out.mif.gz')
+        mif.convert(nii, mif_path)
+        hdr, array, _ = mif.load(mif_path)
+        self.assertIn('scaling', hdr)
+        self.assertTrue(np.allclose(array, nib.load(nii).get_fdata()))
+        self.assertTrue(np.allclose(array, data, atol=0.01))
+
+    def test_gradients(self):
+        nii = self.nifti(np.diag([2.0, 2.0, 2.0, 1.0]))
+        bvecs = op.join(self.tmp_dir, 'bvecs')
+        bvals = op.join(self.tmp_dir, 'bvals')
+        np.savetxt(bvecs, [[0, 1, 0], [0, 0, 1], [0, 0, 0]])
+        np.savetxt(bvals, [[0, 1000, 1000]])
+        mif_path = op.join(self.tmp_dir, 'dwi.mif')
+        mif.convert(nii, mif_path, grad_fsl=(bvecs, bvals))
+        scheme = np.array([[float(v) for v in row.split(',')]
+                           for row in mif.read_header(mif_path)['dw_scheme']])
+        # x-component flipped for images with a neurological voxel order
+        self.assertTrue(np.allclose(scheme, [[0, 0, 0, 0],
+                                             [-1, 0, 0, 1000],
+                                             [0, 1, 0, 1000]]))
+
+    def test_not_supported(self):
+        self.assertRaises(mif.MifNotSupportedError, mif.convert,
+                          op.join(self.tmp_dir, 'dicom_dir'),
+                          op.join(self.tmp_dir, 'out.mif'))
+
+    def test_interface(self):
+        nii = self.nifti(np.diag([2.0, 2.0, 2.0, 1.0]))
+        node = Node(NativeMRConvert(in_file=nii, out_ext='.mif', quiet=True),
+                    name='convert', base_dir=self.tmp_dir)
+        out_file = node.run().outputs.out_file
+        self.assertEqual(op.basename(out_file), 'in_conv.mif')
+        self.assertTrue(np.array_equal(mif.load(out_file)[1], self.data))
@@ -0,0 +1,173 @@
+import os
+import os.path as op
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase
+from arcana import XnatRepo
+from arcana.data import Fileset
+from banana.file_format import nifti_gz_format, dicom_format
+from banana.utils import prefetch
+from banana.utils.prefetch import XnatPrefetcher, PREFETCH_MARKER
+
+PROJECT = 'PROJ'
+
+
+class MockXnatHandler(BaseHTTPRequestHandler):
+    "Serves the file listings and files of scan resources like XNAT does"
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+        server.requests.append((path, self.headers.get('Range')))
+        if path.endswith('/files'):
+            prefix = path[:-len('/files')]
+            results = [
+                {'Name': op.basename(uri), 'URI': uri, 'Size': len(data),
+                 'digest': hashlib.md5(data).hexdigest()}
+                for uri, data in sorted(server.files.items())
+                if uri.startswith(prefix + '/')]
+            body = json.dumps({'ResultSet': {'Result': results}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        try:
+            data = server.files[path]
+        except KeyError:
+            self.send_error(404)
+            return
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header:
+            start = int(range_header.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        if server.drop.pop(path, False):
+            # Drop the connection halfway through the file
+            self.wfile.write(data[start:start + (len(data) - start) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestXnatPrefetcher(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockXnatHandler)
+        self.server.files = {}
+        self.server.drop = {}
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.repo = XnatRepo(
+            server='http://127.0.0.1:{}'.format(self.server.server_port),
+            project_id=PROJECT, cache_dir=op.join(self.tmp_dir, 'cache'))
+        # Small chunks so partially received files are written out
+        self.chunk_size = prefetch.CHUNK_SIZE
+        prefetch.CHUNK_SIZE = 1000
+
+    def tearDown(self):
+        prefetch.CHUNK_SIZE = self.chunk_size
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def fileset(self, name, subject, visit, format=nifti_gz_format,
+                resource='NIFTI_GZ', files=None):
+        scan_uri = ('/data/archive/projects/{p}/subjects/{p}_{s}/'
+                    'experiments/{p}_{s}_{v}/scans/{n}'.format(
+                        p=PROJECT, s=subject, v=visit, n=name))
+        if files is None:
+            files = {name + '.nii.gz': os.urandom(50000)}
+        for fname, data in files.items():
+            self.server.files['{}/resources/{}/files/{}'.format(
+                scan_uri, resource, fname)] = data
+        return Fileset(name, format, uri=scan_uri, repository=self.repo,
+                       subject_id=subject, visit_id=visit,
+                       resource_name=resource)
+
+    def cached(self, fileset):
+        cache_path = self.repo._cache_path(fileset)
+        with open(cache_path + XnatRepo.MD5_SUFFIX) as f:
+            checksums = json.load(f)
+        files = {}
+        for fname in os.listdir(cache_path):
+            with open(op.join(cache_path, fname), 'rb') as f:
+                files[fname] = f.read()
+        return files, checksums
+
+    def test_prefetch(self):
+        filesets = [self.fileset('mprage', s, v)
+                    for s in ('01', '02') for v in ('A', 'B')]
+        dicoms = {'{}.dcm'.format(i): os.urandom(1000) for i in range(3)}
+        filesets.append(self.fileset('t2', '01', 'A', format=dicom_format,
+                                     resource='DICOM', files=dicoms))
+        with XnatPrefetcher(self.repo, num_workers=3) as prefetcher:
+            prefetcher.start(filesets)
+            self.assertEqual(prefetcher.wait(), [])
+        for fileset in filesets[:-1]:
+            files, checksums = self.cached(fileset)
+            data = self.server.files['{}/resources/NIFTI_GZ/files/{}'.format(
+                fileset.uri, fileset.name + '.nii.gz')]
+            self.assertEqual(files, {fileset.name + '.nii.gz': data})
+            # The primary file is keyed by '.' as by the XnatRepo
+            self.assertEqual(checksums,
+                             {'.': hashlib.md5(data).hexdigest()})
+            self.assertFalse(op.exists(self.repo._cache_path(fileset) +
+                                       '.download'))
+        files, checksums = self.cached(filesets[-1])
+        self.assertEqual(files, dicoms)
+        self.assertEqual(sorted(checksums), sorted(dicoms))
+        # Cached filesets aren't downloaded again
+        num_requests = len(self.server.requests)
+        self.assertFalse(XnatPrefetcher(self.repo).download(filesets[0]))
+        self.assertEqual(len(self.server.requests), num_requests)
+
+    def test_resume(self):
+        fileset = self.fileset('mprage', '01', 'A')
+        file_uri = '{}/resources/NIFTI_GZ/files/mprage.nii.gz'.format(
+            fileset.uri)
+        data = self.server.files[file_uri]
+        # The connection is dropped partway through and the download resumed
+        # from where it stopped
+        self.server.drop[file_uri] = True
+        self.assertTrue(XnatPrefetcher(self.repo).download(fileset))
+        self.assertEqual(self.cached(fileset)[0], {'mprage.nii.gz': data})
+        ranges = [r for p, r in self.server.requests if p == file_uri]
+        self.assertEqual(ranges, [None, 'bytes={}-'.format(len(data) // 2)])
+
+    def test_resume_interrupted(self):
+        fileset = self.fileset('mprage', '01', 'A')
+        file_uri = '{}/resources/NIFTI_GZ/files/mprage.nii.gz'.format(
+            fileset.uri)
+        data = self.server.files[file_uri]
+        # A partial download left behind by an interrupted prefetch
+        tmp_dir = self.repo._cache_path(fileset) + '.download'
+        os.makedirs(op.join(tmp_dir, 'files'))
+        open(op.join(tmp_dir, PREFETCH_MARKER), 'w').close()
+        with open(op.join(tmp_dir, 'files', 'mprage.nii.gz'), 'wb') as f:
+            f.write(data[:1000])
+        self.assertTrue(XnatPrefetcher(self.repo).download(fileset))
+        self.assertEqual(self.cached(fileset)[0], {'mprage.nii.gz': data})
+        ranges = [r for p, r in self.server.requests if p == file_uri]
+        self.assertEqual(ranges, ['bytes=1000-'])
+        # Downloads in progress by the XnatRepo are left alone
+        other = self.fileset('t1', '01', 'A')
+        os.makedirs(self.repo._cache_path(other) + '.download')
+        self.assertFalse(XnatPrefetcher(self.repo).download(other))
@@ -0,0 +1,105 @@
+import os
+import os.path as op
+import sys
+import shutil
+import tempfile
+import subprocess as sp
+from unittest import TestCase
+from banana.exceptions import BananaUsageError
+from banana.entrypoint import resolve_class
+from banana.utils.registry import study_classes, find_study_class
+
+
+class TestStudyRegistry(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_path = op.join(self.tmp_dir, 'cache', 'registry.json')
+        # A package to scan, placed on the path so it can be found
+        self.pkg_dir = op.join(self.tmp_dir, 'regtestpkg')
+        os.makedirs(op.join(self.pkg_dir, 'sub'))
+        self.write('__init__.py', 'from .sub.b import BStudy\n')
+        self.write('sub/__init__.py', '')
+        self.write('sub/a.py', (
+            "from banana.study import Study as BaseStudy\n"
+            "class AStudy(BaseStudy, metaclass=StudyMetaClass):\n"
+            "    desc = 'A study'\n"
+            "class NotAStudy(object):\n"
+            "    desc = 'Not a study'\n"))
+        self.write('sub/b.py', (
+            "from .a import AStudy\n"
+            "class BStudy(AStudy):\n"
+            "    desc = 'B study'\n"
+            "class AbstractStudy(AStudy):\n"
+            "    pass\n"))
+        self.write('sub/c.py', (
+            "from banana.study.mri import MriStudy\n"
+            "class MyMriStudy(MriStudy):\n"
+            "    desc = 'Derived from a Banana study'\n"))
+        sys.path.insert(0, self.tmp_dir)
+
+    def tearDown(self):
+        sys.path.remove(self.tmp_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, relpath, src):
+        with open(op.join(self.pkg_dir, relpath), 'w') as f:
+            f.write(src)
+
+    def test_scan(self):
+        classes = study_classes('regtestpkg', cache_path=self.cache_path)
+        self.assertEqual(
+            sorted((c.name, c.module, c.path, c.desc) for c in classes),
+            [('AStudy', 'regtestpkg.sub.a', 'regtestpkg.sub.a', 'A study'),
+             ('BStudy', 'regtestpkg.sub.b', 'regtestpkg', 'B study'),
+             # Derives from a Study class defined in Banana
+             ('MyMriStudy', 'regtestpkg.sub.c', 'regtestpkg.sub.c',
+              'Derived from a Banana study')])
+        self.assertEqual(find_study_class('BStudy', ['regtestpkg'],
+                                          cache_path=self.cache_path),
+                         'regtestpkg.sub.b')
+        # Classes without a 'desc' can still be looked up by name
+        self.assertEqual(find_study_class('AbstractStudy', ['regtestpkg'],
+                                          cache_path=self.cache_path),
+                         'regtestpkg.sub.b')
+        self.assertIsNone(find_study_class('NotAStudy', ['regtestpkg'],
+                                           cache_path=self.cache_path))
+
+    def test_cache(self):
+        study_classes('regtestpkg', cache_path=self.cache_path)
+        self.assertTrue(op.exists(self.cache_path))
+        mtime = op.getmtime(self.cache_path)
+        study_classes('regtestpkg', cache_path=self.cache_path)
+        self.assertEqual(op.getmtime(self.cache_path), mtime)
+        # Modifying a module invalidates the cache
+        self.write('sub/d.py', (
+            "from .b import BStudy\n"
+            "class CStudy(BStudy):\n"
+            "    desc = 'C study'\n"))
+        classes = study_classes('regtestpkg', cache_path=self.cache_path)
+        self.assertIn('CStudy', [c.name for c in classes])
+
+    def test_banana_studies(self):
+        classes = {c.name: c for c in study_classes(cache_path=None)}
+        self.assertEqual(classes['T1Study'].path, 'banana.study.mri')
+        self.assertEqual(classes['T1Study'].module, 'banana.study.mri.t1')
+        self.assertNotIn('MriStudy', classes)  # Doesn't have a 'desc'
+
+    def test_lazy_entrypoint(self):
+        # The command-line tool shouldn't need to import Arcana/Nipype until
+        # a command that requires them is run
+        out = sp.check_output([
+            sys.executable, '-c',
+            "import sys, banana.entrypoint; "
+            "print('nipype' in sys.modules or 'arcana' in sys.modules)"])
+        self.assertEqual(out.decode().strip(), 'False')
+
+
+class TestResolveClass(TestCase):
+
+    def test_resolve(self):
+        # Classes without a 'desc' (e.g. base classes) are found too
+        self.assertEqual(resolve_class('MriStudy').__name__, 'MriStudy')
+        self.assertEqual(resolve_class('T1Study').__module__,
+                         'banana.study.mri.t1')
+        self.assertRaises(BananaUsageError, resolve_class, 'Nonexistent')
@@ -0,0 +1,78 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+from unittest import TestCase
+from banana.utils.staging import stage, stage_file
+from banana.interfaces.utility import CopyToDir
+from banana.exceptions import BananaUsageError
+
+
+class TestStaging(TestCase):
+
+    def setUp(self):
+        # Tests change into the temporary directory
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = op.join(self.tmp_dir, 'src')
+        os.makedirs(op.join(self.src_dir, 'sub'))
+        for fname in ('a.txt', op.join('sub', 'b.txt')):
+            with open(op.join(self.src_dir, fname), 'w') as f:
+                f.write(fname)
+        self.src_file = op.join(self.src_dir, 'a.txt')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stage_file(self):
+        for method in ('auto', 'reflink', 'hardlink', 'symlink', 'copy'):
+            dst = op.join(self.tmp_dir, method + '.txt')
+            used = stage_file(self.src_file, dst, method=method)
+            with open(dst) as f:
+                self.assertEqual(f.read(), 'a.txt')
+            if method == 'symlink':
+                self.assertTrue(op.islink(dst))
+            elif method in ('auto', 'reflink'):
+                # Never shares an inode with the source, so the staged file
+                # can be written to
+                self.assertIn(used, ('reflink', 'copy'))
+                self.assertFalse(os.path.samefile(dst, self.src_file))
+            elif method == 'hardlink':
+                self.assertIn(used, ('hardlink', 'copy'))
+            elif method == 'copy':
+                self.assertEqual(used, 'copy')
+        self.assertRaises(BananaUsageError, stage_file, self.src_file,
+                          op.join(self.tmp_dir, 'bad.txt'), method='bad')
+
+    def test_stage_dir(self):
+        dst = op.join(self.tmp_dir, 'dst')
+        stage(self.src_dir, dst, method='symlink')
+        # Directories are real, so new files don't end up in the source
+        self.assertFalse(op.islink(dst))
+        self.assertTrue(op.islink(op.join(dst, 'sub', 'b.txt')))
+        with open(op.join(dst, 'sub', 'new.txt'), 'w') as f:
+            f.write('new')
+        self.assertFalse(op.exists(op.join(self.src_dir, 'sub', 'new.txt')))
+
+    def test_copy_to_dir(self):
+        os.chdir(self.tmp_dir)
+        # Copies by default like Arcana's CopyToDir
+        out_dir = op.join(self.tmp_dir, 'default_dir')
+        CopyToDir(in_files=[self.src_file], file_names=['subj.txt'],
+                  out_dir=out_dir).run()
+        self.assertFalse(op.islink(op.join(out_dir, 'subj.txt')))
+        self.assertFalse(os.path.samefile(op.join(out_dir, 'subj.txt'),
+                                          self.src_file))
+        for staging in ('symlink', 'auto'):
+            out_dir = op.join(self.tmp_dir, staging + '_dir')
+            result = CopyToDir(
+                in_files=[self.src_dir, self.src_file],
+                file_names=['subj1', 'subj2.txt'], out_dir=out_dir,
+                staging=staging).run()
+            self.assertEqual(result.outputs.file_names,
+                             ['subj1', 'subj2.txt'])
+            self.assertEqual(
+                op.islink(op.join(out_dir, 'subj1')), staging == 'symlink')
+            with open(op.join(out_dir, 'subj1', 'sub', 'b.txt')) as f:
+                self.assertEqual(f.read(), op.join('sub', 'b.txt'))
@@ -0,0 +1,124 @@
+import os.path as op
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase
+from nipype.interfaces.utility import Function
+from arcana import StaticEnv
+from arcana.environment.base import Node
+from banana.utils.telemetry import (
+    TelemetryStore, NodeRun, ResourceMonitor, TelemetryNode, monitor_node)
+from banana.exceptions import BananaUsageError
+
+
+def write_file(size, out_dir, in_file):
+    import os.path as op
+    path = op.join(out_dir, 'out.bin')
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    return path
+
+
+def fail(in_file):
+    raise RuntimeError("Failed on '{}'".format(in_file))
+
+
+def run(wall_time, peak_rss, input_bytes=1000, succeeded=True):
+    return NodeRun(input_bytes=input_bytes, wall_time=wall_time,
+                   cpu_time=wall_time, peak_rss=peak_rss, read_bytes=0,
+                   write_bytes=0, n_procs=1, succeeded=succeeded)
+
+
+class TestTelemetry(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = TelemetryStore(op.join(self.tmp_dir, 'telemetry.db'),
+                                    min_runs=2, margin=1.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_estimate(self):
+        key = ('T1Study', 'freesurfer_pipeline', 'recon_all')
+        self.assertEqual(self.store.estimate(*key), (None, None))
+        self.store.record(*key, run(600.0, 2 * 1024 ** 3, 1000))
+        self.assertEqual(self.store.estimate(*key), (None, None))
+        self.store.record(*key, run(1200.0, 3 * 1024 ** 3, 1000))
+        # Upper end of the previous runs if the input size isn't known
+        self.assertEqual(self.store.estimate(*key), (20.0, 3.0))
+        # Scaled by the size of the inputs
+        self.assertEqual(self.store.estimate(*key, input_bytes=2000),
+                         (40.0, 6.0))
+        # But not below the least used by a previous run
+        self.assertEqual(self.store.estimate(*key, input_bytes=10),
+                         (10.0, 2.0))
+        # Nor below the resources used by a run that failed
+        self.store.record(*key, run(1800.0, 5 * 1024 ** 3, 1000,
+                                    succeeded=False))
+        self.assertEqual(self.store.estimate(*key), (30.0, 5.0))
+        self.assertEqual(self.store.estimate(*key, input_bytes=2000),
+                         (40.0, 6.0))
+
+    def test_hot_nodes(self):
+        self.store.record('T1Study', 'freesurfer_pipeline', 'recon_all',
+                          run(7200.0, 2 * 1024 ** 3))
+        self.store.record('BoldStudy', 'melodic_pipeline', 'melodic',
+                          run(600.0, 8 * 1024 ** 3))
+        self.store.record('BoldStudy', 'melodic_pipeline', 'melodic',
+                          run(700.0, 6 * 1024 ** 3))
+        rows = self.store.hot_nodes()
+        self.assertEqual([r['node'] for r in rows], ['recon_all', 'melodic'])
+        rows = self.store.hot_nodes(sort_by='peak_rss')
+        self.assertEqual(rows[0]['node'], 'melodic')
+        self.assertEqual(rows[0]['runs'], 2)
+        self.assertEqual(rows[0]['total_wall_time'], 1300.0)
+        rows = self.store.hot_nodes(study_class='T1Study')
+        self.assertEqual(len(rows), 1)
+        self.assertRaises(BananaUsageError, self.store.hot_nodes,
+                          sort_by='bad')
+
+    def test_monitor(self):
+        with ResourceMonitor(interval=0.01) as monitor:
+            data = bytearray(64 * 1024 ** 2)  # @UnusedVariable
+            sum(i * i for i in range(10 ** 6))
+        self.assertGreater(monitor.wall_time, 0.0)
+        self.assertGreater(monitor.cpu_time, 0.0)
+        if op.exists('/proc/self/status'):
+            self.assertGreater(monitor.peak_rss, 64 * 1024 ** 2)
+
+    def test_node(self):
+        in_file = op.join(self.tmp_dir, 'in.bin')
+        with open(in_file, 'wb') as f:
+            f.write(b'\0' * 4096)
+        interface = Function(input_names=['size', 'out_dir', 'in_file'],
+                             output_names=['out_file'],
+                             function=write_file)
+        node = Node(StaticEnv(), interface, name='write', wall_time=1,
+                    base_dir=self.tmp_dir)
+        node.inputs.size = 1024
+        node.inputs.out_dir = self.tmp_dir
+        node.inputs.in_file = in_file
+        monitor_node(node, self.store.key('TestStudy', 'test', 'write'))
+        self.assertIsInstance(node, TelemetryNode)
+        # Needs to be sent to worker processes/cluster jobs
+        node = pickle.loads(pickle.dumps(node))
+        node.run()
+        runs = self.store.runs('TestStudy', 'test', 'write')
+        self.assertEqual(len(runs), 1)
+        self.assertTrue(runs[0].succeeded)
+        self.assertEqual(runs[0].input_bytes, 4096)
+        self.assertGreater(runs[0].wall_time, 0.0)
+
+    def test_failed_node(self):
+        interface = Function(input_names=['in_file'], output_names=[],
+                             function=fail)
+        node = Node(StaticEnv(), interface, name='fail', wall_time=1,
+                    base_dir=self.tmp_dir)
+        node.inputs.in_file = 'in.bin'
+        monitor_node(node, self.store.key('TestStudy', 'test', 'fail'))
+        self.assertRaises(Exception, node.run)
+        self.assertEqual(self.store.runs('TestStudy', 'test', 'fail'), [])
+        runs = self.store.runs('TestStudy', 'test', 'fail', succeeded=False)
+        self.assertEqual(len(runs), 1)
+        self.assertGreater(runs[0].wall_time, 0.0)
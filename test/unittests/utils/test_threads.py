@@ -0,0 +1,97 @@
+import os
+import tempfile
+from unittest import TestCase
+from arcana import (
+    BasicRepo, SingleProc, MultiProc, InputFilesetSpec, FilesetSpec,
+    InputFilesets)
+from banana.study.base import Study
+from banana.study import StudyMetaClass
+from banana.file_format import text_format
+from banana.interfaces.ants import AntsRegSyn
+from banana.processor import SlurmProc
+from banana.utils.threads import Threads, ITK_ENV, available_cores
+from banana.exceptions import BananaUsageError
+
+
+class ThreadsStudy(Study, metaclass=StudyMetaClass):
+
+    add_data_specs = [
+        InputFilesetSpec('image', text_format),
+        FilesetSpec('registered', text_format, 'reg_pipeline')]
+
+    def reg_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            'reg', desc="", citations=[], name_maps=name_maps)
+        pipeline.add(
+            'reg',
+            AntsRegSyn(
+                num_dimensions=3),
+            inputs={
+                'input_file': ('image', text_format)},
+            outputs={
+                'registered': ('reg_file', text_format)},
+            threads=Threads(max=8, input='num_threads', env=ITK_ENV))
+        return pipeline
+
+
+class TestThreads(TestCase):
+
+    def test_grant(self):
+        threads = Threads(min=2, max=8, parallel_fraction=0.95)
+        # A single session gets as many threads as it can use
+        self.assertEqual(threads.grant(16, 1), 8)
+        self.assertEqual(threads.grant(4, 1), 4)
+        # Many sessions are packed side by side with fewer threads each
+        self.assertEqual(threads.grant(16, 16), 2)
+        # Nodes that scale poorly get fewer threads
+        self.assertLess(Threads(parallel_fraction=0.3).grant(16, 1),
+                        Threads(parallel_fraction=0.99).grant(16, 1))
+        # Never more than the number of cores
+        self.assertEqual(Threads(min=4).grant(2), 2)
+
+    def test_invalid(self):
+        self.assertRaises(BananaUsageError, Threads, min=4, max=2)
+        self.assertRaises(BananaUsageError, Threads, parallel_fraction=2.0)
+
+    def test_slurm(self):
+        work_dir = tempfile.mkdtemp()
+        processor = SlurmProc(work_dir, email='a@b.c')
+        # The cores of the submit host aren't those of the compute nodes so
+        # jobs get the node's cap, or a single core if it isn't capped
+        self.assertEqual(available_cores(processor), 1)
+        self.assertEqual(available_cores(processor, Threads()), 1)
+        self.assertEqual(available_cores(processor, Threads(max=4)), 4)
+        # Unless the CPUs per task are requested
+        processor = SlurmProc(work_dir, email='a@b.c', cpus_per_task=6)
+        self.assertEqual(available_cores(processor), 6)
+        self.assertEqual(available_cores(processor, Threads(max=4)), 6)
+        study = ThreadsStudy(
+            'threads', BasicRepo(self.repo_dir()),
+            SlurmProc(work_dir, email='a@b.c'),
+            [InputFilesets('image', 'image', text_format)])
+        self.assertEqual(study.reg_pipeline().node('reg').n_procs, 8)
+
+    def repo_dir(self):
+        repo_dir = tempfile.mkdtemp()
+        for subj in ('S1', 'S2', 'S3', 'S4'):
+            session_dir = os.path.join(repo_dir, subj, 'VISIT')
+            os.makedirs(session_dir)
+            with open(os.path.join(session_dir, 'image.txt'), 'w') as f:
+                f.write(subj)
+        return repo_dir
+
+    def test_pipeline(self):
+        repo_dir = self.repo_dir()
+        inputs = [InputFilesets('image', 'image', text_format)]
+        for processor, num_threads in (
+                (MultiProc(tempfile.mkdtemp(), num_processes=8), 2),
+                (SingleProc(tempfile.mkdtemp()), None)):
+            study = ThreadsStudy('threads', BasicRepo(repo_dir), processor,
+                                 inputs)
+            node = study.reg_pipeline().node('reg')
+            if num_threads is None:  # Nodes are run one at a time
+                num_threads = min(os.cpu_count(), 8)
+            self.assertEqual(node.n_procs, num_threads)
+            self.assertEqual(node.interface.inputs.num_threads, num_threads)
+            self.assertEqual(
+                node.interface.inputs.environ[ITK_ENV[0]], str(num_threads))
@@ -0,0 +1,108 @@
+import os
+import os.path as op
+import shutil
+import stat
+import subprocess as sp
+import sys
+import tempfile
+from unittest import TestCase
+from arcana.exceptions import ArcanaVersionNotDetectableError
+import banana
+from banana.requirement import CliRequirement, StirRequirement
+from banana.utils import version_cache
+from banana.utils.version_cache import VersionCache, CACHE_PATH_ENV
+
+TOOL_SCRIPT = """#!/bin/sh
+echo run >> "{calls}"
+echo "{name} version {version}"
+"""
+
+
+class TestVersionCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bin_dir = op.join(self.tmp_dir, 'bin')
+        os.makedirs(self.bin_dir)
+        self.cache = VersionCache(op.join(self.tmp_dir, 'cache',
+                                          'versions.json'))
+        self.env = {k: os.environ.get(k)
+                    for k in ('PATH', 'LOADEDMODULES', CACHE_PATH_ENV)}
+        os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ['PATH']
+        os.environ[CACHE_PATH_ENV] = self.cache.path
+
+    def tearDown(self):
+        for k, v in self.env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        shutil.rmtree(self.tmp_dir)
+
+    def tool(self, name, version, mtime=1e9):
+        path = op.join(self.bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(TOOL_SCRIPT.format(calls=self.calls_path(name),
+                                       name=name, version=version))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        os.utime(path, (mtime, mtime))
+        return CliRequirement(name, test_cmd=name)
+
+    def calls_path(self, name):
+        return op.join(self.tmp_dir, name + '.calls')
+
+    def num_calls(self, name):
+        try:
+            with open(self.calls_path(name)) as f:
+                return len(f.readlines())
+        except OSError:
+            return 0
+
+    def test_cached_across_processes(self):
+        req = self.tool('mytool', '1.2.3')
+        self.assertEqual(str(req.detect_version()), '1.2.3')
+        self.assertEqual(str(req.detect_version()), '1.2.3')
+        self.assertEqual(self.num_calls('mytool'), 1)
+        # A separate process reads the version from the cache file
+        sp.check_call([
+            sys.executable, '-c',
+            "from banana.requirement import CliRequirement; "
+            "assert str(CliRequirement('mytool', test_cmd='mytool')"
+            ".detect_version()) == '1.2.3'"],
+            env=dict(os.environ, PYTHONPATH=op.dirname(op.dirname(
+                op.abspath(banana.__file__)))))
+        self.assertEqual(self.num_calls('mytool'), 1)
+
+    def test_invalidation(self):
+        req = self.tool('mytool', '1.2.3')
+        self.assertEqual(str(req.detect_version()), '1.2.3')
+        # Replacing the executable invalidates the cached version
+        req = self.tool('mytool', '1.3.0', mtime=2e9)
+        self.assertEqual(str(req.detect_version()), '1.3.0')
+        self.assertEqual(self.num_calls('mytool'), 2)
+        # As does loading a different set of environment modules
+        os.environ['LOADEDMODULES'] = 'mytool/1.3.0'
+        self.assertEqual(str(req.detect_version()), '1.3.0')
+        self.assertEqual(self.num_calls('mytool'), 3)
+        # Only the entries for the current executable are kept
+        self.assertEqual(len(self.cache._load()), 2)
+
+    def test_not_detectable(self):
+        self.tool('SSRB', '1')
+        req = StirRequirement('stir', test_cmd='SSRB')
+        for _ in range(2):
+            self.assertRaises(ArcanaVersionNotDetectableError,
+                              req.detect_version)
+        self.assertIn('error', list(self.cache._load().values())[0])
+
+    def test_prefetch(self):
+        reqs = [self.tool('tool{}'.format(i), '{}.0'.format(i))
+                for i in range(4)]
+        missing = CliRequirement('missing', test_cmd='not-a-real-tool')
+        versions = version_cache.prefetch(reqs + [missing], num_threads=4)
+        self.assertEqual(versions, {
+            'tool{}'.format(i): 'tool{} version {}.0\n'.format(i, i)
+            for i in range(4)})
+        for i, req in enumerate(reqs):
+            self.assertEqual(str(req.detect_version()), '{}.0'.format(i))
+            self.assertEqual(self.num_calls(req.name), 1)